@@ -0,0 +1,191 @@
+"""Benchmark of the Chat stream against unary sends.
+
+Starts the chat server and sends messages one by one from a sender to a
+recipient, either with a SendMessage call per message received through
+ReceiveMessages, or over two Chat streams. Measures the time until the
+sent message is stored (the SendMessage call or the Chat confirmation)
+and until it comes out of the recipient stream.
+
+Runs against the in-process etcd stand-in unless --etcd-host is given:
+    PYTHONPATH=../src/project python bench_chat_latency.py
+"""
+import argparse
+import json
+import os
+import queue
+import statistics
+import threading
+import time
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Storage
+from simple_chat_server import create_server
+
+from bench_delivery_latency import get_free_port, percentile, subscribe
+
+MODE_UNARY = 'unary'
+MODE_CHAT = 'chat'
+MODES = (MODE_UNARY, MODE_CHAT)
+
+
+def open_chat(stub, login):
+    """Opens the Chat stream of the user"""
+    requests = queue.Queue()
+    requests.put(simple_chat_pb2.ChatRequest(
+        subscribe=simple_chat_pb2.ReceiveMessagesRequest(login=login)))
+    return requests, stub.Chat(iter(requests.get, None))
+
+
+def consume_chat(requests, responses, received, confirmed):
+    """Records arrival times of received messages and confirmations,
+    received messages are acknowledged
+    """
+    try:
+        for response in responses:
+            if response.HasField('sent'):
+                confirmed[response.sent.body] = time.perf_counter()
+                continue
+
+            received[response.message.body] = time.perf_counter()
+            requests.put(simple_chat_pb2.ChatRequest(
+                ack=simple_chat_pb2.MessagesAck(
+                    message_id=response.message.id)))
+    except grpc.RpcError:
+        pass
+
+
+def summarize(name, latencies):
+    """Mean and percentiles of the latencies in milliseconds"""
+    if not latencies:
+        return {'{}_ms_{}'.format(name, key): None
+                for key in ('mean', 'p50', 'p99')}
+    return {
+        '{}_ms_mean'.format(name): statistics.mean(latencies),
+        '{}_ms_p50'.format(name): percentile(latencies, 0.5),
+        '{}_ms_p99'.format(name): percentile(latencies, 0.99),
+    }
+
+
+def run_mode(mode, storage, args):
+    """Measures send and delivery latency of one mode"""
+    address = '127.0.0.1:{}'.format(get_free_port())
+    server = create_server(address, storage)
+    server.start()
+    channel = grpc.insecure_channel(address)
+    stub = simple_chat_pb2_grpc.SimpleChatStub(channel)
+
+    sender = 'bench-sender-{}'.format(mode)
+    recipient = 'bench-recipient-{}'.format(mode)
+    received = {}
+    confirmed = {}
+    streams = []
+    if mode == MODE_UNARY:
+        ready = threading.Event()
+        threading.Thread(
+            target=lambda: streams.append(
+                subscribe(stub, recipient, received, ready)),
+            daemon=True).start()
+        ready.wait()
+    else:
+        chats = {login: open_chat(stub, login)
+                 for login in (recipient, sender)}
+        for login, (requests, responses) in chats.items():
+            streams.append(responses)
+            threading.Thread(target=consume_chat,
+                             args=(requests, responses,
+                                   received if login == recipient else {},
+                                   confirmed),
+                             daemon=True).start()
+        sender_requests = chats[sender][0]
+    time.sleep(0.5)
+
+    sent = {}
+    for index in range(args.messages):
+        body = str(index)
+        message = simple_chat_pb2.Message(sender=sender,
+                                          recipient=recipient,
+                                          body=body)
+        sent[body] = time.perf_counter()
+        if mode == MODE_UNARY:
+            stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+                message=message))
+            confirmed[body] = time.perf_counter()
+        else:
+            sender_requests.put(simple_chat_pb2.ChatRequest(message=message))
+        time.sleep(args.interval)
+
+    deadline = time.time() + 5
+    while ((len(received) < len(sent) or len(confirmed) < len(sent))
+           and time.time() < deadline):
+        time.sleep(0.05)
+
+    for stream in streams:
+        stream.cancel()
+    server.stop(0)
+    channel.close()
+
+    result = {
+        'mode': mode,
+        'messages': len(sent),
+        'delivered': len([body for body in sent if body in received]),
+    }
+    result.update(summarize('send', [
+        (confirmed[body] - sent[body]) * 1000
+        for body in sent if body in confirmed]))
+    result.update(summarize('delivery', [
+        (received[body] - sent[body]) * 1000
+        for body in sent if body in received]))
+    return result
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='Chat latency benchmark')
+    parser.add_argument('--etcd-host', type=str, default=None,
+                        help='Use real etcd instead of the stand-in')
+    parser.add_argument('--etcd-port', type=int, default=2379)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('-n', '--messages', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.01,
+                        help='Pause between sent messages in seconds')
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=MODES)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+
+    stand_in = None
+    if args.etcd_host:
+        storage = Storage(args.etcd_host, args.etcd_port)
+    else:
+        stand_in = EtcdStandIn(latency=args.latency)
+        storage = Storage('127.0.0.1', stand_in.start())
+
+    results = [run_mode(mode, storage, args) for mode in args.modes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{mode:>5}: delivered {delivered}/{messages}, "
+                  "send p50 {send_ms_p50:.2f} ms, "
+                  "p99 {send_ms_p99:.2f} ms, "
+                  "delivery p50 {delivery_ms_p50:.2f} ms, "
+                  "p99 {delivery_ms_p99:.2f} ms".format(**result))
+
+    if stand_in is not None:
+        stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
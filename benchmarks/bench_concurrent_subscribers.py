@@ -0,0 +1,178 @@
+"""Benchmark of concurrent subscriber capacity per server mode.
+
+Launches simple_chat_server.py in the threaded and the asyncio mode,
+opens many ReceiveMessages streams at once, queues one message per
+subscriber and counts how many streams get their message. GetUsers and
+SendMessage calls are timed while all streams are open to see that
+unary RPCs stay responsive, streams over MAX_STREAMS must be refused
+with RESOURCE_EXHAUSTED rather than hang.
+
+Runs against the in-process etcd stand-in:
+    PYTHONPATH=../src/project python bench_concurrent_subscribers.py -s 2000
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+import simple_chat_server
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Storage, Message
+
+from bench_delivery_latency import get_free_port, percentile
+
+
+def start_server(mode, port, etcd_port, max_streams):
+    """Starts chat server process in the given server mode"""
+    env = dict(os.environ,
+               SERVER_HOST='127.0.0.1', SERVER_PORT=str(port),
+               ETCD_SERVER_HOST='127.0.0.1', ETCD_SERVER_PORT=str(etcd_port),
+               REFLECTION='', SERVER_MODE=mode, MAX_STREAMS=str(max_streams))
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(simple_chat_server.__file__)],
+        env=env, cwd=os.path.dirname(simple_chat_server.__file__))
+
+
+async def subscribe(stub, login, delivered, refused):
+    """Keeps the subscriber stream open and records its delivery"""
+    call = stub.ReceiveMessages(
+        simple_chat_pb2.ReceiveMessagesRequest(login=login))
+    try:
+        async for _ in call:
+            delivered.add(login)
+    except grpc.aio.AioRpcError as error:
+        if error.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+            refused.add(login)
+    finally:
+        call.cancel()
+
+
+async def time_unary_calls(stub, args):
+    """Latencies in milliseconds of GetUsers and SendMessage calls,
+    failed calls are counted by their status codes
+    """
+    latencies = []
+    errors = collections.Counter()
+    for index in range(args.unary_calls):
+        if index % 2:
+            call = stub.GetUsers(simple_chat_pb2.GetUsersRequest(),
+                                 timeout=args.timeout)
+        else:
+            call = stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+                message=simple_chat_pb2.Message(
+                    sender='bench', recipient='bench-unary',
+                    body=str(index))), timeout=args.timeout)
+        started = time.perf_counter()
+        try:
+            await call
+            latencies.append((time.perf_counter() - started) * 1000)
+        except grpc.aio.AioRpcError as error:
+            errors[str(error.code())] += 1
+    return latencies, dict(errors)
+
+
+async def run_clients(address, storage, args):
+    """Opens the subscriber streams and measures what gets served"""
+    delivered = set()
+    refused = set()
+    async with grpc.aio.insecure_channel(address) as channel:
+        await channel.channel_ready()
+        stub = simple_chat_pb2_grpc.SimpleChatStub(channel)
+
+        logins = ['sub{}'.format(index) for index in range(args.subscribers)]
+        tasks = [asyncio.ensure_future(
+                     subscribe(stub, login, delivered, refused))
+                 for login in logins]
+        await asyncio.sleep(args.settle)
+
+        loop = asyncio.get_event_loop()
+        for login in logins:
+            await loop.run_in_executor(
+                None, storage.put_message, Message('bench', login, 'Hello'))
+
+        latencies, errors = await time_unary_calls(stub, args)
+
+        deadline = time.time() + args.timeout
+        while len(delivered) < len(logins) and time.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return len(delivered), len(refused), latencies, errors
+
+
+def run_mode(mode, etcd_port, args):
+    port = get_free_port()
+    server = start_server(mode, port, etcd_port, args.max_streams)
+    storage = Storage('127.0.0.1', etcd_port)
+    try:
+        delivered, refused, latencies, errors = \
+            asyncio.get_event_loop().run_until_complete(
+                run_clients('127.0.0.1:{}'.format(port), storage, args))
+    finally:
+        server.kill()
+        server.wait()
+
+    # drop messages left in the queues of starved subscribers
+    storage._client.delete_prefix('message/')
+    return {'mode': mode, 'subscribers': args.subscribers,
+            'served_streams': delivered, 'refused_streams': refused,
+            'unary_ms_p50': round(percentile(latencies, 0.5), 2)
+            if latencies else None,
+            'unary_ms_p99': round(percentile(latencies, 0.99), 2)
+            if latencies else None,
+            'unary_errors': errors}
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(
+        description='Concurrent subscribers benchmark')
+    parser.add_argument('-s', '--subscribers', type=int, default=1000)
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='Seconds to let the streams connect')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--max-streams', type=int,
+                        default=simple_chat_server.MAX_STREAMS,
+                        help='MAX_STREAMS of the server')
+    parser.add_argument('--unary-calls', type=int, default=100,
+                        help='Unary calls timed while the streams are open')
+    parser.add_argument('--modes', nargs='+',
+                        default=list(simple_chat_server.SERVER_MODES),
+                        choices=simple_chat_server.SERVER_MODES)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+    stand_in = EtcdStandIn()
+    etcd_port = stand_in.start(max_workers=256)
+
+    results = [run_mode(mode, etcd_port, args) for mode in args.modes]
+    stand_in.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{mode:>8}: served {served_streams}/{subscribers} streams, "
+                  "refused {refused_streams}, unary calls while streaming "
+                  "p50 {unary_ms_p50} ms, p99 {unary_ms_p99} ms, "
+                  "errors {unary_errors}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
@@ -0,0 +1,133 @@
+"""Profiling benchmark of per-message CPU on the delivery path.
+
+Queues messages for one recipient and drains them through
+SimpleChatServicer.ReceiveMessages in the watch mode, which decodes every
+stored value and builds a new simple_chat_pb2.Message, and in the forward
+mode, which streams the stored bytes as they are. Every response goes
+through the serializer the gRPC handler would use. Reported CPU time is
+the time of the draining thread, the etcd stand-in runs in other threads.
+The conversion alone is measured on already read values as well.
+
+Runs against the in-process etcd stand-in:
+    PYTHONPATH=../src/project python bench_delivery_cpu.py -n 20000
+    PYTHONPATH=../src/project python bench_delivery_cpu.py --profile
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from unittest.mock import Mock
+
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Storage, Message
+from simple_chat_server import (DELIVERY_MODE_FORWARD, DELIVERY_MODE_WATCH,
+                                SimpleChatServicer, message_to_proto,
+                                serialize_response)
+
+MODES = (DELIVERY_MODE_WATCH, DELIVERY_MODE_FORWARD)
+
+
+def queue_messages(storage, login, count, body_size):
+    storage.put_messages([Message('sender{}'.format(index % 100), login,
+                                  'x' * body_size, 1.7e9 + index)
+                          for index in range(count)])
+
+
+def drain(servicer, login, count):
+    """Reads count messages from the stream serializing each of them"""
+    request = Mock(login=login)
+    responses = servicer.ReceiveMessages(request, Mock())
+    size = 0
+    for _ in range(count):
+        size += len(serialize_response(next(responses)))
+    responses.close()
+    return size
+
+
+def convert(storage, mode, stored_messages):
+    """Converts read values to responses like the delivery mode does"""
+    if mode == DELIVERY_MODE_FORWARD:
+        return [storage.to_wire_message(message).value
+                for message in stored_messages]
+
+    return [message_to_proto(storage.decode_message(message))
+            .SerializeToString() for message in stored_messages]
+
+
+def run_mode(storage, mode, args):
+    login = 'bench-{}'.format(mode)
+    queue_messages(storage, login, args.messages, args.body_size)
+    servicer = SimpleChatServicer(storage, mode)
+
+    profile = cProfile.Profile() if args.profile else None
+    started = time.thread_time()
+    if profile is not None:
+        profile.enable()
+    drain(servicer, login, args.messages)
+    if profile is not None:
+        profile.disable()
+    delivery_seconds = time.thread_time() - started
+
+    queue_messages(storage, login, args.messages, args.body_size)
+    stored_messages, _ = \
+        storage.get_user_queue_stored_messages_with_revision(login)
+    started = time.thread_time()
+    convert(storage, mode, stored_messages)
+    conversion_seconds = time.thread_time() - started
+    storage.delete_user_queue_stored_messages(stored_messages)
+
+    if profile is not None:
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats(
+            'tottime').print_stats(args.profile_lines)
+        print('--- {} ---\n{}'.format(mode, stream.getvalue()))
+
+    return {
+        'mode': mode,
+        'messages': args.messages,
+        'delivery_cpu_us_per_message':
+            delivery_seconds / args.messages * 1e6,
+        'conversion_cpu_us_per_message':
+            conversion_seconds / args.messages * 1e6,
+    }
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='Delivery CPU benchmark')
+    parser.add_argument('-n', '--messages', type=int, default=20000)
+    parser.add_argument('--body-size', type=int, default=40)
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=MODES)
+    parser.add_argument('--profile', action='store_true',
+                        help='Print cProfile statistics of the delivery')
+    parser.add_argument('--profile-lines', type=int, default=15)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+    stand_in = EtcdStandIn()
+    storage = Storage('127.0.0.1', stand_in.start())
+
+    results = [run_mode(storage, mode, args) for mode in args.modes]
+    stand_in.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{mode:>8}: {messages} messages, delivery "
+                  "{delivery_cpu_us_per_message:.1f} us/message CPU, "
+                  "conversion {conversion_cpu_us_per_message:.2f} "
+                  "us/message CPU".format(**result))
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
@@ -0,0 +1,161 @@
+"""Benchmark of message delivery latency in polling and watch modes.
+
+Starts the chat server for every delivery mode, subscribes a recipient,
+sends messages one by one and measures the time between SendMessage and
+the moment the message comes out of the ReceiveMessages stream. It also
+counts etcd range requests issued by idle subscribers.
+
+Runs against the in-process etcd stand-in unless --etcd-host is given:
+    PYTHONPATH=../src/project python bench_delivery_latency.py
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import threading
+import time
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Storage
+from simple_chat_server import create_server, DELIVERY_MODES
+
+
+def get_free_port() -> int:
+    """Asks the OS for a free local port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def subscribe(stub, login, received, ready):
+    """Consumes the recipient stream and records arrival times"""
+    stream = stub.ReceiveMessages(
+        simple_chat_pb2.ReceiveMessagesRequest(login=login))
+    ready.set()
+    try:
+        for message in stream:
+            received[message.body] = time.perf_counter()
+    except grpc.RpcError:
+        pass
+    return stream
+
+
+def run_mode(mode, storage, stand_in, args, is_local_delivery=False):
+    """Measures delivery latency and idle storage load of one mode"""
+    address = '127.0.0.1:{}'.format(get_free_port())
+    server = create_server(address, storage, delivery_mode=mode,
+                           is_local_delivery=is_local_delivery)
+    server.start()
+
+    channel = grpc.insecure_channel(address)
+    stub = simple_chat_pb2_grpc.SimpleChatStub(channel)
+
+    received = {}
+    streams = []
+    for index in range(args.subscribers):
+        ready = threading.Event()
+        login = 'bench-{}-{}'.format(mode, index)
+        thread = threading.Thread(
+            target=lambda l=login, r=ready: streams.append(
+                subscribe(stub, l, received, r)), daemon=True)
+        thread.start()
+        ready.wait()
+    time.sleep(0.5)
+
+    sent = {}
+    recipient = 'bench-{}-0'.format(mode)
+    for index in range(args.messages):
+        body = str(index)
+        sent[body] = time.perf_counter()
+        stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(sender='bench',
+                                            recipient=recipient,
+                                            body=body)))
+        time.sleep(args.interval)
+
+    deadline = time.time() + 5
+    while len(received) < len(sent) and time.time() < deadline:
+        time.sleep(0.05)
+
+    idle_ranges = None
+    if stand_in is not None:
+        before = stand_in.counters['range']
+        time.sleep(args.idle)
+        idle_ranges = (stand_in.counters['range'] - before) / args.idle
+
+    server.stop(0)
+    channel.close()
+
+    latencies = [(received[body] - sent[body]) * 1000
+                 for body in sent if body in received]
+    return {
+        'mode': mode,
+        'messages': len(sent),
+        'delivered': len(latencies),
+        'latency_ms_mean': statistics.mean(latencies) if latencies else None,
+        'latency_ms_p50': percentile(latencies, 0.5) if latencies else None,
+        'latency_ms_p99': percentile(latencies, 0.99) if latencies else None,
+        'idle_range_requests_per_sec': idle_ranges,
+    }
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='Delivery latency benchmark')
+    parser.add_argument('--etcd-host', type=str, default=None,
+                        help='Use real etcd instead of the stand-in')
+    parser.add_argument('--etcd-port', type=int, default=2379)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('-n', '--messages', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.05,
+                        help='Pause between sent messages in seconds')
+    parser.add_argument('--subscribers', type=int, default=5)
+    parser.add_argument('--idle', type=float, default=3.0,
+                        help='Idle window for counting range requests')
+    parser.add_argument('--modes', nargs='+', default=list(DELIVERY_MODES),
+                        choices=DELIVERY_MODES)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+
+    stand_in = None
+    if args.etcd_host:
+        storage = Storage(args.etcd_host, args.etcd_port)
+    else:
+        stand_in = EtcdStandIn(latency=args.latency)
+        storage = Storage('127.0.0.1', stand_in.start())
+
+    results = [run_mode(mode, storage, stand_in, args) for mode in args.modes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{mode:>8}: delivered {delivered}/{messages}, "
+                  "mean {latency_ms_mean:.1f} ms, p50 {latency_ms_p50:.1f} ms, "
+                  "p99 {latency_ms_p99:.1f} ms, idle range requests/s "
+                  "{idle_range_requests_per_sec}".format(**result))
+
+    if stand_in is not None:
+        stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
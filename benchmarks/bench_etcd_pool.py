@@ -0,0 +1,104 @@
+"""Benchmark of storage throughput per etcd client pool size.
+
+Stores queued messages and reads queues from many threads sharing one
+Storage, backed by pools of 1, 2, 4... etcd clients, each with its own
+gRPC channel, and reports calls per second.
+
+Runs against the in-process etcd stand-in unless --etcd-host is given,
+the host may list several endpoints separated by commas:
+    PYTHONPATH=../src/project python bench_etcd_pool.py -p 1 4 8
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import (Message, Storage, POOL_POLICIES,
+                                      POOL_ROUND_ROBIN)
+
+
+def run_calls(storage, thread_index, stop, counts):
+    """Sends a message and reads the recipient queue until stopped"""
+    recipient = 'bench-{}'.format(thread_index % 100)
+    calls = 0
+    while not stop.is_set():
+        storage.put_message(Message('bench', recipient, 'Hello'))
+        storage.get_user_queue_page(recipient, 10)
+        calls += 2
+    counts[thread_index] = calls
+
+
+def run(host, port, pool_size, args):
+    storage = Storage(host, port, pool_size=pool_size,
+                      pool_policy=args.policy)
+    stop = threading.Event()
+    counts = [0] * args.threads
+    threads = [threading.Thread(target=run_calls,
+                                args=(storage, index, stop, counts))
+               for index in range(args.threads)]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    storage.close()
+    storage._client.delete_prefix('message/')
+    return {'pool_size': pool_size, 'policy': args.policy,
+            'threads': args.threads,
+            'calls_per_second': sum(counts) / elapsed}
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='etcd client pool benchmark')
+    parser.add_argument('--etcd-host', type=str, default=None,
+                        help='Use real etcd instead of the stand-in')
+    parser.add_argument('--etcd-port', type=int, default=2379)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('-p', '--pool-sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--policy', default=POOL_ROUND_ROBIN,
+                        choices=POOL_POLICIES)
+    parser.add_argument('-t', '--threads', type=int, default=64)
+    parser.add_argument('-d', '--duration', type=float, default=5.0,
+                        help='Seconds of calls per pool size')
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+
+    stand_in = None
+    if args.etcd_host:
+        host, port = args.etcd_host, args.etcd_port
+    else:
+        stand_in = EtcdStandIn(latency=args.latency)
+        host, port = '127.0.0.1', stand_in.start(max_workers=256)
+
+    results = [run(host, port, pool_size, args)
+               for pool_size in args.pool_sizes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("pool of {pool_size} ({policy}), {threads} threads: "
+                  "{calls_per_second:.0f} calls/s".format(**result))
+
+    if stand_in is not None:
+        stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
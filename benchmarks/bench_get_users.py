@@ -0,0 +1,134 @@
+"""Benchmark of GetUsers with and without the cached user directory.
+
+Loads many users into the storage, starts the chat server with the user
+directory cache switched off and on and measures GetUsers calls per
+second and latency. Uncached calls read and convert every user on each
+request, cached calls return bytes serialized once. Paged calls read one
+page of a name prefix search and should not depend on the directory size.
+
+Runs against the in-process etcd stand-in:
+    PYTHONPATH=../src/project python bench_get_users.py -u 100000
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from dataclasses import asdict
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import (Storage, User, STORAGE_MAX_TXN_OPS,
+                                      STORAGE_USER_KEY,
+                                      STORAGE_USER_NAME_INDEX_KEY)
+from simple_chat_server import create_server
+
+from bench_delivery_latency import get_free_port, percentile
+
+MAX_MESSAGE_LENGTH = 256 * 1024 * 1024
+CASES = ('uncached', 'cached', 'paged')
+
+
+def load_users(storage, count):
+    """Stores users with their name index entries in transactions of the
+    allowed size
+    """
+    client = storage._client
+    batch_size = STORAGE_MAX_TXN_OPS // 2
+    for start in range(0, count, batch_size):
+        puts = []
+        for index in range(start, min(count, start + batch_size)):
+            user = User('user{:06}'.format(index), 'User {}'.format(index))
+            value = json.dumps(asdict(user))
+            puts.append(client.transactions.put(
+                STORAGE_USER_KEY.format(user_id=user.login), value))
+            puts.append(client.transactions.put(
+                STORAGE_USER_NAME_INDEX_KEY.format(
+                    name=user.full_name.lower(), user_id=user.login), value))
+        client.transaction(compare=[], success=puts, failure=[])
+
+
+def run_case(storage, case, args):
+    """Measures GetUsers calls of one server configuration"""
+    address = '127.0.0.1:{}'.format(get_free_port())
+    server = create_server(address, storage,
+                           is_cache_users=case == 'cached')
+    server.start()
+
+    channel = grpc.insecure_channel(address, options=[
+        ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH)])
+    stub = simple_chat_pb2_grpc.SimpleChatStub(channel)
+    request = simple_chat_pb2.GetUsersRequest()
+    if case == 'paged':
+        request = simple_chat_pb2.GetUsersRequest(
+            page_size=args.page_size, name_prefix='user 5')
+
+    # the first call loads the directory and starts its watch
+    started = time.perf_counter()
+    users = len(stub.GetUsers(request).users)
+    first_call_ms = (time.perf_counter() - started) * 1000
+
+    latencies = []
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        stub.GetUsers(request)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    channel.close()
+    server.stop(0)
+
+    return {
+        'case': case,
+        'users': users,
+        'calls': len(latencies),
+        'calls_per_sec': len(latencies) / args.duration,
+        'first_call_ms': first_call_ms,
+        'latency_ms_mean': statistics.mean(latencies),
+        'latency_ms_p50': percentile(latencies, 0.5),
+        'latency_ms_p99': percentile(latencies, 0.99),
+    }
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='GetUsers benchmark')
+    parser.add_argument('-u', '--users', type=int, default=100000)
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='Seconds of calls per configuration')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--cases', nargs='+', default=list(CASES),
+                        choices=CASES)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+    stand_in = EtcdStandIn()
+    port = stand_in.start()
+    # 100k users do not fit the default 4 MB range response
+    storage = Storage('127.0.0.1', port, grpc_options=[
+        ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH)])
+    load_users(storage, args.users)
+
+    results = [run_case(storage, case, args) for case in args.cases]
+    stand_in.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{case:>8}: {users} users, {calls} calls, "
+                  "{calls_per_sec:.1f} calls/s, first call "
+                  "{first_call_ms:.1f} ms, p50 {latency_ms_p50:.1f} ms, "
+                  "p99 {latency_ms_p99:.1f} ms".format(**result))
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
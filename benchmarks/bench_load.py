@@ -0,0 +1,295 @@
+"""End-to-end load benchmark of the chat server.
+
+Launches simple_chat_server.py on the chosen storage backend, stores the
+generated users, opens ReceiveMessages streams for the subscribers and
+makes the senders send messages to random subscribers, each at the given
+rate or as fast as the server answers. Reports sent and delivered
+messages per second, send-to-receive latency percentiles and the CPU and
+memory of the server process, read from /proc (Linux only).
+
+Runs against the in-process etcd stand-in unless --etcd-host is given,
+--output keeps the results as JSON to compare them between releases:
+    PYTHONPATH=../src/project python bench_load.py -u 1000 --senders 50 \\
+        --subscribers 500 --output load.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+import simple_chat_server
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Storage, User
+
+from bench_delivery_latency import get_free_port, percentile
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def start_server(port, etcd_host, etcd_port, args, directory):
+    """Starts chat server process on the chosen backend and mode"""
+    env = dict(os.environ,
+               SERVER_HOST='127.0.0.1', SERVER_PORT=str(port),
+               ETCD_SERVER_HOST=etcd_host, ETCD_SERVER_PORT=str(etcd_port),
+               REFLECTION='', SERVER_MODE=args.server_mode,
+               STORAGE_BACKEND=args.backend,
+               QUEUE_DATABASE_PATH=os.path.join(directory, 'queues.db'))
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(simple_chat_server.__file__)],
+        env=env, cwd=os.path.dirname(simple_chat_server.__file__))
+
+
+def get_cpu_seconds(pid):
+    """User and system CPU seconds of the process, None without /proc"""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat:
+            # fields after the parenthesized command, utime and stime are
+            # the 14th and 15th fields of the line
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def get_rss_bytes(pid):
+    """Resident memory of the process, None without /proc"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class ResourceSampler(threading.Thread):
+    """Samples the resident memory of the server process until stopped"""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = get_rss_bytes(self.pid)
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+async def subscribe(stub, login, latencies, ready):
+    """Keeps the subscriber stream open and records the latency of every
+    message from the send time in its body
+    """
+    call = stub.ReceiveMessages(
+        simple_chat_pb2.ReceiveMessagesRequest(login=login))
+    ready.set()
+    try:
+        async for message in call:
+            latencies.append(
+                time.perf_counter() - float(message.body.split(':')[1]))
+    except grpc.aio.AioRpcError:
+        pass
+    finally:
+        call.cancel()
+
+
+async def send(stub, sender, recipients, deadline, args, counts):
+    """Sends messages to random recipients until the deadline"""
+    interval = 1 / args.rate if args.rate else 0
+    next_send = time.perf_counter()
+    while time.perf_counter() < deadline:
+        await stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(
+                sender=sender, recipient=random.choice(recipients),
+                body='{}:{}'.format(sender, time.perf_counter()))))
+        counts['sent'] += 1
+        if interval:
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.perf_counter()))
+
+
+async def run_clients(address, logins, pid, args):
+    """Subscribes and sends for the benchmark duration, returns sent
+    messages, latencies of delivered ones, seconds spent sending and CPU
+    seconds the server spent until the messages were delivered
+    """
+    async with grpc.aio.insecure_channel(address) as channel:
+        await asyncio.wait_for(channel.channel_ready(), args.timeout)
+        stub = simple_chat_pb2_grpc.SimpleChatStub(channel)
+
+        recipients = logins[:args.subscribers]
+        latencies = []
+        subscribers = []
+        for login in recipients:
+            ready = asyncio.Event()
+            subscribers.append(asyncio.ensure_future(
+                subscribe(stub, login, latencies, ready)))
+            await ready.wait()
+        await asyncio.sleep(args.settle)
+
+        counts = {'sent': 0}
+        cpu_before = get_cpu_seconds(pid)
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*[
+            send(stub, logins[-1 - index % len(logins)], recipients,
+                 deadline, args, counts)
+            for index in range(args.senders)])
+        elapsed = time.perf_counter() - started
+
+        drain_deadline = time.perf_counter() + args.timeout
+        while len(latencies) < counts['sent'] and \
+                time.perf_counter() < drain_deadline:
+            await asyncio.sleep(0.05)
+        cpu_after = get_cpu_seconds(pid)
+        cpu_seconds = (cpu_after - cpu_before
+                       if cpu_before is not None and cpu_after is not None
+                       else None)
+
+        for subscriber in subscribers:
+            subscriber.cancel()
+        await asyncio.gather(*subscribers, return_exceptions=True)
+        return counts['sent'], latencies, elapsed, cpu_seconds
+
+
+def run(etcd_host, etcd_port, args):
+    logins = ['load-{}'.format(index) for index in range(args.users)]
+    if args.backend != simple_chat_server.STORAGE_BACKEND_MEMORY:
+        storage = Storage(etcd_host, etcd_port)
+        for login in logins:
+            storage.put_user(User(login, 'Load User {}'.format(login)))
+        storage.close()
+
+    port = get_free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_server(port, etcd_host, etcd_port, args, directory)
+        sampler = ResourceSampler(server.pid)
+        sampler.start()
+        try:
+            sent, latencies, elapsed, cpu_seconds = \
+                asyncio.get_event_loop().run_until_complete(run_clients(
+                    '127.0.0.1:{}'.format(port), logins, server.pid, args))
+            rss = get_rss_bytes(server.pid)
+        finally:
+            sampler.stop()
+            server.kill()
+            server.wait()
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        'backend': args.backend, 'server_mode': args.server_mode,
+        'users': args.users, 'senders': args.senders,
+        'subscribers': args.subscribers, 'rate': args.rate,
+        'duration': elapsed, 'sent': sent, 'delivered': len(latencies),
+        'sent_per_second': sent / elapsed,
+        'delivered_per_second': len(latencies) / elapsed,
+        'latency_ms_p50': (percentile(latencies_ms, 0.5)
+                           if latencies_ms else None),
+        'latency_ms_p99': (percentile(latencies_ms, 0.99)
+                           if latencies_ms else None),
+        'server_cpu_seconds': cpu_seconds,
+        'server_cpu_percent': (cpu_seconds / elapsed * 100
+                               if cpu_seconds is not None else None),
+        'server_rss_bytes': rss,
+        'server_peak_rss_bytes': sampler.peak_rss,
+    }
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='End-to-end load benchmark')
+    parser.add_argument('--backend', default=simple_chat_server
+                        .STORAGE_BACKEND_ETCD,
+                        choices=simple_chat_server.STORAGE_BACKENDS)
+    parser.add_argument('--server-mode', default=simple_chat_server
+                        .SERVER_MODE_THREADED,
+                        choices=simple_chat_server.SERVER_MODES)
+    parser.add_argument('--etcd-host', type=str, default=None,
+                        help='Use real etcd instead of the stand-in')
+    parser.add_argument('--etcd-port', type=int, default=2379)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('-u', '--users', type=int, default=100,
+                        help='Generated users, senders and subscribers '
+                             'are taken from them')
+    parser.add_argument('--senders', type=int, default=10)
+    parser.add_argument('--subscribers', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages per second of every sender, '
+                             '0 sends as fast as the server answers')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='Seconds of sending')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='Seconds to let the streams connect')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Append the results as a JSON line to a file')
+    args = parser.parse_args()
+    if args.subscribers > args.users:
+        parser.error('There are fewer users than subscribers')
+    return args
+
+
+def main():
+    args = get_parsed_args()
+
+    stand_in = None
+    if args.etcd_host:
+        etcd_host, etcd_port = args.etcd_host, args.etcd_port
+    else:
+        stand_in = EtcdStandIn(latency=args.latency)
+        etcd_host, etcd_port = '127.0.0.1', stand_in.start(max_workers=256)
+
+    result = run(etcd_host, etcd_port, args)
+    result.update({
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'grpc': grpc.__version__, 'cpu_count': os.cpu_count(),
+        'etcd': 'stand-in' if stand_in is not None else etcd_host})
+
+    if stand_in is not None:
+        stand_in.stop()
+
+    if args.output:
+        with open(args.output, 'a') as output:
+            output.write(json.dumps(result) + '\n')
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        peak_rss = result['server_peak_rss_bytes'] or 0
+        print("{backend}/{server_mode}, {senders} senders, {subscribers} "
+              "subscribers: sent {sent_per_second:.0f} msg/s, delivered "
+              "{delivered_per_second:.0f} msg/s ({delivered}/{sent}), "
+              "p50 {latency_ms_p50:.1f} ms, p99 {latency_ms_p99:.1f} ms, "
+              "server CPU {server_cpu_percent:.0f}%, peak RSS "
+              "{peak_rss_mib:.1f} MiB".format(
+                  peak_rss_mib=peak_rss / 2 ** 20, **result))
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
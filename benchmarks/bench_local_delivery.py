@@ -0,0 +1,75 @@
+"""Benchmark of same-node delivery with and without local delivery.
+
+Sender and recipients are connected to one chat server. Messages go
+through the etcd put and watch, or are handed straight to the recipient
+streams and stored in the background. Reports the latency between
+SendMessage and the moment the message comes out of ReceiveMessages.
+
+Runs against the in-process etcd stand-in unless --etcd-host is given:
+    PYTHONPATH=../src/project python bench_local_delivery.py
+"""
+import argparse
+import json
+import os
+
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Storage
+from simple_chat_server import DELIVERY_MODE_FORWARD, DELIVERY_MODE_WATCH
+
+from bench_delivery_latency import run_mode
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='Local delivery benchmark')
+    parser.add_argument('--etcd-host', type=str, default=None,
+                        help='Use real etcd instead of the stand-in')
+    parser.add_argument('--etcd-port', type=int, default=2379)
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('-n', '--messages', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.01,
+                        help='Pause between sent messages in seconds')
+    parser.add_argument('--subscribers', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', default=[DELIVERY_MODE_WATCH],
+                        choices=(DELIVERY_MODE_WATCH, DELIVERY_MODE_FORWARD))
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+
+    if args.etcd_host:
+        stand_in = None
+        storage = Storage(args.etcd_host, args.etcd_port)
+    else:
+        stand_in = EtcdStandIn(latency=args.latency)
+        storage = Storage('127.0.0.1', stand_in.start())
+
+    results = []
+    for mode in args.modes:
+        for is_local_delivery in (False, True):
+            # idle storage load is measured by bench_delivery_latency.py
+            result = run_mode(mode, storage, None, args, is_local_delivery)
+            result['local_delivery'] = is_local_delivery
+            results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{mode:>8} local {local_delivery!s:>5}: "
+                  "delivered {delivered}/{messages}, "
+                  "mean {latency_ms_mean:.2f} ms, "
+                  "p50 {latency_ms_p50:.2f} ms, "
+                  "p99 {latency_ms_p99:.2f} ms".format(**result))
+
+    if stand_in is not None:
+        stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
@@ -0,0 +1,70 @@
+"""Micro-benchmark of the stored message codecs.
+
+Encodes and decodes the same messages with every codec and reports the
+stored bytes per message and encode/decode throughput. No etcd is needed:
+    PYTHONPATH=../src/project python bench_message_codec.py
+"""
+import argparse
+import json
+import time
+
+from simple_chat_etcd_storage import Message, MESSAGE_CODECS
+
+
+def make_messages(count, body_size):
+    """Creates messages looking like chat traffic"""
+    return [Message('user{:06}'.format(index % 1000),
+                    'user{:06}'.format((index * 7) % 1000),
+                    'x' * body_size)
+            for index in range(count)]
+
+
+def run_codec(name, messages):
+    """Measures one codec on the given messages"""
+    codec = MESSAGE_CODECS[name]()
+
+    started = time.perf_counter()
+    values = [codec.encode(message) for message in messages]
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    decoded = [codec.decode(value) for value in values]
+    decode_seconds = time.perf_counter() - started
+
+    assert decoded == messages
+    return {
+        'codec': name,
+        'messages': len(messages),
+        'bytes_per_message': sum(map(len, values)) / len(values),
+        'encode_per_sec': len(messages) / encode_seconds,
+        'decode_per_sec': len(messages) / decode_seconds,
+    }
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='Message codec benchmark')
+    parser.add_argument('-n', '--messages', type=int, default=100000)
+    parser.add_argument('--body-size', type=int, default=40,
+                        help='Message body length in characters')
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+    messages = make_messages(args.messages, args.body_size)
+
+    results = [run_codec(name, messages) for name in MESSAGE_CODECS]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{codec:>8}: {bytes_per_message:.1f} bytes/message, "
+                  "encode {encode_per_sec:.0f}/s, "
+                  "decode {decode_per_sec:.0f}/s".format(**result))
+
+
+if __name__ == '__main__':
+    main()
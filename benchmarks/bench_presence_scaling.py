@@ -0,0 +1,172 @@
+"""Benchmark of multi-node delivery with and without presence routing.
+
+Starts 1, 2, 4... simple_chat_server.py processes on one in-process etcd
+stand-in. Every node gets its own subscribers, and senders connected to
+each node send to the subscribers of the next node, so every message
+crosses nodes. Without NODE_ID every node watches all queues and gets an
+event for every stored message. With NODE_ID set the sender reads the
+presence of the recipient in the same transaction and wakes only the node
+it is subscribed to.
+
+Reports delivered messages per second and etcd watch events per message:
+    PYTHONPATH=../src/project python bench_presence_scaling.py -n 1 2 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+import simple_chat_server
+from simple_chat_etcd_stand_in import EtcdStandIn
+
+from bench_delivery_latency import get_free_port
+
+
+def start_node(port, etcd_port, node_id):
+    """Starts chat server process, presence routing is on with node id"""
+    env = dict(os.environ,
+               SERVER_HOST='127.0.0.1', SERVER_PORT=str(port),
+               ETCD_SERVER_HOST='127.0.0.1', ETCD_SERVER_PORT=str(etcd_port),
+               REFLECTION='', SERVER_MODE=simple_chat_server.SERVER_MODE_AIO,
+               NODE_ID=node_id or '')
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(simple_chat_server.__file__)],
+        env=env, cwd=os.path.dirname(simple_chat_server.__file__))
+
+
+async def subscribe(stub, login, delivered):
+    """Keeps the subscriber stream open and counts its messages"""
+    call = stub.ReceiveMessages(
+        simple_chat_pb2.ReceiveMessagesRequest(login=login))
+    try:
+        async for _ in call:
+            delivered[login] += 1
+    except grpc.aio.AioRpcError:
+        pass
+    finally:
+        call.cancel()
+
+
+async def send(stub, sender, recipients, count):
+    """Sends count messages round robin to the recipients"""
+    for index in range(count):
+        await stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(
+                sender=sender, recipient=recipients[index % len(recipients)],
+                body=str(index))))
+
+
+async def run_clients(addresses, stand_in, args):
+    """Subscribes users on every node and sends messages across nodes,
+    returns delivered messages, seconds spent and watch events
+    """
+    channels = [grpc.aio.insecure_channel(address) for address in addresses]
+    for channel in channels:
+        await asyncio.wait_for(channel.channel_ready(), args.timeout)
+    stubs = [simple_chat_pb2_grpc.SimpleChatStub(channel)
+             for channel in channels]
+
+    logins = [['n{}-u{}'.format(node, index) for index in range(args.users)]
+              for node in range(len(stubs))]
+    delivered = {login: 0 for node_logins in logins for login in node_logins}
+    subscribers = [
+        asyncio.ensure_future(subscribe(stub, login, delivered))
+        for stub, node_logins in zip(stubs, logins) for login in node_logins]
+    await asyncio.sleep(args.settle)
+
+    events = stand_in.counters['watch_events']
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        send(stub, 's{}-{}'.format(node, sender),
+             logins[(node + 1) % len(stubs)], args.messages)
+        for node, stub in enumerate(stubs)
+        for sender in range(args.senders)])
+
+    expected = len(stubs) * args.senders * args.messages
+    deadline = time.time() + args.timeout
+    while sum(delivered.values()) < expected and time.time() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    events = stand_in.counters['watch_events'] - events
+
+    for subscriber in subscribers:
+        subscriber.cancel()
+    await asyncio.gather(*subscribers, return_exceptions=True)
+    for channel in channels:
+        await channel.close()
+
+    return sum(delivered.values()), expected, elapsed, events
+
+
+def run(nodes, is_routed, args):
+    stand_in = EtcdStandIn(latency=args.latency)
+    etcd_port = stand_in.start(max_workers=256)
+    ports = [get_free_port() for _ in range(nodes)]
+    servers = [start_node(port, etcd_port,
+                          'node-{}'.format(node) if is_routed else None)
+               for node, port in enumerate(ports)]
+    try:
+        delivered, expected, elapsed, events = \
+            asyncio.get_event_loop().run_until_complete(run_clients(
+                ['127.0.0.1:{}'.format(port) for port in ports], stand_in,
+                args))
+    finally:
+        for server in servers:
+            server.kill()
+            server.wait()
+        stand_in.stop()
+
+    return {'nodes': nodes, 'routing': 'presence' if is_routed else 'off',
+            'delivered': delivered, 'messages': expected,
+            'messages_per_second': delivered / elapsed,
+            'watch_events_per_message': events / max(delivered, 1)}
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(
+        description='Multi-node presence routing benchmark')
+    parser.add_argument('-n', '--nodes', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('-u', '--users', type=int, default=50,
+                        help='Subscribed users per node')
+    parser.add_argument('--senders', type=int, default=8,
+                        help='Concurrent senders per node')
+    parser.add_argument('-m', '--messages', type=int, default=100,
+                        help='Messages per sender')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='Seconds to let the streams connect')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+
+    results = [run(nodes, is_routed, args)
+               for nodes in args.nodes for is_routed in (False, True)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{nodes} nodes, routing {routing:>8}: delivered "
+                  "{delivered}/{messages}, {messages_per_second:.0f} msg/s, "
+                  "{watch_events_per_message:.2f} watch events/msg"
+                  .format(**result))
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
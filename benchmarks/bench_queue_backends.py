@@ -0,0 +1,145 @@
+"""Benchmark of message queue throughput and disk footprint per backend.
+
+Stores messages from many threads into the queues of many recipients,
+then drains every queue page by page, deleting the read pages, once with
+queues in etcd and once with queues in a SQLite database in WAL mode.
+Reports stored and drained messages per second and the bytes the queues
+take on disk: the etcd database size reported by etcd (only with
+--etcd-host, the stand-in keeps everything in memory) and the SQLite
+database with its write-ahead log.
+
+    PYTHONPATH=../src/project python bench_queue_backends.py -m 20000
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import etcd3
+
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Message, Storage
+from simple_chat_sqlite_storage import SqliteQueueStorage
+
+BACKEND_ETCD = 'etcd'
+BACKEND_SQLITE = 'sqlite'
+
+
+def store(storage, thread_index, args):
+    """Stores this thread's share of messages round robin to recipients"""
+    body = 'x' * args.body_size
+    for index in range(thread_index, args.messages, args.threads):
+        storage.put_message(Message(
+            'bench', 'bench-{}'.format(index % args.recipients), body))
+
+
+def run_threads(target, storage, args):
+    """Runs target in args.threads threads, returns seconds spent"""
+    threads = [threading.Thread(target=target, args=(storage, index, args))
+               for index in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def drain(storage, thread_index, args):
+    """Reads and deletes the queues of this thread's recipients"""
+    for recipient in range(thread_index, args.recipients, args.threads):
+        for messages in storage.iterate_user_queue_stored_messages(
+                'bench-{}'.format(recipient)):
+            storage.delete_user_queue_stored_messages(messages)
+
+
+def get_disk_size(backend, storage, host, port, args):
+    """Bytes the stored queues take on disk, None when not known"""
+    if backend == BACKEND_SQLITE:
+        return sum(os.path.getsize(path) for path in (
+            storage.database_path, storage.database_path + '-wal')
+            if os.path.exists(path))
+    if args.etcd_host:
+        client = etcd3.client(host, port)
+        try:
+            return client.status().db_size
+        finally:
+            client.close()
+    return None
+
+
+def run(backend, host, port, directory, args):
+    if backend == BACKEND_SQLITE:
+        storage = SqliteQueueStorage(
+            host, port, os.path.join(directory, 'queues.db'))
+    else:
+        storage = Storage(host, port)
+
+    store_seconds = run_threads(store, storage, args)
+    disk_size = get_disk_size(backend, storage, host, port, args)
+    drain_seconds = run_threads(drain, storage, args)
+    storage.close()
+
+    return {'backend': backend, 'messages': args.messages,
+            'threads': args.threads,
+            'stored_per_second': args.messages / store_seconds,
+            'drained_per_second': args.messages / drain_seconds,
+            'disk_bytes': disk_size}
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(
+        description='Message queue backend benchmark')
+    parser.add_argument('--etcd-host', type=str, default=None,
+                        help='Use real etcd instead of the stand-in')
+    parser.add_argument('--etcd-port', type=int, default=2379)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('-m', '--messages', type=int, default=20000)
+    parser.add_argument('-r', '--recipients', type=int, default=100)
+    parser.add_argument('-t', '--threads', type=int, default=16)
+    parser.add_argument('-b', '--body-size', type=int, default=100,
+                        help='Characters of every message body')
+    parser.add_argument('--backends', nargs='+',
+                        default=[BACKEND_ETCD, BACKEND_SQLITE],
+                        choices=(BACKEND_ETCD, BACKEND_SQLITE))
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+
+    stand_in = None
+    if args.etcd_host:
+        host, port = args.etcd_host, args.etcd_port
+    else:
+        stand_in = EtcdStandIn(latency=args.latency)
+        host, port = '127.0.0.1', stand_in.start(max_workers=64)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [run(backend, host, port, directory, args)
+                   for backend in args.backends]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            disk = ('{:.1f} MiB'.format(result['disk_bytes'] / 2 ** 20)
+                    if result['disk_bytes'] is not None else 'n/a')
+            print("{backend:>6}, {messages} messages, {threads} threads: "
+                  "stored {stored_per_second:.0f} msg/s, drained "
+                  "{drained_per_second:.0f} msg/s, on disk {disk}"
+                  .format(disk=disk, **result))
+
+    if stand_in is not None:
+        stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
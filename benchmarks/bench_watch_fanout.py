@@ -0,0 +1,88 @@
+"""Stress benchmark of the shared queue watch.
+
+Subscribes many user logins through Storage.watch_user_queue_messages,
+sends one message to each of them and reports how long the fan-out took
+and how many watches etcd had to create for it.
+
+Runs against the in-process etcd stand-in:
+    PYTHONPATH=../src/project python bench_watch_fanout.py -s 2000
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Storage, Message
+
+
+def consume(storage, login, subscribed, delivered, cancels):
+    """Waits for one message of the user login"""
+    batches, cancel = storage.watch_user_queue_messages(login)
+    cancels.append(cancel)
+    subscribed.release()
+    for messages in batches:
+        delivered[login] = time.perf_counter()
+        storage.delete_user_queue_messages(messages)
+        break
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='Watch fan-out benchmark')
+    parser.add_argument('-s', '--subscribers', type=int, default=2000)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+    stand_in = EtcdStandIn()
+    storage = Storage('127.0.0.1', stand_in.start())
+
+    subscribed = threading.Semaphore(0)
+    delivered = {}
+    cancels = []
+    threads = []
+    logins = ['user{}'.format(index) for index in range(args.subscribers)]
+    for login in logins:
+        thread = threading.Thread(target=consume, daemon=True, args=(
+            storage, login, subscribed, delivered, cancels))
+        thread.start()
+        threads.append(thread)
+    for _ in logins:
+        subscribed.acquire()
+    # let every subscription finish its initial backlog read
+    time.sleep(1)
+
+    started = time.perf_counter()
+    for login in logins:
+        storage.put_message(Message('bench', login, 'Hello'))
+    for thread in threads:
+        thread.join(timeout=30)
+    finished = max(delivered.values()) if delivered else started
+
+    for cancel in cancels:
+        cancel()
+    stand_in.stop()
+
+    result = {
+        'subscribers': args.subscribers,
+        'delivered': len(delivered),
+        'fanout_seconds': finished - started,
+        'etcd_watches': stand_in.counters['watches'],
+        'etcd_watch_streams': stand_in.counters['watch_streams'],
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print("subscribers {subscribers}, delivered {delivered} in "
+              "{fanout_seconds:.2f} s, etcd watches {etcd_watches}, "
+              "watch streams {etcd_watch_streams}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
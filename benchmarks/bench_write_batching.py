@@ -0,0 +1,130 @@
+"""Benchmark of SendMessage throughput with and without write batching.
+
+Launches simple_chat_server.py in the threaded and the asyncio mode, with
+and without WRITE_BATCH_WINDOW, and sends messages from many concurrent
+clients. Reports sent messages per second and etcd write requests per
+message, counted by the in-process etcd stand-in.
+
+    PYTHONPATH=../src/project python bench_write_batching.py -c 1 16 256
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+import simple_chat_server
+from simple_chat_etcd_stand_in import EtcdStandIn
+
+from bench_delivery_latency import get_free_port
+
+
+def start_server(mode, port, etcd_port, write_batch_window):
+    """Starts chat server process, batching writes within the window"""
+    env = dict(os.environ,
+               SERVER_HOST='127.0.0.1', SERVER_PORT=str(port),
+               ETCD_SERVER_HOST='127.0.0.1', ETCD_SERVER_PORT=str(etcd_port),
+               REFLECTION='', SERVER_MODE=mode)
+    env.pop('WRITE_BATCH_WINDOW', None)
+    if write_batch_window is not None:
+        env['WRITE_BATCH_WINDOW'] = str(write_batch_window)
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(simple_chat_server.__file__)],
+        env=env, cwd=os.path.dirname(simple_chat_server.__file__))
+
+
+async def send(stub, sender, count):
+    """Sends count messages one after another"""
+    for index in range(count):
+        await stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(
+                sender=sender, recipient='bench-recipient',
+                body=str(index))))
+
+
+async def run_clients(address, concurrency, args):
+    """Sends messages from concurrent clients, returns seconds spent"""
+    async with grpc.aio.insecure_channel(address) as channel:
+        await asyncio.wait_for(channel.channel_ready(), args.timeout)
+        stub = simple_chat_pb2_grpc.SimpleChatStub(channel)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            send(stub, 'bench-sender-{}'.format(client),
+                 args.messages // concurrency)
+            for client in range(concurrency)])
+        return time.perf_counter() - started
+
+
+def run(mode, write_batch_window, concurrency, stand_in, etcd_port, args):
+    port = get_free_port()
+    server = start_server(mode, port, etcd_port, write_batch_window)
+    try:
+        counters = stand_in.counters.copy()
+        elapsed = asyncio.get_event_loop().run_until_complete(run_clients(
+            '127.0.0.1:{}'.format(port), concurrency, args))
+        writes = sum((stand_in.counters[name] - counters[name]
+                      for name in ('put', 'txn')))
+    finally:
+        server.kill()
+        server.wait()
+
+    sent = args.messages // concurrency * concurrency
+    return {'mode': mode, 'concurrency': concurrency,
+            'write_batch_window': write_batch_window,
+            'messages_per_second': sent / elapsed,
+            'etcd_writes_per_message': writes / sent}
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(
+        description='Write batching throughput benchmark')
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+',
+                        default=[1, 16, 256],
+                        help='Numbers of concurrent senders')
+    parser.add_argument('-m', '--messages', type=int, default=2000,
+                        help='Messages sent per run')
+    parser.add_argument('-w', '--window', type=float, default=0.002,
+                        help='WRITE_BATCH_WINDOW of the batched runs')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='Simulated stand-in latency in seconds')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--modes', nargs='+',
+                        default=list(simple_chat_server.SERVER_MODES),
+                        choices=simple_chat_server.SERVER_MODES)
+    parser.add_argument('--json', action='store_true',
+                        help='Print machine-readable results')
+    return parser.parse_args()
+
+
+def main():
+    args = get_parsed_args()
+    stand_in = EtcdStandIn(latency=args.latency)
+    etcd_port = stand_in.start(max_workers=256)
+
+    results = [run(mode, window, concurrency, stand_in, etcd_port, args)
+               for mode in args.modes
+               for concurrency in args.concurrency
+               for window in (None, args.window)]
+    stand_in.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print("{mode:>8}, {concurrency:>4} senders, batch window "
+                  "{write_batch_window}: {messages_per_second:.0f} msg/s, "
+                  "{etcd_writes_per_message:.2f} etcd writes/msg"
+                  .format(**result))
+
+
+if __name__ == '__main__':
+    main()
+    # etcd3 keeps non-daemon gRPC threads alive after the benchmark
+    os._exit(0)
@@ -1,27 +1,227 @@
-"""Simple chat script that load users to storage"""
+"""Simple chat script that load users to storage.
+
+Users are read from a JSON array, or streamed from JSON lines or CSV with
+login and full_name columns, and stored in batches by concurrent workers.
+The number of leading users all stored is kept in a checkpoint file, so
+--resume continues an import after a failure.
+"""
+import argparse
+import csv
+import itertools
 import json
 import os
+import sys
+import time
+from concurrent import futures
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from simple_chat_etcd_storage import (BaseStorage, ETCD_POOL_SIZE, Storage,
+                                      User)
+
+USERS_FILE_PATH = 'data/users.json'
+
+FORMAT_JSON = 'json'
+# one JSON object per line
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+FORMATS = (FORMAT_JSON, FORMAT_JSONL, FORMAT_CSV)
+
+# users given to a worker at once, stored with several transactions
+IMPORT_BATCH_SIZE = 1000
+IMPORT_WORKERS = 8
+# batches read ahead of the workers per worker
+IMPORT_QUEUED_BATCHES = 2
+# seconds between progress lines
+PROGRESS_INTERVAL = 5
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+def get_file_format(file_path: str) -> str:
+    """Format of the users file told by its extension"""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in ('.jsonl', '.ndjson'):
+        return FORMAT_JSONL
+    if extension == '.csv':
+        return FORMAT_CSV
+    return FORMAT_JSON
+
+
+def read_users(file_path: str,
+               file_format: Optional[str] = None) -> Iterator[User]:
+    """Reads users of the file one by one. JSON lines and CSV are parsed
+    while they are read, a JSON array is read at once.
+    """
+    file_format = file_format or get_file_format(file_path)
+    with open(file_path, 'r', newline='') as f:
+        if file_format == FORMAT_CSV:
+            for row in csv.DictReader(f):
+                yield User(row['login'], row['full_name'])
+        elif file_format == FORMAT_JSONL:
+            for line in f:
+                if line.strip():
+                    yield User.from_dict(json.loads(line))
+        else:
+            for user in json.load(f):
+                yield User.from_dict(user)
+
+
+def read_checkpoint(path: str) -> int:
+    """Number of leading users of the file stored before, 0 without
+    checkpoint
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)['stored']
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path: str, stored: int):
+    """Replaces the checkpoint, a crash leaves the previous one"""
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump({'stored': stored}, f)
+    os.replace(temporary_path, path)
+
 
-from simple_chat_etcd_storage import Storage, User
+def import_users(users: Iterable[User], storage: BaseStorage,
+                 workers: int = IMPORT_WORKERS,
+                 batch_size: int = IMPORT_BATCH_SIZE,
+                 on_stored: Optional[Callable[[int], None]] = None) -> int:
+    """Stores users with put_users in batches by concurrent workers and
+    returns their number. on_stored is called with the number of leading
+    users all stored whenever it grows. The first failure is raised once
+    the batches being stored are finished.
+
+    Batches are stored in any order, a login repeated in batches stored
+    at once may keep either of its users.
+    """
+    iterator = iter(users)
+    batches = iter(lambda: list(itertools.islice(iterator, batch_size)), [])
+    # indexes and sizes of the batches being stored
+    pending: Dict[futures.Future, Tuple[int, int]] = {}
+    finished_sizes: Dict[int, int] = {}
+    state = {'next_index': 0, 'stored': 0}
+
+    def collect(finished) -> Optional[Exception]:
+        error = None
+        for future in finished:
+            index, size = pending.pop(future)
+            if future.exception() is not None:
+                error = error or future.exception()
+            else:
+                finished_sizes[index] = size
+
+        stored = state['stored']
+        while state['next_index'] in finished_sizes:
+            state['stored'] += finished_sizes.pop(state['next_index'])
+            state['next_index'] += 1
+        if state['stored'] > stored and on_stored is not None:
+            on_stored(state['stored'])
+        return error
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        error = None
+        for index, batch in enumerate(batches):
+            pending[executor.submit(storage.put_users, batch)] = (
+                index, len(batch))
+            if len(pending) >= workers * IMPORT_QUEUED_BATCHES:
+                finished, _ = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+                error = collect(finished)
+                if error is not None:
+                    break
+
+        error = collect(futures.wait(pending)[0]) or error
+    if error is not None:
+        raise error
+    return state['stored']
 
 
 def load_users_to_storage(file_path: str, etcd_storage: Storage):
     """Load list of users to storage from json file"""
-    with open(file_path, "r") as f:
-        for user in json.load(f):
-            etcd_storage.put_user(User(user['login'], user['full_name']))
+    import_users(read_users(file_path), etcd_storage)
 
     return True
 
 
-def get_etcd_storage_connection(host, port) -> 'Storage':
-    """Creates new one etcd connection for working with storage"""
-    etcd_storage = Storage(host, port)
+def get_etcd_storage_connection(host, port,
+                                pool_size=ETCD_POOL_SIZE) -> 'Storage':
+    """Creates new one etcd connection for working with storage, the host
+    may list several endpoints separated by commas
+    """
+    etcd_storage = Storage(host, port, pool_size=pool_size)
     return etcd_storage
 
 
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='Load users to storage')
+    parser.add_argument('file', nargs='?', default=USERS_FILE_PATH,
+                        help='Users file, data/users.json by default')
+    parser.add_argument('--format', choices=FORMATS, default=None,
+                        help='Format of the file, told by its extension '
+                             'by default')
+    parser.add_argument('-w', '--workers', type=int, default=IMPORT_WORKERS,
+                        help='Batches stored at once')
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=IMPORT_BATCH_SIZE,
+                        help='Users given to a worker at once')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='File keeping the number of stored users, '
+                             'the users file with {} appended by '
+                             'default'.format(CHECKPOINT_SUFFIX))
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the users stored before as the '
+                             'checkpoint tells')
+    parser.add_argument('--reindex', action='store_true',
+                        help='Rebuild the name index of already stored '
+                             'users instead of loading users')
+    return parser.parse_args()
+
+
+def main(args, storage: BaseStorage):
+    file_path = os.path.abspath(args.file)
+    checkpoint_path = args.checkpoint or file_path + CHECKPOINT_SUFFIX
+    skipped = read_checkpoint(checkpoint_path) if args.resume else 0
+    users = itertools.islice(read_users(file_path, args.format), skipped,
+                             None)
+    if skipped:
+        print("{} users stored before are skipped".format(skipped))
+    write_checkpoint(checkpoint_path, skipped)
+
+    started = time.perf_counter()
+    progress = {'printed': started}
+
+    def on_stored(stored: int):
+        write_checkpoint(checkpoint_path, skipped + stored)
+        now = time.perf_counter()
+        if now - progress['printed'] >= PROGRESS_INTERVAL:
+            progress['printed'] = now
+            print("{} users are loaded, {:.0f} users/s".format(
+                skipped + stored, stored / (now - started)), flush=True)
+
+    try:
+        stored = import_users(users, storage, args.workers, args.batch_size,
+                              on_stored)
+    except Exception as error:
+        print("Loading stopped after {} users, run again with --resume to "
+              "continue: {}".format(read_checkpoint(checkpoint_path), error),
+              file=sys.stderr)
+        return 1
+
+    elapsed = time.perf_counter() - started
+    print("{} users were loaded in {:.1f} s, {:.0f} users/s".format(
+        stored, elapsed, stored / elapsed if elapsed else 0))
+    return 0
+
+
 if __name__ == '__main__':
+    parsed_args = get_parsed_args()
     storage = get_etcd_storage_connection(
-        os.environ['ETCD_SERVER_HOST'], os.environ['ETCD_SERVER_PORT'])
+        os.environ['ETCD_SERVER_HOST'], os.environ['ETCD_SERVER_PORT'],
+        int(os.environ.get('ETCD_POOL_SIZE', ETCD_POOL_SIZE)))
 
-    load_users_to_storage(os.path.abspath('data/users.json'), storage)
+    if parsed_args.reindex:
+        print("{} users were indexed".format(storage.reindex_users()))
+    else:
+        sys.exit(main(parsed_args, storage))
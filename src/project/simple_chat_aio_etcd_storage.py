@@ -0,0 +1,199 @@
+"""Asyncio implementation that work with key-value storage"""
+import asyncio
+import functools
+from concurrent import futures
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from simple_chat_etcd_storage import (BaseStorage, Message,
+                                      QueueSubscription, StoredMessage, User)
+
+STORAGE_MAX_WORKERS = 32
+
+
+class AsyncQueueSubscription(QueueSubscription):
+    """Queue subscription consumed from asyncio code.
+
+    The watch thread wakes the event loop instead of a waiting thread, so
+    an idle subscriber costs no thread at all.
+    """
+
+    def __init__(self, dispatcher, login: str, buffer_size: int,
+                 executor: futures.Executor, is_stored: bool = False):
+        super().__init__(dispatcher, login, buffer_size, is_stored)
+        self._executor = executor
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def _wake(self):
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def __aiter__(self) -> AsyncIterator[List[Message]]:
+        """Yields batches of messages like the threaded subscription"""
+        while True:
+            self._event.clear()
+            with self._condition:
+                if self._closed:
+                    return
+
+                resync, buffered = self._take_pending()
+
+            if resync:
+                async for messages in self._iterate_backlog():
+                    if messages:
+                        yield messages
+                continue
+
+            messages = self._skip_seen(buffered)
+            if not buffered:
+                await self._event.wait()
+
+            if messages:
+                yield messages
+
+    async def _iterate_backlog(self) -> AsyncIterator[List[Message]]:
+        """Reads backlog pages in the storage threads"""
+        pages = self._read_backlog()
+        while True:
+            messages = await self._loop.run_in_executor(
+                self._executor, next, pages, None)
+            if messages is None:
+                return
+            yield messages
+
+
+class AsyncStorage:
+    """Provides asyncio methods of the key-value storage.
+
+    The blocking etcd calls run in a dedicated thread pool, subscriptions
+    are served by the watch shared with the wrapped storage.
+    """
+
+    def __init__(self, storage: BaseStorage,
+                 max_workers: int = STORAGE_MAX_WORKERS):
+        self._storage = storage
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='storage')
+
+    async def run(self, function, *args):
+        """Runs blocking function in the storage threads"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(function, *args))
+
+    async def get_users(self) -> List[User]:
+        """Getting sequence of users"""
+        return await self.run(self._storage.get_users)
+
+    async def get_users_page(self, limit: int,
+                             start_key: Optional[str] = None,
+                             login_prefix: str = '', name_prefix: str = ''
+                             ) -> Tuple[List[User], Optional[str]]:
+        """Getting page of users and the start key of the next page"""
+        return await self.run(self._storage.get_users_page, limit,
+                               start_key, login_prefix, name_prefix)
+
+    @property
+    def history_ttl(self) -> Optional[int]:
+        """History time to live of the wrapped storage"""
+        return self._storage.history_ttl
+
+    async def get_history_page(self, login: str, peer: str, limit: int,
+                               start_time: Optional[float] = None,
+                               end_time: Optional[float] = None,
+                               start_key: Optional[str] = None
+                               ) -> Tuple[List[Message], Optional[str]]:
+        """Getting page of messages between the two users, the newest
+        first, and the start key of the next page
+        """
+        return await self.run(self._storage.get_history_page, login, peer,
+                               limit, start_time, end_time, start_key)
+
+    async def put_user(self, user: User):
+        """Adding user to storage"""
+        await self.run(self._storage.put_user, user)
+
+    async def put_message(self, message: Message):
+        """Adding new queue message to storage. Batched writes are
+        awaited without holding a storage thread.
+        """
+        if self._storage.write_batcher is None:
+            await self.run(self._storage.put_message, message)
+        else:
+            await asyncio.wrap_future(self._storage.submit_message(message))
+
+    async def send_message(self, message: Message):
+        """Hands new message over to subscribers in this process and
+        stores it in the background, or stores it like put_message
+        """
+        await self.run(self._storage.send_message, message)
+
+    async def put_messages(self, messages: List[Message]):
+        """Adding batch of new queue messages to storage"""
+        await self.run(self._storage.put_messages, messages)
+
+    async def get_user_queue_messages(self, user_login: str) -> List[Message]:
+        """Getting sequence of queued messages for received user login"""
+        return await self.run(self._storage.get_user_queue_messages,
+                               user_login)
+
+    async def iterate_user_queue_messages(
+            self, user_login: str, page_size: Optional[int] = None,
+            start_key: Optional[str] = None) -> AsyncIterator[List[Message]]:
+        """Yields pages of queued messages read in the storage threads"""
+        pages = self._storage.iterate_user_queue_messages(
+            user_login, page_size, start_key)
+        while True:
+            messages = await self.run(next, pages, None)
+            if messages is None:
+                return
+            yield messages
+
+    async def delete_user_queue_message(self, message: Message):
+        """Deleting queued message from the storage"""
+        await self.run(self._storage.delete_user_queue_message, message)
+
+    async def delete_user_queue_messages(self, messages: List[Message]):
+        """Deleting delivered queued messages from the storage"""
+        await self.run(self._storage.delete_user_queue_messages, messages)
+
+    async def delete_user_queue_stored_messages(
+            self, messages: List[StoredMessage]):
+        """Deleting delivered stored messages by their keys"""
+        await self.run(self._storage.delete_user_queue_stored_messages,
+                        messages)
+
+    async def delete_user_queue_message_ids(self, user_login: str,
+                                            message_ids: List[str]):
+        """Deleting acknowledged queued messages by their ids"""
+        await self.run(self._storage.delete_user_queue_message_ids,
+                       user_login, message_ids)
+
+    async def delete_user_queue_messages_until(self, user_login: str,
+                                               message_id: str):
+        """Deleting queued messages with ids up to the given one"""
+        await self.run(self._storage.delete_user_queue_messages_until,
+                       user_login, message_id)
+
+    def watch_user_queue_messages(self, user_login: str) -> \
+            Tuple[AsyncIterator[List[Message]], Callable[[], None]]:
+        """Getting batches of queued messages for received user login as
+        soon as they are stored. Must be called from the event loop.
+        Returns the batches async iterator and the function closing it.
+        """
+        subscription = self._storage.subscribe_user_queue(
+            user_login, AsyncQueueSubscription, executor=self._executor)
+        return subscription.__aiter__(), subscription.close
+
+    def watch_user_queue_stored_messages(self, user_login: str) -> \
+            Tuple[AsyncIterator[List[StoredMessage]], Callable[[], None]]:
+        """Like watch_user_queue_messages, but the values of messages are
+        serialized simple_chat_pb2.Message ready to be sent as they are
+        """
+        subscription = self._storage.subscribe_user_queue(
+            user_login, AsyncQueueSubscription, executor=self._executor,
+            is_stored=True)
+        return subscription.__aiter__(), subscription.close
+
+    def close(self):
+        """Releases the storage threads"""
+        self._executor.shutdown(wait=False)
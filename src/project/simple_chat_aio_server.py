@@ -0,0 +1,468 @@
+"""Simple chat application served by the asyncio gRPC server"""
+import asyncio
+from typing import Optional
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+from simple_chat_aio_etcd_storage import AsyncStorage
+from simple_chat_etcd_storage import (BaseStorage, Message,
+                                      PartialWriteError)
+from simple_chat_metrics import AsyncMetricsInterceptor, ChatMetrics
+from simple_chat_profiling import AsyncSlowCallInterceptor, SlowCallLog
+from simple_chat_server import (ACK_WINDOW, CHAT_SEND_FAILED_DETAILS,
+                                DELIVERY_MODE_FORWARD, DELIVERY_MODE_POLLING,
+                                DELIVERY_MODE_WATCH, DELIVERY_MODES,
+                                HISTORY_DISABLED_DETAILS,
+                                PARTIAL_WRITE_DETAILS, POLLING_INTERVAL,
+                                SEND_STREAM_BATCH_SIZE,
+                                STREAMS_EXHAUSTED_DETAILS,
+                                SUBSCRIBE_FIRST_DETAILS,
+                                MessageAcknowledger, ServerOptions,
+                                StreamLimiter, UserDirectory,
+                                add_servicer_to_server, enable_reflection,
+                                history_page_from_proto, history_to_proto,
+                                is_users_page_request, message_from_proto,
+                                message_to_proto, serialize_chat_message,
+                                users_page_from_proto, users_to_proto)
+
+
+class AsyncMessageAcknowledger(MessageAcknowledger):
+    """Message acknowledger awaited from asyncio code, acks are read by
+    a task of the same event loop
+    """
+
+    def __init__(self, window: int = ACK_WINDOW):
+        super().__init__(window)
+        self._event = asyncio.Event()
+
+    def _wake(self):
+        self._event.set()
+
+    async def wait_for_room_async(self) -> bool:
+        """Waits until one more message may be streamed, False when the
+        window is full for good
+        """
+        while True:
+            with self._condition:
+                if self._is_settled():
+                    return len(self._pending) < self.window
+                self._event.clear()
+            await self._event.wait()
+
+
+class AsyncSimpleChatServicer(simple_chat_pb2_grpc.SimpleChatServicer):
+    """Provides asyncio methods that implement functionality of simple
+    chat server. A subscribed user holds no thread while waiting.
+    Local delivery works like in the threaded servicer.
+    """
+
+    def __init__(self, storage: AsyncStorage,
+                 delivery_mode: str = DELIVERY_MODE_WATCH,
+                 user_directory: Optional[UserDirectory] = None,
+                 is_local_delivery: bool = False):
+        if delivery_mode not in DELIVERY_MODES:
+            raise ValueError('Unknown delivery mode: {}'.format(delivery_mode))
+
+        self._storage = storage
+        self._delivery_mode = delivery_mode
+        self._user_directory = user_directory
+        self._is_local_delivery = is_local_delivery
+
+    async def GetUsers(self, request, context):
+        """Obtains list of user. The whole list comes from the user
+        directory already serialized, pages are read from the storage.
+        """
+        if is_users_page_request(request):
+            try:
+                page_size, start_key = users_page_from_proto(request)
+                users, next_key = await self._storage.get_users_page(
+                    page_size, start_key, request.login_prefix,
+                    request.name_prefix)
+            except ValueError as error:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                    str(error))
+
+            return users_to_proto(users, next_key)
+
+        if self._user_directory is not None:
+            # the first call loads the directory from etcd
+            return await self._storage.run(
+                self._user_directory.get_serialized_response)
+
+        return users_to_proto(await self._storage.get_users())
+
+    async def GetHistory(self, request, context):
+        """Obtains page of messages between two users, the newest first"""
+        if self._storage.history_ttl is None:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION,
+                                HISTORY_DISABLED_DETAILS)
+
+        try:
+            page_size, start_time, end_time, start_key = \
+                history_page_from_proto(request)
+            messages, next_key = await self._storage.get_history_page(
+                request.login, request.peer, page_size, start_time,
+                end_time, start_key)
+        except ValueError as error:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                str(error))
+
+        return history_to_proto(messages, next_key)
+
+    async def SendMessage(self, request, context):
+        """Put retrieved message to storage"""
+        message = message_from_proto(request.message)
+
+        await self._send(message)
+
+        return simple_chat_pb2.SendMessageResponse()
+
+    async def SendMessages(self, request, context):
+        """Put retrieved batch of messages to storage at once. When the
+        storage fails part way, the RPC is aborted with the number of
+        already stored messages.
+        """
+        messages = [message_from_proto(message)
+                    for message in request.messages]
+
+        try:
+            await self._storage.put_messages(messages)
+        except PartialWriteError as error:
+            await context.abort(grpc.StatusCode.ABORTED,
+                                PARTIAL_WRITE_DETAILS.format(
+                                    error.stored, error.error))
+
+        return simple_chat_pb2.SendMessagesResponse(count=len(messages))
+
+    async def SendMessageStream(self, request_iterator, context):
+        """Put streamed messages to storage in batches. When the storage
+        fails, the RPC is aborted with the number of already stored
+        messages.
+        """
+        count = 0
+        batch = []
+        try:
+            async for request in request_iterator:
+                batch.append(message_from_proto(request.message))
+                if len(batch) == SEND_STREAM_BATCH_SIZE:
+                    await self._storage.put_messages(batch)
+                    count += len(batch)
+                    batch = []
+
+            if batch:
+                await self._storage.put_messages(batch)
+                count += len(batch)
+        except PartialWriteError as error:
+            await context.abort(grpc.StatusCode.ABORTED,
+                                PARTIAL_WRITE_DETAILS.format(
+                                    count + error.stored, error.error))
+
+        return simple_chat_pb2.SendMessagesResponse(count=count)
+
+    async def ReceiveMessages(self, request, context):
+        """Subscribe user to receive messages. Results are
+        streamed rather than returned at once.
+        Deleting queued messages from the storage after getting their,
+        one storage transaction per delivered batch.
+        In the forward mode stored values are streamed as they are.
+        """
+        await self._resume(request)
+
+        if self._delivery_mode == DELIVERY_MODE_FORWARD:
+            batches, cancel = self._storage.watch_user_queue_stored_messages(
+                request.login)
+            try:
+                async for messages in batches:
+                    for message in messages:
+                        yield message.value
+
+                    await self._storage.delete_user_queue_stored_messages(
+                        messages)
+            finally:
+                cancel()
+            return
+
+        if self._delivery_mode == DELIVERY_MODE_POLLING:
+            batches, cancel = \
+                self._poll_user_queue_messages(request.login), None
+        else:
+            batches, cancel = \
+                self._storage.watch_user_queue_messages(request.login)
+
+        try:
+            async for messages in batches:
+                for message in messages:
+                    yield message_to_proto(message)
+
+                await self._storage.delete_user_queue_messages(messages)
+        finally:
+            if cancel is not None:
+                cancel()
+
+    async def SubscribeMessages(self, request_iterator, context):
+        """Subscribe user to receive messages acknowledged by the client.
+        Acks are read by a separate task, acknowledged messages are
+        deleted from the storage. Messages come from the queue watch in
+        all delivery modes, the forward mode streams the stored values.
+        """
+        try:
+            request = await request_iterator.__anext__()
+        except StopAsyncIteration:
+            request = None
+        if request is None or request.WhichOneof('request') != 'subscribe':
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                SUBSCRIBE_FIRST_DETAILS)
+
+        login = request.subscribe.login
+        await self._resume(request.subscribe)
+
+        acknowledger = AsyncMessageAcknowledger()
+        reader = asyncio.ensure_future(
+            self._read_acks(request_iterator, login, acknowledger))
+        batches, cancel = self._watch_user_queue(login)
+
+        try:
+            async for message in self._iterate_acknowledged_messages(
+                    batches, acknowledger):
+                if self._delivery_mode == DELIVERY_MODE_FORWARD:
+                    yield message.value
+                else:
+                    yield message_to_proto(message)
+        finally:
+            cancel()
+            reader.cancel()
+
+    async def Chat(self, request_iterator, context):
+        """Chat as the subscribed user over one stream. Requests are read
+        by a separate task storing sent messages and deleting
+        acknowledged ones, received messages are read by another one.
+        Both put their responses to the queue streamed by the RPC.
+        """
+        try:
+            request = await request_iterator.__anext__()
+        except StopAsyncIteration:
+            request = None
+        if request is None or request.WhichOneof('request') != 'subscribe':
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                SUBSCRIBE_FIRST_DETAILS)
+
+        login = request.subscribe.login
+        await self._resume(request.subscribe)
+
+        acknowledger = AsyncMessageAcknowledger()
+        responses = asyncio.Queue()
+        reader = asyncio.ensure_future(self._read_chat_requests(
+            request_iterator, login, acknowledger, responses))
+        receiver = asyncio.ensure_future(self._receive_chat_messages(
+            login, acknowledger, responses))
+
+        try:
+            while True:
+                response = await responses.get()
+                if response is None:
+                    return
+                if isinstance(response, Exception):
+                    await context.abort(
+                        grpc.StatusCode.ABORTED,
+                        CHAT_SEND_FAILED_DETAILS.format(response))
+
+                yield response
+        finally:
+            reader.cancel()
+            receiver.cancel()
+
+    async def _read_acks(self, request_iterator, login, acknowledger):
+        """Deletes acknowledged messages until the client stops acking"""
+        try:
+            async for request in request_iterator:
+                if request.WhichOneof('request') != 'ack':
+                    continue
+
+                await self._ack(login, acknowledger, request.ack)
+        finally:
+            acknowledger.close()
+
+    async def _read_chat_requests(self, request_iterator, login,
+                                  acknowledger, responses):
+        """Stores sent messages and deletes acknowledged ones until the
+        client stops sending. A storage failure is passed to the stream.
+        """
+        try:
+            async for request in request_iterator:
+                kind = request.WhichOneof('request')
+                if kind == 'ack':
+                    await self._ack(login, acknowledger, request.ack)
+                elif kind == 'message':
+                    message = Message(login, request.message.recipient,
+                                      request.message.body)
+                    try:
+                        await self._send(message)
+                    except Exception as error:
+                        responses.put_nowait(error)
+                        return
+
+                    responses.put_nowait(simple_chat_pb2.ChatResponse(
+                        sent=message_to_proto(message)))
+        finally:
+            acknowledger.close()
+
+    async def _receive_chat_messages(self, login, acknowledger, responses):
+        """Puts messages received by the chat user to the stream, the
+        stream ends with them
+        """
+        batches, cancel = self._watch_user_queue(login)
+        try:
+            async for message in self._iterate_acknowledged_messages(
+                    batches, acknowledger):
+                if self._delivery_mode == DELIVERY_MODE_FORWARD:
+                    responses.put_nowait(serialize_chat_message(message.value))
+                else:
+                    responses.put_nowait(simple_chat_pb2.ChatResponse(
+                        message=message_to_proto(message)))
+        finally:
+            cancel()
+            responses.put_nowait(None)
+
+    def _watch_user_queue(self, login):
+        """Watches the user queue, the forward mode watches stored
+        messages. Messages come from the watch in all delivery modes.
+        """
+        if self._delivery_mode == DELIVERY_MODE_FORWARD:
+            return self._storage.watch_user_queue_stored_messages(login)
+        return self._storage.watch_user_queue_messages(login)
+
+    @staticmethod
+    async def _iterate_acknowledged_messages(batches, acknowledger):
+        """Yields messages of the batches while the ack window has room"""
+        async for messages in batches:
+            for message in messages:
+                if not await acknowledger.wait_for_room_async():
+                    return
+
+                # re-read after a re-sync while waiting for its ack
+                if not acknowledger.add(message.message_id):
+                    continue
+
+                yield message
+
+    async def _send(self, message):
+        """Stores sent message like the threaded servicer"""
+        if self._is_local_delivery:
+            await self._storage.send_message(message)
+        else:
+            await self._storage.put_message(message)
+
+    async def _ack(self, login, acknowledger, ack):
+        """Deletes messages covered by the ack"""
+        acked = acknowledger.ack(ack.message_id)
+        if acked:
+            await self._storage.delete_user_queue_message_ids(login, acked)
+
+    async def _resume(self, request):
+        """Deletes messages the reconnected client has already received"""
+        if request.resume_after:
+            await self._storage.delete_user_queue_messages_until(
+                request.login, request.resume_after)
+
+    async def _poll_user_queue_messages(self, login):
+        """Reads the user queue page by page once per polling interval"""
+        while True:
+            async for messages in self._storage.iterate_user_queue_messages(
+                    login):
+                yield messages
+
+            await asyncio.sleep(POLLING_INTERVAL)
+
+
+class AsyncStreamLimitInterceptor(grpc.aio.ServerInterceptor):
+    """Refuses response streams over the limit with RESOURCE_EXHAUSTED"""
+
+    def __init__(self, max_streams: int):
+        self.limiter = StreamLimiter(max_streams)
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or not handler.response_streaming:
+            return handler
+
+        if handler.request_streaming:
+            return handler._replace(
+                stream_stream=self._limit(handler.stream_stream))
+        return handler._replace(
+            unary_stream=self._limit(handler.unary_stream))
+
+    def _limit(self, behavior):
+        async def limited_behavior(request, context):
+            if not self.limiter.acquire():
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                                    STREAMS_EXHAUSTED_DETAILS)
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            finally:
+                self.limiter.release()
+
+        return limited_behavior
+
+
+def create_aio_server(server_address: str, storage: AsyncStorage,
+                      is_enable_reflection: bool = False,
+                      delivery_mode: str = DELIVERY_MODE_WATCH,
+                      user_directory: Optional[UserDirectory] = None,
+                      is_local_delivery: bool = False,
+                      options: Optional[ServerOptions] = None,
+                      metrics: Optional[ChatMetrics] = None,
+                      slow_call_log: Optional[SlowCallLog] = None
+                      ) -> grpc.aio.Server:
+    """Create asyncio server, must be called from the event loop.
+    Calls hold no thread here, unary_workers of the options is not used.
+    Given metrics, RPCs are measured, given slow-call log, slow RPCs are
+    logged.
+    """
+    options = options or ServerOptions()
+    interceptors = [AsyncStreamLimitInterceptor(options.max_streams)]
+    if slow_call_log is not None:
+        interceptors.insert(0, AsyncSlowCallInterceptor(slow_call_log))
+    if metrics is not None:
+        interceptors.insert(0, AsyncMetricsInterceptor(metrics))
+    server = grpc.aio.server(
+        interceptors=interceptors,
+        options=options.get_grpc_options(),
+        maximum_concurrent_rpcs=options.get_maximum_concurrent_rpcs())
+
+    add_servicer_to_server(
+        AsyncSimpleChatServicer(storage, delivery_mode, user_directory,
+                                is_local_delivery),
+        server)
+
+    if is_enable_reflection:
+        enable_reflection(server)
+
+    server.add_insecure_port(server_address)
+    return server
+
+
+async def serve(server_address: str, storage: BaseStorage,
+                is_enable_reflection: bool = False,
+                delivery_mode: str = DELIVERY_MODE_WATCH,
+                is_local_delivery: bool = False,
+                options: Optional[ServerOptions] = None,
+                metrics: Optional[ChatMetrics] = None,
+                slow_call_log: Optional[SlowCallLog] = None):
+    """Runs asyncio server until termination"""
+    async_storage = AsyncStorage(storage)
+    if metrics is not None:
+        metrics.watch_executor('storage', async_storage._executor)
+    user_directory = UserDirectory(storage)
+    server = create_aio_server(server_address, async_storage,
+                               is_enable_reflection, delivery_mode,
+                               user_directory, is_local_delivery, options,
+                               metrics, slow_call_log)
+    await server.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        user_directory.close()
+        async_storage.close()
@@ -1,5 +1,10 @@
 """Simple chat application for client"""
 import argparse
+import json
+import queue
+import sys
+import threading
+import time
 
 import grpc
 from google.protobuf.internal.well_known_types import Timestamp
@@ -7,6 +12,10 @@ from google.protobuf.internal.well_known_types import Timestamp
 import simple_chat_pb2
 import simple_chat_pb2_grpc
 
+USERS_PAGE_SIZE = 100
+# seconds between attempts to renew a broken subscription
+RECONNECT_INTERVAL = 1
+
 
 def create_arg_parser():
     """Creates and returns the ArgumentParser object"""
@@ -16,19 +25,54 @@ def create_arg_parser():
     parser.add_argument('-p', '--port', help='Port of the server', type=int,
                         default=50052)
     parser.add_argument('method', help='Type of the method', type=str,
-                        choices=['users', 'send', 'receive'])
+                        choices=['users', 'send', 'send-batch', 'receive',
+                                 'chat', 'history'])
     parser.add_argument('-s', '--sender', help='Sender login', type=str)
     parser.add_argument('-r', '--recipient', help='Recipient login', type=str)
     parser.add_argument('-b', '--body', help='Message body', type=str)
+    parser.add_argument('-f', '--file', help='File with messages to send in '
+                        'batch, one JSON object per line with "recipient", '
+                        '"body" and optional "sender" fields. '
+                        'Standard input is read by default', type=str,
+                        default='-')
+    parser.add_argument('--page-size', help='Number of users or history '
+                        'messages requested at once', type=int,
+                        default=USERS_PAGE_SIZE)
+    parser.add_argument('--login-prefix', help='List users whose login '
+                        'starts with the prefix', type=str, default='')
+    parser.add_argument('--name-prefix', help='List users whose full name '
+                        'starts with the prefix', type=str, default='')
+    parser.add_argument('--resume-after', help='Id of the last message '
+                        'received before, the messages up to it are not '
+                        'received again', type=str, default='')
 
     return parser
 
 
-def get_users(stub):
-    """Get list of users"""
-    response = stub.GetUsers(simple_chat_pb2.GetUsersRequest())
+def iterate_users(stub, page_size=USERS_PAGE_SIZE, login_prefix='',
+                  name_prefix=''):
+    """Yields users requesting the next page only when the previous one
+    has been consumed
+    """
+    page_token = ''
+    while True:
+        response = stub.GetUsers(simple_chat_pb2.GetUsersRequest(
+            page_size=page_size,
+            page_token=page_token,
+            login_prefix=login_prefix,
+            name_prefix=name_prefix))
+
+        yield from response.users
+
+        page_token = response.next_page_token
+        if not page_token:
+            return
+
 
-    for user in response.users:
+def get_users(stub, page_size=USERS_PAGE_SIZE, login_prefix='',
+              name_prefix=''):
+    """Get list of users"""
+    for user in iterate_users(stub, page_size, login_prefix, name_prefix):
         print("User login: {}. "
               "User full name: {}".format(user.login, user.full_name))
 
@@ -53,35 +97,206 @@ def send_message(stub, sender, recipient, body):
     print("Message was sent")
 
 
+def read_batch_messages(lines, sender=None):
+    """Parses messages to send from JSON lines, the sender field
+    falls back to given sender login
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+
+        data = json.loads(line)
+        message = simple_chat_pb2.Message(
+            sender=data.get('sender', sender),
+            recipient=data.get('recipient'),
+            body=data.get('body'))
+        validate_send_message_data(message.sender, message.recipient,
+                                   message.body)
+
+        yield simple_chat_pb2.SendMessageRequest(message=message)
+
+
+def send_messages(stub, sender, file_path):
+    """Sends messages read from file or standard input in one
+    client stream
+    """
+    if file_path == '-':
+        response = stub.SendMessageStream(
+            read_batch_messages(sys.stdin, sender))
+    else:
+        with open(file_path, 'r') as f:
+            response = stub.SendMessageStream(read_batch_messages(f, sender))
+
+    print("{} messages were sent".format(response.count))
+
+
 def validate_receive_messages_data(recipient):
     """Validation that all necessary data is given"""
     if not recipient:
         raise ValueError('Recipient has not been received')
 
 
-def receive_messages(stub, recipient):
-    """Subscribe client to receive messages """
+def subscribe_messages(stub, recipient, resume_after=''):
+    """Yields messages of the acknowledged subscription, a message is
+    acknowledged when the next one is requested
+    """
+    requests = queue.Queue()
+    requests.put(simple_chat_pb2.SubscribeMessagesRequest(
+        subscribe=simple_chat_pb2.ReceiveMessagesRequest(
+            login=recipient, resume_after=resume_after)))
+    responses = stub.SubscribeMessages(iter(requests.get, None))
+
+    try:
+        for message in responses:
+            yield message
+
+            requests.put(simple_chat_pb2.SubscribeMessagesRequest(
+                ack=simple_chat_pb2.MessagesAck(message_id=message.id)))
+    finally:
+        requests.put(None)
+        responses.cancel()
+
+
+def print_message(message):
+    """Prints received message"""
+    print("From: {}. \nTo: {}. \nTime: {}. \n"
+          "Message: '{}'.\n".format(
+              message.sender,
+              message.recipient,
+              Timestamp.ToDatetime(message.created),
+              message.body))
+
+
+def receive_messages(stub, recipient, resume_after=''):
+    """Subscribe client to receive messages. Printed messages are
+    acknowledged, and a subscription broken by the network is renewed
+    after the last received message
+    """
     validate_receive_messages_data(recipient)
 
-    messages = stub.ReceiveMessages(
-        simple_chat_pb2.ReceiveMessagesRequest(login=recipient))
+    while True:
+        try:
+            for message in subscribe_messages(stub, recipient, resume_after):
+                print_message(message)
+                resume_after = message.id
+            return
+        except grpc.RpcError as error:
+            if error.code() != grpc.StatusCode.UNAVAILABLE:
+                raise
+            time.sleep(RECONNECT_INTERVAL)
+
+
+def validate_chat_data(sender, recipient):
+    """Validates that all necessary data is given"""
+    if not sender or not recipient:
+        raise ValueError('The following fields are required: '
+                         '"sender", "recipient"')
+
+
+def iterate_history(stub, login, peer, page_size=USERS_PAGE_SIZE):
+    """Yields messages between the users, the newest first, requesting
+    the next page only when the previous one has been consumed
+    """
+    page_token = ''
+    while True:
+        response = stub.GetHistory(simple_chat_pb2.GetHistoryRequest(
+            login=login,
+            peer=peer,
+            page_size=page_size,
+            page_token=page_token))
+
+        yield from response.messages
+
+        page_token = response.next_page_token
+        if not page_token:
+            return
+
+
+def get_history(stub, sender, recipient, page_size=USERS_PAGE_SIZE):
+    """Prints messages between the sender and the recipient, the newest
+    first
+    """
+    validate_chat_data(sender, recipient)
+
+    for message in iterate_history(stub, sender, recipient, page_size):
+        print_message(message)
+
+
+def send_chat_lines(lines, sender, recipient, requests, confirmations,
+                    responses):
+    """Sends not empty lines as chat messages, the chat is ended once
+    all of them are confirmed as stored
+    """
+    count = 0
+    for line in lines:
+        body = line.strip()
+        if not body:
+            continue
+
+        requests.put(simple_chat_pb2.ChatRequest(
+            message=simple_chat_pb2.Message(
+                sender=sender,
+                recipient=recipient,
+                body=body)))
+        count += 1
+
+    for _ in range(count):
+        confirmations.get()
+    responses.cancel()
+
+
+def chat(stub, sender, recipient, resume_after='', lines=None):
+    """Chat as the sender with the recipient over one stream. Lines of
+    the standard input are sent to the recipient, messages received
+    meanwhile are printed and acknowledged. The chat ends with the input
+    """
+    validate_chat_data(sender, recipient)
+
+    requests = queue.Queue()
+    requests.put(simple_chat_pb2.ChatRequest(
+        subscribe=simple_chat_pb2.ReceiveMessagesRequest(
+            login=sender, resume_after=resume_after)))
+    responses = stub.Chat(iter(requests.get, None))
+
+    confirmations = queue.Queue()
+    threading.Thread(target=send_chat_lines,
+                     args=(sys.stdin if lines is None else lines, sender,
+                           recipient, requests, confirmations, responses),
+                     daemon=True).start()
+
+    try:
+        for response in responses:
+            if response.WhichOneof('response') == 'sent':
+                confirmations.put(response.sent)
+                continue
 
-    for message in messages:
-        print("From: {}. \nTo: {}. \nTime: {}. \nMessage: '{}'.\n".format(
-            message.sender,
-            message.recipient,
-            Timestamp.ToDatetime(message.created),
-            message.body))
+            print_message(response.message)
+            requests.put(simple_chat_pb2.ChatRequest(
+                ack=simple_chat_pb2.MessagesAck(
+                    message_id=response.message.id)))
+    except grpc.RpcError as error:
+        # cancelled when the input has ended
+        if error.code() != grpc.StatusCode.CANCELLED:
+            raise
+    finally:
+        requests.put(None)
+        responses.cancel()
 
 
 def submit_request(stub, data):
     """Defining what request will be submitted"""
     if data.method == 'users':
-        get_users(stub)
+        get_users(stub, data.page_size, data.login_prefix, data.name_prefix)
     elif data.method == 'send':
         send_message(stub, data.sender, data.recipient, data.body)
+    elif data.method == 'send-batch':
+        send_messages(stub, data.sender, data.file)
     elif data.method == 'receive':
-        receive_messages(stub, data.recipient)
+        receive_messages(stub, data.recipient, data.resume_after)
+    elif data.method == 'chat':
+        chat(stub, data.sender, data.recipient, data.resume_after)
+    elif data.method == 'history':
+        get_history(stub, data.sender, data.recipient, data.page_size)
 
 
 def get_parsed_args():
@@ -0,0 +1,490 @@
+"""In-process etcd stand-in that speaks the etcd v3 gRPC API.
+
+It implements the subset of the KV, Watch and Lease services that the
+chat storage uses, so `etcd3.client` can talk to it unchanged. It is meant
+for benchmarks and local runs without an etcd cluster, it keeps no MVCC
+history beyond a short event log and it is not durable.
+"""
+import argparse
+import bisect
+import collections
+import itertools
+import queue
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from etcd3 import etcdrpc
+from etcd3.etcdrpc import kv_pb2
+
+WATCH_HISTORY_SIZE = 100000
+# etcd --max-txn-ops default
+MAX_TXN_OPS = 128
+LEASE_CHECK_INTERVAL = 0.2
+
+
+def _in_range(key: bytes, range_start: bytes, range_end: bytes) -> bool:
+    """Checks key against an etcd [range_start, range_end) interval"""
+    if not range_end:
+        return key == range_start
+    if range_end == b'\x00':
+        return key >= range_start
+    return range_start <= key < range_end
+
+
+class _Watcher:
+    """Single watch registered on a watch stream"""
+
+    def __init__(self, watch_id, stream, range_start, range_end, prev_kv):
+        self.watch_id = watch_id
+        self.stream = stream
+        self.range_start = range_start
+        self.range_end = range_end
+        self.prev_kv = prev_kv
+
+
+class EtcdStandIn(etcdrpc.KVServicer, etcdrpc.WatchServicer,
+                  etcdrpc.LeaseServicer, etcdrpc.MaintenanceServicer,
+                  etcdrpc.ClusterServicer):
+    """Keeps keys in memory and serves them through the etcd gRPC API"""
+
+    def __init__(self, latency: float = 0.0,
+                 max_txn_ops: int = MAX_TXN_OPS):
+        self.latency = latency
+        self.max_txn_ops = max_txn_ops
+        self.counters = collections.Counter()
+
+        self._lock = threading.Lock()
+        self._revision = 1
+        self._kvs = {}
+        self._keys = []
+        self._history = collections.deque(maxlen=WATCH_HISTORY_SIZE)
+        self._watchers = {}
+        self._watch_ids = itertools.count(1)
+        self._leases = {}
+        self._lease_ids = itertools.count(1)
+        self._server = None
+        self._closed = threading.Event()
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def start(self, host: str = '127.0.0.1', port: int = 0,
+              max_workers: int = 64) -> int:
+        """Starts serving and returns the bound port"""
+        self._server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=max_workers))
+        etcdrpc.add_KVServicer_to_server(self, self._server)
+        etcdrpc.add_WatchServicer_to_server(self, self._server)
+        etcdrpc.add_LeaseServicer_to_server(self, self._server)
+        etcdrpc.add_MaintenanceServicer_to_server(self, self._server)
+        etcdrpc.add_ClusterServicer_to_server(self, self._server)
+        bound_port = self._server.add_insecure_port(
+            '{}:{}'.format(host, port))
+        self._server.start()
+
+        threading.Thread(target=self._expire_leases, daemon=True).start()
+        return bound_port
+
+    def stop(self):
+        """Stops serving and wakes all watch streams"""
+        self._closed.set()
+        with self._lock:
+            streams = {w.stream for w in self._watchers.values()}
+        for stream in streams:
+            stream.put(None)
+        if self._server is not None:
+            self._server.stop(0)
+
+    # -- helpers -----------------------------------------------------------
+
+    def _header(self):
+        return etcdrpc.ResponseHeader(cluster_id=1, member_id=1,
+                                      revision=self._revision, raft_term=1)
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _range_keys(self, range_start: bytes, range_end: bytes):
+        if not range_end:
+            return [range_start] if range_start in self._kvs else []
+        left = bisect.bisect_left(self._keys, range_start)
+        if range_end == b'\x00':
+            return self._keys[left:]
+        right = bisect.bisect_left(self._keys, range_end)
+        return self._keys[left:right]
+
+    def _range(self, request):
+        keys = self._range_keys(request.key, request.range_end)
+        if request.sort_order == etcdrpc.RangeRequest.DESCEND:
+            keys = list(reversed(keys))
+
+        response = etcdrpc.RangeResponse(header=self._header(),
+                                         count=len(keys))
+        if request.count_only:
+            return response
+
+        if request.limit and len(keys) > request.limit:
+            keys = keys[:request.limit]
+            response.more = True
+
+        for key in keys:
+            kv = response.kvs.add()
+            kv.CopyFrom(self._kvs[key])
+            if request.keys_only:
+                kv.ClearField('value')
+        return response
+
+    def _put(self, request, revision, events):
+        if request.lease and request.lease not in self._leases:
+            raise KeyError('requested lease not found')
+
+        previous = self._kvs.get(request.key)
+        kv = kv_pb2.KeyValue(
+            key=request.key, value=request.value, mod_revision=revision,
+            create_revision=previous.create_revision if previous else revision,
+            version=previous.version + 1 if previous else 1,
+            lease=request.lease)
+        if previous is None:
+            bisect.insort(self._keys, request.key)
+        elif previous.lease and previous.lease in self._leases:
+            self._leases[previous.lease]['keys'].discard(request.key)
+        if request.lease:
+            self._leases[request.lease]['keys'].add(request.key)
+
+        self._kvs[request.key] = kv
+        events.append(kv_pb2.Event(type=kv_pb2.Event.PUT, kv=kv,
+                                   prev_kv=previous))
+
+        response = etcdrpc.PutResponse()
+        if request.prev_kv and previous is not None:
+            response.prev_kv.CopyFrom(previous)
+        return response
+
+    def _delete(self, request, revision, events):
+        keys = self._range_keys(request.key, request.range_end)
+        response = etcdrpc.DeleteRangeResponse(deleted=len(keys))
+        for key in keys:
+            previous = self._kvs.pop(key)
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            if previous.lease in self._leases:
+                self._leases[previous.lease]['keys'].discard(key)
+            if request.prev_kv:
+                response.prev_kvs.add().CopyFrom(previous)
+            events.append(kv_pb2.Event(
+                type=kv_pb2.Event.DELETE, prev_kv=previous,
+                kv=kv_pb2.KeyValue(key=key, mod_revision=revision)))
+        return response
+
+    def _compare(self, compare) -> bool:
+        kv = self._kvs.get(compare.key)
+        target = compare.target
+        if target == etcdrpc.Compare.VALUE:
+            left, right = (kv.value if kv else None), compare.value
+            if left is None:
+                return False
+        elif target == etcdrpc.Compare.VERSION:
+            left, right = (kv.version if kv else 0), compare.version
+        elif target == etcdrpc.Compare.CREATE:
+            left, right = (kv.create_revision if kv else 0), \
+                compare.create_revision
+        elif target == etcdrpc.Compare.MOD:
+            left, right = (kv.mod_revision if kv else 0), compare.mod_revision
+        else:
+            left, right = (kv.lease if kv else 0), compare.lease
+
+        result = compare.result
+        if result == etcdrpc.Compare.EQUAL:
+            return left == right
+        if result == etcdrpc.Compare.NOT_EQUAL:
+            return left != right
+        if result == etcdrpc.Compare.LESS:
+            return left < right
+        return left > right
+
+    def _check_txn(self, request):
+        """Rejects transactions that etcd rejects before applying them"""
+        for ops in (request.compare, request.success, request.failure):
+            if len(ops) > self.max_txn_ops:
+                raise ValueError('etcdserver: too many operations in txn '
+                                 'request')
+
+        for ops in (request.success, request.failure):
+            put_keys = set()
+            deleted = []
+            for op in ops:
+                kind = op.WhichOneof('request')
+                if kind == 'request_put':
+                    if op.request_put.key in put_keys:
+                        raise ValueError('etcdserver: duplicate key given in '
+                                         'txn request')
+                    put_keys.add(op.request_put.key)
+                elif kind == 'request_delete_range':
+                    deleted.append(op.request_delete_range)
+                elif kind == 'request_txn':
+                    self._check_txn(op.request_txn)
+
+            for delete in deleted:
+                if any(_in_range(key, delete.key, delete.range_end)
+                       for key in put_keys):
+                    raise ValueError('etcdserver: duplicate key given in '
+                                     'txn request')
+
+    def _txn(self, request, revision, events):
+        succeeded = all(self._compare(c) for c in request.compare)
+        response = etcdrpc.TxnResponse(succeeded=succeeded)
+        for op in (request.success if succeeded else request.failure):
+            kind = op.WhichOneof('request')
+            if kind == 'request_range':
+                response.responses.add(
+                    response_range=self._range(op.request_range))
+            elif kind == 'request_put':
+                response.responses.add(response_put=self._put(
+                    op.request_put, revision, events))
+            elif kind == 'request_delete_range':
+                response.responses.add(
+                    response_delete_range=self._delete(
+                        op.request_delete_range, revision, events))
+            else:
+                response.responses.add(response_txn=self._txn(
+                    op.request_txn, revision, events))
+        return response
+
+    def _mutate(self, apply, request):
+        """Applies a write under one new revision and notifies watchers"""
+        events = []
+        with self._lock:
+            revision = self._revision + 1
+            response = apply(request, revision, events)
+            if events:
+                self._revision = revision
+                self._history.extend(events)
+                self._notify(events)
+            response.header.CopyFrom(self._header())
+        return response
+
+    def _notify(self, events):
+        by_watcher = collections.defaultdict(list)
+        for event in events:
+            for watcher in self._watchers.values():
+                if _in_range(event.kv.key, watcher.range_start,
+                             watcher.range_end):
+                    by_watcher[watcher].append(event)
+
+        for watcher, watcher_events in by_watcher.items():
+            self.counters['watch_events'] += len(watcher_events)
+            response = etcdrpc.WatchResponse(header=self._header(),
+                                             watch_id=watcher.watch_id)
+            for event in watcher_events:
+                added = response.events.add()
+                added.CopyFrom(event)
+                if not watcher.prev_kv:
+                    added.ClearField('prev_kv')
+            watcher.stream.put(response)
+
+    def _expire_leases(self):
+        while not self._closed.wait(LEASE_CHECK_INTERVAL):
+            now = time.monotonic()
+            with self._lock:
+                expired = [lease_id for lease_id, lease in self._leases.items()
+                           if lease['deadline'] <= now]
+            for lease_id in expired:
+                self._revoke(lease_id)
+
+    def _revoke(self, lease_id):
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+        if not lease:
+            return
+        for key in sorted(lease['keys']):
+            self._mutate(self._delete, etcdrpc.DeleteRangeRequest(key=key))
+
+    # -- KV ----------------------------------------------------------------
+
+    def Range(self, request, context):
+        self.counters['range'] += 1
+        self._delay()
+        with self._lock:
+            return self._range(request)
+
+    def Put(self, request, context):
+        self.counters['put'] += 1
+        self._delay()
+        try:
+            return self._mutate(self._put, request)
+        except KeyError as error:
+            context.abort(grpc.StatusCode.NOT_FOUND, str(error))
+
+    def DeleteRange(self, request, context):
+        self.counters['delete_range'] += 1
+        self._delay()
+        return self._mutate(self._delete, request)
+
+    def Txn(self, request, context):
+        self.counters['txn'] += 1
+        self._delay()
+        try:
+            self._check_txn(request)
+        except ValueError as error:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        try:
+            return self._mutate(self._txn, request)
+        except KeyError as error:
+            context.abort(grpc.StatusCode.NOT_FOUND, str(error))
+
+    def Compact(self, request, context):
+        self.counters['compact'] += 1
+        return etcdrpc.CompactionResponse(header=self._header())
+
+    # -- Watch -------------------------------------------------------------
+
+    def Watch(self, request_iterator, context):
+        self.counters['watch_streams'] += 1
+        stream = queue.Queue()
+        owned = []
+
+        def read_requests():
+            try:
+                for request in request_iterator:
+                    if request.HasField('create_request'):
+                        owned.append(self._create_watch(
+                            stream, request.create_request))
+                    elif request.HasField('cancel_request'):
+                        self._cancel_watch(stream,
+                                           request.cancel_request.watch_id)
+            except grpc.RpcError:
+                pass
+            stream.put(None)
+
+        threading.Thread(target=read_requests, daemon=True).start()
+        try:
+            while context.is_active():
+                response = stream.get()
+                if response is None:
+                    break
+                yield response
+        finally:
+            with self._lock:
+                for watch_id in owned:
+                    self._watchers.pop(watch_id, None)
+
+    def _create_watch(self, stream, create):
+        self.counters['watches'] += 1
+        with self._lock:
+            watch_id = next(self._watch_ids)
+            start = create.start_revision
+            oldest = self._history[0].kv.mod_revision if self._history \
+                else self._revision + 1
+            if start and start < oldest and start <= self._revision:
+                stream.put(etcdrpc.WatchResponse(
+                    header=self._header(), watch_id=watch_id, created=True,
+                    compact_revision=oldest))
+                return watch_id
+
+            watcher = _Watcher(watch_id, stream, create.key,
+                               create.range_end, create.prev_kv)
+            stream.put(etcdrpc.WatchResponse(header=self._header(),
+                                             watch_id=watch_id, created=True))
+            if start and start <= self._revision:
+                self._replay(watcher, start)
+            self._watchers[watch_id] = watcher
+        return watch_id
+
+    def _replay(self, watcher, start_revision):
+        response = None
+        for event in self._history:
+            if event.kv.mod_revision < start_revision or not _in_range(
+                    event.kv.key, watcher.range_start, watcher.range_end):
+                continue
+            if response is None or \
+                    response.events[0].kv.mod_revision != \
+                    event.kv.mod_revision:
+                if response is not None:
+                    watcher.stream.put(response)
+                response = etcdrpc.WatchResponse(header=self._header(),
+                                                 watch_id=watcher.watch_id)
+            response.events.add().CopyFrom(event)
+        if response is not None:
+            watcher.stream.put(response)
+
+    def _cancel_watch(self, stream, watch_id):
+        with self._lock:
+            self._watchers.pop(watch_id, None)
+        stream.put(etcdrpc.WatchResponse(header=self._header(),
+                                         watch_id=watch_id, canceled=True))
+
+    # -- Lease -------------------------------------------------------------
+
+    def LeaseGrant(self, request, context):
+        self.counters['lease_grant'] += 1
+        with self._lock:
+            lease_id = request.ID or next(self._lease_ids)
+            self._leases[lease_id] = {
+                'ttl': request.TTL, 'keys': set(),
+                'deadline': time.monotonic() + request.TTL}
+            return etcdrpc.LeaseGrantResponse(header=self._header(),
+                                              ID=lease_id, TTL=request.TTL)
+
+    def LeaseRevoke(self, request, context):
+        self.counters['lease_revoke'] += 1
+        self._revoke(request.ID)
+        return etcdrpc.LeaseRevokeResponse(header=self._header())
+
+    def LeaseKeepAlive(self, request_iterator, context):
+        for request in request_iterator:
+            self.counters['lease_keepalive'] += 1
+            with self._lock:
+                lease = self._leases.get(request.ID)
+                ttl = 0
+                if lease:
+                    lease['deadline'] = time.monotonic() + lease['ttl']
+                    ttl = lease['ttl']
+                yield etcdrpc.LeaseKeepAliveResponse(
+                    header=self._header(), ID=request.ID, TTL=ttl)
+
+    def LeaseTimeToLive(self, request, context):
+        with self._lock:
+            lease = self._leases.get(request.ID)
+            if not lease:
+                return etcdrpc.LeaseTimeToLiveResponse(
+                    header=self._header(), ID=request.ID, TTL=-1)
+            return etcdrpc.LeaseTimeToLiveResponse(
+                header=self._header(), ID=request.ID,
+                TTL=int(lease['deadline'] - time.monotonic()),
+                grantedTTL=lease['ttl'],
+                keys=sorted(lease['keys']) if request.keys else [])
+
+    # -- Maintenance and cluster -------------------------------------------
+
+    def Status(self, request, context):
+        return etcdrpc.StatusResponse(header=self._header(),
+                                      version='3.5.0-stand-in', leader=1)
+
+    def MemberList(self, request, context):
+        return etcdrpc.MemberListResponse(
+            header=self._header(),
+            members=[etcdrpc.Member(ID=1, name='stand-in')])
+
+
+def get_parsed_args():
+    parser = argparse.ArgumentParser(description='In-process etcd stand-in')
+    parser.add_argument('-H', '--host', help='Host to bind', type=str,
+                        default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port to bind', type=int,
+                        default=2379)
+    parser.add_argument('--latency', help='Simulated KV call latency in '
+                        'seconds', type=float, default=0.0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parsed_args()
+    stand_in = EtcdStandIn(latency=args.latency)
+    stand_in.start(args.host, args.port)
+    print("etcd stand-in listening on {}:{}".format(args.host, args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stand_in.stop()
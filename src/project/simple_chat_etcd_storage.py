@@ -1,16 +1,82 @@
 """The class implementation that work with key-value storage"""
+import abc
+import collections
+import functools
+import itertools
 import json
+import logging
+import math
+import secrets
+import threading
 import time
+from concurrent import futures
 from dataclasses import dataclass, field, asdict
-from typing import List
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import etcd3
+import grpc
+from etcd3 import etcdrpc
+from etcd3.client import _handle_errors
+from etcd3.events import PutEvent
+from etcd3.utils import increment_last_byte
+
+import simple_chat_pb2
 
 
 STORAGE_USER_KEY = 'user/{user_id}'
 STORAGE_USER_MESSAGE_QUEUE_KEY = 'message/queue/user/{user_id}/{message_id}'
 STORAGE_USER_PREFIX_KEY = 'user/'
-STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY = 'message/queue/user/{user_id}'
+STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY = 'message/queue/user/{user_id}/'
+STORAGE_MESSAGE_QUEUE_PREFIX_KEY = 'message/queue/user/'
+STORAGE_USER_NAME_INDEX_KEY = 'index/user/name/{name}/{user_id}'
+STORAGE_USER_NAME_INDEX_PREFIX_KEY = 'index/user/name/'
+STORAGE_PRESENCE_KEY = 'presence/{user_id}/{node_id}'
+STORAGE_PRESENCE_PREFIX_KEY = 'presence/{user_id}/'
+# put next to a queued message for every node its recipient is subscribed
+# to, the revision is the one the message was stored at
+STORAGE_NODE_WAKE_KEY = \
+    'message/wake/{node_id}/{user_id}/{message_id}/{revision}'
+STORAGE_NODE_WAKE_PREFIX_KEY = 'message/wake/{node_id}/'
+# messages of a conversation are kept under the logins in sorted order and
+# their ids with complemented characters, so the newest come first
+STORAGE_HISTORY_KEY = 'history/{first_id}/{second_id}/{inverted_id}'
+STORAGE_HISTORY_PREFIX_KEY = 'history/{first_id}/{second_id}/'
+
+SUBSCRIPTION_BUFFER_SIZE = 1000
+# etcd rejects transactions with more operations (--max-txn-ops default)
+STORAGE_MAX_TXN_OPS = 128
+# queued messages are read in pages, one page is deleted with one txn
+QUEUE_PAGE_SIZE = STORAGE_MAX_TXN_OPS
+# users of one put_users transaction, a user takes up to three operations:
+# its record, its name index entry and the entry of its previous name
+USERS_TXN_SIZE = STORAGE_MAX_TXN_OPS // 3
+# threads storing messages already handed to subscribers in this process
+PERSIST_MAX_WORKERS = 8
+# seconds presence records outlive a node that stopped refreshing them
+PRESENCE_TTL = 10
+# seconds wake keys are kept, they are not deleted otherwise
+WAKE_TTL = 60
+# seconds writes of queued messages wait for others to share a transaction
+WRITE_BATCH_WINDOW = 0.002
+# history leases are granted this many times per history time to live, an
+# entry is kept for the time to live plus at most one such period
+HISTORY_LEASE_PERIODS = 10
+# seconds between removals of expired history entries by backends that
+# keep them without leases
+HISTORY_COMPACTION_INTERVAL = 60
+
+# etcd clients per endpoint, each has its own gRPC channel
+ETCD_POOL_SIZE = 1
+POOL_ROUND_ROBIN = 'round_robin'
+POOL_LEAST_LOADED = 'least_loaded'
+POOL_POLICIES = (POOL_ROUND_ROBIN, POOL_LEAST_LOADED)
+# seconds between health checks of pooled clients and to wait for one
+HEALTH_CHECK_INTERVAL = 5
+HEALTH_CHECK_TIMEOUT = 1
+# read by health checks like etcdctl endpoint health does
+HEALTH_CHECK_KEY = 'health'
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -34,23 +100,1158 @@ class Message:
     recipient: str
     body: str
     created: float = field(default_factory=lambda: time.time())
-
-    def get_unique_queue_message_key(self) -> str:
-        """Creating unique key value for message"""
-        return "{}{}{}".format(self.sender, self.created, self.recipient)
+    message_id: Optional[str] = None
 
     @staticmethod
     def from_dict(data: dict) -> 'Message':
         """Converts dict to object"""
         return Message(data['sender'], data['recipient'], data['body'],
-                       float(data['created']))
+                       float(data['created']), data.get('message_id'))
+
+
+class MessageIdGenerator:
+    """Generates ULID-like message ids: 26 Crockford base32 characters of
+    48-bit millisecond time followed by 80 random bits.
+
+    Ids of one generator are strictly increasing even within a millisecond
+    or when the clock goes back, the random part is incremented then.
+    Random bits keep ids of different processes apart, so keys made of
+    them never collide and sort in the order messages were stored.
+    """
+
+    ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+    LENGTH = 26
+    RANDOM_BITS = 80
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_time = 0
+        self._last_random = 0
+
+    def generate(self) -> str:
+        """Returns the next id"""
+        with self._lock:
+            now = time.time_ns() // 1000000
+            if now > self._last_time:
+                self._last_time = now
+                self._last_random = secrets.randbits(self.RANDOM_BITS)
+            else:
+                self._last_random += 1
+                if self._last_random >> self.RANDOM_BITS:
+                    self._last_time += 1
+                    self._last_random = 0
+            value = (self._last_time << self.RANDOM_BITS) | self._last_random
+
+        return self._encode(value, self.LENGTH)
+
+    @classmethod
+    def encode_time(cls, milliseconds: int) -> str:
+        """Returns the characters all ids generated at the millisecond
+        start with
+        """
+        return cls._encode(max(milliseconds, 0),
+                           cls.LENGTH - cls.RANDOM_BITS // 5)
+
+    @classmethod
+    def _encode(cls, value: int, length: int) -> str:
+        chars = []
+        for _ in range(length):
+            chars.append(cls.ALPHABET[value & 31])
+            value >>= 5
+        return ''.join(reversed(chars))
+
+
+INVERTED_ID_CHARS = str.maketrans(MessageIdGenerator.ALPHABET,
+                                  MessageIdGenerator.ALPHABET[::-1])
+
+
+def invert_message_id(message_id: str) -> str:
+    """Complements every id character, so later ids sort first. Inverted
+    id is inverted back to the id.
+    """
+    return message_id.translate(INVERTED_ID_CHARS)
+
+
+def get_history_prefix(login: str, peer: str) -> str:
+    """Prefix of history keys of the conversation of the two users"""
+    first_id, second_id = sorted((login, peer))
+    return STORAGE_HISTORY_PREFIX_KEY.format(first_id=first_id,
+                                             second_id=second_id)
+
+
+def get_history_key(message: Message) -> str:
+    """History key of the message with an id"""
+    first_id, second_id = sorted((message.sender, message.recipient))
+    return STORAGE_HISTORY_KEY.format(
+        first_id=first_id, second_id=second_id,
+        inverted_id=invert_message_id(message.message_id))
+
+
+def get_history_range(login: str, peer: str,
+                      start_time: Optional[float] = None,
+                      end_time: Optional[float] = None,
+                      start_key: Optional[str] = None) -> Tuple[str, str]:
+    """Range of history keys of the conversation, from the start key
+    and before the end key, with messages stored from the start time on
+    and before the end time. Ids tell stored time to the millisecond,
+    so messages of the millisecond of the start time are included.
+    Raises ValueError for a start key out of the conversation.
+    """
+    prefix = get_history_prefix(login, peer)
+    range_start = prefix
+    range_end = increment_last_byte(prefix.encode()).decode()
+    if end_time is not None:
+        range_start = prefix + invert_message_id(
+            MessageIdGenerator.encode_time(math.ceil(end_time * 1000) - 1))
+    if start_time is not None:
+        range_end = increment_last_byte((prefix + invert_message_id(
+            MessageIdGenerator.encode_time(math.floor(start_time * 1000))))
+            .encode()).decode()
+    if start_key is not None:
+        if not start_key.startswith(prefix):
+            raise ValueError('Page start key is out of the conversation')
+        range_start = max(range_start, start_key)
+
+    return range_start, range_end
+
+
+class PartialWriteError(Exception):
+    """Batch write failed, transactions of the first `stored` messages or
+    users had been committed before the failure
+    """
+
+    def __init__(self, stored: int, error: Exception):
+        super().__init__('{} items were stored before the error: '
+                         '{}'.format(stored, error))
+        self.stored = stored
+        self.error = error
+
+
+@dataclass
+class StoredMessage:
+    """Queued message as it is kept in the storage"""
+
+    key: str
+    value: bytes
+
+    @property
+    def message_id(self) -> str:
+        """Id of the message, the last part of its queue key"""
+        return self.key.rsplit('/', 1)[1]
+
+
+@dataclass
+class QueuePage:
+    """Page of a user queue: stored messages with their mod revisions,
+    the key the next page starts from, None for the last page, and the
+    storage revision the page was read at
+    """
+    messages: List[Tuple[int, StoredMessage]]
+    next_key: Optional[str]
+    revision: int
+
+
+class MessageCodec:
+    """Converts queued messages to stored values and back"""
+
+    name = None
+
+    def encode(self, message: Message) -> bytes:
+        """Converts message to the stored value"""
+        raise NotImplementedError
+
+    def decode(self, value: bytes) -> Message:
+        """Converts stored value to the message"""
+        raise NotImplementedError
+
+
+class JsonMessageCodec(MessageCodec):
+    """Stores messages as JSON objects, the original storage format"""
+
+    name = 'json'
+
+    def encode(self, message: Message) -> bytes:
+        return json.dumps(asdict(message)).encode()
+
+    def decode(self, value: bytes) -> Message:
+        return Message.from_dict(json.loads(value))
+
+
+class ProtobufMessageCodec(MessageCodec):
+    """Stores messages as serialized simple_chat_pb2.Message.
+
+    The created time is split into seconds and nanoseconds so that it is
+    read back as the same float. Values stored as JSON are still decoded,
+    a serialized message never starts with the '{' byte.
+    """
+
+    name = 'protobuf'
+
+    def __init__(self):
+        self._json_codec = JsonMessageCodec()
+
+    def encode(self, message: Message) -> bytes:
+        seconds = math.floor(message.created)
+        nanos = round((message.created - seconds) * 1e9)
+        if nanos == 10 ** 9:
+            seconds, nanos = seconds + 1, 0
+
+        stored_message = simple_chat_pb2.Message(
+            sender=message.sender,
+            recipient=message.recipient,
+            body=message.body,
+            id=message.message_id)
+        stored_message.created.seconds = seconds
+        stored_message.created.nanos = nanos
+        return stored_message.SerializeToString()
+
+    @staticmethod
+    def is_json(value: bytes) -> bool:
+        """Checks if the value was stored by the JSON codec"""
+        return isinstance(value, str) or value[:1] == b'{'
+
+    def decode(self, value: bytes) -> Message:
+        if self.is_json(value):
+            return self._json_codec.decode(value)
+
+        stored_message = simple_chat_pb2.Message.FromString(value)
+        return Message(stored_message.sender, stored_message.recipient,
+                       stored_message.body,
+                       stored_message.created.seconds +
+                       stored_message.created.nanos / 1e9,
+                       stored_message.id or None)
+
+
+MESSAGE_CODECS = {codec.name: codec for codec in (JsonMessageCodec,
+                                                  ProtobufMessageCodec)}
+DEFAULT_MESSAGE_CODEC = ProtobufMessageCodec.name
+# stored values of this codec are sent to subscribers as they are
+WIRE_MESSAGE_CODEC = ProtobufMessageCodec()
+
+
+class QueueSubscription:
+    """In-process queue of messages for one subscribed user login.
+
+    The buffer is bounded. When the watch thread would overflow it, the
+    buffered messages are dropped and the subscription is marked for
+    re-sync: the next read drains the user queue from etcd page by page,
+    so a slow subscriber loses nothing and never blocks the watch.
+
+    Pages after the first one are read at later revisions, messages
+    stored meanwhile may come both with a page and from the watch. Keys
+    of such messages are kept until the watch passes the revision of the
+    last page, their watch copies are dropped.
+
+    Messages sent in this process may be handed over before they are
+    stored. Their keys are kept until the watch reports them stored, and
+    the stored copies are dropped.
+    """
+
+    def __init__(self, dispatcher: 'QueueWatchDispatcher', login: str,
+                 buffer_size: int, is_stored: bool = False):
+        self.login = login
+        self._dispatcher = dispatcher
+        self._buffer_size = buffer_size
+        self._is_stored = is_stored
+        self._buffer = collections.deque()
+        self._condition = threading.Condition()
+        self._revision = 0
+        self._backlog_revision = 0
+        self._backlog_keys: Set[str] = set()
+        self._local_keys: Set[str] = set()
+        self._resync = True
+        self._closed = False
+
+    def push(self, messages: List[Tuple[int, StoredMessage]]):
+        """Buffers messages received by the watch with their revisions"""
+        with self._condition:
+            if self._closed or self._resync:
+                return
+
+            if len(self._buffer) + len(messages) > self._buffer_size:
+                self._clear_buffer()
+                self._resync = True
+            else:
+                self._buffer.extend(messages)
+            self._wake()
+
+    def push_local(self, message: StoredMessage) -> bool:
+        """Buffers message sent in this process before it is stored.
+        False when the subscription can not take it now, the message
+        comes from the storage then.
+        """
+        with self._condition:
+            if self._closed or self._resync or \
+                    len(self._buffer) >= self._buffer_size:
+                return False
+
+            # handed over messages have no revision yet
+            self._buffer.append((None, message))
+            self._local_keys.add(message.key)
+            self._wake()
+            return True
+
+    def resync(self):
+        """Drops buffered messages and re-reads the queue on the next read"""
+        with self._condition:
+            self._clear_buffer()
+            self._resync = True
+            self._wake()
+
+    def close(self):
+        """Stops the iteration and detaches from the dispatcher"""
+        with self._condition:
+            self._closed = True
+            self._wake()
+        self._dispatcher.unsubscribe(self)
+
+    def _wake(self):
+        """Wakes the reader, called with the condition held"""
+        self._condition.notify()
+
+    def _clear_buffer(self):
+        """Drops buffered messages, called with the condition held.
+        Dropped handed over messages are read from the storage then.
+        """
+        self._local_keys.difference_update(
+            message.key for revision, message in self._buffer
+            if revision is None)
+        self._buffer.clear()
+
+    def _take_pending(self) -> \
+            Tuple[bool, List[Tuple[int, StoredMessage]]]:
+        """Takes the re-sync flag and buffered messages without the
+        stored copies of handed over ones, called with the condition held
+        """
+        resync, self._resync = self._resync, False
+        if resync:
+            # stored copies may have been dropped with the buffer, the
+            # backlog has them
+            self._local_keys.clear()
+
+        buffered = []
+        for revision, message in self._buffer:
+            if revision is not None and message.key in self._local_keys:
+                self._local_keys.discard(message.key)
+            else:
+                buffered.append((revision, message))
+        self._buffer.clear()
+        return resync, buffered
+
+    def _read_backlog(self) -> Iterator[List[Message]]:
+        """Reads the user queue page by page, remembers the revision of
+        the first page and keys of messages stored after it
+        """
+        self._dispatcher.ensure_watch()
+        self._dispatcher.register(self)
+        self._backlog_keys = set()
+        pages = self._dispatcher.read_backlog(self.login)
+        for index, page in enumerate(pages):
+            if index == 0:
+                self._revision = page.revision
+            self._backlog_revision = page.revision
+            self._backlog_keys.update(
+                message.key for revision, message in page.messages
+                if revision > self._revision)
+            yield self._dispatcher.convert(
+                [message for _, message in page.messages
+                 if message.key not in self._local_keys], self._is_stored)
+
+    def _skip_seen(self, buffered: List[Tuple[int, StoredMessage]]) -> \
+            List[Message]:
+        """Drops messages already read with the backlog"""
+        messages = [message for revision, message in buffered
+                    if revision is None or (
+                        revision > self._revision and
+                        message.key not in self._backlog_keys)]
+        revisions = [revision for revision, _ in buffered
+                     if revision is not None]
+        if revisions and revisions[-1] > self._backlog_revision:
+            self._backlog_keys = set()
+        return self._dispatcher.convert(messages, self._is_stored)
+
+    def __iter__(self) -> Iterator[List[Message]]:
+        """Yields batches of messages: the queue backlog on (re-)sync and
+        whatever the watch buffered while the previous batch was handled
+        """
+        while True:
+            with self._condition:
+                while not (self._closed or self._resync or self._buffer):
+                    self._condition.wait()
+                if self._closed:
+                    return
+
+                resync, buffered = self._take_pending()
+
+            if resync:
+                for messages in self._read_backlog():
+                    if messages:
+                        yield messages
+                continue
+
+            messages = self._skip_seen(buffered)
+            if messages:
+                yield messages
+
+
+class QueueWatchDispatcher:
+    """Holds one etcd watch on the whole message queue prefix and fans
+    the stored messages out to the subscriptions of their recipients.
+    The number of etcd watches stays the same however many users
+    are subscribed.
+
+    With presence routing the watch covers the wake keys of this node
+    only, so a node gets the messages of its subscribers rather than all
+    messages. Subscribed users get presence records before their queue
+    is read.
+    """
+
+    def __init__(self, storage: 'BaseStorage',
+                 buffer_size: int = SUBSCRIPTION_BUFFER_SIZE,
+                 presence: Optional['PresenceRegistry'] = None):
+        self.buffer_size = buffer_size
+        self._storage = storage
+        self._presence = presence
+        self._lock = threading.Lock()
+        self._watch_id = None
+        self._subscriptions: Dict[str, Set[QueueSubscription]] = \
+            collections.defaultdict(set)
+        self._registered: Set[QueueSubscription] = set()
+        if presence is None:
+            self._watch_prefix = STORAGE_MESSAGE_QUEUE_PREFIX_KEY
+        else:
+            self._watch_prefix = STORAGE_NODE_WAKE_PREFIX_KEY.format(
+                node_id=presence.node_id)
+
+    def subscribe(self, login: str, subscription_class=QueueSubscription,
+                  **kwargs) -> QueueSubscription:
+        """Creates subscription for queued messages of the user login"""
+        subscription = subscription_class(self, login, self.buffer_size,
+                                          **kwargs)
+        with self._lock:
+            self._subscriptions[login].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: QueueSubscription):
+        """Removes subscription from the fan-out"""
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.login)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.login]
+            is_registered = subscription in self._registered
+            self._registered.discard(subscription)
+
+        if is_registered:
+            self._presence.unregister(subscription.login)
+
+    def register(self, subscription: QueueSubscription):
+        """Stores presence of the subscribed user once per subscription
+        before its queue is read
+        """
+        if self._presence is None:
+            return
+
+        with self._lock:
+            if subscription in self._registered:
+                return
+            self._registered.add(subscription)
+
+        self._presence.register(subscription.login)
+
+    def deliver(self, login: str, message: StoredMessage) -> bool:
+        """Hands message over to the subscriptions of the user login in
+        this process, False when none of them took it
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(login, ()))
+
+        is_delivered = False
+        for subscription in subscriptions:
+            if subscription.push_local(message):
+                is_delivered = True
+        return is_delivered
+
+    def ensure_watch(self):
+        """Starts the shared watch unless it is already running"""
+        with self._lock:
+            if self._watch_id is None:
+                client = self._storage._client
+                self._watch_id = client.add_watch_prefix_callback(
+                    self._watch_prefix, self._on_watch_response)
+
+    def read_backlog(self, login: str) -> Iterator[QueuePage]:
+        """Reads queued messages of the user login page by page"""
+        return self._storage.iterate_user_queue_pages(login)
+
+    def convert(self, messages: List[StoredMessage], is_stored: bool):
+        """Decodes stored messages for the subscriber, or brings them to
+        the wire format when the subscriber forwards them as they are
+        """
+        if is_stored:
+            return [self._storage.to_wire_message(message)
+                    for message in messages]
+
+        return [self._storage.decode_message(message)
+                for message in messages]
+
+    def _on_watch_response(self, response):
+        """Called from the etcd watch thread"""
+        if isinstance(response, Exception):
+            # etcd3 drops all callbacks when the watch stream breaks, so the
+            # watch is recreated by the subscriptions on their re-sync.
+            with self._lock:
+                self._watch_id = None
+                subscriptions = [subscription
+                                 for login_subscriptions
+                                 in self._subscriptions.values()
+                                 for subscription in login_subscriptions]
+            for subscription in subscriptions:
+                subscription.resync()
+            return
+
+        messages = collections.defaultdict(list)
+        for event in response.events:
+            if not isinstance(event, PutEvent):
+                continue
+
+            login, revision, message = self._parse_event(event)
+            if login in self._subscriptions:
+                messages[login].append((revision, message))
+
+        self.dispatch(messages)
+
+    def dispatch(self, messages: Dict[str, List[Tuple[int, StoredMessage]]]):
+        """Pushes messages stored at their revisions to the subscriptions
+        of their recipient logins
+        """
+        for login, login_messages in messages.items():
+            with self._lock:
+                subscriptions = list(self._subscriptions.get(login, ()))
+            for subscription in subscriptions:
+                subscription.push(login_messages)
+
+    def _parse_event(self, event: PutEvent) -> \
+            Tuple[str, int, StoredMessage]:
+        """Returns the recipient login, the revision and the queued
+        message of a queue put or of a wake put
+        """
+        key = event.key.decode()
+        if self._presence is None:
+            login = key[len(self._watch_prefix):].split('/', 1)[0]
+            return login, event.mod_revision, StoredMessage(key, event.value)
+
+        login, message_id, revision = \
+            key[len(self._watch_prefix):].split('/')
+        return login, int(revision), StoredMessage(
+            STORAGE_USER_MESSAGE_QUEUE_KEY.format(user_id=login,
+                                                  message_id=message_id),
+            event.value)
+
+
+class LocalQueueDispatcher(QueueWatchDispatcher):
+    """Dispatcher of backends keeping queues in this process, they
+    dispatch messages themselves as they are stored, there is no watch
+    """
+
+    def ensure_watch(self):
+        pass
+
+
+def parse_endpoints(hosts: str, default_port) -> List[Tuple[str, int]]:
+    """Parses comma separated etcd hosts, each given as host[:port]"""
+    endpoints = []
+    for host in hosts.split(','):
+        host, _, port = host.strip().partition(':')
+        if host:
+            endpoints.append((host, int(port or default_port)))
+
+    if not endpoints:
+        raise ValueError('No etcd host given: {!r}'.format(hosts))
+    return endpoints
+
+
+class EtcdClientPool:
+    """etcd clients over one or more endpoints, each with its own gRPC
+    channel, so concurrent calls do not share one HTTP/2 connection.
+
+    get() picks the next client round robin, or the one with the fewest
+    calls in flight, among the clients that passed the last health
+    check. While every client fails the check all of them are used.
+    """
+
+    def __init__(self, endpoints: List[Tuple[str, int]],
+                 size: int = ETCD_POOL_SIZE,
+                 policy: str = POOL_ROUND_ROBIN,
+                 grpc_options: Optional[List[Tuple[str, int]]] = None,
+                 health_check_interval: float = HEALTH_CHECK_INTERVAL):
+        if policy not in POOL_POLICIES:
+            raise ValueError('Unknown pool policy: {}'.format(policy))
+
+        self.policy = policy
+        self.health_check_interval = health_check_interval
+        self.clients = [etcd3.client(host, port, grpc_options=grpc_options)
+                        for _ in range(size) for host, port in endpoints]
+        self._healthy = list(self.clients)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._in_flight = [0] * len(self.clients)
+        self._closed = threading.Event()
+
+        if policy == POOL_LEAST_LOADED:
+            for index, client in enumerate(self.clients):
+                self._count_calls(index, client)
+        if len(self.clients) > 1:
+            threading.Thread(target=self._check_health, name='etcd-health',
+                             daemon=True).start()
+
+    def get(self) -> etcd3.Etcd3Client:
+        """Returns the client for the next call"""
+        clients = self._healthy or self.clients
+        if self.policy == POOL_LEAST_LOADED:
+            return min(clients, key=lambda client: self._in_flight[
+                self.clients.index(client)])
+        return clients[next(self._next) % len(clients)]
+
+    def close(self):
+        """Stops the health checks"""
+        self._closed.set()
+
+    def _count_calls(self, index: int, client: etcd3.Etcd3Client):
+        """Wraps the KV and lease calls of the client to count the ones
+        in flight
+        """
+        for stub in (client.kvstub, client.leasestub):
+            for name, method in list(vars(stub).items()):
+                if callable(method):
+                    setattr(stub, name, self._counted(index, method))
+
+    def _counted(self, index: int, method: Callable) -> Callable:
+        def counted_method(*args, **kwargs):
+            with self._lock:
+                self._in_flight[index] += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._in_flight[index] -= 1
+
+        return counted_method
+
+    def _check_health(self):
+        while not self._closed.wait(self.health_check_interval):
+            healthy = [client for client in self.clients
+                       if self._is_healthy(client)]
+            if len(healthy) != len(self._healthy):
+                logger.warning('%s of %s etcd clients are healthy',
+                               len(healthy), len(self.clients))
+            self._healthy = healthy
+
+    @staticmethod
+    def _is_healthy(client: etcd3.Etcd3Client) -> bool:
+        try:
+            client.kvstub.Range(
+                etcdrpc.RangeRequest(key=HEALTH_CHECK_KEY.encode()),
+                HEALTH_CHECK_TIMEOUT, credentials=client.call_credentials,
+                metadata=client.metadata)
+        except grpc.RpcError:
+            return False
+        return True
+
+
+class WriteBatcher:
+    """Group commit of queued message writes.
+
+    Writes arriving within the window after the first pending one are
+    committed together by one thread, up to max_size writes at once.
+    Every write gets its own future. When a batch fails, its writes are
+    committed one by one, so one failing write does not fail the others.
+    """
+
+    def __init__(self, commit: Callable[[List[tuple]], None],
+                 window: float = WRITE_BATCH_WINDOW,
+                 max_size: int = STORAGE_MAX_TXN_OPS):
+        self.window = window
+        self.max_size = max_size
+        self._commit = commit
+        self._condition = threading.Condition()
+        self._pending: List[Tuple[tuple, futures.Future]] = []
+        self._first_pending_at = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='write-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, value: tuple) -> futures.Future:
+        """Queues the write, the future is done once it is committed"""
+        future = futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Write batcher is closed')
+            if not self._pending:
+                self._first_pending_at = time.monotonic()
+            self._pending.append((value, future))
+            if len(self._pending) in (1, self.max_size):
+                self._condition.notify()
+        return future
+
+    def write(self, value: tuple):
+        """Returns once the write is committed, raises its error"""
+        self.submit(value).result()
+
+    def close(self):
+        """Commits pending writes and stops the thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+
+                # writes queued while the previous batch was committed
+                # may be due already
+                deadline = self._first_pending_at + self.window
+                while len(self._pending) < self.max_size \
+                        and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch = self._pending[:self.max_size]
+                del self._pending[:self.max_size]
+                self._first_pending_at = time.monotonic()
+
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch: List[Tuple[tuple, futures.Future]]):
+        try:
+            self._commit([value for value, _ in batch])
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+                return
+            # nothing of a failed transaction is stored
+            for write in batch:
+                self._commit_batch([write])
+            return
 
+        for _, future in batch:
+            future.set_result(None)
 
-class Storage:
-    """Provides methods that implement functionality of key-value storage"""
 
-    def __init__(self, host, port):
-        self._client = etcd3.client(host, port)
+class PresenceRegistry:
+    """Presence records of the users subscribed in this process.
+
+    The record `presence/{login}/{node_id}` is kept while the user has
+    a subscription on this node. Records are attached to the node lease
+    refreshed by a background thread, so records of a stopped node
+    expire. Records are written by one thread in the order of calls.
+    """
+
+    def __init__(self, client: etcd3.Etcd3Client, node_id: str,
+                 ttl: int = PRESENCE_TTL):
+        self.node_id = node_id
+        self._client = client
+        self._ttl = ttl
+        self._counts = collections.Counter()
+        self._lease = None
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='presence')
+        self._closed = threading.Event()
+
+    def register(self, login: str):
+        """Stores the record of the user unless it is already stored,
+        returns once it is stored
+        """
+        self._executor.submit(self._register, login).result()
+
+    def unregister(self, login: str):
+        """Deletes the record in the background when the last
+        subscription of the user here is gone
+        """
+        self._executor.submit(self._unregister, login)
+
+    def get_nodes(self, login: str) -> List[str]:
+        """Getting ids of the nodes the user is subscribed to"""
+        prefix = STORAGE_PRESENCE_PREFIX_KEY.format(user_id=login)
+        return [metadata.key.decode()[len(prefix):]
+                for _, metadata in self._client.get_prefix(prefix)]
+
+    def close(self):
+        """Stops refreshing and revokes the lease with all records"""
+        self._closed.set()
+        self._executor.submit(self._revoke).result()
+        self._executor.shutdown()
+
+    def _get_key(self, login: str) -> str:
+        return STORAGE_PRESENCE_KEY.format(user_id=login,
+                                           node_id=self.node_id)
+
+    def _register(self, login: str):
+        if self._counts[login] == 0:
+            if self._lease is None:
+                self._lease = self._client.lease(self._ttl)
+                threading.Thread(target=self._keep_alive,
+                                 daemon=True).start()
+            self._client.put(self._get_key(login), self.node_id,
+                             lease=self._lease)
+        self._counts[login] += 1
+
+    def _unregister(self, login: str):
+        self._counts[login] -= 1
+        if self._counts[login] > 0:
+            return
+
+        del self._counts[login]
+        try:
+            self._client.delete(self._get_key(login))
+        except Exception as error:
+            # a stale record only costs its node a wake
+            logger.error('Presence of %s was not deleted: %s', login, error)
+
+    def _keep_alive(self):
+        """Refreshes the lease until the registry is closed"""
+        while not self._closed.wait(self._ttl / 3):
+            try:
+                self._executor.submit(self._refresh).result()
+            except Exception as error:
+                logger.error('Presence lease was not refreshed: %s', error)
+
+    def _refresh(self):
+        """Refreshes the lease, a lease expired meanwhile is replaced
+        and the records are stored again
+        """
+        if self._closed.is_set():
+            return
+
+        responses = self._lease.refresh()
+        if responses and responses[0].TTL > 0:
+            return
+
+        self._lease = self._client.lease(self._ttl)
+        for login in self._counts:
+            self._client.put(self._get_key(login), self.node_id,
+                             lease=self._lease)
+
+    def _revoke(self):
+        if self._lease is not None:
+            self._lease.revoke()
+            self._lease = None
+        self._counts.clear()
+
+
+class BaseStorage(abc.ABC):
+    """Interface of the chat storage backends.
+
+    Queued messages get time ordered ids and are read in the order they
+    were stored. Subscriptions are served by a QueueWatchDispatcher of
+    the backend, fed with the messages stored after the backlog read.
+    """
+
+    def __init__(self, message_codec: Optional[MessageCodec] = None,
+                 queue_page_size: int = QUEUE_PAGE_SIZE,
+                 history_ttl: Optional[int] = None):
+        self.message_codec = message_codec or ProtobufMessageCodec()
+        self.queue_page_size = queue_page_size
+        # seconds stored messages are kept in the conversation history,
+        # no history is kept without it
+        self.history_ttl = history_ttl
+        self.write_batcher: Optional[WriteBatcher] = None
+        self._message_ids = MessageIdGenerator()
+        self._queue_dispatcher: Optional[QueueWatchDispatcher] = None
+
+    @abc.abstractmethod
+    def get_users(self) -> List[User]:
+        """Getting sequence of users"""
+
+    @abc.abstractmethod
+    def get_users_with_revision(self) -> Tuple[List[User], int]:
+        """Getting sequence of users together with the storage revision
+        they were read at
+        """
+
+    @abc.abstractmethod
+    def watch_users(self, callback: Callable, start_revision: int) -> \
+            Callable[[], None]:
+        """Calling back with users changed since received revision as a
+        list of (login, user) pairs, where user is None for deleted ones.
+        Returns the function cancelling the watch.
+        """
+
+    @abc.abstractmethod
+    def get_users_page(self, limit: int, start_key: Optional[str] = None,
+                       login_prefix: str = '', name_prefix: str = ''
+                       ) -> Tuple[List[User], Optional[str]]:
+        """Getting page of users ordered by login, or by full name when
+        name prefix is given. Returns users and the key the next page
+        starts from, None for the last page.
+        """
+
+    @abc.abstractmethod
+    def put_user(self, user: User):
+        """Adding user to storage"""
+
+    def put_users(self, users: List[User]):
+        """Adding batch of users to storage one by one. A failure raises
+        PartialWriteError with the number of already stored users.
+        """
+        for index, user in enumerate(users):
+            try:
+                self.put_user(user)
+            except Exception as error:
+                raise PartialWriteError(index, error) from error
+
+    @abc.abstractmethod
+    def reindex_users(self) -> int:
+        """Makes all stored users searchable by name, returns their
+        number
+        """
+
+    @abc.abstractmethod
+    def put_message(self, message: Message):
+        """Adding new queue message to storage under a generated id"""
+
+    @abc.abstractmethod
+    def get_history_page(self, login: str, peer: str, limit: int,
+                         start_time: Optional[float] = None,
+                         end_time: Optional[float] = None,
+                         start_key: Optional[str] = None
+                         ) -> Tuple[List[Message], Optional[str]]:
+        """Getting page of messages between the two users stored from
+        start time on and before end time, the newest first. Returns
+        messages and the key the next page starts from, None for the last
+        page. Raises ValueError for a start key out of the conversation.
+        """
+
+    @abc.abstractmethod
+    def put_messages(self, messages: List[Message]):
+        """Adding batch of new queue messages to storage under generated
+        ids. A failure raises PartialWriteError with the number of
+        already stored messages.
+        """
+
+    @abc.abstractmethod
+    def send_message(self, message: Message):
+        """Stores new message and hands it over to subscribers of its
+        recipient in this process
+        """
+
+    @abc.abstractmethod
+    def get_user_queue_messages(self, user_login: str) -> List[Message]:
+        """Getting sequence of queued messages for received user login
+        in the order they were stored
+        """
+
+    @abc.abstractmethod
+    def get_user_queue_page(self, user_login: str, limit: int,
+                            start_key: Optional[str] = None) -> QueuePage:
+        """Getting page of queued messages for received user login in the
+        order they were stored, starting from the key of a previous page
+        """
+
+    @abc.abstractmethod
+    def delete_user_queue_message(self, message: Message):
+        """Deleting queued message from the storage"""
+
+    @abc.abstractmethod
+    def delete_user_queue_messages(self, messages: List[Message]):
+        """Deleting delivered queued messages from the storage"""
+
+    @abc.abstractmethod
+    def delete_user_queue_stored_messages(
+            self, messages: List[StoredMessage]):
+        """Deleting delivered stored messages by their keys"""
+
+    @abc.abstractmethod
+    def delete_user_queue_message_ids(self, user_login: str,
+                                      message_ids: List[str]):
+        """Deleting acknowledged queued messages by their ids"""
+
+    @abc.abstractmethod
+    def delete_user_queue_messages_until(self, user_login: str,
+                                         message_id: str):
+        """Deleting queued messages of received user login with ids up to
+        and including the given one
+        """
+
+    def get_user_presence(self, user_login: str) -> List[str]:
+        """Getting ids of the nodes the user is subscribed to"""
+        return []
+
+    def close(self):
+        """Releases resources of the storage"""
+
+    def _set_message_id(self, message: Message):
+        """Gives new message its id unless it already has one"""
+        if message.message_id is None:
+            message.message_id = self._message_ids.generate()
+
+    def iterate_user_queue_pages(self, user_login: str,
+                                 page_size: Optional[int] = None,
+                                 start_key: Optional[str] = None
+                                 ) -> Iterator[QueuePage]:
+        """Reading the user queue lazily one page after another, so the
+        memory used does not depend on the queue length. The next page is
+        read when the previous one was handled, starting after its last
+        key, so deleting the handled messages does not disturb paging.
+        At least one page is yielded, it is empty for an empty queue.
+        """
+        page_size = page_size or self.queue_page_size
+        while True:
+            page = self.get_user_queue_page(user_login, page_size, start_key)
+            yield page
+
+            start_key = page.next_key
+            if start_key is None:
+                return
+
+    def iterate_user_queue_stored_messages(
+            self, user_login: str, page_size: Optional[int] = None,
+            start_key: Optional[str] = None) -> Iterator[List[StoredMessage]]:
+        """Yields non-empty pages of queued messages as they are stored"""
+        for page in self.iterate_user_queue_pages(user_login, page_size,
+                                                  start_key):
+            if page.messages:
+                yield [message for _, message in page.messages]
+
+    def iterate_user_queue_messages(
+            self, user_login: str, page_size: Optional[int] = None,
+            start_key: Optional[str] = None) -> Iterator[List[Message]]:
+        """Yields non-empty pages of decoded queued messages"""
+        for messages in self.iterate_user_queue_stored_messages(
+                user_login, page_size, start_key):
+            yield [self.decode_message(message) for message in messages]
+
+    def decode_history_message(self, key: str, value: bytes) -> Message:
+        """Converts history entry to the message"""
+        decoded = self.message_codec.decode(value)
+        decoded.message_id = invert_message_id(key.rsplit('/', 1)[1])
+        return decoded
+
+    def decode_message(self, message: StoredMessage) -> Message:
+        """Converts stored message to the message. The id is taken from
+        the key, messages stored before ids have their old key suffix.
+        """
+        decoded = self.message_codec.decode(message.value)
+        decoded.message_id = message.message_id
+        return decoded
+
+    def to_wire_message(self, message: StoredMessage) -> StoredMessage:
+        """Returns stored message with the value serialized as
+        simple_chat_pb2.Message, which is how the protobuf codec stores
+        it. Values of other codecs are re-encoded.
+        """
+        if isinstance(self.message_codec, ProtobufMessageCodec) and \
+                not self.message_codec.is_json(message.value):
+            message_id = message.message_id
+            if message.value.endswith(message_id.encode()):
+                return message
+
+            # the id is the last field, appended bytes set it for values
+            # stored before ids
+            return StoredMessage(
+                message.key, message.value + simple_chat_pb2.Message(
+                    id=message_id).SerializeToString())
+
+        return StoredMessage(message.key, WIRE_MESSAGE_CODEC.encode(
+            self.decode_message(message)))
+
+    def subscribe_user_queue(self, user_login: str,
+                             subscription_class=QueueSubscription,
+                             **kwargs) -> QueueSubscription:
+        """Subscribing to queued messages of received user login through
+        the watch shared by all subscribers
+        """
+        return self._queue_dispatcher.subscribe(
+            user_login, subscription_class, **kwargs)
+
+    def watch_user_queue_messages(self, user_login: str) -> \
+            Tuple[Iterator[List[Message]], Callable[[], None]]:
+        """Getting batches of queued messages for received user login as
+        soon as they are stored. The backlog is drained in pages of
+        queue_page_size messages, and then messages come from the watch
+        shared by all subscribers.
+        Returns the batches iterator and the function closing it.
+        """
+        subscription = self.subscribe_user_queue(user_login)
+        return iter(subscription), subscription.close
+
+    def watch_user_queue_stored_messages(self, user_login: str) -> \
+            Tuple[Iterator[List[StoredMessage]], Callable[[], None]]:
+        """Like watch_user_queue_messages, but messages are not decoded:
+        their values are serialized simple_chat_pb2.Message ready to be
+        sent to the subscriber.
+        """
+        subscription = self.subscribe_user_queue(user_login, is_stored=True)
+        return iter(subscription), subscription.close
+
+
+class Storage(BaseStorage):
+    """Provides methods that implement functionality of key-value storage.
+
+    The host may list several etcd endpoints separated by commas, calls
+    are spread over a pool of pool_size clients per endpoint.
+
+    Given a node id, the storage routes messages by presence: queued
+    messages of users subscribed on other nodes are woken on those nodes
+    only, instead of every node watching all queues.
+
+    Given a history time to live, every queued message is also kept in
+    the history of its conversation by the same transaction, attached to
+    a lease that removes it once the time passes.
+    """
+
+    def __init__(self, host, port,
+                 subscription_buffer_size: int = SUBSCRIPTION_BUFFER_SIZE,
+                 message_codec: Optional[MessageCodec] = None,
+                 queue_page_size: int = QUEUE_PAGE_SIZE,
+                 node_id: Optional[str] = None,
+                 write_batch_window: Optional[float] = None,
+                 write_batch_size: int = STORAGE_MAX_TXN_OPS,
+                 pool_size: int = ETCD_POOL_SIZE,
+                 pool_policy: str = POOL_ROUND_ROBIN,
+                 grpc_options: Optional[List[Tuple[str, int]]] = None,
+                 history_ttl: Optional[int] = None):
+        super().__init__(message_codec, queue_page_size, history_ttl)
+        self.clients = EtcdClientPool(parse_endpoints(host, port), pool_size,
+                                      pool_policy, grpc_options)
+        self.presence = None
+        if node_id is not None:
+            self.presence = PresenceRegistry(self._client, node_id)
+        self._queue_dispatcher = QueueWatchDispatcher(
+            self, subscription_buffer_size, self.presence)
+        self._wake_lock = threading.Lock()
+        self._wake_lease = None
+        self._wake_lease_renewal = 0
+        self._history_lock = threading.Lock()
+        self._history_lease = None
+        self._history_lease_renewal = 0
+        # queued messages of one transaction, leaving room for reading
+        # presence of every recipient and for history entries
+        self._values_per_txn = STORAGE_MAX_TXN_OPS // (
+            1 + (self.presence is not None) + (history_ttl is not None))
+        if write_batch_window is not None:
+            self.write_batcher = WriteBatcher(
+                self._put_queue_values, write_batch_window,
+                min(write_batch_size, self._values_per_txn))
+        self._persist_executor = futures.ThreadPoolExecutor(
+            max_workers=PERSIST_MAX_WORKERS, thread_name_prefix='persist')
+        self._persist_lock = threading.Lock()
+        # futures of messages handed over before they are stored by keys
+        self._persisting: Dict[str, futures.Future] = {}
+
+    @property
+    def _client(self) -> etcd3.Etcd3Client:
+        """Client of the pool for the next call"""
+        return self.clients.get()
 
     def get_users(self) -> List[User]:
         """Getting sequence of users"""
@@ -62,36 +1263,550 @@ class Storage:
 
         return users
 
+    def get_users_with_revision(self) -> Tuple[List[User], int]:
+        """Getting sequence of users together with the storage revision
+        they were read at
+        """
+        response = self._client.get_prefix_response(STORAGE_USER_PREFIX_KEY)
+        users = [User.from_dict(json.loads(kv.value)) for kv in response.kvs]
+
+        return users, response.header.revision
+
+    def watch_users(self, callback: Callable, start_revision: int) -> \
+            Callable[[], None]:
+        """Calling back with users changed since received revision as a
+        list of (login, user) pairs, where user is None for deleted ones.
+        Watch failures are passed to the callback as exceptions.
+        Returns the function cancelling the watch.
+        """
+        def on_watch_response(response):
+            if isinstance(response, Exception):
+                callback(response)
+                return
+
+            changes = []
+            for event in response.events:
+                login = event.key.decode()[len(STORAGE_USER_PREFIX_KEY):]
+                if isinstance(event, PutEvent):
+                    changes.append(
+                        (login, User.from_dict(json.loads(event.value))))
+                else:
+                    changes.append((login, None))
+            callback(changes)
+
+        client = self._client
+        watch_id = client.add_watch_prefix_callback(
+            STORAGE_USER_PREFIX_KEY, on_watch_response,
+            start_revision=start_revision)
+
+        return lambda: client.cancel_watch(watch_id)
+
+    def get_user_presence(self, user_login: str) -> List[str]:
+        """Getting ids of the nodes the user is subscribed to"""
+        if self.presence is None:
+            return []
+        return self.presence.get_nodes(user_login)
+
+    def close(self):
+        """Removes presence records of this node once stored messages
+        are persisted. The etcd clients are kept, their watch threads
+        would fail on closed channels.
+        """
+        self._persist_executor.shutdown()
+        if self.write_batcher is not None:
+            self.write_batcher.close()
+        if self.presence is not None:
+            self.presence.close()
+        self.clients.close()
+
+    @_handle_errors
+    def _get_range(self, key: str, range_end: str, limit: int):
+        """Range read limited on the etcd side, the etcd3 client
+        does not pass the limit of its get requests. gRPC errors are
+        translated to etcd3 exceptions like in the client calls.
+        """
+        request = etcdrpc.RangeRequest(key=key.encode(),
+                                       range_end=range_end.encode(),
+                                       limit=limit)
+        client = self._client
+        return client.kvstub.Range(
+            request, client.timeout, credentials=client.call_credentials,
+            metadata=client.metadata)
+
+    def get_users_page(self, limit: int, start_key: Optional[str] = None,
+                       login_prefix: str = '', name_prefix: str = ''
+                       ) -> Tuple[List[User], Optional[str]]:
+        """Getting page of users ordered by login, or by full name from
+        the name index when name prefix is given. Login prefix is applied
+        inside the page then, so such pages may be shorter than the limit.
+        Returns users and the key the next page starts from, None for the
+        last page.
+        """
+        if name_prefix:
+            prefix = STORAGE_USER_NAME_INDEX_PREFIX_KEY + name_prefix.lower()
+        else:
+            prefix = STORAGE_USER_PREFIX_KEY + login_prefix
+
+        if start_key is None:
+            start_key = prefix
+        elif not start_key.startswith(prefix):
+            raise ValueError('Page start key is out of the requested range')
+
+        range_end = increment_last_byte(prefix.encode()).decode()
+        response = self._get_range(start_key, range_end, limit)
+        users = [User.from_dict(json.loads(kv.value)) for kv in response.kvs]
+        if name_prefix and login_prefix:
+            users = [user for user in users
+                     if user.login.startswith(login_prefix)]
+
+        next_key = None
+        if response.more:
+            next_key = response.kvs[-1].key.decode() + '\0'
+
+        return users, next_key
+
+    @staticmethod
+    def _get_user_name_index_key(user: User) -> str:
+        return STORAGE_USER_NAME_INDEX_KEY.format(
+            name=user.full_name.lower(), user_id=user.login)
+
+    def reindex_users(self) -> int:
+        """Writes name index entries of all stored users, one transaction
+        per page of users. Users stored before the index appeared become
+        searchable by name. Returns the number of indexed users.
+        """
+        put = self._client.transactions.put
+        count = 0
+        start_key = None
+        while True:
+            users, start_key = self.get_users_page(STORAGE_MAX_TXN_OPS,
+                                                   start_key)
+            if users:
+                self._client.transaction(
+                    compare=[],
+                    success=[put(self._get_user_name_index_key(user),
+                                 json.dumps(asdict(user)))
+                             for user in users],
+                    failure=[])
+                count += len(users)
+
+            if start_key is None:
+                return count
+
     def put_user(self, user: User):
-        """Adding user to storage"""
-        self._client.put(STORAGE_USER_KEY.format(user_id=user.login),
-                         json.dumps(asdict(user)))
+        """Adding user to storage together with its name index entry,
+        the entry of the previous name is removed in the same transaction
+        """
+        key = STORAGE_USER_KEY.format(user_id=user.login)
+        value = json.dumps(asdict(user))
+        index_key = self._get_user_name_index_key(user)
+        transactions = self._client.transactions
+
+        while True:
+            stored_value, metadata = self._client.get(key)
+            success = [transactions.put(key, value),
+                       transactions.put(index_key, value)]
+            if stored_value is None:
+                compare = [transactions.version(key) == 0]
+            else:
+                compare = [transactions.mod(key) == metadata.mod_revision]
+                stored_index_key = self._get_user_name_index_key(
+                    User.from_dict(json.loads(stored_value)))
+                if stored_index_key != index_key:
+                    success.append(transactions.delete(stored_index_key))
+
+            # retried when the user was changed since it was read
+            succeeded, _ = self._client.transaction(
+                compare=compare, success=success, failure=[])
+            if succeeded:
+                return
+
+    def put_users(self, users: List[User]):
+        """Adding batch of users like put_user does, with one transaction
+        reading the stored users and one writing the new ones per
+        USERS_TXN_SIZE users. Transactions are committed one by one, so
+        a failure raises PartialWriteError with the number of already
+        stored users.
+        """
+        for start in range(0, len(users), USERS_TXN_SIZE):
+            try:
+                self._put_users(users[start:start + USERS_TXN_SIZE])
+            except Exception as error:
+                raise PartialWriteError(start, error) from error
+
+    def _put_users(self, users: List[User]):
+        # etcd rejects a transaction writing a key twice, the last user
+        # of a login is kept as if they were stored one by one
+        users = list({user.login: user for user in users}.values())
+        keys = [STORAGE_USER_KEY.format(user_id=user.login)
+                for user in users]
+        transactions = self._client.transactions
+
+        while True:
+            _, stored = self._client.transaction(
+                compare=[], success=[transactions.get(key) for key in keys],
+                failure=[])
+            compare = []
+            success = []
+            for user, key, stored_kvs in zip(users, keys, stored):
+                value = json.dumps(asdict(user))
+                index_key = self._get_user_name_index_key(user)
+                success.extend((transactions.put(key, value),
+                                transactions.put(index_key, value)))
+                if not stored_kvs:
+                    compare.append(transactions.version(key) == 0)
+                    continue
+
+                stored_value, metadata = stored_kvs[0]
+                compare.append(transactions.mod(key) == metadata.mod_revision)
+                stored_index_key = self._get_user_name_index_key(
+                    User.from_dict(json.loads(stored_value)))
+                if stored_index_key != index_key:
+                    success.append(transactions.delete(stored_index_key))
+
+            # retried when any of the users was changed since it was read
+            succeeded, _ = self._client.transaction(
+                compare=compare, success=success, failure=[])
+            if succeeded:
+                return
+
+    @staticmethod
+    def _get_queue_message_key(message: Message) -> str:
+        return STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+            user_id=message.recipient, message_id=message.message_id)
 
     def put_message(self, message: Message):
-        """Adding new queue message to storage"""
-        unique_key = message.get_unique_queue_message_key()
+        """Adding new queue message to storage under a generated id.
+        With write batching it shares a transaction with other messages
+        and returns once that is committed.
+        """
+        self._set_message_id(message)
+        self._put_queue_value(*self._get_queue_value(message))
+
+    def submit_message(self, message: Message) -> futures.Future:
+        """Queues new message to the write batcher without waiting,
+        the future is done once the message is stored
+        """
+        self._set_message_id(message)
+        return self.write_batcher.submit(self._get_queue_value(message))
+
+    def _put_queue_value(self, recipient: str, key: str, value: bytes,
+                         history_key: Optional[str]):
+        """Stores one queued message"""
+        if self.write_batcher is not None:
+            self.write_batcher.write((recipient, key, value, history_key))
+        elif self.presence is None and history_key is None:
+            self._client.put(key, value)
+        else:
+            self._put_queue_values([(recipient, key, value, history_key)])
+
+    def _get_queue_value(self, message: Message
+                         ) -> Tuple[str, str, bytes, Optional[str]]:
+        """Returns the recipient, the key, the stored value and the
+        history key, None when no history is kept
+        """
+        history_key = None
+        if self.history_ttl is not None:
+            history_key = get_history_key(message)
+        return (message.recipient, self._get_queue_message_key(message),
+                self.message_codec.encode(message), history_key)
+
+    def _put_queue_values(
+            self, values: List[Tuple[str, str, bytes, Optional[str]]]):
+        """Stores queued messages with one transaction. With presence
+        routing the presence of their recipients is read by the same
+        transaction, and the nodes they are subscribed to are woken.
+        History entries are stored by the same transaction.
+        """
+        transactions = self._client.transactions
+        success = [transactions.put(key, value)
+                   for _, key, value, _ in values]
+        recipients = []
+        if self.presence is not None:
+            recipients = sorted({recipient for recipient, _, _, _ in values})
+            for recipient in recipients:
+                prefix = STORAGE_PRESENCE_PREFIX_KEY.format(
+                    user_id=recipient)
+                success.append(transactions.get(
+                    prefix, increment_last_byte(prefix.encode()).decode()))
+        if self.history_ttl is not None:
+            lease = self._get_history_lease()
+            success.extend(transactions.put(history_key, value, lease=lease)
+                           for _, _, value, history_key in values)
+
+        response = self._client.transaction(compare=[], success=success,
+                                            failure=[])
+        if recipients:
+            self._wake_nodes(values, dict(zip(
+                recipients,
+                response[1][len(values):len(values) + len(recipients)])))
+
+    def _wake_nodes(self, values: List[Tuple[str, str, bytes,
+                                            Optional[str]]],
+                    presence: Dict[str, list]):
+        """Puts wake keys of stored messages for the nodes their
+        recipients are subscribed to. The messages stay queued when it
+        fails, the nodes read them on their next re-sync.
+        """
+        nodes = collections.defaultdict(list)
+        revision = None
+        for recipient, records in presence.items():
+            for node_id, metadata in records:
+                nodes[recipient].append(node_id.decode())
+                revision = metadata.response_header.revision
+        if not nodes:
+            return
+
+        put = self._client.transactions.put
+        try:
+            lease = self._get_wake_lease()
+            wakes = [put(STORAGE_NODE_WAKE_KEY.format(
+                         node_id=node_id, user_id=recipient,
+                         message_id=key.rsplit('/', 1)[1],
+                         revision=revision), value, lease=lease)
+                     for recipient, key, value, _ in values
+                     for node_id in nodes[recipient]]
+            for start in range(0, len(wakes), STORAGE_MAX_TXN_OPS):
+                self._client.transaction(
+                    compare=[],
+                    success=wakes[start:start + STORAGE_MAX_TXN_OPS],
+                    failure=[])
+        except Exception as error:
+            logger.error('Nodes were not woken for %s: %s',
+                         sorted(nodes), error)
 
-        self._client.put(STORAGE_USER_MESSAGE_QUEUE_KEY.format(
-                user_id=message.recipient,
-                message_id=unique_key),
-            json.dumps(asdict(message)))
+    def _get_wake_lease(self):
+        """Returns the lease of wake keys, a new one is granted every
+        half of its time to live so wake keys expire on their own
+        """
+        with self._wake_lock:
+            if time.monotonic() >= self._wake_lease_renewal:
+                self._wake_lease = self._client.lease(WAKE_TTL)
+                self._wake_lease_renewal = time.monotonic() + WAKE_TTL / 2
+            return self._wake_lease
+
+    def _get_history_lease(self):
+        """Returns the lease of history entries, a new one is granted
+        every HISTORY_LEASE_PERIODS-th of the history time to live and
+        outlives it by that period
+        """
+        with self._history_lock:
+            if time.monotonic() >= self._history_lease_renewal:
+                period = self.history_ttl / HISTORY_LEASE_PERIODS
+                self._history_lease = self._client.lease(
+                    math.ceil(self.history_ttl + period))
+                self._history_lease_renewal = time.monotonic() + period
+            return self._history_lease
+
+    def send_message(self, message: Message):
+        """Hands new message over to subscribers of its recipient in this
+        process and stores it in the background. Without such subscribers
+        it returns once the message is stored like put_message.
+        Deleting the message waits until it is stored.
+        """
+        self._set_message_id(message)
+        queue_value = self._get_queue_value(message)
+        _, key, value, _ = queue_value
+
+        persisted = futures.Future()
+        with self._persist_lock:
+            self._persisting[key] = persisted
+
+        if self._queue_dispatcher.deliver(message.recipient,
+                                          StoredMessage(key, value)):
+            persisted.add_done_callback(
+                functools.partial(self._on_persisted, key))
+            self._persist_executor.submit(self._persist, queue_value,
+                                          persisted)
+        else:
+            self._persist(queue_value, persisted)
+            persisted.result()
+
+    def _persist(self, queue_value: Tuple[str, str, bytes, Optional[str]],
+                 persisted: futures.Future):
+        """Stores message, the future is done once it is stored"""
+        try:
+            self._put_queue_value(*queue_value)
+        except Exception as error:
+            persisted.set_exception(error)
+        else:
+            persisted.set_result(None)
+        finally:
+            with self._persist_lock:
+                del self._persisting[queue_value[1]]
+
+    @staticmethod
+    def _on_persisted(key: str, persisted: futures.Future):
+        if persisted.exception() is not None:
+            logger.error('Handed over message %s was not stored: %s', key,
+                         persisted.exception())
+
+    def _wait_persisted(self, keys: List[str]):
+        """Waits until handed over messages of the keys are stored"""
+        with self._persist_lock:
+            pending = [self._persisting[key] for key in keys
+                       if key in self._persisting]
+        futures.wait(pending)
+
+    def put_messages(self, messages: List[Message]):
+        """Adding batch of new queue messages to storage under generated
+        ids with one etcd transaction per STORAGE_MAX_TXN_OPS messages,
+        fewer with presence routing or history. Transactions are
+        committed one by one, so a failure raises PartialWriteError with
+        the number of already stored messages.
+        """
+        for message in messages:
+            self._set_message_id(message)
+
+        step = self._values_per_txn
+        for start in range(0, len(messages), step):
+            try:
+                self._put_queue_values(
+                    [self._get_queue_value(message)
+                     for message in messages[start:start + step]])
+            except Exception as error:
+                raise PartialWriteError(start, error) from error
+
+    def get_history_page(self, login: str, peer: str, limit: int,
+                         start_time: Optional[float] = None,
+                         end_time: Optional[float] = None,
+                         start_key: Optional[str] = None
+                         ) -> Tuple[List[Message], Optional[str]]:
+        """Getting page of messages between the two users stored from
+        start time on and before end time, the newest first, with one
+        range request reading the page only. Returns messages and the key
+        the next page starts from, None for the last page.
+        """
+        range_start, range_end = get_history_range(login, peer, start_time,
+                                                   end_time, start_key)
+        if range_start >= range_end:
+            return [], None
+
+        response = self._get_range(range_start, range_end, limit)
+        messages = [self.decode_history_message(kv.key.decode(), kv.value)
+                    for kv in response.kvs]
+
+        next_key = None
+        if response.more:
+            next_key = response.kvs[-1].key.decode() + '\0'
+
+        return messages, next_key
 
     def get_user_queue_messages(self, user_login: str) -> List[Message]:
-        """Getting sequence of queued messages for received user login"""
+        """Getting sequence of queued messages for received user login
+        in the order they were stored. The whole queue is read at once,
+        iterate_user_queue_messages reads it in pages.
+        """
         prefix = STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY.format(
             user_id=user_login)
 
         messages = []
-        for value, _ in self._client.get_prefix(prefix):
-            message = Message.from_dict(json.loads(value))
+        for value, metadata in self._client.get_prefix(prefix):
+            message = self.decode_message(
+                StoredMessage(metadata.key.decode(), value))
             messages.append(message)
 
         return messages
 
+    def get_user_queue_page(self, user_login: str, limit: int,
+                            start_key: Optional[str] = None) -> QueuePage:
+        """Getting page of queued messages for received user login in the
+        order they were stored, starting from the key of a previous page
+        """
+        prefix = STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY.format(
+            user_id=user_login)
+        if start_key is None:
+            start_key = prefix
+        elif not start_key.startswith(prefix):
+            raise ValueError('Page start key is out of the user queue')
+
+        range_end = increment_last_byte(prefix.encode()).decode()
+        response = self._get_range(start_key, range_end, limit)
+        messages = [(kv.mod_revision, StoredMessage(kv.key.decode(),
+                                                    kv.value))
+                    for kv in response.kvs]
+
+        next_key = None
+        if response.more:
+            next_key = response.kvs[-1].key.decode() + '\0'
+
+        return QueuePage(messages, next_key, response.header.revision)
+
     def delete_user_queue_message(self, message: Message):
         """Deleting queued message from the storage"""
-        delete_key = STORAGE_USER_MESSAGE_QUEUE_KEY.format(
-            user_id=message.recipient,
-            message_id=message.get_unique_queue_message_key())
+        key = self._get_queue_message_key(message)
+        self._wait_persisted([key])
+        self._client.delete(key)
+
+    def delete_user_queue_messages(self, messages: List[Message]):
+        """Deleting delivered queued messages from the storage with one
+        etcd transaction per STORAGE_MAX_TXN_OPS messages
+        """
+        self._delete_keys(
+            [self._get_queue_message_key(message) for message in messages])
+
+    def delete_user_queue_stored_messages(
+            self, messages: List[StoredMessage]):
+        """Deleting delivered stored messages by their keys"""
+        self._delete_keys([message.key for message in messages])
+
+    def delete_user_queue_message_ids(self, user_login: str,
+                                      message_ids: List[str]):
+        """Deleting acknowledged queued messages by their ids"""
+        self._delete_keys([STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+            user_id=user_login, message_id=message_id)
+            for message_id in message_ids])
+
+    def delete_user_queue_messages_until(self, user_login: str,
+                                         message_id: str):
+        """Deleting queued messages of received user login with ids up to
+        and including the given one with a single range delete
+        """
+        prefix = STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY.format(
+            user_id=user_login)
+        key = STORAGE_USER_MESSAGE_QUEUE_KEY.format(user_id=user_login,
+                                                   message_id=message_id)
+        with self._persist_lock:
+            persisting = list(self._persisting)
+        self._wait_persisted([pending_key for pending_key in persisting
+                              if prefix <= pending_key <= key])
+        self._client.transaction(
+            compare=[],
+            success=[self._client.transactions.delete(
+                prefix, range_end=key + '\0')],
+            failure=[])
+
+    def _delete_keys(self, keys: List[str]):
+        self._wait_persisted(keys)
+        delete = self._client.transactions.delete
+        for start in range(0, len(keys), STORAGE_MAX_TXN_OPS):
+            self._client.transaction(
+                compare=[],
+                success=[delete(key) for key in
+                         keys[start:start + STORAGE_MAX_TXN_OPS]],
+                failure=[])
+
+    def get_user_queue_messages_with_revision(
+            self, user_login: str) -> Tuple[List[Message], int]:
+        """Getting sequence of queued messages for received user login
+        together with the storage revision they were read at
+        """
+        messages, revision = \
+            self.get_user_queue_stored_messages_with_revision(user_login)
+
+        return [self.decode_message(message) for message in messages], \
+            revision
+
+    def get_user_queue_stored_messages_with_revision(
+            self, user_login: str) -> Tuple[List[StoredMessage], int]:
+        """Getting queued messages for received user login as they are
+        stored, together with the storage revision they were read at
+        """
+        prefix = STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY.format(
+            user_id=user_login)
+
+        response = self._client.get_prefix_response(prefix)
+        messages = [StoredMessage(kv.key.decode(), kv.value)
+                    for kv in response.kvs]
 
-        self._client.delete(delete_key)
+        return messages, response.header.revision
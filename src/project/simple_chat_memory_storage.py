@@ -0,0 +1,501 @@
+"""In-memory storage backend for benchmarks and single-node servers"""
+import bisect
+import collections
+import threading
+import time
+from concurrent import futures
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from simple_chat_etcd_storage import (BaseStorage, LocalQueueDispatcher,
+                                      Message, MessageCodec, QueuePage,
+                                      StoredMessage, User,
+                                      get_history_key, get_history_prefix,
+                                      get_history_range,
+                                      HISTORY_COMPACTION_INTERVAL,
+                                      QUEUE_PAGE_SIZE,
+                                      STORAGE_MESSAGE_QUEUE_PREFIX_KEY,
+                                      STORAGE_USER_KEY,
+                                      STORAGE_USER_MESSAGE_QUEUE_KEY,
+                                      STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY,
+                                      STORAGE_USER_NAME_INDEX_KEY,
+                                      STORAGE_USER_NAME_INDEX_PREFIX_KEY,
+                                      STORAGE_USER_PREFIX_KEY,
+                                      SUBSCRIPTION_BUFFER_SIZE)
+
+# number of user changes kept for watches started at an older revision
+USER_CHANGES_KEPT = 10000
+
+
+class MemoryUserQueue:
+    """Queued messages of one user in the order they were stored.
+
+    Keys are kept sorted from the head index on, so pages and deletions
+    start from a bisected position. Deleted keys are dropped from the
+    messages at once and from the keys when they reach the head, the
+    list is shortened once the head passes half of it.
+    """
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.messages: Dict[str, Tuple[int, StoredMessage]] = {}
+        self._head = 0
+
+    def append(self, revision: int, message: StoredMessage):
+        if message.key not in self.messages:
+            if len(self.keys) == self._head or self.keys[-1] < message.key:
+                self.keys.append(message.key)
+            else:
+                # stored after a later message of another thread
+                index = bisect.bisect_left(self.keys, message.key,
+                                           self._head)
+                if index == len(self.keys) or \
+                        self.keys[index] != message.key:
+                    self.keys.insert(index, message.key)
+        self.messages[message.key] = (revision, message)
+
+    def delete(self, keys: List[str]):
+        for key in keys:
+            self.messages.pop(key, None)
+        self._compact()
+
+    def delete_until(self, key: str):
+        """Deletes messages with keys up to and including the given one"""
+        end = bisect.bisect_right(self.keys, key, self._head)
+        for index in range(self._head, end):
+            self.messages.pop(self.keys[index], None)
+        self._compact()
+
+    def get_page(self, start_key: str, limit: Optional[int]) -> \
+            Tuple[List[Tuple[int, StoredMessage]], bool]:
+        """Returns messages from the start key on and whether more follow,
+        all of them without a limit
+        """
+        messages = []
+        for index in range(bisect.bisect_left(self.keys, start_key,
+                                              self._head), len(self.keys)):
+            key = self.keys[index]
+            if key not in self.messages:
+                continue
+            if len(messages) == limit:
+                return messages, True
+            messages.append(self.messages[key])
+        return messages, False
+
+    def _compact(self):
+        while self._head < len(self.keys) and \
+                self.keys[self._head] not in self.messages:
+            self._head += 1
+        if self._head * 2 >= len(self.keys):
+            del self.keys[:self._head]
+            self._head = 0
+
+
+def bisect_descending(keys: List[str], key: str) -> int:
+    """Index of the first of the keys in descending order that is less
+    than the key
+    """
+    low, high = 0, len(keys)
+    while low < high:
+        middle = (low + high) // 2
+        if keys[middle] < key:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+class MemoryConversation:
+    """History of one conversation.
+
+    Keys are kept in descending order, so the key of the newest message,
+    the least one, is appended, and a page is read backwards from a
+    bisected position. Values are kept with the time they expire at.
+    """
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.messages: Dict[str, Tuple[bytes, float]] = {}
+
+    def put(self, key: str, value: bytes, expires: float):
+        if key not in self.messages:
+            if not self.keys or self.keys[-1] > key:
+                self.keys.append(key)
+            else:
+                # stored after a later message of another thread
+                self.keys.insert(bisect_descending(self.keys, key), key)
+        self.messages[key] = (value, expires)
+
+    def get_page(self, range_start: str, range_end: str, limit: int,
+                 now: float) -> Tuple[List[Tuple[str, bytes]], bool]:
+        """Returns unexpired entries with keys from the range start and
+        before the range end in ascending order, and whether more follow
+        """
+        entries = []
+        end = bisect_descending(self.keys, range_end)
+        for index in range(bisect_descending(self.keys, range_start) - 1,
+                           end - 1, -1):
+            value, expires = self.messages[self.keys[index]]
+            if expires <= now:
+                continue
+            if len(entries) == limit:
+                return entries, True
+            entries.append((self.keys[index], value))
+        return entries, False
+
+    def compact(self, now: float):
+        """Drops expired entries"""
+        self.keys = [key for key in self.keys
+                     if self.messages[key][1] > now]
+        self.messages = {key: self.messages[key] for key in self.keys}
+
+
+class MemoryStorage(BaseStorage):
+    """Storage keeping users and queues in the process memory, under the
+    same keys the etcd storage uses.
+
+    Every user queue is a sorted list of message keys. Stored messages are
+    pushed to the subscriptions of their recipient by the storing thread,
+    and subscriptions wake their readers with condition variables, so
+    nothing polls. Nothing survives the process, the storage serves
+    benchmarks and single-node servers. Conversation histories drop
+    expired messages every HISTORY_COMPACTION_INTERVAL.
+    """
+
+    def __init__(self,
+                 subscription_buffer_size: int = SUBSCRIPTION_BUFFER_SIZE,
+                 message_codec: Optional[MessageCodec] = None,
+                 queue_page_size: int = QUEUE_PAGE_SIZE,
+                 history_ttl: Optional[int] = None):
+        super().__init__(message_codec, queue_page_size, history_ttl)
+        self._queue_dispatcher = LocalQueueDispatcher(
+            self, subscription_buffer_size)
+        self._lock = threading.Lock()
+        self._revision = 0
+        # users by their user keys and name index keys
+        self._users: Dict[str, User] = {}
+        self._user_keys: List[str] = []
+        self._user_changes: Deque[Tuple[int, str, Optional[User]]] = \
+            collections.deque(maxlen=USER_CHANGES_KEPT)
+        self._user_watches: Dict[int, Tuple[Callable, int]] = {}
+        self._user_watch_ids = 0
+        # user watches are called back in the order of changes, outside
+        # the storage lock
+        self._user_watch_executor = futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='user-watch')
+        self._queues: Dict[str, MemoryUserQueue] = \
+            collections.defaultdict(MemoryUserQueue)
+        # conversations by their history prefixes
+        self._conversations: Dict[str, MemoryConversation] = \
+            collections.defaultdict(MemoryConversation)
+        self._history_compaction_time = time.time() + \
+            HISTORY_COMPACTION_INTERVAL
+
+    def get_users(self) -> List[User]:
+        """Getting sequence of users"""
+        return self.get_users_with_revision()[0]
+
+    def get_users_with_revision(self) -> Tuple[List[User], int]:
+        """Getting sequence of users together with the storage revision
+        they were read at
+        """
+        with self._lock:
+            start = bisect.bisect_left(self._user_keys,
+                                       STORAGE_USER_PREFIX_KEY)
+            users = []
+            for key in self._user_keys[start:]:
+                if not key.startswith(STORAGE_USER_PREFIX_KEY):
+                    break
+                users.append(self._users[key])
+            return users, self._revision
+
+    def watch_users(self, callback: Callable, start_revision: int) -> \
+            Callable[[], None]:
+        """Calling back with users changed since received revision as a
+        list of (login, user) pairs from a thread of the storage. Watches
+        starting before the oldest kept change get an exception.
+        Returns the function cancelling the watch.
+        """
+        with self._lock:
+            self._user_watch_ids += 1
+            watch_id = self._user_watch_ids
+            if len(self._user_changes) == USER_CHANGES_KEPT and \
+                    start_revision < self._user_changes[0][0]:
+                self._user_watch_executor.submit(callback, LookupError(
+                    'User changes since revision {} are no longer '
+                    'kept'.format(start_revision)))
+            else:
+                self._user_watches[watch_id] = (callback, start_revision)
+                changes = [(login, user) for revision, login, user
+                           in self._user_changes if revision >= start_revision]
+                if changes:
+                    self._user_watch_executor.submit(callback, changes)
+
+        def cancel():
+            with self._lock:
+                self._user_watches.pop(watch_id, None)
+
+        return cancel
+
+    def _notify_users(self, revision: int, login: str, user: User):
+        """Calls back the watches started up to the change revision"""
+        with self._lock:
+            callbacks = [callback for callback, start_revision
+                         in self._user_watches.values()
+                         if start_revision <= revision]
+        for callback in callbacks:
+            callback([(login, user)])
+
+    def get_users_page(self, limit: int, start_key: Optional[str] = None,
+                       login_prefix: str = '', name_prefix: str = ''
+                       ) -> Tuple[List[User], Optional[str]]:
+        """Getting page of users ordered by login, or by full name when
+        name prefix is given. Login prefix is applied inside the page then,
+        so such pages may be shorter than the limit. Returns users and the
+        key the next page starts from, None for the last page.
+        """
+        if name_prefix:
+            prefix = STORAGE_USER_NAME_INDEX_PREFIX_KEY + name_prefix.lower()
+        else:
+            prefix = STORAGE_USER_PREFIX_KEY + login_prefix
+
+        if start_key is None:
+            start_key = prefix
+        elif not start_key.startswith(prefix):
+            raise ValueError('Page start key is out of the requested range')
+
+        with self._lock:
+            start = bisect.bisect_left(self._user_keys, start_key)
+            keys = []
+            for key in self._user_keys[start:start + limit + 1]:
+                if not key.startswith(prefix):
+                    break
+                keys.append(key)
+            users = [self._users[key] for key in keys[:limit]]
+
+        if name_prefix and login_prefix:
+            users = [user for user in users
+                     if user.login.startswith(login_prefix)]
+
+        next_key = None
+        if len(keys) > limit:
+            next_key = keys[limit - 1] + '\0'
+
+        return users, next_key
+
+    def put_user(self, user: User):
+        """Adding user to storage together with its name index entry"""
+        # stored users are not shared with the callers
+        user = User.from_dict(asdict(user))
+        key = STORAGE_USER_KEY.format(user_id=user.login)
+        with self._lock:
+            stored_user = self._users.get(key)
+            if stored_user is not None:
+                self._delete_user_key(self._get_user_name_index_key(
+                    stored_user))
+            self._put_user_key(key, user)
+            self._put_user_key(self._get_user_name_index_key(user), user)
+
+            self._revision += 1
+            self._user_changes.append((self._revision, user.login, user))
+            self._user_watch_executor.submit(self._notify_users,
+                                             self._revision, user.login, user)
+
+    def _put_user_key(self, key: str, user: User):
+        if key not in self._users:
+            bisect.insort(self._user_keys, key)
+        self._users[key] = user
+
+    def _delete_user_key(self, key: str):
+        if self._users.pop(key, None) is not None:
+            del self._user_keys[bisect.bisect_left(self._user_keys, key)]
+
+    @staticmethod
+    def _get_user_name_index_key(user: User) -> str:
+        return STORAGE_USER_NAME_INDEX_KEY.format(
+            name=user.full_name.lower(), user_id=user.login)
+
+    def reindex_users(self) -> int:
+        """Users are indexed as they are stored, returns their number"""
+        return len(self.get_users())
+
+    def put_message(self, message: Message):
+        """Adding new queue message to storage under a generated id"""
+        self.put_messages([message])
+
+    def put_messages(self, messages: List[Message]):
+        """Adding batch of new queue messages to storage under generated
+        ids, all of them are stored at once
+        """
+        values = []
+        for message in messages:
+            self._set_message_id(message)
+            history = None
+            if self.history_ttl is not None:
+                history = (get_history_prefix(message.sender,
+                                              message.recipient),
+                           get_history_key(message))
+            values.append((message.recipient, StoredMessage(
+                STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+                    user_id=message.recipient,
+                    message_id=message.message_id),
+                self.message_codec.encode(message)), history))
+
+        now = time.time()
+        with self._lock:
+            stored = collections.defaultdict(list)
+            for recipient, value, history in values:
+                self._revision += 1
+                self._queues[recipient].append(self._revision, value)
+                stored[recipient].append((self._revision, value))
+                if history is not None:
+                    prefix, history_key = history
+                    self._conversations[prefix].put(
+                        history_key, value.value, now + self.history_ttl)
+            # pushed under the lock, so subscriptions get messages in the
+            # order of their revisions
+            self._queue_dispatcher.dispatch(stored)
+
+            if now >= self._history_compaction_time:
+                self._compact_history(now)
+
+    def _compact_history(self, now: float):
+        """Drops expired history entries and emptied conversations,
+        called with the lock held
+        """
+        for prefix, conversation in list(self._conversations.items()):
+            conversation.compact(now)
+            if not conversation.keys:
+                del self._conversations[prefix]
+        self._history_compaction_time = now + HISTORY_COMPACTION_INTERVAL
+
+    def get_history_page(self, login: str, peer: str, limit: int,
+                         start_time: Optional[float] = None,
+                         end_time: Optional[float] = None,
+                         start_key: Optional[str] = None
+                         ) -> Tuple[List[Message], Optional[str]]:
+        """Getting page of messages between the two users stored from
+        start time on and before end time, the newest first. Returns
+        messages and the key the next page starts from, None for the last
+        page.
+        """
+        range_start, range_end = get_history_range(login, peer, start_time,
+                                                   end_time, start_key)
+        prefix = get_history_prefix(login, peer)
+        with self._lock:
+            conversation = self._conversations.get(prefix)
+            if conversation is None:
+                return [], None
+            entries, is_more = conversation.get_page(
+                range_start, range_end, limit, time.time())
+
+        next_key = None
+        if is_more:
+            next_key = entries[-1][0] + '\0'
+
+        return [self.decode_history_message(key, value)
+                for key, value in entries], next_key
+
+    def send_message(self, message: Message):
+        """Stores new message, subscribers get it as soon as it is
+        stored
+        """
+        self.put_message(message)
+
+    def get_user_queue_messages(self, user_login: str) -> List[Message]:
+        """Getting sequence of queued messages for received user login
+        in the order they were stored
+        """
+        with self._lock:
+            page, _ = self._get_queue(user_login).get_page('', None)
+        return [self.decode_message(message) for _, message in page]
+
+    def get_user_queue_page(self, user_login: str, limit: int,
+                            start_key: Optional[str] = None) -> QueuePage:
+        """Getting page of queued messages for received user login in the
+        order they were stored, starting from the key of a previous page
+        """
+        prefix = STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY.format(
+            user_id=user_login)
+        if start_key is None:
+            start_key = prefix
+        elif not start_key.startswith(prefix):
+            raise ValueError('Page start key is out of the user queue')
+
+        with self._lock:
+            messages, is_more = self._get_queue(user_login).get_page(
+                start_key, limit)
+            revision = self._revision
+
+        next_key = None
+        if is_more:
+            next_key = messages[-1][1].key + '\0'
+
+        return QueuePage(messages, next_key, revision)
+
+    def _get_queue(self, user_login: str) -> MemoryUserQueue:
+        """Queue of the user login, empty queues are not created"""
+        return self._queues.get(user_login) or MemoryUserQueue()
+
+    def delete_user_queue_message(self, message: Message):
+        """Deleting queued message from the storage"""
+        self.delete_user_queue_messages([message])
+
+    def delete_user_queue_messages(self, messages: List[Message]):
+        """Deleting delivered queued messages from the storage"""
+        keys = collections.defaultdict(list)
+        for message in messages:
+            keys[message.recipient].append(
+                STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+                    user_id=message.recipient,
+                    message_id=message.message_id))
+        with self._lock:
+            for login, login_keys in keys.items():
+                self._delete(login, login_keys)
+
+    def delete_user_queue_stored_messages(
+            self, messages: List[StoredMessage]):
+        """Deleting delivered stored messages by their keys"""
+        keys = collections.defaultdict(list)
+        for message in messages:
+            login = message.key[len(STORAGE_MESSAGE_QUEUE_PREFIX_KEY):] \
+                .split('/', 1)[0]
+            keys[login].append(message.key)
+        with self._lock:
+            for login, login_keys in keys.items():
+                self._delete(login, login_keys)
+
+    def delete_user_queue_message_ids(self, user_login: str,
+                                      message_ids: List[str]):
+        """Deleting acknowledged queued messages by their ids"""
+        keys = [STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+            user_id=user_login, message_id=message_id)
+            for message_id in message_ids]
+        with self._lock:
+            self._delete(user_login, keys)
+
+    def delete_user_queue_messages_until(self, user_login: str,
+                                         message_id: str):
+        """Deleting queued messages of received user login with ids up to
+        and including the given one
+        """
+        key = STORAGE_USER_MESSAGE_QUEUE_KEY.format(user_id=user_login,
+                                                   message_id=message_id)
+        with self._lock:
+            queue = self._get_queue(user_login)
+            queue.delete_until(key)
+            if not queue.messages:
+                self._queues.pop(user_login, None)
+
+    def _delete(self, user_login: str, keys: List[str]):
+        """Deletes message keys of the user queue, called with the lock
+        held. Emptied queues are dropped.
+        """
+        queue = self._get_queue(user_login)
+        queue.delete(keys)
+        if not queue.messages:
+            self._queues.pop(user_login, None)
+
+    def close(self):
+        """Stops calling back user watches"""
+        self._user_watch_executor.shutdown()
@@ -0,0 +1,601 @@
+"""Metrics of the chat server in the Prometheus text format.
+
+Counters, gauges and histograms are kept in the process and rendered on
+every scrape of the HTTP endpoint. RPCs are measured by a server
+interceptor and storage calls by a storage wrapper, the servicer and the
+storage classes stay as they are.
+"""
+import bisect
+import http.server
+import logging
+import random
+import threading
+import time
+from concurrent import futures
+from typing import Callable, Dict, Iterator, List, Set, Tuple
+
+import etcd3
+import grpc
+
+from simple_chat_etcd_storage import Message, PartialWriteError
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = '/metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from half a millisecond to long streams
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+OUTCOME_OK = 'ok'
+OUTCOME_ERROR = 'error'
+
+# recipients of messages sent since the previous sample have their queue
+# depth sampled, queues are counted up to the limit
+QUEUE_DEPTH_SAMPLE_INTERVAL = 30
+QUEUE_DEPTH_SAMPLE_SIZE = 20
+QUEUE_DEPTH_LIMIT = 1000
+
+# response streams carrying one queued message per response
+DELIVERY_METHODS = frozenset(('/SimpleChat/ReceiveMessages',
+                              '/SimpleChat/SubscribeMessages'))
+CHAT_METHOD = '/SimpleChat/Chat'
+# field 1 of ChatResponse, length-delimited, starts received messages
+CHAT_RESPONSE_MESSAGE_PREFIX = b'\x0a'
+
+# etcd KV requests, every client call ends in one of them
+ETCD_OPERATIONS = ('Range', 'Put', 'DeleteRange', 'Txn')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values)) + '}'
+
+
+class _Value:
+    """Value of a counter or gauge"""
+
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.value
+
+
+class _FunctionValue:
+    """Gauge value read from the function on every scrape"""
+
+    __slots__ = ('function',)
+
+    def __init__(self, function: Callable[[], float]):
+        self.function = function
+
+    def get(self) -> float:
+        return self.function()
+
+
+class _HistogramValue:
+    """Counts of observations per bucket together with their sum"""
+
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Metric:
+    """Metric family, values are kept per label values"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        """Value of the label values, created on first use"""
+        value = self._values.get(values)
+        if value is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} takes labels {}'.format(
+                    self.name, self.labelnames))
+            with self._lock:
+                value = self._values.setdefault(values, self._create())
+        return value
+
+    def clear(self):
+        """Drops the values of all label values"""
+        with self._lock:
+            self._values = {}
+
+    def _create(self):
+        return _Value()
+
+    def collect(self) -> Iterator[str]:
+        """Lines of the metric in the text format"""
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.type)
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            yield from self._collect_value(values, value)
+
+    def _collect_value(self, values, value) -> Iterator[str]:
+        yield '{}{} {}'.format(self.name,
+                               _format_labels(self.labelnames, values),
+                               _format_value(value.get()))
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float], *values: str):
+        """Makes the value of the label values read from the function"""
+        with self._lock:
+            self._values[values] = _FunctionValue(function)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _create(self):
+        return _HistogramValue(self.buckets)
+
+    def _collect_value(self, values, value) -> Iterator[str]:
+        labelnames = self.labelnames + ('le',)
+        with value._lock:
+            counts = list(value.counts)
+            total = value.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                self.name,
+                _format_labels(labelnames, values + (_format_value(bound),)),
+                cumulative)
+        labels = _format_labels(self.labelnames, values)
+        yield '{}_sum{} {}'.format(self.name, labels, _format_value(total))
+        yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+class MetricsRegistry:
+    """Metrics rendered together on a scrape"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+class ChatMetrics(MetricsRegistry):
+    """Metrics of the chat server"""
+
+    def __init__(self):
+        super().__init__()
+        self.rpc_seconds = self.register(Histogram(
+            'chat_rpc_seconds',
+            'Time of handling RPCs, the whole stream for streaming RPCs',
+            ('method',)))
+        self.rpcs_handled = self.register(Counter(
+            'chat_rpcs_handled_total', 'Handled RPCs by their outcome',
+            ('method', 'outcome')))
+        self.rpcs_in_flight = self.register(Gauge(
+            'chat_rpcs_in_flight', 'RPCs and streams being handled',
+            ('method',)))
+        self.messages_sent = self.register(Counter(
+            'chat_messages_sent_total', 'Messages stored for receivers'))
+        self.messages_delivered = self.register(Counter(
+            'chat_messages_delivered_total',
+            'Queued messages streamed to receivers'))
+        self.queue_depth = self.register(Gauge(
+            'chat_user_queue_depth',
+            'Queued messages of sampled users sent to since the previous '
+            'sample, counted up to {}'.format(QUEUE_DEPTH_LIMIT),
+            ('login',)))
+        self.storage_seconds = self.register(Histogram(
+            'chat_storage_call_seconds', 'Time of storage calls',
+            ('method',)))
+        self.etcd_seconds = self.register(Histogram(
+            'chat_etcd_request_seconds', 'Time of etcd requests',
+            ('operation',)))
+        self.executor_threads = self.register(Gauge(
+            'chat_executor_threads', 'Threads started by the thread pool',
+            ('executor',)))
+        self.executor_max_threads = self.register(Gauge(
+            'chat_executor_max_threads', 'Threads the thread pool may start',
+            ('executor',)))
+        self.executor_queued = self.register(Gauge(
+            'chat_executor_queued_calls',
+            'Calls waiting for a thread of the thread pool', ('executor',)))
+
+    def watch_executor(self, name: str,
+                       executor: futures.ThreadPoolExecutor):
+        """Reads the saturation of the thread pool on every scrape"""
+        self.executor_threads.set_function(
+            lambda: len(executor._threads), name)
+        self.executor_max_threads.set_function(
+            lambda: executor._max_workers, name)
+        self.executor_queued.set_function(executor._work_queue.qsize, name)
+
+    def instrument_etcd(self, clients: List[etcd3.Etcd3Client]):
+        """Times the KV requests of the etcd clients"""
+        for client in clients:
+            for operation in ETCD_OPERATIONS:
+                setattr(client.kvstub, operation, self._timed(
+                    self.etcd_seconds.labels(operation),
+                    getattr(client.kvstub, operation)))
+
+    @staticmethod
+    def _timed(histogram: _HistogramValue, function: Callable) -> Callable:
+        def timed_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return timed_function
+
+
+def is_delivered_chat_response(response) -> bool:
+    """Tells received messages from sent confirmations among Chat
+    responses, which may be pre-serialized
+    """
+    if isinstance(response, bytes):
+        return response.startswith(CHAT_RESPONSE_MESSAGE_PREFIX)
+    return response.WhichOneof('response') == 'message'
+
+
+class _RpcObserver:
+    """Metric values of one RPC method"""
+
+    def __init__(self, metrics: ChatMetrics, method: str):
+        self.seconds = metrics.rpc_seconds.labels(method)
+        self.in_flight = metrics.rpcs_in_flight.labels(method)
+        self.handled_ok = metrics.rpcs_handled.labels(method, OUTCOME_OK)
+        self.handled_error = metrics.rpcs_handled.labels(method,
+                                                         OUTCOME_ERROR)
+        self.delivered = metrics.messages_delivered.labels()
+        self.is_delivery = None
+        if method in DELIVERY_METHODS:
+            self.is_delivery = lambda response: True
+        elif method == CHAT_METHOD:
+            self.is_delivery = is_delivered_chat_response
+
+    def finish(self, started: float, is_ok: bool):
+        self.seconds.observe(time.perf_counter() - started)
+        self.in_flight.dec()
+        (self.handled_ok if is_ok else self.handled_error).inc()
+
+
+class _ObservedHandlers:
+    """Handlers of the RPC methods with observed behaviors. The observed
+    handler is kept while the continuation returns the same handler of
+    the method, so calls do not build new handlers.
+    """
+
+    def __init__(self, metrics: ChatMetrics):
+        self.metrics = metrics
+        self._handlers: Dict[str, Tuple[object, object]] = {}
+
+    def _get_observed(self, method: str, handler):
+        if handler is None:
+            return handler
+
+        cached = self._handlers.get(method)
+        if cached is not None and cached[0] is handler:
+            return cached[1]
+
+        observer = _RpcObserver(self.metrics, method)
+        if handler.response_streaming:
+            if handler.request_streaming:
+                observed = handler._replace(stream_stream=self._observe_stream(
+                    observer, handler.stream_stream))
+            else:
+                observed = handler._replace(unary_stream=self._observe_stream(
+                    observer, handler.unary_stream))
+        elif handler.request_streaming:
+            observed = handler._replace(stream_unary=self._observe_unary(
+                observer, handler.stream_unary))
+        else:
+            observed = handler._replace(unary_unary=self._observe_unary(
+                observer, handler.unary_unary))
+
+        self._handlers[method] = (handler, observed)
+        return observed
+
+    @staticmethod
+    def _observe_unary(observer: _RpcObserver, behavior):
+        raise NotImplementedError
+
+    @staticmethod
+    def _observe_stream(observer: _RpcObserver, behavior):
+        raise NotImplementedError
+
+
+class MetricsInterceptor(_ObservedHandlers, grpc.ServerInterceptor):
+    """Measures time, outcome and concurrency of RPCs and counts the
+    messages streamed to receivers
+    """
+
+    def intercept_service(self, continuation, handler_call_details):
+        return self._get_observed(handler_call_details.method,
+                                  continuation(handler_call_details))
+
+    @staticmethod
+    def _observe_unary(observer: _RpcObserver, behavior):
+        def observed_behavior(request, context):
+            observer.in_flight.inc()
+            started = time.perf_counter()
+            is_ok = False
+            try:
+                response = behavior(request, context)
+                is_ok = True
+                return response
+            finally:
+                observer.finish(started, is_ok)
+
+        return observed_behavior
+
+    @staticmethod
+    def _observe_stream(observer: _RpcObserver, behavior):
+        def observed_behavior(request, context):
+            observer.in_flight.inc()
+            started = time.perf_counter()
+            is_ok = False
+            try:
+                for response in behavior(request, context):
+                    if observer.is_delivery is not None and \
+                            observer.is_delivery(response):
+                        observer.delivered.inc()
+                    yield response
+                is_ok = True
+            finally:
+                observer.finish(started, is_ok)
+
+        return observed_behavior
+
+
+class AsyncMetricsInterceptor(_ObservedHandlers,
+                              grpc.aio.ServerInterceptor):
+    """MetricsInterceptor of the asyncio server"""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return self._get_observed(handler_call_details.method,
+                                  await continuation(handler_call_details))
+
+    @staticmethod
+    def _observe_unary(observer: _RpcObserver, behavior):
+        async def observed_behavior(request, context):
+            observer.in_flight.inc()
+            started = time.perf_counter()
+            is_ok = False
+            try:
+                response = await behavior(request, context)
+                is_ok = True
+                return response
+            finally:
+                observer.finish(started, is_ok)
+
+        return observed_behavior
+
+    @staticmethod
+    def _observe_stream(observer: _RpcObserver, behavior):
+        async def observed_behavior(request, context):
+            observer.in_flight.inc()
+            started = time.perf_counter()
+            is_ok = False
+            try:
+                async for response in behavior(request, context):
+                    if observer.is_delivery is not None and \
+                            observer.is_delivery(response):
+                        observer.delivered.inc()
+                    yield response
+                is_ok = True
+            finally:
+                observer.finish(started, is_ok)
+
+        return observed_behavior
+
+
+class MetricsStorage:
+    """Storage wrapper timing the calls of the wrapped storage, counting
+    stored messages and sampling the queue depth of their recipients.
+    Other attributes are the ones of the wrapped storage.
+    """
+
+    TIMED_METHODS = (
+        'get_users', 'get_users_with_revision', 'get_users_page',
+        'put_user', 'reindex_users', 'get_user_queue_messages',
+        'get_user_queue_page', 'delete_user_queue_message',
+        'delete_user_queue_messages', 'delete_user_queue_stored_messages',
+        'delete_user_queue_message_ids', 'delete_user_queue_messages_until',
+        'get_history_page')
+
+    def __init__(self, storage, metrics: ChatMetrics,
+                 sample_interval: float = QUEUE_DEPTH_SAMPLE_INTERVAL,
+                 sample_size: int = QUEUE_DEPTH_SAMPLE_SIZE):
+        self.storage = storage
+        self.metrics = metrics
+        self.sample_size = sample_size
+        self._sent = metrics.messages_sent.labels()
+        self._recipients: Set[str] = set()
+        self._recipients_lock = threading.Lock()
+        self._closed = threading.Event()
+        for name in self.TIMED_METHODS:
+            setattr(self, name, ChatMetrics._timed(
+                metrics.storage_seconds.labels(name),
+                getattr(storage, name)))
+        self._put_message = ChatMetrics._timed(
+            metrics.storage_seconds.labels('put_message'),
+            storage.put_message)
+        self._send_message = ChatMetrics._timed(
+            metrics.storage_seconds.labels('send_message'),
+            storage.send_message)
+        self._put_messages = ChatMetrics._timed(
+            metrics.storage_seconds.labels('put_messages'),
+            storage.put_messages)
+
+        if sample_interval:
+            threading.Thread(target=self._sample_queue_depth,
+                             args=(sample_interval,), name='queue-depth',
+                             daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def put_message(self, message: Message):
+        self._put_message(message)
+        self._count_sent([message])
+
+    def send_message(self, message: Message):
+        self._send_message(message)
+        self._count_sent([message])
+
+    def put_messages(self, messages: List[Message]):
+        try:
+            self._put_messages(messages)
+        except PartialWriteError as error:
+            self._count_sent(messages[:error.stored])
+            raise
+        self._count_sent(messages)
+
+    def submit_message(self, message: Message) -> futures.Future:
+        def on_done(done: futures.Future):
+            if not done.cancelled() and done.exception() is None:
+                self._count_sent([message])
+
+        future = self.storage.submit_message(message)
+        future.add_done_callback(on_done)
+        return future
+
+    def _count_sent(self, messages: List[Message]):
+        self._sent.inc(len(messages))
+        with self._recipients_lock:
+            if len(self._recipients) < self.sample_size * 100:
+                self._recipients.update(
+                    message.recipient for message in messages)
+
+    def _sample_queue_depth(self, interval: float):
+        """Replaces the queue depths with the ones of recipients of
+        messages sent since the previous sample
+        """
+        while not self._closed.wait(interval):
+            with self._recipients_lock:
+                recipients, self._recipients = self._recipients, set()
+            logins = random.sample(sorted(recipients),
+                                   min(self.sample_size, len(recipients)))
+            depths = {}
+            try:
+                for login in logins:
+                    depths[login] = len(self.storage.get_user_queue_page(
+                        login, QUEUE_DEPTH_LIMIT).messages)
+            except Exception:
+                logger.exception('Failed to sample queue depth')
+
+            self.metrics.queue_depth.clear()
+            for login, depth in depths.items():
+                self.metrics.queue_depth.labels(login).set(depth)
+
+    def close(self):
+        """Stops sampling and closes the wrapped storage"""
+        self._closed.set()
+        self.storage.close()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics of the server registry"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(registry: MetricsRegistry, host: str,
+                         port: int) -> http.server.ThreadingHTTPServer:
+    """Serves the metrics on http://host:port/metrics from a daemon
+    thread, returns the HTTP server
+    """
+    server = http.server.ThreadingHTTPServer((host, port),
+                                             MetricsRequestHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    return server
@@ -20,7 +20,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   syntax='proto3',
   serialized_options=None,
   create_key=_descriptor._internal_create_key,
-  serialized_pb=b'\n\x11simple_chat.proto\x1a\x1fgoogle/protobuf/timestamp.proto\"(\n\x04User\x12\r\n\x05login\x18\x01 \x01(\t\x12\x11\n\tfull_name\x18\x02 \x01(\t\"g\n\x07Message\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x11\n\trecipient\x18\x02 \x01(\t\x12+\n\x07\x63reated\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12\x0c\n\x04\x62ody\x18\x04 \x01(\t\"\x11\n\x0fGetUsersRequest\"(\n\x10GetUsersResponse\x12\x14\n\x05users\x18\x01 \x03(\x0b\x32\x05.User\"/\n\x12SendMessageRequest\x12\x19\n\x07message\x18\x01 \x01(\x0b\x32\x08.Message\"\x15\n\x13SendMessageResponse\"\'\n\x16ReceiveMessagesRequest\x12\r\n\x05login\x18\x01 \x01(\t2\xaf\x01\n\nSimpleChat\x12/\n\x08GetUsers\x12\x10.GetUsersRequest\x1a\x11.GetUsersResponse\x12\x38\n\x0bSendMessage\x12\x13.SendMessageRequest\x1a\x14.SendMessageResponse\x12\x36\n\x0fReceiveMessages\x12\x17.ReceiveMessagesRequest\x1a\x08.Message0\x01\x62\x06proto3'
+  serialized_pb=b'\n\x11simple_chat.proto\x1a\x1fgoogle/protobuf/timestamp.proto\"(\n\x04User\x12\r\n\x05login\x18\x01 \x01(\t\x12\x11\n\tfull_name\x18\x02 \x01(\t\"s\n\x07Message\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x11\n\trecipient\x18\x02 \x01(\t\x12+\n\x07\x63reated\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12\x0c\n\x04\x62ody\x18\x04 \x01(\t\x12\n\n\x02id\x18\x05 \x01(\t\"c\n\x0fGetUsersRequest\x12\x11\n\tpage_size\x18\x01 \x01(\x05\x12\x12\n\npage_token\x18\x02 \x01(\t\x12\x14\n\x0clogin_prefix\x18\x03 \x01(\t\x12\x13\n\x0bname_prefix\x18\x04 \x01(\t\"A\n\x10GetUsersResponse\x12\x14\n\x05users\x18\x01 \x03(\x0b\x32\x05.User\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\"/\n\x12SendMessageRequest\x12\x19\n\x07message\x18\x01 \x01(\x0b\x32\x08.Message\"\x15\n\x13SendMessageResponse\"1\n\x13SendMessagesRequest\x12\x1a\n\x08messages\x18\x01 \x03(\x0b\x32\x08.Message\"%\n\x14SendMessagesResponse\x12\r\n\x05\x63ount\x18\x01 \x01(\x05\"=\n\x16ReceiveMessagesRequest\x12\r\n\x05login\x18\x01 \x01(\t\x12\x14\n\x0cresume_after\x18\x02 \x01(\t\"!\n\x0bMessagesAck\x12\x12\n\nmessage_id\x18\x01 \x01(\t\"p\n\x18SubscribeMessagesRequest\x12,\n\tsubscribe\x18\x01 \x01(\x0b\x32\x17.ReceiveMessagesRequestH\x00\x12\x1b\n\x03\x61\x63k\x18\x02 \x01(\x0b\x32\x0c.MessagesAckH\x00\x42\t\n\x07request\"\x80\x01\n\x0b\x43hatRequest\x12,\n\tsubscribe\x18\x01 \x01(\x0b\x32\x17.ReceiveMessagesRequestH\x00\x12\x1b\n\x07message\x18\x02 \x01(\x0b\x32\x08.MessageH\x00\x12\x1b\n\x03\x61\x63k\x18\x03 \x01(\x0b\x32\x0c.MessagesAckH\x00\x42\t\n\x07request\"Q\n\x0c\x43hatResponse\x12\x1b\n\x07message\x18\x01 \x01(\x0b\x32\x08.MessageH\x00\x12\x18\n\x04sent\x18\x02 \x01(\x0b\x32\x08.MessageH\x00\x42\n\n\x08response\"\xb5\x01\n\x11GetHistoryRequest\x12\r\n\x05login\x18\x01 \x01(\t\x12\x0c\n\x04peer\x18\x02 \x01(\t\x12.\n\nstart_time\x18\x03 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12,\n\x08\x65nd_time\x18\x04 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12\x11\n\tpage_size\x18\x05 \x01(\x05\x12\x12\n\npage_token\x18\x06 \x01(\t\"I\n\x12GetHistoryResponse\x12\x1a\n\x08messages\x18\x01 \x03(\x0b\x32\x08.Message\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t2\xcd\x03\n\nSimpleChat\x12/\n\x08GetUsers\x12\x10.GetUsersRequest\x1a\x11.GetUsersResponse\x12\x38\n\x0bSendMessage\x12\x13.SendMessageRequest\x1a\x14.SendMessageResponse\x12;\n\x0cSendMessages\x12\x14.SendMessagesRequest\x1a\x15.SendMessagesResponse\x12\x41\n\x11SendMessageStream\x12\x13.SendMessageRequest\x1a\x15.SendMessagesResponse(\x01\x12\x36\n\x0fReceiveMessages\x12\x17.ReceiveMessagesRequest\x1a\x08.Message0\x01\x12<\n\x11SubscribeMessages\x12\x19.SubscribeMessagesRequest\x1a\x08.Message(\x01\x30\x01\x12\'\n\x04\x43hat\x12\x0c.ChatRequest\x1a\r.ChatResponse(\x01\x30\x01\x12\x35\n\nGetHistory\x12\x12.GetHistoryRequest\x1a\x13.GetHistoryResponseb\x06proto3'
   ,
   dependencies=[google_dot_protobuf_dot_timestamp__pb2.DESCRIPTOR,])
 
@@ -102,6 +102,13 @@ _MESSAGE = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='id', full_name='Message.id', index=4,
+      number=5, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
   ],
   extensions=[
   ],
@@ -115,7 +122,7 @@ _MESSAGE = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=96,
-  serialized_end=199,
+  serialized_end=211,
 )
 
 
@@ -127,6 +134,34 @@ _GETUSERSREQUEST = _descriptor.Descriptor(
   containing_type=None,
   create_key=_descriptor._internal_create_key,
   fields=[
+    _descriptor.FieldDescriptor(
+      name='page_size', full_name='GetUsersRequest.page_size', index=0,
+      number=1, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='page_token', full_name='GetUsersRequest.page_token', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='login_prefix', full_name='GetUsersRequest.login_prefix', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='name_prefix', full_name='GetUsersRequest.name_prefix', index=3,
+      number=4, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
   ],
   extensions=[
   ],
@@ -139,8 +174,8 @@ _GETUSERSREQUEST = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=201,
-  serialized_end=218,
+  serialized_start=213,
+  serialized_end=312,
 )
 
 
@@ -159,6 +194,13 @@ _GETUSERSRESPONSE = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='next_page_token', full_name='GetUsersResponse.next_page_token', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
   ],
   extensions=[
   ],
@@ -171,8 +213,8 @@ _GETUSERSRESPONSE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=220,
-  serialized_end=260,
+  serialized_start=314,
+  serialized_end=379,
 )
 
 
@@ -203,8 +245,8 @@ _SENDMESSAGEREQUEST = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=262,
-  serialized_end=309,
+  serialized_start=381,
+  serialized_end=428,
 )
 
 
@@ -228,8 +270,72 @@ _SENDMESSAGERESPONSE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=311,
-  serialized_end=332,
+  serialized_start=430,
+  serialized_end=451,
+)
+
+
+_SENDMESSAGESREQUEST = _descriptor.Descriptor(
+  name='SendMessagesRequest',
+  full_name='SendMessagesRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='messages', full_name='SendMessagesRequest.messages', index=0,
+      number=1, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=453,
+  serialized_end=502,
+)
+
+
+_SENDMESSAGESRESPONSE = _descriptor.Descriptor(
+  name='SendMessagesResponse',
+  full_name='SendMessagesResponse',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='count', full_name='SendMessagesResponse.count', index=0,
+      number=1, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=504,
+  serialized_end=541,
 )
 
 
@@ -248,6 +354,290 @@ _RECEIVEMESSAGESREQUEST = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='resume_after', full_name='ReceiveMessagesRequest.resume_after', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=543,
+  serialized_end=604,
+)
+
+
+_MESSAGESACK = _descriptor.Descriptor(
+  name='MessagesAck',
+  full_name='MessagesAck',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='message_id', full_name='MessagesAck.message_id', index=0,
+      number=1, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=606,
+  serialized_end=639,
+)
+
+
+_SUBSCRIBEMESSAGESREQUEST = _descriptor.Descriptor(
+  name='SubscribeMessagesRequest',
+  full_name='SubscribeMessagesRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='subscribe', full_name='SubscribeMessagesRequest.subscribe', index=0,
+      number=1, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='ack', full_name='SubscribeMessagesRequest.ack', index=1,
+      number=2, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+    _descriptor.OneofDescriptor(
+      name='request', full_name='SubscribeMessagesRequest.request',
+      index=0, containing_type=None,
+      create_key=_descriptor._internal_create_key,
+    fields=[]),
+  ],
+  serialized_start=641,
+  serialized_end=753,
+)
+
+
+_CHATREQUEST = _descriptor.Descriptor(
+  name='ChatRequest',
+  full_name='ChatRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='subscribe', full_name='ChatRequest.subscribe', index=0,
+      number=1, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='message', full_name='ChatRequest.message', index=1,
+      number=2, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='ack', full_name='ChatRequest.ack', index=2,
+      number=3, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+    _descriptor.OneofDescriptor(
+      name='request', full_name='ChatRequest.request',
+      index=0, containing_type=None,
+      create_key=_descriptor._internal_create_key,
+    fields=[]),
+  ],
+  serialized_start=756,
+  serialized_end=884,
+)
+
+
+_CHATRESPONSE = _descriptor.Descriptor(
+  name='ChatResponse',
+  full_name='ChatResponse',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='message', full_name='ChatResponse.message', index=0,
+      number=1, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='sent', full_name='ChatResponse.sent', index=1,
+      number=2, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+    _descriptor.OneofDescriptor(
+      name='response', full_name='ChatResponse.response',
+      index=0, containing_type=None,
+      create_key=_descriptor._internal_create_key,
+    fields=[]),
+  ],
+  serialized_start=886,
+  serialized_end=967,
+)
+
+
+_GETHISTORYREQUEST = _descriptor.Descriptor(
+  name='GetHistoryRequest',
+  full_name='GetHistoryRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='login', full_name='GetHistoryRequest.login', index=0,
+      number=1, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='peer', full_name='GetHistoryRequest.peer', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='start_time', full_name='GetHistoryRequest.start_time', index=2,
+      number=3, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='end_time', full_name='GetHistoryRequest.end_time', index=3,
+      number=4, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='page_size', full_name='GetHistoryRequest.page_size', index=4,
+      number=5, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='page_token', full_name='GetHistoryRequest.page_token', index=5,
+      number=6, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=970,
+  serialized_end=1151,
+)
+
+
+_GETHISTORYRESPONSE = _descriptor.Descriptor(
+  name='GetHistoryResponse',
+  full_name='GetHistoryResponse',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  create_key=_descriptor._internal_create_key,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='messages', full_name='GetHistoryResponse.messages', index=0,
+      number=1, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
+    _descriptor.FieldDescriptor(
+      name='next_page_token', full_name='GetHistoryResponse.next_page_token', index=1,
+      number=2, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=b"".decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
   ],
   extensions=[
   ],
@@ -260,20 +650,60 @@ _RECEIVEMESSAGESREQUEST = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=334,
-  serialized_end=373,
+  serialized_start=1153,
+  serialized_end=1226,
 )
 
 _MESSAGE.fields_by_name['created'].message_type = google_dot_protobuf_dot_timestamp__pb2._TIMESTAMP
 _GETUSERSRESPONSE.fields_by_name['users'].message_type = _USER
 _SENDMESSAGEREQUEST.fields_by_name['message'].message_type = _MESSAGE
+_SENDMESSAGESREQUEST.fields_by_name['messages'].message_type = _MESSAGE
+_SUBSCRIBEMESSAGESREQUEST.fields_by_name['subscribe'].message_type = _RECEIVEMESSAGESREQUEST
+_SUBSCRIBEMESSAGESREQUEST.fields_by_name['ack'].message_type = _MESSAGESACK
+_SUBSCRIBEMESSAGESREQUEST.oneofs_by_name['request'].fields.append(
+  _SUBSCRIBEMESSAGESREQUEST.fields_by_name['subscribe'])
+_SUBSCRIBEMESSAGESREQUEST.fields_by_name['subscribe'].containing_oneof = _SUBSCRIBEMESSAGESREQUEST.oneofs_by_name['request']
+_SUBSCRIBEMESSAGESREQUEST.oneofs_by_name['request'].fields.append(
+  _SUBSCRIBEMESSAGESREQUEST.fields_by_name['ack'])
+_SUBSCRIBEMESSAGESREQUEST.fields_by_name['ack'].containing_oneof = _SUBSCRIBEMESSAGESREQUEST.oneofs_by_name['request']
+_CHATREQUEST.fields_by_name['subscribe'].message_type = _RECEIVEMESSAGESREQUEST
+_CHATREQUEST.fields_by_name['message'].message_type = _MESSAGE
+_CHATREQUEST.fields_by_name['ack'].message_type = _MESSAGESACK
+_CHATREQUEST.oneofs_by_name['request'].fields.append(
+  _CHATREQUEST.fields_by_name['subscribe'])
+_CHATREQUEST.fields_by_name['subscribe'].containing_oneof = _CHATREQUEST.oneofs_by_name['request']
+_CHATREQUEST.oneofs_by_name['request'].fields.append(
+  _CHATREQUEST.fields_by_name['message'])
+_CHATREQUEST.fields_by_name['message'].containing_oneof = _CHATREQUEST.oneofs_by_name['request']
+_CHATREQUEST.oneofs_by_name['request'].fields.append(
+  _CHATREQUEST.fields_by_name['ack'])
+_CHATREQUEST.fields_by_name['ack'].containing_oneof = _CHATREQUEST.oneofs_by_name['request']
+_CHATRESPONSE.fields_by_name['message'].message_type = _MESSAGE
+_CHATRESPONSE.fields_by_name['sent'].message_type = _MESSAGE
+_CHATRESPONSE.oneofs_by_name['response'].fields.append(
+  _CHATRESPONSE.fields_by_name['message'])
+_CHATRESPONSE.fields_by_name['message'].containing_oneof = _CHATRESPONSE.oneofs_by_name['response']
+_CHATRESPONSE.oneofs_by_name['response'].fields.append(
+  _CHATRESPONSE.fields_by_name['sent'])
+_CHATRESPONSE.fields_by_name['sent'].containing_oneof = _CHATRESPONSE.oneofs_by_name['response']
+_GETHISTORYREQUEST.fields_by_name['start_time'].message_type = google_dot_protobuf_dot_timestamp__pb2._TIMESTAMP
+_GETHISTORYREQUEST.fields_by_name['end_time'].message_type = google_dot_protobuf_dot_timestamp__pb2._TIMESTAMP
+_GETHISTORYRESPONSE.fields_by_name['messages'].message_type = _MESSAGE
 DESCRIPTOR.message_types_by_name['User'] = _USER
 DESCRIPTOR.message_types_by_name['Message'] = _MESSAGE
 DESCRIPTOR.message_types_by_name['GetUsersRequest'] = _GETUSERSREQUEST
 DESCRIPTOR.message_types_by_name['GetUsersResponse'] = _GETUSERSRESPONSE
 DESCRIPTOR.message_types_by_name['SendMessageRequest'] = _SENDMESSAGEREQUEST
 DESCRIPTOR.message_types_by_name['SendMessageResponse'] = _SENDMESSAGERESPONSE
+DESCRIPTOR.message_types_by_name['SendMessagesRequest'] = _SENDMESSAGESREQUEST
+DESCRIPTOR.message_types_by_name['SendMessagesResponse'] = _SENDMESSAGESRESPONSE
 DESCRIPTOR.message_types_by_name['ReceiveMessagesRequest'] = _RECEIVEMESSAGESREQUEST
+DESCRIPTOR.message_types_by_name['MessagesAck'] = _MESSAGESACK
+DESCRIPTOR.message_types_by_name['SubscribeMessagesRequest'] = _SUBSCRIBEMESSAGESREQUEST
+DESCRIPTOR.message_types_by_name['ChatRequest'] = _CHATREQUEST
+DESCRIPTOR.message_types_by_name['ChatResponse'] = _CHATRESPONSE
+DESCRIPTOR.message_types_by_name['GetHistoryRequest'] = _GETHISTORYREQUEST
+DESCRIPTOR.message_types_by_name['GetHistoryResponse'] = _GETHISTORYRESPONSE
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
 User = _reflection.GeneratedProtocolMessageType('User', (_message.Message,), {
@@ -318,6 +748,20 @@ SendMessageResponse = _reflection.GeneratedProtocolMessageType('SendMessageRespo
   })
 _sym_db.RegisterMessage(SendMessageResponse)
 
+SendMessagesRequest = _reflection.GeneratedProtocolMessageType('SendMessagesRequest', (_message.Message,), {
+  'DESCRIPTOR' : _SENDMESSAGESREQUEST,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:SendMessagesRequest)
+  })
+_sym_db.RegisterMessage(SendMessagesRequest)
+
+SendMessagesResponse = _reflection.GeneratedProtocolMessageType('SendMessagesResponse', (_message.Message,), {
+  'DESCRIPTOR' : _SENDMESSAGESRESPONSE,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:SendMessagesResponse)
+  })
+_sym_db.RegisterMessage(SendMessagesResponse)
+
 ReceiveMessagesRequest = _reflection.GeneratedProtocolMessageType('ReceiveMessagesRequest', (_message.Message,), {
   'DESCRIPTOR' : _RECEIVEMESSAGESREQUEST,
   '__module__' : 'simple_chat_pb2'
@@ -325,6 +769,48 @@ ReceiveMessagesRequest = _reflection.GeneratedProtocolMessageType('ReceiveMessag
   })
 _sym_db.RegisterMessage(ReceiveMessagesRequest)
 
+MessagesAck = _reflection.GeneratedProtocolMessageType('MessagesAck', (_message.Message,), {
+  'DESCRIPTOR' : _MESSAGESACK,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:MessagesAck)
+  })
+_sym_db.RegisterMessage(MessagesAck)
+
+SubscribeMessagesRequest = _reflection.GeneratedProtocolMessageType('SubscribeMessagesRequest', (_message.Message,), {
+  'DESCRIPTOR' : _SUBSCRIBEMESSAGESREQUEST,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:SubscribeMessagesRequest)
+  })
+_sym_db.RegisterMessage(SubscribeMessagesRequest)
+
+ChatRequest = _reflection.GeneratedProtocolMessageType('ChatRequest', (_message.Message,), {
+  'DESCRIPTOR' : _CHATREQUEST,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:ChatRequest)
+  })
+_sym_db.RegisterMessage(ChatRequest)
+
+ChatResponse = _reflection.GeneratedProtocolMessageType('ChatResponse', (_message.Message,), {
+  'DESCRIPTOR' : _CHATRESPONSE,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:ChatResponse)
+  })
+_sym_db.RegisterMessage(ChatResponse)
+
+GetHistoryRequest = _reflection.GeneratedProtocolMessageType('GetHistoryRequest', (_message.Message,), {
+  'DESCRIPTOR' : _GETHISTORYREQUEST,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:GetHistoryRequest)
+  })
+_sym_db.RegisterMessage(GetHistoryRequest)
+
+GetHistoryResponse = _reflection.GeneratedProtocolMessageType('GetHistoryResponse', (_message.Message,), {
+  'DESCRIPTOR' : _GETHISTORYRESPONSE,
+  '__module__' : 'simple_chat_pb2'
+  # @@protoc_insertion_point(class_scope:GetHistoryResponse)
+  })
+_sym_db.RegisterMessage(GetHistoryResponse)
+
 
 
 _SIMPLECHAT = _descriptor.ServiceDescriptor(
@@ -334,8 +820,8 @@ _SIMPLECHAT = _descriptor.ServiceDescriptor(
   index=0,
   serialized_options=None,
   create_key=_descriptor._internal_create_key,
-  serialized_start=376,
-  serialized_end=551,
+  serialized_start=1229,
+  serialized_end=1690,
   methods=[
   _descriptor.MethodDescriptor(
     name='GetUsers',
@@ -357,16 +843,66 @@ _SIMPLECHAT = _descriptor.ServiceDescriptor(
     serialized_options=None,
     create_key=_descriptor._internal_create_key,
   ),
+  _descriptor.MethodDescriptor(
+    name='SendMessages',
+    full_name='SimpleChat.SendMessages',
+    index=2,
+    containing_service=None,
+    input_type=_SENDMESSAGESREQUEST,
+    output_type=_SENDMESSAGESRESPONSE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
+  _descriptor.MethodDescriptor(
+    name='SendMessageStream',
+    full_name='SimpleChat.SendMessageStream',
+    index=3,
+    containing_service=None,
+    input_type=_SENDMESSAGEREQUEST,
+    output_type=_SENDMESSAGESRESPONSE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
   _descriptor.MethodDescriptor(
     name='ReceiveMessages',
     full_name='SimpleChat.ReceiveMessages',
-    index=2,
+    index=4,
     containing_service=None,
     input_type=_RECEIVEMESSAGESREQUEST,
     output_type=_MESSAGE,
     serialized_options=None,
     create_key=_descriptor._internal_create_key,
   ),
+  _descriptor.MethodDescriptor(
+    name='SubscribeMessages',
+    full_name='SimpleChat.SubscribeMessages',
+    index=5,
+    containing_service=None,
+    input_type=_SUBSCRIBEMESSAGESREQUEST,
+    output_type=_MESSAGE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
+  _descriptor.MethodDescriptor(
+    name='Chat',
+    full_name='SimpleChat.Chat',
+    index=6,
+    containing_service=None,
+    input_type=_CHATREQUEST,
+    output_type=_CHATRESPONSE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
+  _descriptor.MethodDescriptor(
+    name='GetHistory',
+    full_name='SimpleChat.GetHistory',
+    index=7,
+    containing_service=None,
+    input_type=_GETHISTORYREQUEST,
+    output_type=_GETHISTORYRESPONSE,
+    serialized_options=None,
+    create_key=_descriptor._internal_create_key,
+  ),
 ])
 _sym_db.RegisterServiceDescriptor(_SIMPLECHAT)
 
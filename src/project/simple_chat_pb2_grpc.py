@@ -25,11 +25,36 @@ class SimpleChatStub(object):
                 request_serializer=simple__chat__pb2.SendMessageRequest.SerializeToString,
                 response_deserializer=simple__chat__pb2.SendMessageResponse.FromString,
                 )
+        self.SendMessages = channel.unary_unary(
+                '/SimpleChat/SendMessages',
+                request_serializer=simple__chat__pb2.SendMessagesRequest.SerializeToString,
+                response_deserializer=simple__chat__pb2.SendMessagesResponse.FromString,
+                )
+        self.SendMessageStream = channel.stream_unary(
+                '/SimpleChat/SendMessageStream',
+                request_serializer=simple__chat__pb2.SendMessageRequest.SerializeToString,
+                response_deserializer=simple__chat__pb2.SendMessagesResponse.FromString,
+                )
         self.ReceiveMessages = channel.unary_stream(
                 '/SimpleChat/ReceiveMessages',
                 request_serializer=simple__chat__pb2.ReceiveMessagesRequest.SerializeToString,
                 response_deserializer=simple__chat__pb2.Message.FromString,
                 )
+        self.SubscribeMessages = channel.stream_stream(
+                '/SimpleChat/SubscribeMessages',
+                request_serializer=simple__chat__pb2.SubscribeMessagesRequest.SerializeToString,
+                response_deserializer=simple__chat__pb2.Message.FromString,
+                )
+        self.Chat = channel.stream_stream(
+                '/SimpleChat/Chat',
+                request_serializer=simple__chat__pb2.ChatRequest.SerializeToString,
+                response_deserializer=simple__chat__pb2.ChatResponse.FromString,
+                )
+        self.GetHistory = channel.unary_unary(
+                '/SimpleChat/GetHistory',
+                request_serializer=simple__chat__pb2.GetHistoryRequest.SerializeToString,
+                response_deserializer=simple__chat__pb2.GetHistoryResponse.FromString,
+                )
 
 
 class SimpleChatServicer(object):
@@ -37,7 +62,8 @@ class SimpleChatServicer(object):
     """
 
     def GetUsers(self, request, context):
-        """Obtains list of user
+        """Obtains list of user. The list is returned at once for an empty
+        request, otherwise page by page
         """
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
@@ -50,6 +76,23 @@ class SimpleChatServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendMessages(self, request, context):
+        """Send batch of retrieved messages to users at once. Fails with
+        ABORTED telling how many messages were stored before the error
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SendMessageStream(self, request_iterator, context):
+        """Send stream of retrieved messages to users. Messages are
+        stored in batches while the stream is being read. Fails with
+        ABORTED telling how many messages were stored before the error
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def ReceiveMessages(self, request, context):
         """Subscribe user to receive messages. Results are
         streamed rather than returned at once
@@ -58,6 +101,35 @@ class SimpleChatServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SubscribeMessages(self, request_iterator, context):
+        """Subscribe user to receive messages acknowledged by the client. The
+        first request subscribes, the next ones acknowledge received
+        messages. Queued messages are deleted only when acknowledged, so
+        unacknowledged ones are streamed again after a reconnect
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Chat(self, request_iterator, context):
+        """Chat as the subscribed user over one stream. The first request
+        subscribes like in SubscribeMessages, the next ones send messages
+        from the user or acknowledge received ones. Every sent message is
+        confirmed once stored, received messages come on the same stream
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetHistory(self, request, context):
+        """Obtains messages between two users, the newest first, page by page.
+        Messages are kept for the history time to live of the server, fails
+        with FAILED_PRECONDITION when the server keeps no history
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_SimpleChatServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -71,11 +143,36 @@ def add_SimpleChatServicer_to_server(servicer, server):
                     request_deserializer=simple__chat__pb2.SendMessageRequest.FromString,
                     response_serializer=simple__chat__pb2.SendMessageResponse.SerializeToString,
             ),
+            'SendMessages': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendMessages,
+                    request_deserializer=simple__chat__pb2.SendMessagesRequest.FromString,
+                    response_serializer=simple__chat__pb2.SendMessagesResponse.SerializeToString,
+            ),
+            'SendMessageStream': grpc.stream_unary_rpc_method_handler(
+                    servicer.SendMessageStream,
+                    request_deserializer=simple__chat__pb2.SendMessageRequest.FromString,
+                    response_serializer=simple__chat__pb2.SendMessagesResponse.SerializeToString,
+            ),
             'ReceiveMessages': grpc.unary_stream_rpc_method_handler(
                     servicer.ReceiveMessages,
                     request_deserializer=simple__chat__pb2.ReceiveMessagesRequest.FromString,
                     response_serializer=simple__chat__pb2.Message.SerializeToString,
             ),
+            'SubscribeMessages': grpc.stream_stream_rpc_method_handler(
+                    servicer.SubscribeMessages,
+                    request_deserializer=simple__chat__pb2.SubscribeMessagesRequest.FromString,
+                    response_serializer=simple__chat__pb2.Message.SerializeToString,
+            ),
+            'Chat': grpc.stream_stream_rpc_method_handler(
+                    servicer.Chat,
+                    request_deserializer=simple__chat__pb2.ChatRequest.FromString,
+                    response_serializer=simple__chat__pb2.ChatResponse.SerializeToString,
+            ),
+            'GetHistory': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetHistory,
+                    request_deserializer=simple__chat__pb2.GetHistoryRequest.FromString,
+                    response_serializer=simple__chat__pb2.GetHistoryResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'SimpleChat', rpc_method_handlers)
@@ -121,6 +218,40 @@ class SimpleChat(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def SendMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/SimpleChat/SendMessages',
+            simple__chat__pb2.SendMessagesRequest.SerializeToString,
+            simple__chat__pb2.SendMessagesResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SendMessageStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/SimpleChat/SendMessageStream',
+            simple__chat__pb2.SendMessageRequest.SerializeToString,
+            simple__chat__pb2.SendMessagesResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def ReceiveMessages(request,
             target,
@@ -137,3 +268,54 @@ class SimpleChat(object):
             simple__chat__pb2.Message.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SubscribeMessages(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/SimpleChat/SubscribeMessages',
+            simple__chat__pb2.SubscribeMessagesRequest.SerializeToString,
+            simple__chat__pb2.Message.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Chat(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/SimpleChat/Chat',
+            simple__chat__pb2.ChatRequest.SerializeToString,
+            simple__chat__pb2.ChatResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def GetHistory(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/SimpleChat/GetHistory',
+            simple__chat__pb2.GetHistoryRequest.SerializeToString,
+            simple__chat__pb2.GetHistoryResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
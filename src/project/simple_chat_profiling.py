@@ -0,0 +1,259 @@
+"""Profiling hooks of the chat server.
+
+A sampling profiler started by a signal records the stacks of all
+threads for a while and writes them as collapsed stacks, one line per
+stack with the number of samples it was seen in, the input of flame
+graph tools. A slow-call log reports storage calls and RPCs taking
+longer than a threshold together with the sizes of their arguments.
+"""
+import collections
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from typing import Callable, Counter, Dict, Optional, Tuple
+
+import grpc
+
+from simple_chat_etcd_storage import Message
+from simple_chat_metrics import MetricsStorage
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIRECTORY = '.'
+PROFILE_SECONDS = 10
+# seconds between samples, a sample of a few dozen threads takes well
+# under a millisecond
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_FILE_NAME = 'profile-{pid}-{time}.collapsed'
+
+# pools number their threads, numbers are dropped to merge their stacks
+THREAD_NUMBER_PATTERN = re.compile(r'[-_]?\d+$')
+
+
+class SamplingProfiler:
+    """Counts the stacks of all other threads sampled at the interval"""
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter[str] = collections.Counter()
+        self.samples = 0
+
+    def sample(self):
+        names = {thread.ident: THREAD_NUMBER_PATTERN.sub('', thread.name)
+                 for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append('{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            frames.append(names.get(ident, 'thread'))
+            frames.reverse()
+            self.stacks[';'.join(frames)] += 1
+        self.samples += 1
+
+    def run(self, seconds: float):
+        """Samples until the seconds pass"""
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+
+    def write_collapsed(self, path: str):
+        """Writes the stacks, the most frequent first"""
+        with open(path, 'w') as collapsed:
+            for stack, count in self.stacks.most_common():
+                collapsed.write('{} {}\n'.format(stack.replace(' ', '_'),
+                                                 count))
+
+
+class ProfileTrigger:
+    """Profiles the process in the background on request, one profile at
+    a time, and writes it to a new file of the directory
+    """
+
+    def __init__(self, directory: str = PROFILE_DIRECTORY,
+                 seconds: float = PROFILE_SECONDS,
+                 interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.directory = directory
+        self.seconds = seconds
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def install(self, signum: int = getattr(signal, 'SIGUSR1', None)):
+        """Profiles on the signal, must be called from the main thread"""
+        signal.signal(signum, lambda *_: self.start())
+
+    def start(self) -> Optional[threading.Thread]:
+        """Starts profiling, returns the profiling thread or None when a
+        profile is already being taken
+        """
+        if not self._lock.acquire(blocking=False):
+            logger.warning('Profile is already being taken')
+            return None
+
+        thread = threading.Thread(target=self._profile, name='profiler',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _profile(self):
+        try:
+            path = os.path.join(self.directory, PROFILE_FILE_NAME.format(
+                pid=os.getpid(), time=time.strftime('%Y%m%d-%H%M%S')))
+            profiler = SamplingProfiler(self.interval)
+            profiler.run(self.seconds)
+            profiler.write_collapsed(path)
+            logger.warning('Profile of %s samples is written to %s',
+                           profiler.samples, path)
+        except Exception:
+            logger.exception('Failed to profile')
+        finally:
+            self._lock.release()
+
+
+def describe_size(value) -> str:
+    """Short description of the size of a call argument"""
+    if isinstance(value, Message):
+        return 'message of {} chars'.format(len(value.body))
+    if hasattr(value, 'ByteSize'):
+        return '{} bytes'.format(value.ByteSize())
+    if isinstance(value, (str, bytes)):
+        return '{} chars'.format(len(value))
+    if isinstance(value, (list, tuple, dict, set)):
+        return '{} items'.format(len(value))
+    if hasattr(value, '__next__') or hasattr(value, '__anext__'):
+        return 'stream'
+    return type(value).__name__
+
+
+class SlowCallLog:
+    """Logs calls taking at least the threshold seconds with the sizes of
+    their arguments
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+
+    def log(self, name: str, seconds: float, args: tuple,
+            kwargs: Optional[dict] = None):
+        sizes = [describe_size(arg) for arg in args]
+        sizes.extend('{}={}'.format(key, describe_size(value))
+                     for key, value in (kwargs or {}).items())
+        logger.warning('Slow call %s took %.3f s, arguments: %s', name,
+                       seconds, ', '.join(sizes))
+
+    def traced(self, name: str, function: Callable,
+               described_args: Optional[int] = None) -> Callable:
+        """Function logging its slow calls, only the first described_args
+        positional arguments are described when given
+        """
+        threshold = self.threshold
+
+        def traced_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - started
+                if seconds >= threshold:
+                    self.log(name, seconds, args[:described_args], kwargs)
+
+        return traced_function
+
+    def traced_async(self, name: str, function: Callable,
+                     described_args: Optional[int] = None) -> Callable:
+        """traced for coroutine functions"""
+        threshold = self.threshold
+
+        async def traced_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - started
+                if seconds >= threshold:
+                    self.log(name, seconds, args[:described_args], kwargs)
+
+        return traced_function
+
+
+class _TracedHandlers:
+    """Handlers of the RPC methods with a single response with traced
+    behaviors, kept while the continuation returns the same handler.
+    Response streams last as long as their clients want, the storage
+    calls made for them are logged instead.
+    """
+
+    def __init__(self, slow_call_log: SlowCallLog):
+        self.slow_call_log = slow_call_log
+        self._handlers: Dict[str, Tuple[object, object]] = {}
+
+    def _get_traced(self, method: str, handler):
+        if handler is None or handler.response_streaming:
+            return handler
+
+        cached = self._handlers.get(method)
+        if cached is not None and cached[0] is handler:
+            return cached[1]
+
+        if handler.request_streaming:
+            traced = handler._replace(stream_unary=self._trace(
+                method, handler.stream_unary))
+        else:
+            traced = handler._replace(unary_unary=self._trace(
+                method, handler.unary_unary))
+        self._handlers[method] = (handler, traced)
+        return traced
+
+    def _trace(self, method: str, behavior: Callable) -> Callable:
+        raise NotImplementedError
+
+
+class SlowCallInterceptor(_TracedHandlers, grpc.ServerInterceptor):
+    """Logs slow RPCs with a single response"""
+
+    def intercept_service(self, continuation, handler_call_details):
+        return self._get_traced(handler_call_details.method,
+                                continuation(handler_call_details))
+
+    def _trace(self, method: str, behavior: Callable) -> Callable:
+        # the request is described, the context is not
+        return self.slow_call_log.traced(method, behavior, 1)
+
+
+class AsyncSlowCallInterceptor(_TracedHandlers, grpc.aio.ServerInterceptor):
+    """SlowCallInterceptor of the asyncio server"""
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return self._get_traced(handler_call_details.method,
+                                await continuation(handler_call_details))
+
+    def _trace(self, method: str, behavior: Callable) -> Callable:
+        return self.slow_call_log.traced_async(method, behavior, 1)
+
+
+class SlowCallStorage:
+    """Storage wrapper logging slow calls of the wrapped storage. Other
+    attributes are the ones of the wrapped storage.
+    """
+
+    TRACED_METHODS = MetricsStorage.TIMED_METHODS + (
+        'put_message', 'send_message', 'put_messages')
+
+    def __init__(self, storage, slow_call_log: SlowCallLog):
+        self.storage = storage
+        for name in self.TRACED_METHODS:
+            setattr(self, name, slow_call_log.traced(
+                name, getattr(storage, name)))
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
@@ -1,7 +1,15 @@
 """Simple chat application"""
+import asyncio
+import base64
+import collections
 import os
+import queue
+import signal
+import threading
 import time
 from concurrent import futures
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
 import grpc
 from grpc_reflection.v1alpha import reflection
@@ -9,53 +17,681 @@ from google.protobuf.timestamp_pb2 import Timestamp
 
 import simple_chat_pb2
 import simple_chat_pb2_grpc
-from simple_chat_etcd_storage import Storage, Message
+from simple_chat_etcd_storage import (BaseStorage, Storage, Message,
+                                      PartialWriteError, User,
+                                      DEFAULT_MESSAGE_CODEC,
+                                      ETCD_POOL_SIZE, MESSAGE_CODECS,
+                                      POOL_ROUND_ROBIN, QUEUE_PAGE_SIZE,
+                                      STORAGE_MAX_TXN_OPS)
+from simple_chat_memory_storage import MemoryStorage
+from simple_chat_metrics import (ChatMetrics, MetricsInterceptor,
+                                 MetricsStorage, start_metrics_server)
+from simple_chat_profiling import (ProfileTrigger, SlowCallInterceptor,
+                                   SlowCallLog, SlowCallStorage,
+                                   PROFILE_DIRECTORY, PROFILE_SECONDS)
+from simple_chat_sqlite_storage import SqliteQueueStorage, QUEUE_DATABASE_PATH
+
+DELIVERY_MODE_POLLING = 'polling'
+DELIVERY_MODE_WATCH = 'watch'
+# watch delivery streaming the stored protobuf values without decoding
+DELIVERY_MODE_FORWARD = 'forward'
+DELIVERY_MODES = (DELIVERY_MODE_POLLING, DELIVERY_MODE_WATCH,
+                  DELIVERY_MODE_FORWARD)
+POLLING_INTERVAL = 1
+
+SERVER_MODE_THREADED = 'threaded'
+SERVER_MODE_AIO = 'aio'
+SERVER_MODES = (SERVER_MODE_THREADED, SERVER_MODE_AIO)
+
+STORAGE_BACKEND_ETCD = 'etcd'
+# single-node storage in the server memory, queues are lost on restart
+STORAGE_BACKEND_MEMORY = 'memory'
+# message queues in a local SQLite database, users in etcd
+STORAGE_BACKEND_SQLITE = 'sqlite'
+STORAGE_BACKENDS = (STORAGE_BACKEND_ETCD, STORAGE_BACKEND_MEMORY,
+                    STORAGE_BACKEND_SQLITE)
+
+# messages of a client stream are stored with one transaction per batch
+SEND_STREAM_BATCH_SIZE = STORAGE_MAX_TXN_OPS
+# messages stored before a failed batch stay stored, the client is told
+PARTIAL_WRITE_DETAILS = '{} messages were stored before the error: {}'
+
+USERS_PAGE_SIZE = 100
+USERS_MAX_PAGE_SIZE = 1000
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+HISTORY_DISABLED_DETAILS = 'History is not kept, HISTORY_TTL is not set'
+
+# messages streamed to an acknowledged subscription without an ack
+ACK_WINDOW = 1000
+SUBSCRIBE_FIRST_DETAILS = 'The first request must be a subscription'
+# a failed send ends the chat stream, messages sent after it are dropped
+CHAT_SEND_FAILED_DETAILS = 'Message was not stored: {}'
+# field 1 of ChatResponse, length-delimited
+CHAT_RESPONSE_MESSAGE_TAG = 0x0a
+
+# threads serving unary and client streaming calls, streams get their own
+UNARY_MAX_WORKERS = 10
+# response streams open at once, more are refused
+MAX_STREAMS = 1000
+# unary calls waiting for a thread, more are refused by gRPC
+UNARY_MAX_QUEUED = 100
+# seconds between pings of idle connections and to wait for their ack
+KEEPALIVE_TIME = 60
+KEEPALIVE_TIMEOUT = 20
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+STREAMS_EXHAUSTED_DETAILS = 'Too many open streams, try again later'
+
+
+def message_from_proto(message: simple_chat_pb2.Message) -> Message:
+    """Converts retrieved protocol message to the stored message"""
+    return Message(message.sender, message.recipient, message.body)
+
+
+def message_to_proto(message: Message) -> simple_chat_pb2.Message:
+    """Converts stored message to the protocol message"""
+    timestamp = Timestamp()
+    timestamp.FromSeconds(int(message.created))
+    return simple_chat_pb2.Message(
+        sender=message.sender,
+        recipient=message.recipient,
+        body=message.body,
+        created=timestamp,
+        id=message.message_id)
+
+
+def encode_page_token(next_key: Optional[str]) -> Optional[str]:
+    """Passes the storage key of the next page as an opaque token"""
+    if next_key is None:
+        return None
+    return base64.urlsafe_b64encode(next_key.encode()).decode()
+
+
+def decode_page_token(page_token: str) -> Optional[str]:
+    """Storage start key of the page token, None for the first page.
+    Raises ValueError for invalid token
+    """
+    if not page_token:
+        return None
+    try:
+        return base64.urlsafe_b64decode(page_token.encode()).decode()
+    except ValueError:
+        raise ValueError('Invalid page token')
+
+
+def get_page_size(page_size: int, default: int, maximum: int) -> int:
+    """Requested page size, the default when not set. Raises ValueError
+    for negative size
+    """
+    if page_size < 0:
+        raise ValueError('Page size must not be negative')
+    return min(page_size or default, maximum)
+
+
+def users_to_proto(users: List[User], next_key: Optional[str] = None
+                   ) -> simple_chat_pb2.GetUsersResponse:
+    """Converts stored users to the protocol response, the storage key
+    of the next page is passed as an opaque page token
+    """
+    return simple_chat_pb2.GetUsersResponse(
+        users=[simple_chat_pb2.User(login=user.login,
+                                    full_name=user.full_name)
+               for user in users],
+        next_page_token=encode_page_token(next_key))
+
+
+def is_users_page_request(request: simple_chat_pb2.GetUsersRequest) -> bool:
+    """Empty request asks for the whole list like before paging"""
+    return request != simple_chat_pb2.GetUsersRequest()
+
+
+def users_page_from_proto(request: simple_chat_pb2.GetUsersRequest
+                          ) -> Tuple[int, Optional[str]]:
+    """Converts the page request to the page size and the storage start
+    key. Raises ValueError for invalid page size or token
+    """
+    return (get_page_size(request.page_size, USERS_PAGE_SIZE,
+                          USERS_MAX_PAGE_SIZE),
+            decode_page_token(request.page_token))
+
+
+def history_page_from_proto(request: simple_chat_pb2.GetHistoryRequest
+                            ) -> Tuple[int, Optional[float], Optional[float],
+                                       Optional[str]]:
+    """Converts the history request to the page size, the start and end
+    times in seconds and the storage start key. Raises ValueError for
+    missing logins, invalid page size or token
+    """
+    if not request.login or not request.peer:
+        raise ValueError('Login and peer must be set')
+
+    start_time = end_time = None
+    if request.HasField('start_time'):
+        start_time = request.start_time.ToMicroseconds() / 1e6
+    if request.HasField('end_time'):
+        end_time = request.end_time.ToMicroseconds() / 1e6
+
+    return (get_page_size(request.page_size, HISTORY_PAGE_SIZE,
+                          HISTORY_MAX_PAGE_SIZE),
+            start_time, end_time, decode_page_token(request.page_token))
+
+
+def history_to_proto(messages: List[Message],
+                     next_key: Optional[str] = None
+                     ) -> simple_chat_pb2.GetHistoryResponse:
+    """Converts history page to the protocol response"""
+    return simple_chat_pb2.GetHistoryResponse(
+        messages=[message_to_proto(message) for message in messages],
+        next_page_token=encode_page_token(next_key))
+
+
+def serialize_response(response) -> bytes:
+    """Response serializer that passes pre-serialized responses through"""
+    if isinstance(response, bytes):
+        return response
+    return response.SerializeToString()
+
+
+def serialize_chat_message(value: bytes) -> bytes:
+    """Serializes ChatResponse carrying the received message from the
+    already serialized message, the message is not decoded
+    """
+    header = bytearray((CHAT_RESPONSE_MESSAGE_TAG,))
+    length = len(value)
+    while length > 0x7f:
+        header.append(length & 0x7f | 0x80)
+        length >>= 7
+    header.append(length)
+    return bytes(header) + value
+
+
+class PreSerializedResponseHandler(grpc.GenericRpcHandler):
+    """Serves the servicer methods that may return pre-serialized bytes.
+    It is registered before the generated handler, which serves the rest.
+    """
+
+    def __init__(self, servicer):
+        get_users_request = simple_chat_pb2.GetUsersRequest
+        receive_messages_request = simple_chat_pb2.ReceiveMessagesRequest
+        subscribe_messages_request = \
+            simple_chat_pb2.SubscribeMessagesRequest
+        chat_request = simple_chat_pb2.ChatRequest
+        self._handlers = {
+            '/SimpleChat/GetUsers': grpc.unary_unary_rpc_method_handler(
+                servicer.GetUsers,
+                request_deserializer=get_users_request.FromString,
+                response_serializer=serialize_response),
+            '/SimpleChat/ReceiveMessages':
+                grpc.unary_stream_rpc_method_handler(
+                    servicer.ReceiveMessages,
+                    request_deserializer=receive_messages_request.FromString,
+                    response_serializer=serialize_response),
+            '/SimpleChat/SubscribeMessages':
+                grpc.stream_stream_rpc_method_handler(
+                    servicer.SubscribeMessages,
+                    request_deserializer=subscribe_messages_request.FromString,
+                    response_serializer=serialize_response),
+            '/SimpleChat/Chat': grpc.stream_stream_rpc_method_handler(
+                servicer.Chat,
+                request_deserializer=chat_request.FromString,
+                response_serializer=serialize_response),
+        }
+
+    def service(self, handler_call_details):
+        return self._handlers.get(handler_call_details.method)
+
+
+class MessageAcknowledger:
+    """Ids of messages streamed to a subscriber and not acknowledged yet.
+
+    An ack of a message id covers it and all messages streamed before it.
+    At most `window` messages stay unacknowledged, the stream waits for
+    acks then. The acknowledger is closed when no more acks can come, the
+    stream ends when the window fills then.
+    """
+
+    def __init__(self, window: int = ACK_WINDOW):
+        self.window = window
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def add(self, message_id: str) -> bool:
+        """Remembers streamed message, False when it is already pending"""
+        with self._condition:
+            if message_id in self._pending:
+                return False
+            self._pending[message_id] = None
+            return True
+
+    def ack(self, message_id: str) -> List[str]:
+        """Returns ids of the acknowledged messages, an unknown id
+        acknowledges nothing
+        """
+        with self._condition:
+            if message_id not in self._pending:
+                return []
+
+            acked = []
+            while not acked or acked[-1] != message_id:
+                acked.append(self._pending.popitem(last=False)[0])
+            self._wake()
+            return acked
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._wake()
+
+    def wait_for_room(self, timeout: Optional[float] = None) -> bool:
+        """Waits until one more message may be streamed. False when the
+        window is full after the timeout or for good
+        """
+        with self._condition:
+            self._condition.wait_for(self._is_settled, timeout)
+            return len(self._pending) < self.window
+
+    def _is_settled(self) -> bool:
+        """Called with the condition held"""
+        return self._closed or len(self._pending) < self.window
+
+    def _wake(self):
+        """Wakes the stream, called with the condition held"""
+        self._condition.notify_all()
+
+
+class UserDirectory:
+    """In-memory copy of the stored users kept current by an etcd watch.
+
+    The directory is loaded on first use. The serialized GetUsersResponse
+    is kept until a user changes, so unchanged directory is served without
+    any storage I/O or protobuf encoding.
+    """
+
+    def __init__(self, storage: BaseStorage):
+        self._storage = storage
+        self._lock = threading.Lock()
+        self._users = None
+        self._response = None
+        self._cancel_watch = None
+
+    def _load(self):
+        """Loads the users and watches them, called with the lock held"""
+        users, revision = self._storage.get_users_with_revision()
+        self._users = {user.login: user for user in users}
+        self._response = None
+        self._cancel_watch = self._storage.watch_users(
+            self._on_users_changed, revision + 1)
+
+    def _on_users_changed(self, changes):
+        """Called from the etcd watch thread"""
+        with self._lock:
+            if isinstance(changes, Exception):
+                # reloaded with a new watch on the next request
+                self._users = None
+            elif self._users is not None:
+                for login, user in changes:
+                    if user is None:
+                        self._users.pop(login, None)
+                    else:
+                        self._users[login] = user
+            self._response = None
+
+    def get_users(self) -> List[User]:
+        """Getting sequence of users ordered by login"""
+        with self._lock:
+            if self._users is None:
+                self._load()
+            return [self._users[login] for login in sorted(self._users)]
+
+    def get_serialized_response(self) -> bytes:
+        """Getting serialized GetUsersResponse with all users"""
+        with self._lock:
+            if self._users is None:
+                self._load()
+            if self._response is None:
+                self._response = users_to_proto(
+                    [self._users[login] for login in sorted(self._users)]
+                ).SerializeToString()
+            return self._response
+
+    def close(self):
+        """Stops watching the users"""
+        with self._lock:
+            if self._cancel_watch is not None:
+                self._cancel_watch()
+            self._cancel_watch = None
+            self._users = None
 
 
 class SimpleChatServicer(simple_chat_pb2_grpc.SimpleChatServicer):
-    """Provides methods that implement functionality of simple chat server."""
+    """Provides methods that implement functionality of simple chat server.
+
+    With local delivery a sent message is handed straight to the streams
+    of its recipient subscribed to this server and stored afterwards.
+    """
+
+    def __init__(self, storage: BaseStorage,
+                 delivery_mode: str = DELIVERY_MODE_WATCH,
+                 user_directory: Optional[UserDirectory] = None,
+                 is_local_delivery: bool = False):
+        if delivery_mode not in DELIVERY_MODES:
+            raise ValueError('Unknown delivery mode: {}'.format(delivery_mode))
 
-    def __init__(self, storage: Storage):
         self._storage = storage
+        self._delivery_mode = delivery_mode
+        self._user_directory = user_directory
+        self._is_local_delivery = is_local_delivery
 
     def GetUsers(self, request, context):
-        """Obtains list of user"""
-        return simple_chat_pb2.GetUsersResponse(
-            users=[simple_chat_pb2.User(login=user.login,
-                                        full_name=user.full_name)
-                   for user in self._storage.get_users()])
+        """Obtains list of user. The whole list comes from the user
+        directory already serialized, pages are read from the storage.
+        """
+        if is_users_page_request(request):
+            try:
+                page_size, start_key = users_page_from_proto(request)
+                users, next_key = self._storage.get_users_page(
+                    page_size, start_key, request.login_prefix,
+                    request.name_prefix)
+            except ValueError as error:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+
+            return users_to_proto(users, next_key)
+
+        if self._user_directory is not None:
+            return self._user_directory.get_serialized_response()
+
+        return users_to_proto(self._storage.get_users())
+
+    def GetHistory(self, request, context):
+        """Obtains page of messages between two users, the newest first"""
+        if self._storage.history_ttl is None:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION,
+                          HISTORY_DISABLED_DETAILS)
+
+        try:
+            page_size, start_time, end_time, start_key = \
+                history_page_from_proto(request)
+            messages, next_key = self._storage.get_history_page(
+                request.login, request.peer, page_size, start_time,
+                end_time, start_key)
+        except ValueError as error:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+
+        return history_to_proto(messages, next_key)
 
     def SendMessage(self, request, context):
         """Put retrieved message to storage"""
-        message = Message(request.message.sender,
-                          request.message.recipient,
-                          request.message.body)
+        message = message_from_proto(request.message)
 
-        self._storage.put_message(message)
+        self._send(message)
 
         return simple_chat_pb2.SendMessageResponse()
 
+    def SendMessages(self, request, context):
+        """Put retrieved batch of messages to storage at once. When the
+        storage fails part way, the RPC is aborted with the number of
+        already stored messages.
+        """
+        messages = [message_from_proto(message)
+                    for message in request.messages]
+
+        try:
+            self._storage.put_messages(messages)
+        except PartialWriteError as error:
+            context.abort(grpc.StatusCode.ABORTED,
+                          PARTIAL_WRITE_DETAILS.format(error.stored,
+                                                       error.error))
+
+        return simple_chat_pb2.SendMessagesResponse(count=len(messages))
+
+    def SendMessageStream(self, request_iterator, context):
+        """Put streamed messages to storage in batches. When the storage
+        fails, the RPC is aborted with the number of already stored
+        messages.
+        """
+        count = 0
+        batch = []
+        try:
+            for request in request_iterator:
+                batch.append(message_from_proto(request.message))
+                if len(batch) == SEND_STREAM_BATCH_SIZE:
+                    self._storage.put_messages(batch)
+                    count += len(batch)
+                    batch = []
+
+            if batch:
+                self._storage.put_messages(batch)
+                count += len(batch)
+        except PartialWriteError as error:
+            context.abort(grpc.StatusCode.ABORTED,
+                          PARTIAL_WRITE_DETAILS.format(count + error.stored,
+                                                       error.error))
+
+        return simple_chat_pb2.SendMessagesResponse(count=count)
+
     def ReceiveMessages(self, request, context):
         """Subscribe user to receive messages. Results are
         streamed rather than returned at once.
-        Deleting queued messages from the storage after getting their.
+        Deleting queued messages from the storage after getting their,
+        one storage transaction per delivered batch. The backlog is read
+        in pages of the storage queue page size, so a long queue is not
+        loaded at once.
+        In the forward mode stored values are streamed as they are.
         """
-        while context.is_active():
-            messages = self._storage.get_user_queue_messages(request.login)
+        self._resume(request)
 
+        if self._delivery_mode == DELIVERY_MODE_FORWARD:
+            yield from self._forward_user_queue_messages(request.login,
+                                                         context)
+            return
+
+        if self._delivery_mode == DELIVERY_MODE_POLLING:
+            batches = self._poll_user_queue_messages(request.login, context)
+        else:
+            batches = self._watch_user_queue_messages(
+                request.login, context,
+                self._storage.watch_user_queue_messages)
+
+        for messages in batches:
             for message in messages:
-                timestamp = Timestamp()
-                timestamp.FromSeconds(int(message.created))
-                yield simple_chat_pb2.Message(
-                    sender=message.sender,
-                    recipient=message.recipient,
-                    body=message.body,
-                    created=timestamp)
+                yield message_to_proto(message)
+
+            self._storage.delete_user_queue_messages(messages)
+
+    def SubscribeMessages(self, request_iterator, context):
+        """Subscribe user to receive messages acknowledged by the client.
+        Acks are read by a separate thread, acknowledged messages are
+        deleted from the storage. Messages come from the queue watch in
+        all delivery modes, the forward mode streams the stored values.
+        """
+        request = next(request_iterator, None)
+        if request is None or request.WhichOneof('request') != 'subscribe':
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          SUBSCRIBE_FIRST_DETAILS)
+
+        login = request.subscribe.login
+        self._resume(request.subscribe)
+
+        acknowledger = MessageAcknowledger()
+        threading.Thread(target=self._read_acks,
+                         args=(request_iterator, login, acknowledger),
+                         daemon=True).start()
+
+        for message in self._iterate_acknowledged_messages(
+                login, context, acknowledger):
+            if self._delivery_mode == DELIVERY_MODE_FORWARD:
+                yield message.value
+            else:
+                yield message_to_proto(message)
+
+    def Chat(self, request_iterator, context):
+        """Chat as the subscribed user over one stream. Requests are read
+        by a separate thread storing sent messages and deleting
+        acknowledged ones, received messages are read by another one.
+        Both put their responses to the queue streamed by the RPC.
+        """
+        request = next(request_iterator, None)
+        if request is None or request.WhichOneof('request') != 'subscribe':
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          SUBSCRIBE_FIRST_DETAILS)
+
+        login = request.subscribe.login
+        self._resume(request.subscribe)
+
+        acknowledger = MessageAcknowledger()
+        responses = queue.Queue()
+        threading.Thread(target=self._read_chat_requests,
+                         args=(request_iterator, login, acknowledger,
+                               responses),
+                         daemon=True).start()
+        threading.Thread(target=self._receive_chat_messages,
+                         args=(login, context, acknowledger, responses),
+                         daemon=True).start()
+
+        for response in iter(responses.get, None):
+            if isinstance(response, Exception):
+                context.abort(grpc.StatusCode.ABORTED,
+                              CHAT_SEND_FAILED_DETAILS.format(response))
+
+            yield response
+
+    def _read_acks(self, request_iterator, login, acknowledger):
+        """Deletes acknowledged messages until the client stops acking"""
+        try:
+            for request in request_iterator:
+                if request.WhichOneof('request') != 'ack':
+                    continue
+
+                self._ack(login, acknowledger, request.ack)
+        except grpc.RpcError:
+            # the RPC was cancelled
+            pass
+        finally:
+            acknowledger.close()
+
+    def _read_chat_requests(self, request_iterator, login, acknowledger,
+                            responses):
+        """Stores sent messages and deletes acknowledged ones until the
+        client stops sending. A storage failure is passed to the stream.
+        """
+        try:
+            for request in request_iterator:
+                kind = request.WhichOneof('request')
+                if kind == 'ack':
+                    self._ack(login, acknowledger, request.ack)
+                elif kind == 'message':
+                    message = Message(login, request.message.recipient,
+                                      request.message.body)
+                    try:
+                        self._send(message)
+                    except Exception as error:
+                        responses.put(error)
+                        return
+
+                    responses.put(simple_chat_pb2.ChatResponse(
+                        sent=message_to_proto(message)))
+        except grpc.RpcError:
+            # the RPC was cancelled
+            pass
+        finally:
+            acknowledger.close()
+
+    def _receive_chat_messages(self, login, context, acknowledger,
+                               responses):
+        """Puts messages received by the chat user to the stream, the
+        stream ends with them
+        """
+        try:
+            for message in self._iterate_acknowledged_messages(
+                    login, context, acknowledger):
+                if self._delivery_mode == DELIVERY_MODE_FORWARD:
+                    responses.put(serialize_chat_message(message.value))
+                else:
+                    responses.put(simple_chat_pb2.ChatResponse(
+                        message=message_to_proto(message)))
+        finally:
+            responses.put(None)
+
+    def _iterate_acknowledged_messages(self, login, context, acknowledger):
+        """Yields messages of the user queue while the ack window has
+        room. Messages come from the queue watch in all delivery modes,
+        the forward mode yields stored messages.
+        """
+        if self._delivery_mode == DELIVERY_MODE_FORWARD:
+            watch = self._storage.watch_user_queue_stored_messages
+        else:
+            watch = self._storage.watch_user_queue_messages
+
+        for messages in self._watch_user_queue_messages(login, context,
+                                                        watch):
+            for message in messages:
+                while not acknowledger.wait_for_room(POLLING_INTERVAL):
+                    if acknowledger.closed or not context.is_active():
+                        return
+
+                # re-read after a re-sync while waiting for its ack
+                if not acknowledger.add(message.message_id):
+                    continue
 
-                self._storage.delete_user_queue_message(message)
+                yield message
+
+    def _send(self, message):
+        """Stores sent message, with local delivery it is handed over to
+        the recipient subscribed here first
+        """
+        if self._is_local_delivery:
+            self._storage.send_message(message)
+        else:
+            self._storage.put_message(message)
+
+    def _ack(self, login, acknowledger, ack):
+        """Deletes messages covered by the ack"""
+        acked = acknowledger.ack(ack.message_id)
+        if acked:
+            self._storage.delete_user_queue_message_ids(login, acked)
+
+    def _resume(self, request):
+        """Deletes messages the reconnected client has already received"""
+        if request.resume_after:
+            self._storage.delete_user_queue_messages_until(
+                request.login, request.resume_after)
+
+    def _poll_user_queue_messages(self, login, context):
+        """Reads the user queue page by page once per polling interval"""
+        while context.is_active():
+            yield from self._storage.iterate_user_queue_messages(login)
 
             if context.is_active():
-                time.sleep(1)
+                time.sleep(POLLING_INTERVAL)
+
+    def _forward_user_queue_messages(self, login, context):
+        """Yields serialized messages without converting them"""
+        batches = self._watch_user_queue_messages(
+            login, context, self._storage.watch_user_queue_stored_messages)
+
+        for messages in batches:
+            for message in messages:
+                yield message.value
+
+            self._storage.delete_user_queue_stored_messages(messages)
+
+    def _watch_user_queue_messages(self, login, context, watch):
+        """Streams batches of the user queue as etcd reports new messages.
+        The watch is cancelled when the RPC terminates.
+        """
+        batches, cancel = watch(login)
+        if not context.add_callback(cancel):
+            cancel()
+
+        try:
+            yield from batches
+        finally:
+            cancel()
 
 
 def enable_reflection(server):
@@ -67,13 +703,130 @@ def enable_reflection(server):
     reflection.enable_server_reflection(SERVICE_NAMES, server)
 
 
-def create_server(server_address: str, storage: Storage,
-                  is_enable_reflection: bool = False) -> grpc.server:
-    """Create server and doing additional actions with server here"""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+@dataclass
+class ServerOptions:
+    """Capacity and transport options of the server.
+
+    Response streams (ReceiveMessages, SubscribeMessages, Chat) are
+    limited to max_streams, the threaded server keeps unary_workers
+    threads for the other calls besides them. Calls over
+    maximum_concurrent_rpcs, by default all streams and unary workers
+    with UNARY_MAX_QUEUED waiting calls, are refused by gRPC with
+    RESOURCE_EXHAUSTED.
+    """
+    unary_workers: int = UNARY_MAX_WORKERS
+    max_streams: int = MAX_STREAMS
+    maximum_concurrent_rpcs: Optional[int] = None
+    keepalive_time: float = KEEPALIVE_TIME
+    keepalive_timeout: float = KEEPALIVE_TIMEOUT
+    max_message_size: int = MAX_MESSAGE_SIZE
+
+    def get_maximum_concurrent_rpcs(self) -> int:
+        if self.maximum_concurrent_rpcs is not None:
+            return self.maximum_concurrent_rpcs
+        return self.max_streams + self.unary_workers + UNARY_MAX_QUEUED
+
+    def get_grpc_options(self) -> List[Tuple[str, int]]:
+        """Channel arguments of the server"""
+        return [
+            ('grpc.keepalive_time_ms', int(self.keepalive_time * 1000)),
+            ('grpc.keepalive_timeout_ms',
+             int(self.keepalive_timeout * 1000)),
+            ('grpc.max_send_message_length', self.max_message_size),
+            ('grpc.max_receive_message_length', self.max_message_size),
+        ]
+
 
-    simple_chat_pb2_grpc.add_SimpleChatServicer_to_server(
-        SimpleChatServicer(storage), server)
+class StreamLimiter:
+    """Counts open response streams up to the limit"""
+
+    def __init__(self, max_streams: int):
+        self.max_streams = max_streams
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """Takes room for a stream unless the limit is reached"""
+        with self._lock:
+            if self.count >= self.max_streams:
+                return False
+            self.count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.count -= 1
+
+
+class StreamLimitInterceptor(grpc.ServerInterceptor):
+    """Refuses response streams over the limit with RESOURCE_EXHAUSTED,
+    so open streams never take the threads of unary calls
+    """
+
+    def __init__(self, max_streams: int):
+        self.limiter = StreamLimiter(max_streams)
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or not handler.response_streaming:
+            return handler
+
+        if handler.request_streaming:
+            return handler._replace(
+                stream_stream=self._limit(handler.stream_stream))
+        return handler._replace(
+            unary_stream=self._limit(handler.unary_stream))
+
+    def _limit(self, behavior):
+        def limited_behavior(request, context):
+            if not self.limiter.acquire():
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                              STREAMS_EXHAUSTED_DETAILS)
+            try:
+                yield from behavior(request, context)
+            finally:
+                self.limiter.release()
+
+        return limited_behavior
+
+
+def add_servicer_to_server(servicer, server):
+    """Registers the servicer together with its pre-serialized handlers"""
+    server.add_generic_rpc_handlers((PreSerializedResponseHandler(servicer),))
+    simple_chat_pb2_grpc.add_SimpleChatServicer_to_server(servicer, server)
+
+
+def create_server(server_address: str, storage: BaseStorage,
+                  is_enable_reflection: bool = False,
+                  delivery_mode: str = DELIVERY_MODE_WATCH,
+                  is_cache_users: bool = True,
+                  is_local_delivery: bool = False,
+                  options: Optional[ServerOptions] = None,
+                  metrics: Optional[ChatMetrics] = None,
+                  slow_call_log: Optional[SlowCallLog] = None
+                  ) -> grpc.server:
+    """Create server and doing additional actions with server here.
+    Given metrics, RPCs and the thread pool are measured, given slow-call
+    log, slow RPCs are logged.
+    """
+    options = options or ServerOptions()
+    executor = futures.ThreadPoolExecutor(
+        max_workers=options.max_streams + options.unary_workers)
+    interceptors = [StreamLimitInterceptor(options.max_streams)]
+    if slow_call_log is not None:
+        interceptors.insert(0, SlowCallInterceptor(slow_call_log))
+    if metrics is not None:
+        metrics.watch_executor('server', executor)
+        interceptors.insert(0, MetricsInterceptor(metrics))
+    server = grpc.server(
+        executor, interceptors=interceptors,
+        options=options.get_grpc_options(),
+        maximum_concurrent_rpcs=options.get_maximum_concurrent_rpcs())
+
+    user_directory = UserDirectory(storage) if is_cache_users else None
+    add_servicer_to_server(
+        SimpleChatServicer(storage, delivery_mode, user_directory,
+                           is_local_delivery), server)
 
     if is_enable_reflection:
         enable_reflection(server)
@@ -83,12 +836,85 @@ def create_server(server_address: str, storage: Storage,
 
 
 def main(server_host: str, server_port: str, storage_host: str,
-         storage_port: str, is_enable_reflection: bool = False):
-    """Start point"""
-    storage = Storage(host=storage_host, port=storage_port)
+         storage_port: str, is_enable_reflection: bool = False,
+         delivery_mode: str = DELIVERY_MODE_WATCH,
+         server_mode: str = SERVER_MODE_THREADED,
+         message_codec: str = DEFAULT_MESSAGE_CODEC,
+         queue_page_size: int = QUEUE_PAGE_SIZE,
+         is_local_delivery: bool = False, node_id: Optional[str] = None,
+         write_batch_window: Optional[float] = None,
+         write_batch_size: int = STORAGE_MAX_TXN_OPS,
+         server_options: Optional[ServerOptions] = None,
+         etcd_pool_size: int = ETCD_POOL_SIZE,
+         etcd_pool_policy: str = POOL_ROUND_ROBIN,
+         storage_backend: str = STORAGE_BACKEND_ETCD,
+         queue_database_path: str = QUEUE_DATABASE_PATH,
+         metrics_port: Optional[int] = None,
+         slow_call_threshold: Optional[float] = None,
+         profile_directory: str = PROFILE_DIRECTORY,
+         profile_seconds: float = PROFILE_SECONDS,
+         history_ttl: Optional[int] = None):
+    """Start point. The storage host may list several etcd endpoints
+    separated by commas, the memory backend uses no storage host.
+    Given metrics port, metrics are served on the server host. Given
+    slow-call threshold, slower RPCs and storage calls are logged.
+    SIGUSR1 writes a profile of the next profile seconds to the profile
+    directory. Given history time to live in seconds, sent messages are
+    kept for GetHistory that long.
+    """
+    if server_mode not in SERVER_MODES:
+        raise ValueError('Unknown server mode: {}'.format(server_mode))
+    if message_codec not in MESSAGE_CODECS:
+        raise ValueError('Unknown message codec: {}'.format(message_codec))
+    if storage_backend not in STORAGE_BACKENDS:
+        raise ValueError(
+            'Unknown storage backend: {}'.format(storage_backend))
 
+    if storage_backend == STORAGE_BACKEND_MEMORY:
+        storage = MemoryStorage(
+            message_codec=MESSAGE_CODECS[message_codec](),
+            queue_page_size=queue_page_size, history_ttl=history_ttl)
+    elif storage_backend == STORAGE_BACKEND_SQLITE:
+        storage = SqliteQueueStorage(
+            storage_host, storage_port, queue_database_path,
+            message_codec=MESSAGE_CODECS[message_codec](),
+            queue_page_size=queue_page_size, pool_size=etcd_pool_size,
+            pool_policy=etcd_pool_policy, history_ttl=history_ttl)
+    else:
+        storage = Storage(host=storage_host, port=storage_port,
+                          message_codec=MESSAGE_CODECS[message_codec](),
+                          queue_page_size=queue_page_size, node_id=node_id,
+                          write_batch_window=write_batch_window,
+                          write_batch_size=write_batch_size,
+                          pool_size=etcd_pool_size,
+                          pool_policy=etcd_pool_policy,
+                          history_ttl=history_ttl)
+    if hasattr(signal, 'SIGUSR1'):
+        ProfileTrigger(profile_directory, profile_seconds).install()
+    metrics = None
+    if metrics_port is not None:
+        metrics = ChatMetrics()
+        if isinstance(storage, Storage):
+            metrics.instrument_etcd(storage.clients.clients)
+        storage = MetricsStorage(storage, metrics)
+        start_metrics_server(metrics, server_host, metrics_port)
+    slow_call_log = None
+    if slow_call_threshold is not None:
+        slow_call_log = SlowCallLog(slow_call_threshold)
+        storage = SlowCallStorage(storage, slow_call_log)
     server_address = "{}:{}".format(server_host, server_port)
-    server = create_server(server_address, storage, is_enable_reflection)
+
+    if server_mode == SERVER_MODE_AIO:
+        import simple_chat_aio_server
+        asyncio.run(simple_chat_aio_server.serve(
+            server_address, storage, is_enable_reflection, delivery_mode,
+            is_local_delivery, server_options, metrics, slow_call_log))
+        return
+
+    server = create_server(server_address, storage, is_enable_reflection,
+                           delivery_mode, is_local_delivery=is_local_delivery,
+                           options=server_options, metrics=metrics,
+                           slow_call_log=slow_call_log)
     server.start()
     server.wait_for_termination()
 
@@ -96,8 +922,57 @@ def main(server_host: str, server_port: str, storage_host: str,
 if __name__ == '__main__':
     host = os.environ['SERVER_HOST']
     port = os.environ['SERVER_PORT']
-    etcd_host = os.environ['ETCD_SERVER_HOST']
-    etcd_port = os.environ['ETCD_SERVER_PORT']
+    etcd_host = os.environ.get('ETCD_SERVER_HOST')
+    etcd_port = os.environ.get('ETCD_SERVER_PORT')
     is_reflected = bool(os.environ['REFLECTION'])
+    message_delivery_mode = os.environ.get('DELIVERY_MODE',
+                                           DELIVERY_MODE_WATCH)
+    execution_mode = os.environ.get('SERVER_MODE', SERVER_MODE_THREADED)
+    storage_message_codec = os.environ.get('MESSAGE_CODEC',
+                                           DEFAULT_MESSAGE_CODEC)
+    storage_queue_page_size = int(os.environ.get('QUEUE_PAGE_SIZE',
+                                                 QUEUE_PAGE_SIZE))
+    is_local_message_delivery = bool(os.environ.get('LOCAL_DELIVERY'))
+    server_node_id = os.environ.get('NODE_ID') or None
+    storage_write_batch_window = os.environ.get('WRITE_BATCH_WINDOW')
+    if storage_write_batch_window is not None:
+        storage_write_batch_window = float(storage_write_batch_window)
+    storage_write_batch_size = int(os.environ.get('WRITE_BATCH_SIZE',
+                                                  STORAGE_MAX_TXN_OPS))
+    maximum_concurrent_rpcs = os.environ.get('MAX_CONCURRENT_RPCS')
+    server_execution_options = ServerOptions(
+        unary_workers=int(os.environ.get('MAX_WORKERS', UNARY_MAX_WORKERS)),
+        max_streams=int(os.environ.get('MAX_STREAMS', MAX_STREAMS)),
+        maximum_concurrent_rpcs=(int(maximum_concurrent_rpcs)
+                                 if maximum_concurrent_rpcs else None),
+        keepalive_time=float(os.environ.get('KEEPALIVE_TIME',
+                                            KEEPALIVE_TIME)),
+        keepalive_timeout=float(os.environ.get('KEEPALIVE_TIMEOUT',
+                                               KEEPALIVE_TIMEOUT)),
+        max_message_size=int(os.environ.get('MAX_MESSAGE_SIZE',
+                                            MAX_MESSAGE_SIZE)))
+    storage_pool_size = int(os.environ.get('ETCD_POOL_SIZE', ETCD_POOL_SIZE))
+    storage_pool_policy = os.environ.get('ETCD_POOL_POLICY', POOL_ROUND_ROBIN)
+    storage_backend_name = os.environ.get('STORAGE_BACKEND',
+                                          STORAGE_BACKEND_ETCD)
+    storage_queue_database_path = os.environ.get('QUEUE_DATABASE_PATH',
+                                                 QUEUE_DATABASE_PATH)
+    server_metrics_port = os.environ.get('METRICS_PORT')
+    server_slow_call_threshold = os.environ.get('SLOW_CALL_THRESHOLD')
+    server_profile_directory = os.environ.get('PROFILE_DIRECTORY',
+                                              PROFILE_DIRECTORY)
+    server_profile_seconds = float(os.environ.get('PROFILE_SECONDS',
+                                                  PROFILE_SECONDS))
+    storage_history_ttl = os.environ.get('HISTORY_TTL')
 
-    main(host, port, etcd_host, etcd_port, is_reflected)
+    main(host, port, etcd_host, etcd_port, is_reflected,
+         message_delivery_mode, execution_mode, storage_message_codec,
+         storage_queue_page_size, is_local_message_delivery, server_node_id,
+         storage_write_batch_window, storage_write_batch_size,
+         server_execution_options, storage_pool_size, storage_pool_policy,
+         storage_backend_name, storage_queue_database_path,
+         int(server_metrics_port) if server_metrics_port else None,
+         (float(server_slow_call_threshold)
+          if server_slow_call_threshold else None),
+         server_profile_directory, server_profile_seconds,
+         int(storage_history_ttl) if storage_history_ttl else None)
@@ -0,0 +1,293 @@
+"""Storage keeping message queues in SQLite and users in etcd"""
+import collections
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from simple_chat_etcd_storage import (LocalQueueDispatcher, Message,
+                                      MessageCodec, PartialWriteError,
+                                      QueuePage, Storage, StoredMessage,
+                                      get_history_key, get_history_range,
+                                      ETCD_POOL_SIZE,
+                                      HISTORY_COMPACTION_INTERVAL,
+                                      POOL_ROUND_ROBIN, QUEUE_PAGE_SIZE,
+                                      STORAGE_MESSAGE_QUEUE_PREFIX_KEY,
+                                      STORAGE_USER_MESSAGE_QUEUE_KEY,
+                                      STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY,
+                                      SUBSCRIPTION_BUFFER_SIZE)
+
+QUEUE_DATABASE_PATH = 'queues.db'
+# seconds a connection waits for the database locked by another process
+DATABASE_TIMEOUT = 5
+
+# the revision is the row id, it only grows, so messages keep the order
+# they were stored in and subscriptions tell backlog from new messages
+CREATE_QUEUE_TABLE = '''
+CREATE TABLE IF NOT EXISTS queue (
+    revision INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    value BLOB NOT NULL
+)'''
+CREATE_QUEUE_INDEX = '''
+CREATE UNIQUE INDEX IF NOT EXISTS queue_recipient
+ON queue (recipient, message_id)'''
+
+INSERT_MESSAGE = '''
+INSERT OR REPLACE INTO queue (recipient, message_id, value) VALUES (?, ?, ?)
+'''
+SELECT_QUEUE = '''
+SELECT revision, message_id, value FROM queue
+WHERE recipient = ? AND message_id >= ? ORDER BY message_id LIMIT ?'''
+SELECT_REVISION = "SELECT seq FROM sqlite_sequence WHERE name = 'queue'"
+DELETE_MESSAGE = 'DELETE FROM queue WHERE recipient = ? AND message_id = ?'
+DELETE_MESSAGES_UNTIL = \
+    'DELETE FROM queue WHERE recipient = ? AND message_id <= ?'
+
+# history entries keyed as in etcd, so a page is a range of the primary
+# key read in key order, the newest message first
+CREATE_HISTORY_TABLE = '''
+CREATE TABLE IF NOT EXISTS history (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID'''
+CREATE_HISTORY_INDEX = '''
+CREATE INDEX IF NOT EXISTS history_expires ON history (expires)'''
+
+INSERT_HISTORY = '''
+INSERT OR REPLACE INTO history (key, value, expires) VALUES (?, ?, ?)'''
+SELECT_HISTORY = '''
+SELECT key, value FROM history
+WHERE key >= ? AND key < ? AND expires > ? ORDER BY key LIMIT ?'''
+DELETE_EXPIRED_HISTORY = 'DELETE FROM history WHERE expires <= ?'
+
+
+class SqliteQueueStorage(Storage):
+    """Storage keeping users in etcd and message queues in a local SQLite
+    database in WAL mode.
+
+    Every queued message is a row indexed by its recipient and id, so a
+    queue is read in id order without the value limits and the history
+    of etcd. Stored messages are dispatched to the subscriptions of this
+    process only, so one server owns the database. Conversation histories
+    are kept in the database too, expired entries are deleted every
+    HISTORY_COMPACTION_INTERVAL.
+    """
+
+    def __init__(self, host, port,
+                 database_path: str = QUEUE_DATABASE_PATH,
+                 subscription_buffer_size: int = SUBSCRIPTION_BUFFER_SIZE,
+                 message_codec: Optional[MessageCodec] = None,
+                 queue_page_size: int = QUEUE_PAGE_SIZE,
+                 pool_size: int = ETCD_POOL_SIZE,
+                 pool_policy: str = POOL_ROUND_ROBIN,
+                 grpc_options: Optional[List[Tuple[str, int]]] = None,
+                 history_ttl: Optional[int] = None):
+        super().__init__(host, port, subscription_buffer_size,
+                         message_codec, queue_page_size,
+                         pool_size=pool_size, pool_policy=pool_policy,
+                         grpc_options=grpc_options, history_ttl=history_ttl)
+        self.database_path = database_path
+        self._queue_dispatcher = LocalQueueDispatcher(
+            self, subscription_buffer_size)
+        self._connections_lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._local = threading.local()
+        # SQLite has a single writer, writes are also dispatched in the
+        # order of their revisions under the lock
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        with self._writer:
+            self._writer.execute(CREATE_QUEUE_TABLE)
+            self._writer.execute(CREATE_QUEUE_INDEX)
+            self._writer.execute(CREATE_HISTORY_TABLE)
+            self._writer.execute(CREATE_HISTORY_INDEX)
+        self._history_compaction_time = time.time()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.database_path,
+                                     timeout=DATABASE_TIMEOUT,
+                                     check_same_thread=False)
+        # in WAL mode commits stay atomic, only the last ones may be lost
+        # on a power failure
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connections_lock:
+            self._connections.append(connection)
+        return connection
+
+    @property
+    def _reader(self) -> sqlite3.Connection:
+        """Connection of the calling thread, WAL readers do not block the
+        writer nor each other
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def put_message(self, message: Message):
+        """Adding new queue message to storage under a generated id"""
+        self._set_message_id(message)
+        self._insert([message])
+
+    def send_message(self, message: Message):
+        """Stores new message, subscribers of this process get it as soon
+        as it is stored
+        """
+        self.put_message(message)
+
+    def put_messages(self, messages: List[Message]):
+        """Adding batch of new queue messages to storage under generated
+        ids in a single transaction, so a failure stores none of them
+        """
+        for message in messages:
+            self._set_message_id(message)
+        try:
+            self._insert(messages)
+        except sqlite3.Error as error:
+            raise PartialWriteError(0, error) from error
+
+    def _insert(self, messages: List[Message]):
+        rows = [(message.recipient, message.message_id,
+                 self.message_codec.encode(message)) for message in messages]
+        history_rows = []
+        now = time.time()
+        if self.history_ttl is not None:
+            history_rows = [(get_history_key(message), value,
+                             now + self.history_ttl)
+                            for message, (_, _, value) in zip(messages, rows)]
+        stored = collections.defaultdict(list)
+        with self._write_lock:
+            with self._writer:
+                for recipient, message_id, value in rows:
+                    revision = self._writer.execute(INSERT_MESSAGE, (
+                        recipient, message_id, value)).lastrowid
+                    stored[recipient].append((revision, StoredMessage(
+                        STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+                            user_id=recipient, message_id=message_id),
+                        value)))
+                self._writer.executemany(INSERT_HISTORY, history_rows)
+                if history_rows and now >= self._history_compaction_time:
+                    self._writer.execute(DELETE_EXPIRED_HISTORY, (now,))
+                    self._history_compaction_time = \
+                        now + HISTORY_COMPACTION_INTERVAL
+            self._queue_dispatcher.dispatch(stored)
+
+    def get_user_queue_messages(self, user_login: str) -> List[Message]:
+        """Getting sequence of queued messages for received user login
+        in the order they were stored
+        """
+        return [self.decode_message(message) for message in
+                self.get_user_queue_stored_messages_with_revision(
+                    user_login)[0]]
+
+    def get_user_queue_page(self, user_login: str, limit: int,
+                            start_key: Optional[str] = None) -> QueuePage:
+        """Getting page of queued messages for received user login in the
+        order they were stored, starting from the key of a previous page
+        """
+        prefix = STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY.format(
+            user_id=user_login)
+        if start_key is None:
+            start_key = prefix
+        elif not start_key.startswith(prefix):
+            raise ValueError('Page start key is out of the user queue')
+
+        # read before the page, messages stored in between are both in
+        # the page and dispatched, and subscriptions skip them once
+        revision = self._get_revision()
+        rows = self._reader.execute(SELECT_QUEUE, (
+            user_login, start_key[len(prefix):], limit + 1)).fetchall()
+        messages = [(row_revision, StoredMessage(prefix + message_id, value))
+                    for row_revision, message_id, value in rows[:limit]]
+
+        next_key = None
+        if len(rows) > limit:
+            next_key = messages[-1][1].key + '\0'
+
+        return QueuePage(messages, next_key, revision)
+
+    def get_history_page(self, login: str, peer: str, limit: int,
+                         start_time: Optional[float] = None,
+                         end_time: Optional[float] = None,
+                         start_key: Optional[str] = None
+                         ) -> Tuple[List[Message], Optional[str]]:
+        """Getting page of messages between the two users stored from
+        start time on and before end time, the newest first. Returns
+        messages and the key the next page starts from, None for the last
+        page.
+        """
+        range_start, range_end = get_history_range(login, peer, start_time,
+                                                   end_time, start_key)
+        rows = self._reader.execute(SELECT_HISTORY, (
+            range_start, range_end, time.time(), limit + 1)).fetchall()
+
+        next_key = None
+        if len(rows) > limit:
+            next_key = rows[limit - 1][0] + '\0'
+
+        return [self.decode_history_message(key, value)
+                for key, value in rows[:limit]], next_key
+
+    def _get_revision(self) -> int:
+        row = self._reader.execute(SELECT_REVISION).fetchone()
+        return row[0] if row else 0
+
+    def get_user_queue_stored_messages_with_revision(
+            self, user_login: str) -> Tuple[List[StoredMessage], int]:
+        """Getting queued messages for received user login as they are
+        stored, together with the revision they were read at
+        """
+        messages = []
+        revision = None
+        for page in self.iterate_user_queue_pages(user_login):
+            if revision is None:
+                revision = page.revision
+            messages.extend(message for _, message in page.messages)
+
+        return messages, revision
+
+    def delete_user_queue_message(self, message: Message):
+        """Deleting queued message from the storage"""
+        self.delete_user_queue_messages([message])
+
+    def delete_user_queue_messages(self, messages: List[Message]):
+        """Deleting delivered queued messages from the storage"""
+        self._delete([(message.recipient, message.message_id)
+                      for message in messages])
+
+    def delete_user_queue_stored_messages(
+            self, messages: List[StoredMessage]):
+        """Deleting delivered stored messages by their keys"""
+        self._delete([tuple(message.key[len(
+            STORAGE_MESSAGE_QUEUE_PREFIX_KEY):].split('/', 1))
+            for message in messages])
+
+    def delete_user_queue_message_ids(self, user_login: str,
+                                      message_ids: List[str]):
+        """Deleting acknowledged queued messages by their ids"""
+        self._delete([(user_login, message_id)
+                      for message_id in message_ids])
+
+    def delete_user_queue_messages_until(self, user_login: str,
+                                         message_id: str):
+        """Deleting queued messages of received user login with ids up to
+        and including the given one
+        """
+        with self._write_lock, self._writer:
+            self._writer.execute(DELETE_MESSAGES_UNTIL,
+                                 (user_login, message_id))
+
+    def _delete(self, rows: List[Tuple[str, str]]):
+        with self._write_lock, self._writer:
+            self._writer.executemany(DELETE_MESSAGE, rows)
+
+    def close(self):
+        """Closes the database connections besides the etcd storage"""
+        super().close()
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
@@ -0,0 +1,91 @@
+"""Tests of run_load_users script"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+import run_load_users
+from simple_chat_etcd_storage import User
+from simple_chat_memory_storage import MemoryStorage
+
+
+class LoadUsersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_read_users(self):
+        users = [User('ann', 'Ann Lee'), User('bob', 'Bob, Jr.')]
+        paths = [
+            self.write('users.json', json.dumps(
+                [{'login': user.login, 'full_name': user.full_name}
+                 for user in users])),
+            self.write('users.jsonl', ''.join(
+                json.dumps({'login': user.login,
+                            'full_name': user.full_name}) + '\n\n'
+                for user in users)),
+            self.write('users.csv', 'login,full_name\r\nann,Ann Lee\r\n'
+                                    'bob,"Bob, Jr."\r\n')]
+
+        for path in paths:
+            self.assertEqual(list(run_load_users.read_users(path)), users)
+        self.assertEqual(list(run_load_users.read_users(
+            paths[1], run_load_users.FORMAT_JSONL)), users)
+
+    def test_import_users(self):
+        storage = MemoryStorage()
+        users = [User(str(index), 'User') for index in range(25)]
+        stored = []
+
+        self.assertEqual(run_load_users.import_users(
+            users, storage, workers=3, batch_size=10,
+            on_stored=stored.append), 25)
+
+        self.assertEqual(sorted(storage.get_users(), key=lambda user: int(
+            user.login)), users)
+        self.assertEqual(stored, sorted(stored))
+        self.assertEqual(stored[-1], 25)
+
+    def test_import_failure(self):
+        """Tests that only the batches stored before the failed one count
+        as stored
+        """
+        storage = Mock()
+        storage.put_users.side_effect = [None, Exception('failed'), None]
+        stored = []
+
+        with self.assertRaises(Exception):
+            run_load_users.import_users(
+                [User(str(index), 'User') for index in range(25)], storage,
+                workers=1, batch_size=10, on_stored=stored.append)
+
+        self.assertEqual(stored, [10])
+
+    def test_resume(self):
+        path = self.write('users.jsonl', ''.join(
+            json.dumps({'login': str(index), 'full_name': 'User'}) + '\n'
+            for index in range(5)))
+        run_load_users.write_checkpoint(path + '.checkpoint', 3)
+        storage = MemoryStorage()
+        args = argparse.Namespace(file=path, format=None, workers=2,
+                                  batch_size=1, checkpoint=None, resume=True)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(run_load_users.main(args, storage), 0)
+
+        self.assertEqual(sorted(user.login for user in storage.get_users()),
+                         ['3', '4'])
+        self.assertEqual(run_load_users.read_checkpoint(
+            path + '.checkpoint'), 5)
@@ -0,0 +1,154 @@
+"""Tests of simple_chat_aio_etcd_storage module"""
+import asyncio
+import functools
+import logging
+import threading
+import unittest
+from concurrent import futures
+from unittest.mock import MagicMock, Mock
+
+from simple_chat_aio_etcd_storage import AsyncStorage
+from simple_chat_etcd_storage import (Message, ProtobufMessageCodec,
+                                      QueueWatchDispatcher, Storage,
+                                      StoredMessage, User)
+from test_simple_chat_etcd_storage import (make_queue_pages,
+                                           make_stored_message)
+
+
+class AsyncStorageTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.storage = Mock(write_batcher=None)
+        self.async_storage = AsyncStorage(self.storage)
+
+    def tearDown(self):
+        self.async_storage.close()
+
+    async def test_run(self):
+        """Tests that blocking calls run in the storage threads"""
+        thread_name = await self.async_storage.run(
+            lambda: threading.current_thread().name)
+
+        self.assertTrue(thread_name.startswith('storage'))
+
+    async def test_get_users(self):
+        """Tests of get_users method"""
+        self.storage.get_users = Mock(return_value=[User('1', 'User')])
+
+        users = await self.async_storage.get_users()
+
+        self.assertEqual(users, [User('1', 'User')])
+
+    async def test_get_users_page(self):
+        """Tests of get_users_page method"""
+        self.storage.get_users_page = Mock(
+            return_value=([User('1', 'User')], None))
+
+        page = await self.async_storage.get_users_page(10, None, '1')
+
+        self.storage.get_users_page.assert_called_once_with(10, None, '1', '')
+        self.assertEqual(page, ([User('1', 'User')], None))
+
+    async def test_get_history_page(self):
+        self.storage.history_ttl = 60
+        self.storage.get_history_page = Mock(
+            return_value=([Message('1', '2', 'Hi', 1.7e9)], None))
+
+        page = await self.async_storage.get_history_page('1', '2', 10)
+
+        self.assertEqual(self.async_storage.history_ttl, 60)
+        self.storage.get_history_page.assert_called_once_with(
+            '1', '2', 10, None, None, None)
+        self.assertEqual(page, ([Message('1', '2', 'Hi', 1.7e9)], None))
+
+    async def test_put_message(self):
+        """Tests of put_message method"""
+        message = Message('1', '2', 'Hello!')
+
+        await self.async_storage.put_message(message)
+
+        self.storage.put_message.assert_called_once_with(message)
+
+    async def test_put_message_batched(self):
+        """Tests that batched writes are awaited on the event loop"""
+        stored = futures.Future()
+        self.storage.write_batcher = Mock()
+        self.storage.submit_message = Mock(return_value=stored)
+        message = Message('1', '2', 'Hello!')
+
+        task = asyncio.ensure_future(self.async_storage.put_message(message))
+        await asyncio.sleep(0)
+        self.assertFalse(task.done())
+        stored.set_result(None)
+        await task
+
+        self.storage.submit_message.assert_called_once_with(message)
+        self.storage.put_message.assert_not_called()
+
+    async def test_send_message(self):
+        """Tests of send_message method"""
+        message = Message('1', '2', 'Hello!')
+
+        await self.async_storage.send_message(message)
+
+        self.storage.send_message.assert_called_once_with(message)
+
+    async def test_delete_user_queue_stored_messages(self):
+        """Tests of delete_user_queue_stored_messages method"""
+        messages = [StoredMessage('key', b'value')]
+
+        await self.async_storage.delete_user_queue_stored_messages(messages)
+
+        self.storage.delete_user_queue_stored_messages.assert_called_once_with(
+            messages)
+
+    async def test_watch_user_queue_stored_messages(self):
+        """Tests of watch_user_queue_stored_messages method"""
+        self.storage.subscribe_user_queue.return_value = MagicMock()
+
+        messages, cancel = \
+            self.async_storage.watch_user_queue_stored_messages('2')
+
+        self.storage.subscribe_user_queue.assert_called_once()
+        self.assertEqual(
+            self.storage.subscribe_user_queue.call_args.kwargs['is_stored'],
+            True)
+        self.assertIs(cancel,
+                      self.storage.subscribe_user_queue.return_value.close)
+
+    async def test_watch_user_queue_messages(self):
+        """Tests of watch_user_queue_messages method"""
+        queued_message = Message('1', '2', 'Hello!')
+        new_message = Message('3', '2', 'Hi!')
+
+        self.storage.message_codec = ProtobufMessageCodec()
+        self.storage.iterate_user_queue_pages = Mock(
+            return_value=iter(make_queue_pages([queued_message], 1)))
+        self.storage.decode_message = functools.partial(
+            Storage.decode_message, self.storage)
+        dispatcher = QueueWatchDispatcher(self.storage)
+        self.storage.subscribe_user_queue = dispatcher.subscribe
+
+        messages, cancel = self.async_storage.watch_user_queue_messages('2')
+        self.assertEqual(await messages.__anext__(), [queued_message])
+
+        # the watch thread pushes a message while the reader waits
+        reader = asyncio.ensure_future(messages.__anext__())
+        await asyncio.sleep(0)
+        subscription = next(iter(dispatcher._subscriptions['2']))
+        threading.Thread(
+            target=subscription.push,
+            args=([(2, make_stored_message(new_message))],)).start()
+        self.assertEqual(await asyncio.wait_for(reader, 1), [new_message])
+
+        reader = asyncio.ensure_future(messages.__anext__())
+        await asyncio.sleep(0)
+        cancel()
+        with self.assertRaises(StopAsyncIteration):
+            await asyncio.wait_for(reader, 1)
+        self.assertNotIn('2', dispatcher._subscriptions)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main(verbosity=2)
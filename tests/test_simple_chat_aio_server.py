@@ -0,0 +1,339 @@
+"""Tests of simple_chat_aio_server module"""
+import asyncio
+import logging
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import grpc
+
+import simple_chat_aio_server
+import simple_chat_pb2
+import simple_chat_server
+from simple_chat_etcd_storage import (User, Message, ProtobufMessageCodec,
+                                      StoredMessage)
+
+
+async def iterate_async(items):
+    for item in items:
+        yield item
+
+
+class AsyncSimpleChatServicerTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.storage = Mock()
+        self.servicer = simple_chat_aio_server.AsyncSimpleChatServicer(
+            self.storage)
+
+    async def test_GetUsers(self):
+        """Tests of GetUsers method"""
+        user = User('123', 'Mock user')
+        self.storage.get_users = AsyncMock(return_value=[user])
+
+        response = await self.servicer.GetUsers(
+            simple_chat_pb2.GetUsersRequest(), Mock())
+
+        self.storage.get_users.assert_awaited_once()
+        response_user = User(response.users[0].login,
+                             response.users[0].full_name)
+        self.assertEqual(response_user, user)
+
+    async def test_GetUsers_user_directory(self):
+        """Tests that the cached list is read in the storage threads"""
+        user_directory = Mock()
+        user_directory.get_serialized_response.return_value = b'users'
+        self.storage.run = AsyncMock(return_value=b'users')
+        self.servicer = simple_chat_aio_server.AsyncSimpleChatServicer(
+            self.storage, user_directory=user_directory)
+
+        response = await self.servicer.GetUsers(
+            simple_chat_pb2.GetUsersRequest(), Mock())
+
+        self.assertEqual(response, b'users')
+        self.storage.run.assert_awaited_once_with(
+            user_directory.get_serialized_response)
+
+    async def test_GetUsers_page(self):
+        """Tests of GetUsers method with paging and filters"""
+        self.storage.get_users_page = AsyncMock(return_value=(
+            [User('123', 'Mock user')], 'index/user/name/mock user/123\0'))
+
+        response = await self.servicer.GetUsers(
+            simple_chat_pb2.GetUsersRequest(page_size=1, name_prefix='mo'),
+            Mock())
+
+        self.storage.get_users_page.assert_awaited_once_with(
+            1, None, '', 'mo')
+        self.assertEqual(len(response.users), 1)
+        self.assertTrue(response.next_page_token)
+
+    async def test_GetHistory(self):
+        """Tests of GetHistory method"""
+        self.storage.history_ttl = 60
+        self.storage.get_history_page = AsyncMock(return_value=(
+            [Message('2', '1', 'Hi', 1.7e9, '01ID')], None))
+
+        response = await self.servicer.GetHistory(
+            simple_chat_pb2.GetHistoryRequest(login='1', peer='2'), Mock())
+
+        self.storage.get_history_page.assert_awaited_once_with(
+            '1', '2', simple_chat_server.HISTORY_PAGE_SIZE, None, None, None)
+        self.assertEqual(response.messages[0].body, 'Hi')
+        self.assertEqual(response.next_page_token, '')
+
+    async def test_GetHistory_disabled(self):
+        context = Mock()
+        context.abort = AsyncMock(side_effect=grpc.RpcError)
+        self.storage.history_ttl = None
+
+        with self.assertRaises(grpc.RpcError):
+            await self.servicer.GetHistory(
+                simple_chat_pb2.GetHistoryRequest(login='1', peer='2'),
+                context)
+
+        context.abort.assert_awaited_once_with(
+            grpc.StatusCode.FAILED_PRECONDITION,
+            simple_chat_server.HISTORY_DISABLED_DETAILS)
+
+    async def test_SendMessage(self):
+        """Tests of SendMessage method"""
+        self.storage.put_message = AsyncMock()
+        mock_message = Mock(sender='1', recipient='2', body='Hello!')
+
+        response = await self.servicer.SendMessage(Mock(
+            message=mock_message), Mock())
+
+        self.storage.put_message.assert_awaited_once()
+        self.assertIsInstance(response, simple_chat_pb2.SendMessageResponse)
+
+    async def test_SendMessageStream(self):
+        """Tests of SendMessageStream method"""
+        self.storage.put_messages = AsyncMock()
+        requests = iterate_async([simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(sender='1', recipient='2',
+                                            body='Hello!'))] * 3)
+
+        response = await self.servicer.SendMessageStream(requests, Mock())
+
+        self.storage.put_messages.assert_awaited_once()
+        self.assertEqual(response.count, 3)
+
+    async def test_ReceiveMessages(self):
+        """Tests of ReceiveMessages method in watch mode"""
+        mock_message = Message('1', '2', 'Hello!', int(time.time()))
+        mock_cancel = Mock()
+        self.storage.watch_user_queue_messages = Mock(
+            return_value=(iterate_async([[mock_message]]), mock_cancel))
+        self.storage.delete_user_queue_messages = AsyncMock()
+
+        request = Mock(login='2', resume_after='')
+        response = [message async for message in
+                    self.servicer.ReceiveMessages(request, Mock())]
+
+        self.assertEqual(response, [
+            simple_chat_server.message_to_proto(mock_message)])
+        self.storage.watch_user_queue_messages.assert_called_once_with('2')
+        self.storage.delete_user_queue_messages.assert_awaited_once_with(
+            [mock_message])
+        mock_cancel.assert_called_once()
+
+    async def test_ReceiveMessages_forward(self):
+        """Tests of ReceiveMessages method in forward mode"""
+        self.servicer = simple_chat_aio_server.AsyncSimpleChatServicer(
+            self.storage, simple_chat_server.DELIVERY_MODE_FORWARD)
+        stored_message = StoredMessage('key', ProtobufMessageCodec().encode(
+            Message('1', '2', 'Hello!')))
+        mock_cancel = Mock()
+        self.storage.watch_user_queue_stored_messages = Mock(
+            return_value=(iterate_async([[stored_message]]), mock_cancel))
+        self.storage.delete_user_queue_stored_messages = AsyncMock()
+
+        request = Mock(login='2', resume_after='')
+        response = [message async for message in
+                    self.servicer.ReceiveMessages(request, Mock())]
+
+        self.assertEqual(response, [stored_message.value])
+        delete = self.storage.delete_user_queue_stored_messages
+        delete.assert_awaited_once_with([stored_message])
+        mock_cancel.assert_called_once()
+
+    async def test_SubscribeMessages(self):
+        """Tests that only acknowledged messages are deleted"""
+        messages = [Message('1', '2', str(index), message_id=str(index))
+                    for index in range(3)]
+        mock_cancel = Mock()
+        self.storage.watch_user_queue_messages = Mock(
+            return_value=(iterate_async([messages[:2], messages]),
+                          mock_cancel))
+        deleted = asyncio.Event()
+        self.storage.delete_user_queue_message_ids = AsyncMock(
+            side_effect=lambda login, message_ids: deleted.set())
+        self.storage.delete_user_queue_messages_until = AsyncMock()
+        requests = asyncio.Queue()
+        requests.put_nowait(simple_chat_pb2.SubscribeMessagesRequest(
+            subscribe=simple_chat_pb2.ReceiveMessagesRequest(
+                login='2', resume_after='01HD')))
+
+        async def iterate_requests():
+            while True:
+                request = await requests.get()
+                if request is None:
+                    return
+                yield request
+
+        response = self.servicer.SubscribeMessages(iterate_requests(),
+                                                   Mock())
+        received = [await response.__anext__() for _ in range(3)]
+        requests.put_nowait(simple_chat_pb2.SubscribeMessagesRequest(
+            ack=simple_chat_pb2.MessagesAck(message_id='1')))
+        await asyncio.wait_for(deleted.wait(), 5)
+        requests.put_nowait(None)
+        self.assertEqual([message async for message in response], [])
+
+        # the re-read message 1 is not sent twice
+        self.assertEqual([message.id for message in received],
+                         ['0', '1', '2'])
+        self.storage.delete_user_queue_messages_until.assert_awaited_once_with(
+            '2', '01HD')
+        self.storage.delete_user_queue_message_ids.assert_awaited_once_with(
+            '2', ['0', '1'])
+        mock_cancel.assert_called_once()
+
+    async def test_requires_subscription(self):
+        """Tests that streams ended before a subscription are rejected
+        like in the threaded server
+        """
+        for method in (self.servicer.SubscribeMessages, self.servicer.Chat):
+            context = Mock(abort=AsyncMock(side_effect=grpc.RpcError))
+
+            with self.assertRaises(grpc.RpcError):
+                await method(iterate_async([]), context).__anext__()
+
+            context.abort.assert_awaited_once_with(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                simple_chat_server.SUBSCRIBE_FIRST_DETAILS)
+
+    async def test_Chat(self):
+        """Tests that sent messages are confirmed and received ones are
+        streamed on the same stream
+        """
+        batches = asyncio.Queue()
+
+        async def iterate_batches():
+            while True:
+                messages = await batches.get()
+                if messages is None:
+                    return
+                yield messages
+
+        mock_cancel = Mock()
+        self.storage.watch_user_queue_messages = Mock(
+            return_value=(iterate_batches(), mock_cancel))
+        self.storage.put_message = AsyncMock()
+        deleted = asyncio.Event()
+        self.storage.delete_user_queue_message_ids = AsyncMock(
+            side_effect=lambda login, message_ids: deleted.set())
+        requests = asyncio.Queue()
+        requests.put_nowait(simple_chat_pb2.ChatRequest(
+            subscribe=simple_chat_pb2.ReceiveMessagesRequest(login='2')))
+        requests.put_nowait(simple_chat_pb2.ChatRequest(
+            message=simple_chat_pb2.Message(sender='3', recipient='1',
+                                            body='Hi!')))
+
+        async def iterate_requests():
+            while True:
+                request = await requests.get()
+                if request is None:
+                    return
+                yield request
+
+        response = self.servicer.Chat(iterate_requests(), Mock())
+
+        # the sender is the subscribed user
+        sent = (await response.__anext__()).sent
+        self.assertEqual((sent.sender, sent.recipient, sent.body),
+                         ('2', '1', 'Hi!'))
+        batches.put_nowait([Message('1', '2', 'Hello!', message_id='0')])
+        self.assertEqual((await response.__anext__()).message.id, '0')
+        requests.put_nowait(simple_chat_pb2.ChatRequest(
+            ack=simple_chat_pb2.MessagesAck(message_id='0')))
+        await asyncio.wait_for(deleted.wait(), 5)
+        batches.put_nowait(None)
+        requests.put_nowait(None)
+        self.assertEqual([response async for response in response], [])
+
+        self.storage.delete_user_queue_message_ids.assert_awaited_once_with(
+            '2', ['0'])
+        mock_cancel.assert_called_once()
+
+    async def test_ReceiveMessages_polling(self):
+        """Tests of ReceiveMessages method in polling mode"""
+        self.servicer = simple_chat_aio_server.AsyncSimpleChatServicer(
+            self.storage, simple_chat_server.DELIVERY_MODE_POLLING)
+        mock_message = Message('1', '2', 'Hello!', int(time.time()))
+
+        async def iterate_user_queue_messages(login):
+            yield [mock_message]
+
+        self.storage.iterate_user_queue_messages = Mock(
+            side_effect=iterate_user_queue_messages)
+        self.storage.delete_user_queue_messages = AsyncMock()
+
+        request = Mock(login='2', resume_after='')
+        response = self.servicer.ReceiveMessages(request, Mock())
+        message = await response.__anext__()
+        await response.aclose()
+
+        self.assertEqual(message,
+                         simple_chat_server.message_to_proto(mock_message))
+        self.storage.iterate_user_queue_messages.assert_called_once_with('2')
+
+
+class AsyncMessageAcknowledgerTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_wait_for_room_async(self):
+        """Tests that the stream waits for an ack when the window is full"""
+        acknowledger = simple_chat_aio_server.AsyncMessageAcknowledger(
+            window=1)
+        acknowledger.add('1')
+
+        waiter = asyncio.ensure_future(acknowledger.wait_for_room_async())
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+
+        acknowledger.ack('1')
+        self.assertTrue(await asyncio.wait_for(waiter, 1))
+
+        acknowledger.add('2')
+        acknowledger.close()
+        self.assertFalse(await acknowledger.wait_for_room_async())
+
+
+class AsyncStreamLimitInterceptorTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_intercept_service(self):
+        """Tests that response streams over the limit are refused"""
+        interceptor = simple_chat_aio_server.AsyncStreamLimitInterceptor(1)
+        stream = grpc.unary_stream_rpc_method_handler(
+            lambda request, context: iterate_async([request]))
+        limited = await interceptor.intercept_service(
+            AsyncMock(return_value=stream), Mock())
+        context = Mock(abort=AsyncMock(side_effect=Exception('aborted')))
+
+        responses = limited.unary_stream('request', context)
+        self.assertEqual(await responses.__anext__(), 'request')
+
+        with self.assertRaises(Exception):
+            await limited.unary_stream('request', context).__anext__()
+        context.abort.assert_awaited_once_with(
+            grpc.StatusCode.RESOURCE_EXHAUSTED,
+            simple_chat_server.STREAMS_EXHAUSTED_DETAILS)
+
+        self.assertEqual([response async for response in responses], [])
+        self.assertEqual(interceptor.limiter.count, 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main(verbosity=2)
@@ -1,9 +1,12 @@
 """Tests of simple_chat_client module"""
 import logging
+import queue
+import tempfile
 import time
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 
+import grpc
 from google.protobuf.timestamp_pb2 import Timestamp
 
 import simple_chat_client
@@ -15,11 +18,12 @@ class ClientTestCase(unittest.TestCase):
     @patch('simple_chat_client.get_users')
     def test_submit_request_get_users(self, get_users):
         """Tests of submit_request 'users branch' method"""
-        mock_parser = Mock(method='users')
+        mock_parser = Mock(method='users', page_size=10, login_prefix='a',
+                           name_prefix='')
         mock_stub = Mock()
 
         simple_chat_client.submit_request(mock_stub, mock_parser)
-        get_users.assert_called_once_with(mock_stub)
+        get_users.assert_called_once_with(mock_stub, 10, 'a', '')
 
     @patch('simple_chat_client.send_message')
     def test_submit_request_send_message(self, send_message):
@@ -33,15 +37,27 @@ class ClientTestCase(unittest.TestCase):
                                              mock_parser.recipient,
                                              mock_parser.body)
 
+    @patch('simple_chat_client.send_messages')
+    def test_submit_request_send_messages(self, send_messages):
+        """Tests of submit_request 'send-batch branch' method"""
+        mock_parser = Mock(method='send-batch', sender='1', file='-')
+        mock_stub = Mock()
+
+        simple_chat_client.submit_request(mock_stub, mock_parser)
+        send_messages.assert_called_once_with(mock_stub, mock_parser.sender,
+                                              mock_parser.file)
+
     @patch('simple_chat_client.receive_messages')
     def test_submit_request_receive_messages(self, receive_messages):
         """Tests of submit_request 'receive branch' method"""
-        mock_parser = Mock(method='receive', recipient='2')
+        mock_parser = Mock(method='receive', recipient='2',
+                           resume_after='01ID')
         mock_stub = Mock()
 
         simple_chat_client.submit_request(mock_stub, mock_parser)
         receive_messages.assert_called_once_with(mock_stub,
-                                                 mock_parser.recipient)
+                                                 mock_parser.recipient,
+                                                 '01ID')
 
     def test_validate_send_message_data(self):
         """Tests of validate_send_message_data method"""
@@ -58,6 +74,30 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             simple_chat_client.validate_send_message_data("1234", "1111", "")
 
+    def test_read_batch_messages(self):
+        """Tests of read_batch_messages method"""
+        lines = ['{"recipient": "2", "body": "Hello!"}\n',
+                 '\n',
+                 '{"sender": "3", "recipient": "2", "body": "Hi!"}\n']
+
+        requests = list(simple_chat_client.read_batch_messages(lines, '1'))
+
+        self.assertEqual(requests, [
+            simple_chat_pb2.SendMessageRequest(message=simple_chat_pb2.Message(
+                sender='1', recipient='2', body='Hello!')),
+            simple_chat_pb2.SendMessageRequest(message=simple_chat_pb2.Message(
+                sender='3', recipient='2', body='Hi!'))])
+
+    def test_read_batch_messages_error(self):
+        """Tests of read_batch_messages method values errors"""
+        with self.assertRaises(ValueError):
+            list(simple_chat_client.read_batch_messages(
+                ['{"recipient": "2", "body": "Hello!"}'], None))
+
+        with self.assertRaises(ValueError):
+            list(simple_chat_client.read_batch_messages(
+                ['{"recipient": "2"}'], '1'))
+
     def test_validate_receive_messages_data(self):
         """Tests of validate_receive_messages_data method"""
         simple_chat_client.validate_receive_messages_data("1234")
@@ -74,7 +114,7 @@ class ClientTestCase(unittest.TestCase):
         login = '111'
         full_name = "Mock User"
 
-        mock_stub.GetUsers.return_value = Mock(
+        mock_stub.GetUsers.return_value = simple_chat_pb2.GetUsersResponse(
             users=[simple_chat_pb2.User(login=login, full_name=full_name)])
 
         simple_chat_client.get_users(mock_stub)
@@ -83,6 +123,47 @@ class ClientTestCase(unittest.TestCase):
         mock_print.assert_called_once_with(
             "User login: {}. User full name: {}".format(login, full_name))
 
+    def test_iterate_users(self):
+        """Tests that iterate_users requests pages lazily"""
+        mock_stub = Mock()
+        mock_stub.GetUsers.side_effect = [
+            simple_chat_pb2.GetUsersResponse(
+                users=[simple_chat_pb2.User(login='1')],
+                next_page_token='next'),
+            simple_chat_pb2.GetUsersResponse(
+                users=[simple_chat_pb2.User(login='2')])]
+
+        users = simple_chat_client.iterate_users(mock_stub, 1, name_prefix='a')
+
+        self.assertEqual(next(users).login, '1')
+        mock_stub.GetUsers.assert_called_once_with(
+            simple_chat_pb2.GetUsersRequest(page_size=1, name_prefix='a'))
+        self.assertEqual([user.login for user in users], ['2'])
+        mock_stub.GetUsers.assert_called_with(
+            simple_chat_pb2.GetUsersRequest(
+                page_size=1, page_token='next', name_prefix='a'))
+
+    def test_iterate_history(self):
+        """Tests that iterate_history requests pages lazily"""
+        mock_stub = Mock()
+        mock_stub.GetHistory.side_effect = [
+            simple_chat_pb2.GetHistoryResponse(
+                messages=[simple_chat_pb2.Message(body='2')],
+                next_page_token='next'),
+            simple_chat_pb2.GetHistoryResponse(
+                messages=[simple_chat_pb2.Message(body='1')])]
+
+        messages = simple_chat_client.iterate_history(mock_stub, 'a', 'b', 1)
+
+        self.assertEqual(next(messages).body, '2')
+        mock_stub.GetHistory.assert_called_once_with(
+            simple_chat_pb2.GetHistoryRequest(login='a', peer='b',
+                                              page_size=1))
+        self.assertEqual([message.body for message in messages], ['1'])
+        mock_stub.GetHistory.assert_called_with(
+            simple_chat_pb2.GetHistoryRequest(
+                login='a', peer='b', page_size=1, page_token='next'))
+
     @patch('builtins.print')
     @patch('simple_chat_pb2_grpc.SimpleChatStub')
     def test_send_message(self, mock_stub, mock_print):
@@ -104,6 +185,25 @@ class ClientTestCase(unittest.TestCase):
 
         mock_print.assert_called_once_with("Message was sent")
 
+    @patch('builtins.print')
+    @patch('simple_chat_pb2_grpc.SimpleChatStub')
+    def test_send_messages(self, mock_stub, mock_print):
+        """Tests of send_messages method"""
+        sent = []
+        mock_stub.SendMessageStream = Mock(side_effect=lambda requests: (
+            sent.extend(requests) or Mock(count=len(sent))))
+
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write('{"recipient": "2", "body": "Hello!"}\n'
+                    '{"recipient": "3", "body": "Hi!"}\n')
+            f.flush()
+
+            simple_chat_client.send_messages(mock_stub, '1', f.name)
+
+        self.assertEqual([request.message.recipient for request in sent],
+                         ['2', '3'])
+        mock_print.assert_called_once_with("2 messages were sent")
+
     @patch('builtins.print')
     @patch('simple_chat_pb2_grpc.SimpleChatStub')
     def test_receive_messages(self, mock_stub, mock_print):
@@ -114,19 +214,124 @@ class ClientTestCase(unittest.TestCase):
         timestamp = Timestamp()
         timestamp.FromSeconds(int(time.time()))
 
-        mock_stub.ReceiveMessages.return_value = [simple_chat_pb2.Message(
-            sender=sender,
-            recipient=recipient,
-            body=body,
-            created=timestamp)]
+        mock_stub.SubscribeMessages.return_value = MagicMock()
+        mock_stub.SubscribeMessages.return_value.__iter__.return_value = [
+            simple_chat_pb2.Message(
+                sender=sender,
+                recipient=recipient,
+                body=body,
+                created=timestamp)]
 
         simple_chat_client.receive_messages(mock_stub, recipient)
-        mock_stub.ReceiveMessages.assert_called_once()
+        mock_stub.SubscribeMessages.assert_called_once()
 
         mock_print.assert_called_once_with(
             "From: {}. \nTo: {}. \nTime: {}. \nMessage: '{}'.\n".format(
                 sender, recipient, Timestamp.ToDatetime(timestamp), body))
 
+    def test_subscribe_messages(self):
+        """Tests that a message is acknowledged when the next one is
+        requested
+        """
+        mock_stub = Mock()
+        messages = [simple_chat_pb2.Message(id=str(index))
+                    for index in range(2)]
+        mock_stub.SubscribeMessages.return_value = MagicMock()
+        mock_stub.SubscribeMessages.return_value.__iter__.return_value = \
+            messages
+
+        received = simple_chat_client.subscribe_messages(mock_stub, '2',
+                                                         '01ID')
+        self.assertEqual(next(received), messages[0])
+        requests = mock_stub.SubscribeMessages.call_args[0][0]
+        subscription = next(requests)
+        self.assertEqual(subscription.subscribe.login, '2')
+        self.assertEqual(subscription.subscribe.resume_after, '01ID')
+
+        self.assertEqual(next(received), messages[1])
+        self.assertEqual(next(requests).ack.message_id, '0')
+        self.assertEqual(list(received), [])
+        self.assertEqual(next(requests).ack.message_id, '1')
+        self.assertEqual(list(requests), [])
+        mock_stub.SubscribeMessages.return_value.cancel.assert_called_once()
+
+    @patch('builtins.print')
+    def test_chat(self, mock_print):
+        """Tests that input lines are sent, received messages are acked
+        and the chat ends once the sent messages are confirmed
+        """
+        mock_stub = Mock()
+        responses = queue.Queue()
+        cancelled = grpc.RpcError()
+        cancelled.code = Mock(return_value=grpc.StatusCode.CANCELLED)
+
+        def iterate_responses():
+            for response in iter(responses.get, None):
+                yield response
+            raise cancelled
+
+        mock_stub.Chat.return_value = MagicMock()
+        mock_stub.Chat.return_value.__iter__.return_value = \
+            iterate_responses()
+        mock_stub.Chat.return_value.cancel.side_effect = \
+            lambda: responses.put(None)
+        responses.put(simple_chat_pb2.ChatResponse(
+            message=simple_chat_pb2.Message(sender='3', id='01ID')))
+        responses.put(simple_chat_pb2.ChatResponse(
+            sent=simple_chat_pb2.Message(id='01IE')))
+
+        simple_chat_client.chat(mock_stub, '1', '2', lines=['Hi!\n', '\n'])
+
+        requests = mock_stub.Chat.call_args[0][0]
+        self.assertEqual(next(requests).subscribe.login, '1')
+        sent = [next(requests) for _ in range(2)]
+        self.assertEqual(
+            sorted(request.WhichOneof('request') for request in sent),
+            ['ack', 'message'])
+        for request in sent:
+            if request.HasField('message'):
+                self.assertEqual((request.message.sender,
+                                  request.message.recipient,
+                                  request.message.body), ('1', '2', 'Hi!'))
+            else:
+                self.assertEqual(request.ack.message_id, '01ID')
+        self.assertEqual(list(requests), [])
+        mock_print.assert_called_once()
+
+    def test_chat_requires_sender(self):
+        """Tests that chat needs both sender and recipient"""
+        with self.assertRaises(ValueError):
+            simple_chat_client.chat(Mock(), '', '2', lines=[])
+
+    @patch('builtins.print')
+    @patch('simple_chat_client.RECONNECT_INTERVAL', 0)
+    def test_receive_messages_reconnect(self, mock_print):
+        """Tests that broken subscription resumes after the last message"""
+        mock_stub = Mock()
+        error = grpc.RpcError()
+        error.code = Mock(return_value=grpc.StatusCode.UNAVAILABLE)
+
+        def subscribe(requests):
+            resume_after = next(requests).subscribe.resume_after
+            if resume_after:
+                return MagicMock()
+            responses = MagicMock()
+            responses.__iter__.return_value = \
+                iterate_then_raise(simple_chat_pb2.Message(id='1'), error)
+            return responses
+
+        mock_stub.SubscribeMessages.side_effect = subscribe
+
+        simple_chat_client.receive_messages(mock_stub, '2')
+
+        self.assertEqual(mock_stub.SubscribeMessages.call_count, 2)
+        mock_print.assert_called_once()
+
+
+def iterate_then_raise(item, error):
+    yield item
+    raise error
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
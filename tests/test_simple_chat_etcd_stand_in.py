@@ -0,0 +1,270 @@
+"""Tests of simple_chat_etcd_stand_in module"""
+import logging
+import socket
+import threading
+import time
+import unittest
+
+import etcd3
+import grpc
+
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import (EtcdClientPool, Message,
+                                      PresenceRegistry, Storage, User,
+                                      POOL_LEAST_LOADED, STORAGE_MAX_TXN_OPS,
+                                      STORAGE_USER_KEY)
+
+
+class EtcdStandInTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = EtcdStandIn()
+        self.port = self.stand_in.start()
+        self.client = etcd3.client('127.0.0.1', self.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.stand_in.stop()
+
+    def test_txn_duplicate_key(self):
+        """Tests that a txn putting one key twice is rejected like etcd"""
+        put = self.client.transactions.put
+        delete = self.client.transactions.delete
+
+        for success in ([put('a', '1'), put('a', '2')],
+                        [put('a', '1'), delete('a')]):
+            with self.assertRaises(grpc.RpcError) as raised:
+                self.client.transaction(compare=[], success=success,
+                                        failure=[])
+            self.assertEqual(raised.exception.code(),
+                             grpc.StatusCode.INVALID_ARGUMENT)
+
+        self.assertEqual(self.client.get('a'), (None, None))
+
+    def test_txn_too_many_operations(self):
+        """Tests that a txn over the operation limit is rejected"""
+        put = self.client.transactions.put
+        success = [put(str(index), 'value')
+                   for index in range(self.stand_in.max_txn_ops + 1)]
+
+        with self.assertRaises(grpc.RpcError) as raised:
+            self.client.transaction(compare=[], success=success, failure=[])
+        self.assertEqual(raised.exception.code(),
+                         grpc.StatusCode.INVALID_ARGUMENT)
+
+        self.client.transaction(compare=[], success=success[1:], failure=[])
+
+    def test_put_messages_same_created(self):
+        """Tests that a batch with equal created times is fully stored"""
+        storage = Storage('127.0.0.1', self.port)
+        messages = [Message('1', '2', str(index), 1.7e9)
+                    for index in range(2 * STORAGE_MAX_TXN_OPS + 1)]
+
+        storage.put_messages(messages)
+
+        stored = storage.get_user_queue_messages('2')
+        self.assertEqual([message.body for message in stored],
+                         [message.body for message in messages])
+
+    def test_put_message_concurrent(self):
+        """Tests that messages sent by many threads at once are all stored
+        and each sender's messages are read in the order they were sent
+        """
+        storage = Storage('127.0.0.1', self.port)
+        threads_count, messages_count = 8, 500
+
+        def send(sender):
+            for index in range(messages_count):
+                storage.put_message(Message(sender, '2', str(index), 1.7e9))
+
+        threads = [threading.Thread(target=send, args=(str(sender),))
+                   for sender in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stored = storage.get_user_queue_messages('2')
+        self.assertEqual(len(stored), threads_count * messages_count)
+        self.assertEqual(len({message.message_id for message in stored}),
+                         len(stored))
+        for sender in range(threads_count):
+            self.assertEqual(
+                [int(message.body) for message in stored
+                 if message.sender == str(sender)],
+                list(range(messages_count)))
+
+    def test_watch_pages_backlog(self):
+        """Tests that messages sent while a long backlog is paged are
+        delivered once and in order
+        """
+        storage = Storage('127.0.0.1', self.port, queue_page_size=16)
+        sent = 100
+        storage.put_messages([Message('1', '2', str(index))
+                              for index in range(sent)])
+
+        batches, cancel = storage.watch_user_queue_messages('2')
+        timer = threading.Timer(10, cancel)
+        timer.start()
+        delivered = []
+        for messages in batches:
+            self.assertLessEqual(len(messages), 16)
+            delivered.extend(messages)
+            storage.delete_user_queue_messages(messages)
+            if sent < 120:
+                storage.put_message(Message('1', '2', str(sent)))
+                sent += 1
+            if len(delivered) >= sent:
+                break
+        cancel()
+        timer.cancel()
+
+        self.assertEqual([int(message.body) for message in delivered],
+                         list(range(120)))
+        self.assertEqual(storage.get_user_queue_messages('2'), [])
+
+    def test_send_message_local(self):
+        """Tests that a message handed over to a subscriber is streamed
+        once and deleted once stored
+        """
+        storage = Storage('127.0.0.1', self.port)
+        storage.put_message(Message('1', '2', 'queued'))
+        batches, cancel = storage.watch_user_queue_messages('2')
+        timer = threading.Timer(10, cancel)
+        timer.start()
+
+        delivered = []
+        for body in ('local', 'stored'):
+            delivered.extend(next(batches))
+            storage.delete_user_queue_messages(delivered[-1:])
+            if body == 'local':
+                storage.send_message(Message('1', '2', body))
+            else:
+                storage.put_message(Message('1', '2', body))
+        delivered.extend(next(batches))
+        storage.delete_user_queue_messages(delivered[-1:])
+        cancel()
+        timer.cancel()
+
+        self.assertEqual([message.body for message in delivered],
+                         ['queued', 'local', 'stored'])
+        self.assertEqual(storage.get_user_queue_messages('2'), [])
+
+    def test_presence_routing(self):
+        """Tests that a message sent on one node is woken on the node its
+        recipient is subscribed to and that presence ends with the node
+        """
+        nodes = [Storage('127.0.0.1', self.port, node_id=node_id)
+                 for node_id in ('a', 'b')]
+        batches, cancel = nodes[0].watch_user_queue_messages('2')
+        timer = threading.Timer(10, cancel)
+        timer.start()
+        delivered = []
+        reader = threading.Thread(
+            target=lambda: delivered.extend(next(batches)))
+        reader.start()
+        while not nodes[1].get_user_presence('2'):
+            time.sleep(0.01)
+        self.assertEqual(nodes[1].get_user_presence('2'), ['a'])
+
+        nodes[1].put_messages([Message('1', login, 'Hello {}'.format(login))
+                               for login in ('2', '3')])
+        reader.join()
+        cancel()
+        timer.cancel()
+
+        self.assertEqual([message.body for message in delivered],
+                         ['Hello 2'])
+        self.assertEqual(len(nodes[1].get_user_queue_messages('2')), 1)
+        nodes[0].close()
+        self.assertEqual(nodes[1].get_user_presence('2'), [])
+        nodes[1].close()
+
+    def test_presence_expires(self):
+        """Tests that presence is kept alive while the registry refreshes
+        its lease and expires once it stops
+        """
+        registry = PresenceRegistry(self.client, 'a', ttl=1)
+        registry.register('2')
+        registry.register('2')
+        registry.unregister('2')
+
+        time.sleep(1.5)
+        self.assertEqual(registry.get_nodes('2'), ['a'])
+
+        registry._closed.set()
+        time.sleep(1.5)
+        self.assertEqual(registry.get_nodes('2'), [])
+
+    def test_client_pool_health_check(self):
+        """Tests that calls go around an endpoint failing health checks"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            dead_port = sock.getsockname()[1]
+        pool = EtcdClientPool([('127.0.0.1', self.port),
+                               ('127.0.0.1', dead_port)],
+                              health_check_interval=0.1)
+        deadline = time.time() + 10
+        while len(pool._healthy) != 1:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        pool.close()
+
+        for index in range(4):
+            pool.get().put('key', str(index))
+        self.assertEqual(self.client.get('key')[0], b'3')
+
+    def test_client_pool_least_loaded(self):
+        """Tests that the client with the fewest calls in flight is
+        picked and calls are counted until they return
+        """
+        self.stand_in.latency = 0.2
+        pool = EtcdClientPool([('127.0.0.1', self.port)], 2,
+                              POOL_LEAST_LOADED)
+        busy = pool.get()
+        thread = threading.Thread(target=busy.get, args=('key',))
+        thread.start()
+        time.sleep(0.1)
+
+        self.assertEqual(pool._in_flight, [1, 0])
+        self.assertIsNot(pool.get(), busy)
+        thread.join()
+        self.assertEqual(pool._in_flight, [0, 0])
+
+    def test_delete_user_queue_messages_until(self):
+        """Tests that only messages up to the id are deleted"""
+        storage = Storage('127.0.0.1', self.port)
+        messages = [Message('1', login, str(index))
+                    for login in ('2', '20') for index in range(3)]
+        storage.put_messages(messages)
+
+        storage.delete_user_queue_messages_until('2', messages[1].message_id)
+
+        self.assertEqual([message.body for message
+                          in storage.get_user_queue_messages('2')], ['2'])
+        self.assertEqual(len(storage.get_user_queue_messages('20')), 3)
+
+    def test_reindex_users(self):
+        """Tests that users stored without the name index become
+        searchable by name
+        """
+        storage = Storage('127.0.0.1', self.port)
+        for index in range(STORAGE_MAX_TXN_OPS + 1):
+            self.client.put(STORAGE_USER_KEY.format(user_id=index),
+                            '{{"login": "{0}", "full_name": "User {0}"}}'
+                            .format(index))
+        self.assertEqual(storage.get_users_page(10, name_prefix='user'),
+                         ([], None))
+
+        self.assertEqual(storage.reindex_users(), STORAGE_MAX_TXN_OPS + 1)
+
+        users, _ = storage.get_users_page(10, name_prefix='user 12')
+        self.assertEqual([user.login for user in users],
+                         ['12', '120', '121', '122', '123', '124', '125',
+                          '126', '127', '128'])
+        self.assertEqual(users[0], User('12', 'User 12'))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main(verbosity=2)
@@ -1,13 +1,23 @@
 """Tests of simple_chat_etcdstorage module"""
+import functools
 import json
 import logging
+import threading
 import time
 import unittest
+from concurrent import futures
 from dataclasses import asdict
+from types import SimpleNamespace
+from typing import List
 from unittest.mock import patch, Mock
 
+import etcd3
+import grpc
+from etcd3.events import PutEvent, DeleteEvent
+
 import simple_chat_etcd_storage as storage
-from simple_chat_etcd_storage import User, Message, Storage
+from simple_chat_etcd_storage import (User, Message, QueuePage, Storage,
+                                      StoredMessage)
 
 
 class UserTestCase(unittest.TestCase):
@@ -47,20 +57,74 @@ class MessageTestCase(unittest.TestCase):
 
         self.assertEqual(message, message2)
 
-    def test_get_unique_queue_message_key(self):
-        """ Tests of get_unique_queue_message_key method"""
-        message = Message('1', '2', 'Hello!')
-        
-        message_key = \
-            "{}{}{}".format(message.sender, message.created, message.recipient)
-        self.assertEqual(message.get_unique_queue_message_key(), message_key)
+
+class MessageIdGeneratorTestCase(unittest.TestCase):
+
+    def test_generate(self):
+        """Tests that ids have fixed width and increase"""
+        generator = storage.MessageIdGenerator()
+
+        ids = [generator.generate() for _ in range(1000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        for message_id in ids:
+            self.assertEqual(len(message_id), generator.LENGTH)
+            self.assertTrue(set(message_id) <= set(generator.ALPHABET))
+
+    @patch('time.time_ns')
+    def test_clock_goes_back(self, mock_time_ns):
+        """Tests that ids keep increasing when the clock goes back"""
+        generator = storage.MessageIdGenerator()
+
+        mock_time_ns.return_value = 2000 * 1000000
+        first = generator.generate()
+        mock_time_ns.return_value = 1000 * 1000000
+        second = generator.generate()
+        mock_time_ns.return_value = 3000 * 1000000
+        third = generator.generate()
+
+        self.assertLess(first, second)
+        self.assertLess(second, third)
+
+    @patch('secrets.randbits')
+    @patch('time.time_ns', Mock(return_value=1000 * 1000000))
+    def test_random_overflow(self, mock_randbits):
+        """Tests that overflow of the random part moves to next millisecond"""
+        generator = storage.MessageIdGenerator()
+        mock_randbits.return_value = (1 << generator.RANDOM_BITS) - 1
+
+        first = generator.generate()
+        second = generator.generate()
+
+        self.assertLess(first, second)
+        self.assertEqual(generator._last_time, 1001)
+
+    def test_concurrent_generate(self):
+        """Tests that ids of many threads are unique and ordered per thread"""
+        generator = storage.MessageIdGenerator()
+        results = [[] for _ in range(8)]
+
+        def generate(ids):
+            for _ in range(1000):
+                ids.append(generator.generate())
+
+        threads = [threading.Thread(target=generate, args=(ids,))
+                   for ids in results]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for ids in results:
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(sum(results, []))), 8000)
 
 
 class StorageTestCase(unittest.TestCase):
 
     @patch('etcd3.client')
     def setUp(self, mock_etcd_client):
-        self.storage = Storage(Mock(), Mock())
+        self.storage = Storage('etcd', 2379)
 
     def test_get_users(self):
         """Tests of get_users method"""
@@ -76,17 +140,161 @@ class StorageTestCase(unittest.TestCase):
 
         self.assertEqual(users[0], User('1', 'User'))
 
+    def test_get_users_with_revision(self):
+        """Tests of get_users_with_revision method"""
+        mock_response = Mock(
+            kvs=[Mock(value='{"login": "1", "full_name": "User"}')])
+        mock_response.header.revision = 10
+        self.storage._client.get_prefix_response = Mock(
+            return_value=mock_response)
+
+        users, revision = self.storage.get_users_with_revision()
+
+        self.storage._client.get_prefix_response.assert_called_once_with(
+            storage.STORAGE_USER_PREFIX_KEY)
+        self.assertEqual(users, [User('1', 'User')])
+        self.assertEqual(revision, 10)
+
+    def test_watch_users(self):
+        """Tests of watch_users method"""
+        callback = Mock()
+        client = self.storage._client
+
+        cancel = self.storage.watch_users(callback, 11)
+
+        client.add_watch_prefix_callback.assert_called_once()
+        args, kwargs = client.add_watch_prefix_callback.call_args
+        self.assertEqual(args[0], storage.STORAGE_USER_PREFIX_KEY)
+        self.assertEqual(kwargs, {'start_revision': 11})
+
+        on_watch_response = args[1]
+        put_event = PutEvent(SimpleNamespace(kv=SimpleNamespace(
+            key=b'user/1', value='{"login": "1", "full_name": "User"}')))
+        delete_event = DeleteEvent(SimpleNamespace(kv=SimpleNamespace(
+            key=b'user/2')))
+        on_watch_response(SimpleNamespace(events=[put_event, delete_event]))
+        callback.assert_called_once_with([('1', User('1', 'User')),
+                                          ('2', None)])
+
+        error = Exception('stream broken')
+        on_watch_response(error)
+        callback.assert_called_with(error)
+
+        cancel()
+        client.cancel_watch.assert_called_once_with(
+            client.add_watch_prefix_callback.return_value)
+
     def test_put_user(self):
         """Tests of put_user method"""
-        mock_etcd_client_put = Mock()
-        self.storage._client.put = mock_etcd_client_put
+        client = self.storage._client
+        client.get = Mock(return_value=(None, None))
+        client.transaction = Mock(return_value=(True, []))
 
         user = User('1', 'User')
         self.storage.put_user(user)
 
-        prefix = storage.STORAGE_USER_KEY.format(user_id=user.login)
-        mock_etcd_client_put.assert_called_once_with(
-            prefix, json.dumps(asdict(user)))
+        key = storage.STORAGE_USER_KEY.format(user_id=user.login)
+        index_key = storage.STORAGE_USER_NAME_INDEX_KEY.format(
+            name='user', user_id=user.login)
+        value = json.dumps(asdict(user))
+        client.get.assert_called_once_with(key)
+        client.transactions.put.assert_any_call(key, value)
+        client.transactions.put.assert_any_call(index_key, value)
+        client.transactions.delete.assert_not_called()
+        client.transactions.version.assert_called_once_with(key)
+
+    def test_put_user_renamed(self):
+        """Tests that put_user replaces index entry of the old name"""
+        client = self.storage._client
+        client.get = Mock(return_value=(
+            '{"login": "1", "full_name": "Old Name"}', Mock(mod_revision=5)))
+        # the user is changed concurrently once
+        client.transaction = Mock(side_effect=[(False, []), (True, [])])
+
+        self.storage.put_user(User('1', 'New Name'))
+
+        self.assertEqual(client.get.call_count, 2)
+        self.assertEqual(client.transaction.call_count, 2)
+        client.transactions.delete.assert_called_with(
+            storage.STORAGE_USER_NAME_INDEX_KEY.format(
+                name='old name', user_id='1'))
+        client.transactions.mod.assert_called_with(
+            storage.STORAGE_USER_KEY.format(user_id='1'))
+
+    def test_get_users_page(self):
+        """Tests of get_users_page method"""
+        response = SimpleNamespace(more=True, kvs=[SimpleNamespace(
+            key=b'user/ab', value='{"login": "ab", "full_name": "User"}')])
+        self.storage._client.kvstub.Range = Mock(return_value=response)
+
+        users, next_key = self.storage.get_users_page(1, login_prefix='a')
+
+        request = self.storage._client.kvstub.Range.call_args[0][0]
+        self.assertEqual(request.key, b'user/a')
+        self.assertEqual(request.range_end, b'user/b')
+        self.assertEqual(request.limit, 1)
+        self.assertEqual(users, [User('ab', 'User')])
+        self.assertEqual(next_key, 'user/ab\0')
+
+        response.more = False
+        users, next_key = self.storage.get_users_page(
+            1, next_key, login_prefix='a')
+
+        request = self.storage._client.kvstub.Range.call_args[0][0]
+        self.assertEqual(request.key, b'user/ab\0')
+        self.assertIsNone(next_key)
+
+    def test_get_users_page_by_name(self):
+        """Tests of get_users_page method with name prefix"""
+        response = SimpleNamespace(more=False, kvs=[
+            SimpleNamespace(key=b'index/user/name/ann/b',
+                            value='{"login": "b", "full_name": "Ann"}'),
+            SimpleNamespace(key=b'index/user/name/anna/a',
+                            value='{"login": "a", "full_name": "Anna"}')])
+        self.storage._client.kvstub.Range = Mock(return_value=response)
+
+        users, next_key = self.storage.get_users_page(
+            10, login_prefix='a', name_prefix='AN')
+
+        request = self.storage._client.kvstub.Range.call_args[0][0]
+        self.assertEqual(request.key, b'index/user/name/an')
+        self.assertEqual(request.range_end, b'index/user/name/ao')
+        self.assertEqual(users, [User('a', 'Anna')])
+        self.assertIsNone(next_key)
+
+    def test_get_users_page_errors(self):
+        """Tests that range errors are translated like etcd3 does"""
+        class UnavailableError(grpc.RpcError):
+            def code(self):
+                return grpc.StatusCode.UNAVAILABLE
+
+        self.storage._client.kvstub.Range = Mock(
+            side_effect=UnavailableError())
+
+        with self.assertRaises(etcd3.exceptions.ConnectionFailedError):
+            self.storage.get_users_page(10)
+
+    def test_reindex_users(self):
+        """Tests that reindex_users indexes all users page by page"""
+        client = self.storage._client
+        first_page = [User(str(index), 'User') for index in range(2)]
+        self.storage.get_users_page = Mock(side_effect=[
+            (first_page, 'user/1\0'), ([User('2', 'Last')], None)])
+
+        self.assertEqual(self.storage.reindex_users(), 3)
+
+        self.storage.get_users_page.assert_called_with(
+            storage.STORAGE_MAX_TXN_OPS, 'user/1\0')
+        self.assertEqual(client.transaction.call_count, 2)
+        client.transactions.put.assert_called_with(
+            storage.STORAGE_USER_NAME_INDEX_KEY.format(name='last',
+                                                       user_id='2'),
+            json.dumps({'login': '2', 'full_name': 'Last'}))
+
+    def test_get_users_page_foreign_start_key(self):
+        """Tests that page start key must belong to the requested range"""
+        with self.assertRaises(ValueError):
+            self.storage.get_users_page(10, 'message/', login_prefix='a')
 
     def test_put_message(self):
         """Tests of put_message method"""
@@ -96,12 +304,132 @@ class StorageTestCase(unittest.TestCase):
         message = Message('1', '2', 'Hello!')
         self.storage.put_message(message)
 
+        self.assertEqual(len(message.message_id),
+                         storage.MessageIdGenerator.LENGTH)
         prefix = storage.STORAGE_USER_MESSAGE_QUEUE_KEY.format(
-            user_id=message.recipient,
-            message_id=message.get_unique_queue_message_key())
+            user_id=message.recipient, message_id=message.message_id)
 
         mock_etcd_client_put.assert_called_once_with(
-            prefix, json.dumps(asdict(message)))
+            prefix, self.storage.message_codec.encode(message))
+
+    def test_put_messages_same_created(self):
+        """Tests that messages created at one time get unique ordered keys"""
+        client = self.storage._client
+        messages = [Message('1', '2', str(index), 1.7e9)
+                    for index in range(storage.STORAGE_MAX_TXN_OPS + 1)]
+
+        self.storage.put_messages(messages)
+
+        keys = [put_call[0][0]
+                for put_call in client.transactions.put.call_args_list]
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertEqual(len(keys), len(messages))
+        self.assertEqual(messages[1].created, 1.7e9)
+
+    def test_put_message_keeps_id(self):
+        """Tests that message id given by the caller is kept"""
+        message = Message('1', '2', 'Hello!', message_id='01ID')
+
+        self.storage.put_message(message)
+
+        self.storage._client.put.assert_called_once_with(
+            'message/queue/user/2/01ID',
+            self.storage.message_codec.encode(message))
+
+    def test_put_messages_partial_write(self):
+        """Tests that failed batch tells how many messages were stored"""
+        client = self.storage._client
+        error = Exception('etcd is gone')
+        client.transaction = Mock(side_effect=[(True, []), error])
+        messages = [Message('1', '2', str(index), index)
+                    for index in range(storage.STORAGE_MAX_TXN_OPS + 1)]
+
+        with self.assertRaises(storage.PartialWriteError) as raised:
+            self.storage.put_messages(messages)
+
+        self.assertEqual(raised.exception.stored, storage.STORAGE_MAX_TXN_OPS)
+        self.assertIs(raised.exception.error, error)
+
+    def test_put_messages(self):
+        """Tests of put_messages method"""
+        client = self.storage._client
+        messages = [Message('1', '2', str(index), index)
+                    for index in range(storage.STORAGE_MAX_TXN_OPS + 1)]
+
+        self.storage.put_messages(messages)
+
+        client.put.assert_not_called()
+        self.assertEqual(client.transaction.call_count, 2)
+        client.transactions.put.assert_called_with(
+            storage.STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+                user_id='2', message_id=messages[-1].message_id),
+            self.storage.message_codec.encode(messages[-1]))
+
+    @patch('etcd3.client')
+    def test_put_message_wakes_nodes(self, mock_etcd_client):
+        """Tests that nodes of the subscribed recipient are woken with
+        the revision the message was stored at
+        """
+        routed = Storage('etcd', 2379, node_id='node-1')
+        client = routed._client
+        metadata = SimpleNamespace(response_header=SimpleNamespace(revision=7))
+        client.transaction.return_value = (True, [
+            Mock(), [(b'node-1', metadata), (b'node-2', metadata)]])
+        message = Message('1', '2', 'Hello!')
+
+        routed.put_message(message)
+
+        client.put.assert_not_called()
+        client.transactions.get.assert_called_once_with('presence/2/',
+                                                        'presence/20')
+        client.lease.assert_called_once_with(storage.WAKE_TTL)
+        value = routed.message_codec.encode(message)
+        wake_keys = [put_call[0][0]
+                     for put_call in client.transactions.put.call_args_list
+                     if put_call[1].get('lease') is client.lease.return_value]
+        self.assertEqual(wake_keys, [
+            'message/wake/{}/2/{}/7'.format(node_id, message.message_id)
+            for node_id in ('node-1', 'node-2')])
+        client.transactions.put.assert_called_with(wake_keys[-1], value,
+                                                   lease=client.lease())
+        self.assertEqual(client.transaction.call_count, 2)
+
+    @patch('etcd3.client')
+    def test_put_message_without_presence(self, mock_etcd_client):
+        """Tests that no node is woken for a recipient not subscribed"""
+        routed = Storage('etcd', 2379, node_id='node-1')
+        client = routed._client
+        client.transaction.return_value = (True, [Mock(), []])
+
+        routed.put_message(Message('1', '2', 'Hello!'))
+
+        client.transaction.assert_called_once()
+        client.lease.assert_not_called()
+
+    @patch('etcd3.client')
+    def test_put_message_batched(self, mock_etcd_client):
+        """Tests that messages put at once share one transaction"""
+        batched = Storage('etcd', 2379, write_batch_window=0.05)
+        client = batched._client
+        client.transaction.return_value = (True, [])
+        messages = [Message('1', '2', str(index)) for index in range(3)]
+
+        threads = [threading.Thread(target=batched.put_message,
+                                    args=(message,))
+                   for message in messages]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batched.close()
+
+        client.put.assert_not_called()
+        client.transaction.assert_called_once()
+        self.assertEqual(
+            sorted(put_call[0][0]
+                   for put_call in client.transactions.put.call_args_list),
+            sorted(batched._get_queue_message_key(message)
+                   for message in messages))
 
     def test_get_user_queue_messages(self):
         """Tests of get_user_queue_messages method"""
@@ -109,10 +437,12 @@ class StorageTestCase(unittest.TestCase):
             'sender': '111',
             'recipient': '123',
             'body': 'Hello!',
-            'created': time.time()
+            'created': time.time(),
+            'message_id': '01ID'
         }
 
-        users_tuple = ((json.dumps(message_dict), Mock()), )
+        users_tuple = ((json.dumps(message_dict),
+                        Mock(key=b'message/queue/user/123/01ID')), )
 
         mock_etcd_client_get_prefix = Mock(return_value=users_tuple)
         self.storage._client.get_prefix = mock_etcd_client_get_prefix
@@ -126,20 +456,636 @@ class StorageTestCase(unittest.TestCase):
 
         self.assertEqual(Message.from_dict(message_dict), messages[0])
 
+    def test_get_user_queue_page(self):
+        """Tests of get_user_queue_page method"""
+        key = 'message/queue/user/2/01ID'
+        message = Message('1', '2', 'Hello!')
+        response = Mock(kvs=[Mock(key=key.encode(), value=b'value',
+                                  mod_revision=3)], more=True)
+        response.header.revision = 10
+        self.storage._get_range = Mock(return_value=response)
+
+        page = self.storage.get_user_queue_page('2', 1)
+
+        self.storage._get_range.assert_called_once_with(
+            'message/queue/user/2/', 'message/queue/user/20', 1)
+        self.assertEqual(page, QueuePage([(3, StoredMessage(key, b'value'))],
+                                         key + '\0', 10))
+
+        response.more = False
+        page = self.storage.get_user_queue_page('2', 1, page.next_key)
+        self.storage._get_range.assert_called_with(
+            key + '\0', 'message/queue/user/20', 1)
+        self.assertIsNone(page.next_key)
+
+        with self.assertRaises(ValueError):
+            self.storage.get_user_queue_page('2', 1, 'message/queue/user/3/')
+
+    def test_iterate_user_queue_messages(self):
+        """Tests that the queue is read lazily page after page"""
+        messages = [Message('1', '2', str(index), index, str(index))
+                    for index in range(5)]
+        pages = make_queue_pages(messages, 10, page_size=2)
+        for page, next_page in zip(pages, pages[1:]):
+            page.next_key = next_page.messages[0][1].key
+        self.storage.get_user_queue_page = Mock(side_effect=pages)
+
+        iterator = self.storage.iterate_user_queue_messages('2')
+        self.storage.get_user_queue_page.assert_not_called()
+
+        self.assertEqual(list(iterator),
+                         [messages[:2], messages[2:4], messages[4:]])
+        self.assertEqual(
+            [call[0] for call in
+             self.storage.get_user_queue_page.call_args_list],
+            [('2', storage.QUEUE_PAGE_SIZE, None),
+             ('2', storage.QUEUE_PAGE_SIZE, pages[0].next_key),
+             ('2', storage.QUEUE_PAGE_SIZE, pages[1].next_key)])
+
+    def test_iterate_user_queue_messages_empty(self):
+        """Tests that an empty queue yields no pages"""
+        self.storage.get_user_queue_page = Mock(
+            return_value=QueuePage([], None, 10))
+
+        self.assertEqual(
+            list(self.storage.iterate_user_queue_messages('2', 5, 'key')),
+            [])
+        self.storage.get_user_queue_page.assert_called_once_with(
+            '2', 5, 'key')
+
     def test_delete_user_queue_message(self):
         """Tests of delete_user_queue_message method"""
         mock_etcd_client_delete = Mock()
         self.storage._client.delete = mock_etcd_client_delete
 
-        message = Message('1', '2', 'Hello!')
+        message = Message('1', '2', 'Hello!', message_id='01ID')
         self.storage.delete_user_queue_message(message)
 
         delete_message_key = storage.STORAGE_USER_MESSAGE_QUEUE_KEY.format(
-            user_id=message.recipient,
-            message_id=message.get_unique_queue_message_key())
+            user_id=message.recipient, message_id=message.message_id)
 
         mock_etcd_client_delete.assert_called_once_with(delete_message_key)
 
+    def test_delete_user_queue_messages(self):
+        """Tests of delete_user_queue_messages method"""
+        client = self.storage._client
+        messages = [Message('1', '2', str(index), index, str(index))
+                    for index in range(storage.STORAGE_MAX_TXN_OPS + 1)]
+
+        self.storage.delete_user_queue_messages(messages)
+
+        client.delete.assert_not_called()
+        self.assertEqual(client.transaction.call_count, 2)
+        first, second = client.transaction.call_args_list
+        self.assertEqual(len(first.kwargs['success']),
+                         storage.STORAGE_MAX_TXN_OPS)
+        client.transactions.delete.assert_called_with(
+            storage.STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+                user_id='2', message_id=messages[-1].message_id))
+
+    def test_delete_user_queue_message_ids(self):
+        """Tests of delete_user_queue_message_ids method"""
+        client = self.storage._client
+
+        self.storage.delete_user_queue_message_ids('2', ['01A', '01B'])
+
+        client.transaction.assert_called_once()
+        self.assertEqual(
+            [call[0][0] for call in
+             client.transactions.delete.call_args_list],
+            ['message/queue/user/2/01A', 'message/queue/user/2/01B'])
+
+    def test_delete_user_queue_messages_until(self):
+        """Tests that messages up to the id are deleted with one range"""
+        client = self.storage._client
+
+        self.storage.delete_user_queue_messages_until('2', '01ID')
+
+        client.transactions.delete.assert_called_once_with(
+            'message/queue/user/2/',
+            range_end='message/queue/user/2/01ID\0')
+        client.transaction.assert_called_once_with(
+            compare=[], success=[client.transactions.delete.return_value],
+            failure=[])
+
+    def test_send_message(self):
+        """Tests that a message without local subscribers is stored
+        before send_message returns
+        """
+        client = self.storage._client
+        message = Message('1', '2', 'Hello!', message_id='01ID')
+
+        self.storage.send_message(message)
+
+        client.put.assert_called_once_with(
+            'message/queue/user/2/01ID',
+            self.storage.message_codec.encode(message))
+        self.assertEqual(self.storage._persisting, {})
+
+    def test_send_message_local(self):
+        """Tests that a handed over message is stored in the background
+        and deleting it waits until it is stored
+        """
+        client = self.storage._client
+        stored = threading.Event()
+        client.put.side_effect = lambda key, value: stored.wait(5)
+        self.storage._queue_dispatcher.deliver = Mock(return_value=True)
+        message = Message('1', '2', 'Hello!', message_id='01ID')
+
+        self.storage.send_message(message)
+
+        self.storage._queue_dispatcher.deliver.assert_called_once_with(
+            '2', StoredMessage('message/queue/user/2/01ID',
+                               self.storage.message_codec.encode(message)))
+        deleting = threading.Thread(
+            target=self.storage.delete_user_queue_message_ids,
+            args=('2', ['01ID']))
+        deleting.start()
+        deleting.join(0.1)
+        self.assertTrue(deleting.is_alive())
+        client.transaction.assert_not_called()
+
+        stored.set()
+        deleting.join(5)
+        client.put.assert_called_once()
+        client.transaction.assert_called_once()
+        self.assertEqual(self.storage._persisting, {})
+
+    def test_get_user_queue_messages_with_revision(self):
+        """Tests of get_user_queue_messages_with_revision method"""
+        message = Message('1', '2', 'Hello!', message_id='01ID')
+
+        mock_response = Mock(kvs=[Mock(key=b'message/queue/user/2/01ID',
+                                       value=json.dumps(asdict(message)))])
+        mock_response.header.revision = 10
+        mock_etcd_client_get_prefix_response = Mock(
+            return_value=mock_response)
+        self.storage._client.get_prefix_response = \
+            mock_etcd_client_get_prefix_response
+
+        messages, revision = \
+            self.storage.get_user_queue_messages_with_revision('2')
+
+        mock_etcd_client_get_prefix_response.assert_called_once_with(
+            storage.STORAGE_USER_MESSAGE_QUEUE_PREFIX_KEY.format(user_id='2'))
+        self.assertEqual(messages, [message])
+        self.assertEqual(revision, 10)
+
+    def test_get_user_queue_stored_messages_with_revision(self):
+        """Tests of get_user_queue_stored_messages_with_revision method"""
+        mock_response = Mock(kvs=[Mock(key=b'message/queue/user/2/1',
+                                       value=b'value')])
+        mock_response.header.revision = 10
+        self.storage._client.get_prefix_response = Mock(
+            return_value=mock_response)
+
+        messages, revision = \
+            self.storage.get_user_queue_stored_messages_with_revision('2')
+
+        self.assertEqual(messages,
+                         [StoredMessage('message/queue/user/2/1', b'value')])
+        self.assertEqual(revision, 10)
+
+    def test_delete_user_queue_stored_messages(self):
+        """Tests of delete_user_queue_stored_messages method"""
+        client = self.storage._client
+        messages = [StoredMessage('message/queue/user/2/{}'.format(index),
+                                  b'value')
+                    for index in range(storage.STORAGE_MAX_TXN_OPS + 1)]
+
+        self.storage.delete_user_queue_stored_messages(messages)
+
+        self.assertEqual(client.transaction.call_count, 2)
+        client.transactions.delete.assert_called_with(messages[-1].key)
+
+    def test_to_wire_message(self):
+        """Tests that stored values are brought to the wire format"""
+        key = 'message/queue/user/2/01ID'
+        message = Message('1', '2', 'Hello!', message_id='01ID')
+        wire_value = storage.ProtobufMessageCodec().encode(message)
+        stored = StoredMessage(key, wire_value)
+
+        self.assertIs(self.storage.to_wire_message(stored), stored)
+        message.message_id = None
+        self.assertEqual(
+            self.storage.to_wire_message(StoredMessage(
+                key, storage.ProtobufMessageCodec().encode(message))),
+            stored)
+        self.assertEqual(
+            self.storage.to_wire_message(StoredMessage(
+                key, storage.JsonMessageCodec().encode(message))),
+            stored)
+
+        self.storage.message_codec = storage.JsonMessageCodec()
+        self.assertEqual(
+            self.storage.to_wire_message(StoredMessage(
+                key, self.storage.message_codec.encode(message))),
+            stored)
+
+    def test_watch_user_queue_messages(self):
+        """Tests of watch_user_queue_messages method"""
+        queued_message = Message('1', '2', 'Hello!')
+        new_message = Message('3', '2', 'Hi!')
+
+        self.storage.iterate_user_queue_pages = Mock(
+            return_value=iter(make_queue_pages([queued_message], 10)))
+
+        messages, cancel = self.storage.watch_user_queue_messages('2')
+        self.assertEqual(next(messages), [queued_message])
+
+        self.storage._client.add_watch_prefix_callback.assert_called_once()
+        callback = \
+            self.storage._client.add_watch_prefix_callback.call_args[0][1]
+        callback(make_watch_response(new_message, 11))
+        self.assertEqual(next(messages), [new_message])
+
+        cancel()
+        with self.assertRaises(StopIteration):
+            next(messages)
+
+    def test_watch_user_queue_stored_messages(self):
+        """Tests of watch_user_queue_stored_messages method"""
+        queued_message = Message('1', '2', 'Hello!')
+        new_message = Message('3', '2', 'Hi!')
+
+        self.storage.iterate_user_queue_pages = Mock(
+            return_value=iter(make_queue_pages([queued_message], 10)))
+
+        messages, cancel = self.storage.watch_user_queue_stored_messages('2')
+        self.assertEqual(next(messages), [make_stored_message(queued_message)])
+
+        callback = \
+            self.storage._client.add_watch_prefix_callback.call_args[0][1]
+        callback(make_watch_response(new_message, 11))
+        self.assertEqual(next(messages), [make_stored_message(new_message)])
+
+        cancel()
+
+
+MESSAGE_IDS = storage.MessageIdGenerator()
+
+
+def make_stored_message(message: Message, login: str = None):
+    """Creates the queued message as it is stored by default, the message
+    gets an id unless it has one
+    """
+    if message.message_id is None:
+        message.message_id = MESSAGE_IDS.generate()
+    return StoredMessage(
+        storage.STORAGE_USER_MESSAGE_QUEUE_KEY.format(
+            user_id=login or message.recipient,
+            message_id=message.message_id),
+        storage.ProtobufMessageCodec().encode(message))
+
+
+def make_queue_pages(messages: List[Message], revision: int,
+                     page_size: int = None) -> List[QueuePage]:
+    """Creates pages of the queue read at the revision"""
+    stored = [(revision, make_stored_message(message))
+              for message in messages]
+    page_size = page_size or len(stored) or 1
+    return [QueuePage(stored[start:start + page_size], None, revision)
+            for start in range(0, len(stored), page_size)] or \
+        [QueuePage([], None, revision)]
+
+
+def make_watch_response(message: Message, revision: int, login: str = None):
+    """Creates watch response with put event of the queued message"""
+    stored_message = make_stored_message(message, login)
+    put_event = PutEvent(SimpleNamespace(kv=SimpleNamespace(
+        key=stored_message.key.encode(), value=stored_message.value,
+        mod_revision=revision)))
+    delete_event = DeleteEvent(SimpleNamespace(kv=SimpleNamespace(
+        key=stored_message.key.encode())))
+    return SimpleNamespace(events=[put_event, delete_event])
+
+
+def make_wake_response(message: Message, revision: int, node_id: str):
+    """Creates watch response with put event of the wake key of
+    the queued message stored at the revision
+    """
+    stored_message = make_stored_message(message)
+    key = storage.STORAGE_NODE_WAKE_KEY.format(
+        node_id=node_id, user_id=message.recipient,
+        message_id=message.message_id, revision=revision)
+    put_event = PutEvent(SimpleNamespace(kv=SimpleNamespace(
+        key=key.encode(), value=stored_message.value,
+        mod_revision=revision + 1)))
+    return SimpleNamespace(events=[put_event])
+
+
+class EtcdClientPoolTestCase(unittest.TestCase):
+
+    def test_parse_endpoints(self):
+        """Tests of parse_endpoints function"""
+        self.assertEqual(storage.parse_endpoints('etcd', '2379'),
+                         [('etcd', 2379)])
+        self.assertEqual(
+            storage.parse_endpoints('etcd-1, etcd-2:2380,', 2379),
+            [('etcd-1', 2379), ('etcd-2', 2380)])
+        with self.assertRaises(ValueError):
+            storage.parse_endpoints(' , ', 2379)
+
+    @patch('etcd3.client')
+    def test_get(self, mock_etcd_client):
+        """Tests that clients are picked round robin among the healthy
+        ones, and among all of them while none is healthy
+        """
+        mock_etcd_client.side_effect = lambda host, port, **kwargs: \
+            Mock(endpoint=(host, port))
+        pool = storage.EtcdClientPool([('etcd-1', 1), ('etcd-2', 2)], 2)
+        pool.close()
+
+        self.assertEqual([pool.get().endpoint for _ in range(4)],
+                         [('etcd-1', 1), ('etcd-2', 2)] * 2)
+        pool._healthy = pool.clients[1::2]
+        self.assertEqual({pool.get().endpoint for _ in range(4)},
+                         {('etcd-2', 2)})
+        pool._healthy = []
+        self.assertEqual(len({pool.get() for _ in range(4)}), 4)
+
+        with self.assertRaises(ValueError):
+            storage.EtcdClientPool([('etcd', 1)], policy='random')
+
+
+class WriteBatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.commit = Mock()
+        self.batcher = storage.WriteBatcher(self.commit, window=0.05,
+                                            max_size=2)
+
+    def tearDown(self):
+        self.batcher.close()
+
+    def test_submit(self):
+        """Tests that writes are committed in batches of max size"""
+        written = [self.batcher.submit((str(index),))
+                   for index in range(3)]
+
+        futures.wait(written)
+
+        self.assertEqual([write.result() for write in written],
+                         [None] * 3)
+        self.assertEqual(
+            [commit_call[0][0]
+             for commit_call in self.commit.call_args_list],
+            [[('0',), ('1',)], [('2',)]])
+
+    def test_failed_batch(self):
+        """Tests that writes of a failed batch get their own results"""
+        error = Exception('value too large')
+
+        def commit(values):
+            if ('large',) in values:
+                raise error
+        self.commit.side_effect = commit
+
+        written = [self.batcher.submit(value)
+                   for value in (('large',), ('small',))]
+
+        self.assertIsNone(written[1].result(timeout=5))
+        self.assertIs(written[0].exception(timeout=5), error)
+        self.assertEqual(self.commit.call_count, 3)
+
+    def test_close(self):
+        """Tests that pending writes are committed on close and later
+        writes are refused
+        """
+        self.batcher.window = 10
+        written = self.batcher.submit(('pending',))
+
+        self.batcher.close()
+
+        self.assertTrue(written.done())
+        self.commit.assert_called_once_with([('pending',)])
+        with self.assertRaises(RuntimeError):
+            self.batcher.submit(('late',))
+
+
+class MessageCodecTestCase(unittest.TestCase):
+
+    def test_json(self):
+        """Tests of JSON codec"""
+        codec = storage.JsonMessageCodec()
+        message = Message('1', '2', 'Hello!')
+
+        value = codec.encode(message)
+
+        self.assertEqual(json.loads(value), asdict(message))
+        self.assertEqual(codec.decode(value), message)
+
+    def test_protobuf(self):
+        """Tests that protobuf codec keeps wall clock created time"""
+        codec = storage.ProtobufMessageCodec()
+
+        for created in (time.time(), 1.5, 1e9 + 0.1234567):
+            message = Message('1', '2', 'Привет!', created, '01ID')
+            value = codec.encode(message)
+
+            self.assertEqual(codec.decode(value), message)
+            self.assertEqual(codec.decode(value).created, created)
+
+    def test_protobuf_reads_json(self):
+        """Tests that protobuf codec reads values stored as JSON"""
+        codec = storage.ProtobufMessageCodec()
+        message = Message('', '2', 'Hello!')
+
+        json_value = storage.JsonMessageCodec().encode(message)
+
+        self.assertEqual(codec.decode(json_value), message)
+        self.assertEqual(codec.decode(json_value.decode()), message)
+        self.assertLess(len(codec.encode(message)), len(json_value))
+
+
+class QueueWatchDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Mock(message_codec=storage.ProtobufMessageCodec())
+        self.storage.decode_message = functools.partial(
+            Storage.decode_message, self.storage)
+        self.storage.iterate_user_queue_pages = Mock(
+            side_effect=lambda login: iter(make_queue_pages(
+                [Message('bot', login, 'queued')], 1)))
+        self.dispatcher = storage.QueueWatchDispatcher(self.storage,
+                                                       buffer_size=2)
+
+    def get_watch_callback(self):
+        return self.storage._client.add_watch_prefix_callback.call_args[0][1]
+
+    def test_single_watch_for_many_subscribers(self):
+        """Stress test: one etcd watch serves 10k subscribed users"""
+        subscribers = 10000
+        iterators = [iter(self.dispatcher.subscribe(str(login)))
+                     for login in range(subscribers)]
+
+        for iterator in iterators:
+            self.assertEqual(next(iterator)[0].body, 'queued')
+
+        callback = self.get_watch_callback()
+        for login in range(subscribers):
+            callback(make_watch_response(
+                Message('bot', str(login), 'Hello {}'.format(login)), 2))
+
+        for login, iterator in enumerate(iterators):
+            self.assertEqual(next(iterator)[0].body,
+                             'Hello {}'.format(login))
+
+        self.storage._client.add_watch_prefix_callback.assert_called_once_with(
+            storage.STORAGE_MESSAGE_QUEUE_PREFIX_KEY, callback)
+
+    def test_skips_messages_read_with_backlog(self):
+        """Tests that watch events already seen in the backlog are skipped"""
+        queued_message = Message('1', '2', 'Hello!')
+        self.storage.iterate_user_queue_pages = Mock(
+            return_value=iter(make_queue_pages([queued_message], 5)))
+        messages = iter(self.dispatcher.subscribe('2'))
+        self.assertEqual(next(messages), [queued_message])
+
+        new_message = Message('1', '2', 'Hi!')
+        callback = self.get_watch_callback()
+        callback(make_watch_response(queued_message, 5))
+        callback(make_watch_response(new_message, 6))
+
+        self.assertEqual(next(messages), [new_message])
+
+    def test_skips_messages_read_with_later_pages(self):
+        """Tests that messages stored while the backlog was paged are
+        delivered once
+        """
+        first, second, late, new = [Message('1', '2', body)
+                                    for body in ('1', '2', 'late', 'new')]
+        pages = make_queue_pages([first, second], 5, page_size=1)
+        pages[1].revision = 7
+        pages[1].messages.append((6, make_stored_message(late)))
+        self.storage.iterate_user_queue_pages = Mock(
+            return_value=iter(pages))
+        subscription = self.dispatcher.subscribe('2')
+        messages = iter(subscription)
+
+        callback = self.get_watch_callback
+        self.assertEqual(next(messages), [first])
+        callback()(make_watch_response(late, 6))
+        self.assertEqual(next(messages), [second, late])
+        self.assertEqual(subscription._backlog_keys,
+                         {make_stored_message(late).key})
+
+        callback()(make_watch_response(new, 8))
+        self.assertEqual(next(messages), [new])
+        self.assertEqual(subscription._backlog_keys, set())
+
+    def test_overflow_resyncs_from_storage(self):
+        """Tests that overflowed buffer is replaced by a range read"""
+        subscription = self.dispatcher.subscribe('2')
+        messages = iter(subscription)
+        next(messages)
+
+        callback = self.get_watch_callback()
+        stored = [Message('1', '2', str(index)) for index in range(3)]
+        for revision, message in enumerate(stored, 2):
+            callback(make_watch_response(message, revision))
+
+        self.assertTrue(subscription._resync)
+        self.assertEqual(len(subscription._buffer), 0)
+
+        self.storage.iterate_user_queue_pages = Mock(
+            return_value=iter(make_queue_pages(stored, 4, page_size=2)))
+        self.assertEqual(next(messages), stored[:2])
+        self.assertEqual(next(messages), stored[2:])
+
+    def test_watch_error_restarts_watch(self):
+        """Tests that broken watch stream is recreated on re-sync"""
+        subscription = self.dispatcher.subscribe('2')
+        messages = iter(subscription)
+        next(messages)
+
+        self.get_watch_callback()(Exception('stream broken'))
+        self.assertTrue(subscription._resync)
+
+        self.assertEqual(next(messages)[0].body, 'queued')
+        self.assertEqual(
+            self.storage._client.add_watch_prefix_callback.call_count, 2)
+
+    def test_deliver_local(self):
+        """Tests that handed over messages are streamed at once and
+        their stored copies are dropped
+        """
+        local, new = Message('1', '2', 'local'), Message('1', '2', 'new')
+        subscription = self.dispatcher.subscribe('2')
+        messages = iter(subscription)
+        # the backlog is not read yet
+        self.assertFalse(self.dispatcher.deliver(
+            '2', make_stored_message(local)))
+        next(messages)
+
+        self.assertTrue(self.dispatcher.deliver(
+            '2', make_stored_message(local)))
+        self.assertFalse(self.dispatcher.deliver(
+            '3', make_stored_message(Message('1', '3', 'offline'))))
+        self.assertEqual(next(messages), [local])
+
+        callback = self.get_watch_callback()
+        callback(make_watch_response(local, 2))
+        callback(make_watch_response(new, 3))
+        self.assertEqual(next(messages), [new])
+        self.assertEqual(subscription._local_keys, set())
+
+    def test_deliver_local_overflow(self):
+        """Tests that handed over messages dropped with the buffer are
+        read from the storage
+        """
+        subscription = self.dispatcher.subscribe('2')
+        messages = iter(subscription)
+        next(messages)
+        local = [Message('1', '2', str(index)) for index in range(3)]
+
+        self.assertTrue(self.dispatcher.deliver(
+            '2', make_stored_message(local[0])))
+        self.assertTrue(self.dispatcher.deliver(
+            '2', make_stored_message(local[1])))
+        self.assertFalse(self.dispatcher.deliver(
+            '2', make_stored_message(local[2])))
+        self.get_watch_callback()(make_watch_response(local[0], 2))
+
+        self.assertTrue(subscription._resync)
+        self.assertEqual(subscription._local_keys, set())
+        self.storage.iterate_user_queue_pages = Mock(
+            return_value=iter(make_queue_pages(local, 4)))
+        self.assertEqual(next(messages), local)
+
+    def test_presence_routing(self):
+        """Tests that the subscribed user gets presence before its queue
+        is read and that wake keys of this node are delivered
+        """
+        presence = Mock(node_id='node-1')
+        presence.register.side_effect = lambda login: self.assertFalse(
+            self.storage.iterate_user_queue_pages.called)
+        dispatcher = storage.QueueWatchDispatcher(self.storage, 2, presence)
+        subscription = dispatcher.subscribe('2')
+        messages = iter(subscription)
+        self.assertEqual(next(messages)[0].body, 'queued')
+
+        read, new = Message('1', '2', 'read'), Message('1', '2', 'new')
+        subscription._backlog_keys.add(make_stored_message(read).key)
+        callback = self.get_watch_callback()
+        for message, revision in ((read, 1), (new, 2)):
+            callback(make_wake_response(message, revision, 'node-1'))
+        self.assertEqual(next(messages), [new])
+
+        self.storage._client.add_watch_prefix_callback.assert_called_once_with(
+            'message/wake/node-1/', callback)
+        subscription.close()
+        presence.register.assert_called_once_with('2')
+        presence.unregister.assert_called_once_with('2')
+
+    def test_unsubscribe(self):
+        """Tests that closed subscriptions stop receiving messages"""
+        subscription = self.dispatcher.subscribe('2')
+        subscription.close()
+
+        self.assertNotIn('2', self.dispatcher._subscriptions)
+        self.assertEqual(list(subscription), [])
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
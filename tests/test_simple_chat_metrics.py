@@ -0,0 +1,242 @@
+"""Tests of simple_chat_metrics module"""
+import socket
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import Mock
+
+import grpc
+
+import simple_chat_pb2
+import simple_chat_pb2_grpc
+import simple_chat_server
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import Message, PartialWriteError, Storage
+from simple_chat_memory_storage import MemoryStorage
+from simple_chat_metrics import (ChatMetrics, Counter, Gauge, Histogram,
+                                 MetricsInterceptor, MetricsRegistry,
+                                 MetricsStorage, start_metrics_server)
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+
+    def test_render(self):
+        """Tests the text format of every metric type"""
+        registry = MetricsRegistry()
+        counter = registry.register(Counter('sent_total', 'Sent'))
+        gauge = registry.register(Gauge('depth', 'Depth', ('login',)))
+        histogram = registry.register(
+            Histogram('seconds', 'Seconds', buckets=(0.1, 1)))
+
+        counter.inc()
+        counter.inc(2)
+        gauge.labels('a"b').set(5)
+        gauge.set_function(lambda: 7, 'c')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP sent_total Sent',
+            '# TYPE sent_total counter',
+            'sent_total 3.0',
+            '# HELP depth Depth',
+            '# TYPE depth gauge',
+            'depth{login="a\\"b"} 5.0',
+            'depth{login="c"} 7.0',
+            '# HELP seconds Seconds',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="0.1"} 1',
+            'seconds_bucket{le="1.0"} 2',
+            'seconds_bucket{le="+Inf"} 3',
+            'seconds_sum 2.55',
+            'seconds_count 3',
+        ])
+
+        gauge.clear()
+        self.assertNotIn('depth{', registry.render())
+        with self.assertRaises(ValueError):
+            gauge.labels('a', 'b')
+
+    def test_metrics_server(self):
+        registry = MetricsRegistry()
+        registry.register(Counter('sent_total', 'Sent')).inc()
+        server = start_metrics_server(registry, '127.0.0.1', 0)
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            self.assertIn(b'sent_total 1.0', response.read())
+            self.assertTrue(response.headers['Content-Type'].startswith(
+                'text/plain'))
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other', timeout=5)
+
+        server.shutdown()
+        server.server_close()
+
+
+class MetricsInterceptorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = ChatMetrics()
+        self.interceptor = MetricsInterceptor(self.metrics)
+
+    def intercept(self, method, handler):
+        return self.interceptor.intercept_service(
+            Mock(return_value=handler), Mock(method=method))
+
+    def test_unary(self):
+        behavior = Mock(side_effect=['response', Exception('failed')])
+        handler = self.intercept(
+            '/SimpleChat/SendMessage',
+            grpc.unary_unary_rpc_method_handler(behavior))
+
+        self.assertEqual(handler.unary_unary('request', Mock()), 'response')
+        with self.assertRaises(Exception):
+            handler.unary_unary('request', Mock())
+
+        method = '/SimpleChat/SendMessage'
+        self.assertEqual(
+            self.metrics.rpcs_handled.labels(method, 'ok').get(), 1)
+        self.assertEqual(
+            self.metrics.rpcs_handled.labels(method, 'error').get(), 1)
+        self.assertEqual(
+            self.metrics.rpc_seconds.labels(method).counts[-1], 0)
+        self.assertEqual(sum(
+            self.metrics.rpc_seconds.labels(method).counts), 2)
+        self.assertEqual(self.metrics.rpcs_in_flight.labels(method).get(),
+                         0)
+        self.assertIsNone(self.intercept(method, None))
+
+    def test_cached_handler(self):
+        """Tests that the observed handler is reused while the method has
+        the same handler
+        """
+        handler = grpc.unary_unary_rpc_method_handler(Mock())
+        observed = self.intercept('/SimpleChat/SendMessage', handler)
+
+        self.assertIs(self.intercept('/SimpleChat/SendMessage', handler),
+                      observed)
+        self.assertIsNot(self.intercept(
+            '/SimpleChat/SendMessage',
+            grpc.unary_unary_rpc_method_handler(Mock())), observed)
+
+    def test_stream(self):
+        """Tests that streams count as in flight until they end and their
+        received messages count as delivered
+        """
+        chat = self.intercept('/SimpleChat/Chat',
+                              grpc.stream_stream_rpc_method_handler(
+                                  lambda requests, context: iter([
+                                      b'\x0a\x00', b'\x12\x00',
+                                      simple_chat_pb2.ChatResponse(
+                                          message=simple_chat_pb2.Message())
+                                  ])))
+        receive = self.intercept('/SimpleChat/ReceiveMessages',
+                                 grpc.unary_stream_rpc_method_handler(
+                                     lambda request, context: iter('ab')))
+
+        responses = receive.unary_stream('request', Mock())
+        next(responses)
+        self.assertEqual(self.metrics.rpcs_in_flight.labels(
+            '/SimpleChat/ReceiveMessages').get(), 1)
+        self.assertEqual(list(responses), ['b'])
+        self.assertEqual(len(list(chat.stream_stream(iter([]), Mock()))), 3)
+
+        self.assertEqual(self.metrics.messages_delivered.labels().get(), 4)
+        self.assertEqual(self.metrics.rpcs_in_flight.labels(
+            '/SimpleChat/ReceiveMessages').get(), 0)
+
+
+class MetricsStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = ChatMetrics()
+        self.storage = Mock()
+        self.metrics_storage = MetricsStorage(self.storage, self.metrics,
+                                              sample_interval=0.05)
+
+    def tearDown(self):
+        self.metrics_storage.close()
+
+    def test_sent_messages(self):
+        messages = [Message('1', str(index), 'Hello!') for index in range(3)]
+
+        self.metrics_storage.put_message(messages[0])
+        self.storage.put_messages.side_effect = PartialWriteError(
+            1, Exception())
+        with self.assertRaises(PartialWriteError):
+            self.metrics_storage.put_messages(messages)
+
+        self.assertEqual(self.metrics.messages_sent.labels().get(), 2)
+        self.storage.put_message.assert_called_once_with(messages[0])
+        self.assertEqual(sum(self.metrics.storage_seconds.labels(
+            'put_message').counts), 1)
+        self.assertIs(self.metrics_storage.write_batcher,
+                      self.storage.write_batcher)
+
+    def test_queue_depth(self):
+        """Tests that queue depths of recipients are sampled"""
+        self.storage.get_user_queue_page.return_value = Mock(
+            messages=[1, 2])
+
+        self.metrics_storage.put_message(Message('1', '2', 'Hello!'))
+        deadline = time.time() + 5
+        while not self.metrics.queue_depth._values:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+        self.assertEqual(self.metrics.queue_depth.labels('2').get(), 2)
+        self.storage.get_user_queue_page.assert_called_with('2', 1000)
+
+
+class ServerMetricsTestCase(unittest.TestCase):
+
+    def test_create_server(self):
+        """Tests that the served calls and the etcd requests are measured
+        """
+        stand_in = EtcdStandIn()
+        self.addCleanup(stand_in.stop)
+        storage = Storage('127.0.0.1', stand_in.start())
+        metrics = ChatMetrics()
+        metrics.instrument_etcd(storage.clients.clients)
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            address = '127.0.0.1:{}'.format(sock.getsockname()[1])
+        server = simple_chat_server.create_server(
+            address, MetricsStorage(storage, metrics, sample_interval=0),
+            metrics=metrics)
+        server.start()
+        self.addCleanup(server.stop, 0)
+        channel = grpc.insecure_channel(address)
+        self.addCleanup(channel.close)
+        stub = simple_chat_pb2_grpc.SimpleChatStub(channel)
+
+        stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(sender='1', recipient='2',
+                                            body='Hello!')), timeout=5)
+        responses = stub.ReceiveMessages(
+            simple_chat_pb2.ReceiveMessagesRequest(login='2'), timeout=5)
+        self.assertEqual(next(responses).body, 'Hello!')
+        responses.cancel()
+
+        rendered = metrics.render()
+        self.assertIn('chat_messages_sent_total 1.0', rendered)
+        self.assertIn('chat_messages_delivered_total 1.0', rendered)
+        self.assertIn('chat_rpcs_handled_total{method="/SimpleChat/'
+                      'SendMessage",outcome="ok"} 1.0', rendered)
+        self.assertIn('chat_executor_threads{executor="server"}', rendered)
+        self.assertIn('chat_etcd_request_seconds_count{operation="Put"} 1',
+                      rendered)
+
+    def test_memory_storage(self):
+        metrics = ChatMetrics()
+        storage = MetricsStorage(MemoryStorage(), metrics, sample_interval=0)
+
+        storage.send_message(Message('1', '2', 'Hello!'))
+
+        self.assertEqual([message.body for message in
+                          storage.get_user_queue_messages('2')], ['Hello!'])
+        self.assertEqual(metrics.messages_sent.labels().get(), 1)
+        storage.close()
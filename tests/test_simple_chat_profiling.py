@@ -0,0 +1,156 @@
+"""Tests of simple_chat_profiling module"""
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+import grpc
+
+import simple_chat_pb2
+from simple_chat_etcd_storage import Message
+from simple_chat_profiling import (ProfileTrigger, SamplingProfiler,
+                                   SlowCallInterceptor, SlowCallLog,
+                                   SlowCallStorage, describe_size)
+
+
+def wait_in_profiled_function(event):
+    event.wait(5)
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+
+    def test_sample(self):
+        """Tests that stacks of other threads are counted from the thread
+        name to the innermost function
+        """
+        event = threading.Event()
+        thread = threading.Thread(target=wait_in_profiled_function,
+                                  args=(event,), name='waiting-7')
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(event.set)
+        profiler = SamplingProfiler()
+
+        profiler.sample()
+        profiler.sample()
+
+        self.assertEqual(profiler.samples, 2)
+        stacks = [stack for stack in profiler.stacks
+                  if 'wait_in_profiled_function' in stack]
+        self.assertEqual(len(stacks), 1)
+        self.assertTrue(stacks[0].startswith('waiting;threading.py:'))
+        self.assertIn(';test_simple_chat_profiling.py:'
+                      'wait_in_profiled_function;', stacks[0])
+        self.assertEqual(profiler.stacks[stacks[0]], 2)
+        self.assertFalse(any('test_sample' in stack
+                             for stack in profiler.stacks))
+
+    def test_write_collapsed(self):
+        profiler = SamplingProfiler()
+        profiler.stacks.update({'main;a.py:f': 1, 'main;a.py:<g h>': 3})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'profile.collapsed')
+            profiler.write_collapsed(path)
+            with open(path) as collapsed:
+                self.assertEqual(collapsed.read(),
+                                 'main;a.py:<g_h> 3\nmain;a.py:f 1\n')
+
+
+class ProfileTriggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.trigger = ProfileTrigger(self.directory, 0.05, 0.01)
+
+    def test_start(self):
+        """Tests that one profile is taken at a time"""
+        with self.assertLogs('simple_chat_profiling') as logs:
+            thread = self.trigger.start()
+            self.assertIsNone(self.trigger.start())
+            thread.join()
+
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertTrue(os.listdir(self.directory)[0].endswith('.collapsed'))
+        self.assertIn('already', logs.output[0])
+        with self.assertLogs('simple_chat_profiling'):
+            self.trigger.start().join()
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'No SIGUSR1')
+    def test_install(self):
+        self.addCleanup(signal.signal, signal.SIGUSR1,
+                        signal.getsignal(signal.SIGUSR1))
+        self.trigger.install()
+
+        with self.assertLogs('simple_chat_profiling'):
+            os.kill(os.getpid(), signal.SIGUSR1)
+            deadline = time.time() + 5
+            while not os.listdir(self.directory):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+            # the file appears before it is written and logged
+            self.assertTrue(self.trigger._lock.acquire(timeout=5))
+        self.trigger._lock.release()
+
+
+class SlowCallLogTestCase(unittest.TestCase):
+
+    def test_describe_size(self):
+        self.assertEqual(describe_size(Message('1', '2', 'Hello!')),
+                         'message of 6 chars')
+        self.assertEqual(describe_size(simple_chat_pb2.Message(body='Hi')),
+                         '4 bytes')
+        self.assertEqual(describe_size('login'), '5 chars')
+        self.assertEqual(describe_size([1, 2]), '2 items')
+        self.assertEqual(describe_size(iter([])), 'stream')
+        self.assertEqual(describe_size(None), 'NoneType')
+
+    def test_traced(self):
+        """Tests that only calls over the threshold are logged"""
+        function = Mock(return_value='result')
+        slow = SlowCallLog(0).traced('put_messages', function)
+        fast = SlowCallLog(60).traced('put_messages', function)
+
+        with self.assertLogs('simple_chat_profiling') as logs:
+            self.assertEqual(slow([1, 2], 'a', limit=3), 'result')
+            self.assertEqual(fast([1, 2]), 'result')
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Slow call put_messages took', logs.output[0])
+        self.assertIn('arguments: 2 items, 1 chars, limit=int',
+                      logs.output[0])
+
+    def test_interceptor(self):
+        interceptor = SlowCallInterceptor(SlowCallLog(0))
+        handler = grpc.unary_unary_rpc_method_handler(
+            Mock(return_value='response'))
+        details = Mock(method='/SimpleChat/SendMessage')
+        traced = interceptor.intercept_service(Mock(return_value=handler),
+                                               details)
+
+        with self.assertLogs('simple_chat_profiling') as logs:
+            self.assertEqual(traced.unary_unary(
+                simple_chat_pb2.Message(body='Hi'), Mock()), 'response')
+
+        self.assertIn('/SimpleChat/SendMessage took', logs.output[0])
+        self.assertTrue(logs.output[0].endswith('arguments: 4 bytes'))
+        self.assertIs(interceptor.intercept_service(
+            Mock(return_value=handler), details), traced)
+        stream_handler = grpc.unary_stream_rpc_method_handler(Mock())
+        self.assertIs(interceptor.intercept_service(
+            Mock(return_value=stream_handler), details), stream_handler)
+
+    def test_storage(self):
+        storage = Mock()
+        slow_call_storage = SlowCallStorage(storage, SlowCallLog(0))
+
+        with self.assertLogs('simple_chat_profiling') as logs:
+            slow_call_storage.put_message(Message('1', '2', 'Hello!'))
+
+        storage.put_message.assert_called_once()
+        self.assertIn('put_message took', logs.output[0])
+        self.assertIs(slow_call_storage.write_batcher, storage.write_batcher)
@@ -1,12 +1,26 @@
 """Tests of simple_chat_server module"""
+import json
 import logging
+import math
+import queue
+import socket
+import threading
 import time
 import unittest
-from unittest.mock import Mock
+from dataclasses import asdict
+from types import SimpleNamespace
+from unittest.mock import ANY, Mock, patch
 
+import grpc
+
+import simple_chat_etcd_storage as storage_module
 import simple_chat_pb2
+import simple_chat_pb2_grpc
 import simple_chat_server
-from simple_chat_etcd_storage import User, Message
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import (User, Message, PartialWriteError,
+                                      ProtobufMessageCodec, Storage,
+                                      StoredMessage)
 
 
 class SimpleChatServicerTestCase(unittest.TestCase):
@@ -22,13 +36,129 @@ class SimpleChatServicerTestCase(unittest.TestCase):
         mock_storage_get_users = Mock(return_value=[user])
         self.storage.get_users = mock_storage_get_users
 
-        response = self.servicer.GetUsers(Mock(), Mock())
+        response = self.servicer.GetUsers(
+            simple_chat_pb2.GetUsersRequest(), Mock())
 
         mock_storage_get_users.assert_called_once()
         response_user = User(response.users[0].login,
                              response.users[0].full_name)
         self.assertEqual(response_user, user)
 
+    def test_GetUsers_page(self):
+        """Tests of GetUsers method with paging and filters"""
+        self.storage.get_users_page = Mock(return_value=(
+            [User('ab', 'User')], 'user/ab\0'))
+
+        response = self.servicer.GetUsers(simple_chat_pb2.GetUsersRequest(
+            page_size=1, login_prefix='a'), Mock())
+
+        self.storage.get_users_page.assert_called_once_with(1, None, 'a', '')
+        self.assertEqual(list(response.users),
+                         [simple_chat_pb2.User(login='ab', full_name='User')])
+
+        self.storage.get_users_page.return_value = ([], None)
+        response = self.servicer.GetUsers(simple_chat_pb2.GetUsersRequest(
+            page_token=response.next_page_token, login_prefix='a'), Mock())
+
+        self.storage.get_users_page.assert_called_with(
+            simple_chat_server.USERS_PAGE_SIZE, 'user/ab\0', 'a', '')
+        self.assertEqual(response.next_page_token, '')
+
+    def test_GetUsers_page_size_limit(self):
+        """Tests that page size is capped"""
+        self.storage.get_users_page = Mock(return_value=([], None))
+
+        self.servicer.GetUsers(simple_chat_pb2.GetUsersRequest(
+            page_size=10 ** 6), Mock())
+
+        self.storage.get_users_page.assert_called_once_with(
+            simple_chat_server.USERS_MAX_PAGE_SIZE, None, '', '')
+
+    def test_GetUsers_invalid_page(self):
+        """Tests that invalid page requests are rejected"""
+        context = Mock()
+        context.abort.side_effect = grpc.RpcError
+
+        for request in (simple_chat_pb2.GetUsersRequest(page_size=-1),
+                        simple_chat_pb2.GetUsersRequest(page_token='a')):
+            with self.assertRaises(grpc.RpcError):
+                self.servicer.GetUsers(request, context)
+
+            context.abort.assert_called_with(
+                grpc.StatusCode.INVALID_ARGUMENT, ANY)
+
+    def test_GetHistory(self):
+        """Tests of GetHistory method with a time range and paging"""
+        self.storage.history_ttl = 60
+        self.storage.get_history_page = Mock(return_value=(
+            [Message('2', '1', 'Hi', 1.7e9, '01ID')], 'history/1/2/ZZ\0'))
+        request = simple_chat_pb2.GetHistoryRequest(login='1', peer='2',
+                                                    page_size=1)
+        request.start_time.FromSeconds(1700000000)
+
+        response = self.servicer.GetHistory(request, Mock())
+
+        self.storage.get_history_page.assert_called_once_with(
+            '1', '2', 1, 1.7e9, None, None)
+        self.assertEqual(response.messages[0].id, '01ID')
+        self.assertEqual(response.messages[0].created.seconds, 1700000000)
+
+        self.storage.get_history_page.return_value = ([], None)
+        response = self.servicer.GetHistory(
+            simple_chat_pb2.GetHistoryRequest(
+                login='1', peer='2',
+                page_token=response.next_page_token), Mock())
+
+        self.storage.get_history_page.assert_called_with(
+            '1', '2', simple_chat_server.HISTORY_PAGE_SIZE, None, None,
+            'history/1/2/ZZ\0')
+        self.assertEqual(response.next_page_token, '')
+
+    def test_GetHistory_invalid(self):
+        """Tests that history requests are rejected without history or
+        with invalid arguments
+        """
+        context = Mock()
+        context.abort.side_effect = grpc.RpcError
+        self.storage.history_ttl = None
+
+        with self.assertRaises(grpc.RpcError):
+            self.servicer.GetHistory(simple_chat_pb2.GetHistoryRequest(
+                login='1', peer='2'), context)
+        context.abort.assert_called_with(
+            grpc.StatusCode.FAILED_PRECONDITION,
+            simple_chat_server.HISTORY_DISABLED_DETAILS)
+
+        self.storage.history_ttl = 60
+        self.storage.get_history_page.side_effect = ValueError('out')
+        for request in (simple_chat_pb2.GetHistoryRequest(login='1'),
+                        simple_chat_pb2.GetHistoryRequest(
+                            login='1', peer='2', page_size=-1),
+                        simple_chat_pb2.GetHistoryRequest(
+                            login='1', peer='2', page_token='a')):
+            with self.assertRaises(grpc.RpcError):
+                self.servicer.GetHistory(request, context)
+
+            context.abort.assert_called_with(
+                grpc.StatusCode.INVALID_ARGUMENT, ANY)
+
+    def test_GetUsers_user_directory(self):
+        """Tests of GetUsers method served from the user directory"""
+        user_directory = Mock()
+        user_directory.get_serialized_response.return_value = \
+            simple_chat_server.users_to_proto(
+                [User('123', 'Mock user')]).SerializeToString()
+        self.servicer = simple_chat_server.SimpleChatServicer(
+            self.storage, user_directory=user_directory)
+
+        response = self.servicer.GetUsers(
+            simple_chat_pb2.GetUsersRequest(), Mock())
+
+        self.storage.get_users.assert_not_called()
+        self.assertEqual(
+            simple_chat_pb2.GetUsersResponse.FromString(response).users[0],
+            simple_chat_pb2.User(login='123', full_name='Mock user'))
+
     def test_SendMessage(self):
         """Tests of SendMessage method"""
         mock_storage_put_message = Mock()
@@ -42,23 +172,108 @@ class SimpleChatServicerTestCase(unittest.TestCase):
         mock_storage_put_message.assert_called_once()
         self.assertIsInstance(response, simple_chat_pb2.SendMessageResponse)
 
+    def test_SendMessage_local_delivery(self):
+        """Tests that local delivery hands sent message over first"""
+        servicer = simple_chat_server.SimpleChatServicer(
+            self.storage, is_local_delivery=True)
+        request = simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(sender='1', recipient='2',
+                                            body='Hello!'))
+
+        servicer.SendMessage(request, Mock())
+
+        self.storage.send_message.assert_called_once_with(
+            Message('1', '2', 'Hello!', ANY))
+        self.storage.put_message.assert_not_called()
+
+    def test_SendMessages(self):
+        """Tests of SendMessages method"""
+        request = simple_chat_pb2.SendMessagesRequest(messages=[
+            simple_chat_pb2.Message(sender='1', recipient='2', body='Hello!'),
+            simple_chat_pb2.Message(sender='1', recipient='3', body='Hi!')])
+
+        response = self.servicer.SendMessages(request, Mock())
+
+        self.storage.put_messages.assert_called_once()
+        messages = self.storage.put_messages.call_args[0][0]
+        self.assertEqual([(message.recipient, message.body)
+                          for message in messages],
+                         [('2', 'Hello!'), ('3', 'Hi!')])
+        self.assertEqual(response.count, 2)
+
+    def test_SendMessageStream(self):
+        """Tests of SendMessageStream method storing messages in batches"""
+        total = simple_chat_server.SEND_STREAM_BATCH_SIZE + 1
+        requests = (simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(sender='1', recipient='2',
+                                            body=str(index)))
+                    for index in range(total))
+
+        response = self.servicer.SendMessageStream(requests, Mock())
+
+        self.assertEqual(self.storage.put_messages.call_count, 2)
+        first, second = self.storage.put_messages.call_args_list
+        self.assertEqual(len(first[0][0]),
+                         simple_chat_server.SEND_STREAM_BATCH_SIZE)
+        self.assertEqual(len(second[0][0]), 1)
+        self.assertEqual(response.count, total)
+
+    def test_SendMessageStream_partial_write(self):
+        """Tests that failed stream reports already stored messages"""
+        total = simple_chat_server.SEND_STREAM_BATCH_SIZE + 1
+        requests = (simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(sender='1', recipient='2',
+                                            body=str(index)))
+                    for index in range(total))
+        self.storage.put_messages.side_effect = [
+            None, PartialWriteError(0, Exception('etcd is gone'))]
+        context = Mock()
+        context.abort.side_effect = grpc.RpcError
+
+        with self.assertRaises(grpc.RpcError):
+            self.servicer.SendMessageStream(requests, context)
+
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.ABORTED,
+            simple_chat_server.PARTIAL_WRITE_DETAILS.format(
+                simple_chat_server.SEND_STREAM_BATCH_SIZE, 'etcd is gone'))
+
+    def test_SendMessages_partial_write(self):
+        """Tests that failed batch reports already stored messages"""
+        self.storage.put_messages.side_effect = PartialWriteError(
+            128, Exception('etcd is gone'))
+        context = Mock()
+        context.abort.side_effect = grpc.RpcError
+
+        with self.assertRaises(grpc.RpcError):
+            self.servicer.SendMessages(simple_chat_pb2.SendMessagesRequest(
+                messages=[simple_chat_pb2.Message(sender='1', recipient='2',
+                                                  body='Hello!')]), context)
+
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.ABORTED,
+            simple_chat_server.PARTIAL_WRITE_DETAILS.format(
+                128, 'etcd is gone'))
+
     def test_ReceiveMessages(self):
-        """Tests of ReceiveMessages method"""
+        """Tests of ReceiveMessages method in polling mode"""
+        self.servicer = simple_chat_server.SimpleChatServicer(
+            self.storage, simple_chat_server.DELIVERY_MODE_POLLING)
         message_recipient = '2'
         mock_message = Message('1', message_recipient,
                                'Hello!', int(time.time()))
 
-        mock_storage_get_user_queue_messages = Mock(
-            return_value=[mock_message])
+        mock_storage_iterate_user_queue_messages = Mock(
+            side_effect=lambda login: iter([[mock_message]]))
 
-        self.storage.get_user_queue_messages = \
-            mock_storage_get_user_queue_messages
+        self.storage.iterate_user_queue_messages = \
+            mock_storage_iterate_user_queue_messages
 
-        mock_storage_delete_user_queue_message = Mock()
-        self.storage.delete_user_queue_message = \
-            mock_storage_delete_user_queue_message
+        mock_storage_delete_user_queue_messages = Mock()
+        self.storage.delete_user_queue_messages = \
+            mock_storage_delete_user_queue_messages
 
-        mock_request_login = Mock(login=message_recipient)
+        mock_request_login = Mock(login=message_recipient, resume_after='')
         response = self.servicer.ReceiveMessages(mock_request_login, Mock())
 
         message = next(response)
@@ -67,13 +282,608 @@ class SimpleChatServicerTestCase(unittest.TestCase):
         response_message = Message(message.sender, message.recipient,
                                    message.body, message.created.seconds)
 
-        mock_storage_get_user_queue_messages.assert_called_with(
+        mock_storage_iterate_user_queue_messages.assert_called_with(
             message_recipient)
 
         self.assertEqual(response_message, mock_message)
 
-        mock_storage_delete_user_queue_message.assert_called_with(
-            mock_message)
+        mock_storage_delete_user_queue_messages.assert_called_with(
+            [mock_message])
+
+    def test_ReceiveMessages_watch(self):
+        """Tests of ReceiveMessages method in watch mode"""
+        message_recipient = '2'
+        mock_message = Message('1', message_recipient,
+                               'Hello!', int(time.time()))
+
+        mock_cancel = Mock()
+        mock_storage_watch_user_queue_messages = Mock(
+            return_value=(iter([[mock_message]]), mock_cancel))
+        self.storage.watch_user_queue_messages = \
+            mock_storage_watch_user_queue_messages
+
+        mock_context = Mock()
+        response = self.servicer.ReceiveMessages(
+            Mock(login=message_recipient, resume_after=''), mock_context)
+
+        message = next(response)
+        response_message = Message(message.sender, message.recipient,
+                                   message.body, message.created.seconds)
+        self.assertEqual(response_message, mock_message)
+
+        mock_storage_watch_user_queue_messages.assert_called_once_with(
+            message_recipient)
+        mock_context.add_callback.assert_called_once_with(mock_cancel)
+        self.storage.get_user_queue_messages.assert_not_called()
+
+        with self.assertRaises(StopIteration):
+            next(response)
+
+        self.storage.delete_user_queue_messages.assert_called_once_with(
+            [mock_message])
+
+    def test_ReceiveMessages_forward(self):
+        """Tests of ReceiveMessages method in forward mode"""
+        self.servicer = simple_chat_server.SimpleChatServicer(
+            self.storage, simple_chat_server.DELIVERY_MODE_FORWARD)
+        message = Message('1', '2', 'Hello!')
+        stored_message = StoredMessage(
+            'key', ProtobufMessageCodec().encode(message))
+
+        mock_cancel = Mock()
+        self.storage.watch_user_queue_stored_messages = Mock(
+            return_value=(iter([[stored_message]]), mock_cancel))
+
+        mock_context = Mock()
+        response = list(self.servicer.ReceiveMessages(
+            Mock(login='2', resume_after=''), mock_context))
+
+        # the stored value is the serialized response
+        self.assertEqual(response, [stored_message.value])
+        response_message = simple_chat_pb2.Message.FromString(response[0])
+        self.assertEqual(response_message.body, 'Hello!')
+        self.storage.watch_user_queue_stored_messages.assert_called_once_with(
+            '2')
+        self.storage.delete_user_queue_stored_messages.assert_called_once_with(
+            [stored_message])
+        self.storage.watch_user_queue_messages.assert_not_called()
+        mock_context.add_callback.assert_called_once_with(mock_cancel)
+        mock_cancel.assert_called()
+        mock_cancel.assert_called()
+
+    @patch('etcd3.client')
+    def test_ReceiveMessages_acknowledges_batches(self, mock_etcd_client):
+        """Tests that a 10k messages backlog is read in pages and
+        acknowledged with one etcd transaction per STORAGE_MAX_TXN_OPS
+        messages instead of one delete per message
+        """
+        backlog_size = 10000
+        storage = Storage('etcd', 2379)
+        client = storage._client
+        kvs = [SimpleNamespace(
+                   key='message/queue/user/2/{:05}'.format(index).encode(),
+                   value=json.dumps(asdict(Message('1', '2', str(index),
+                                                   index))),
+                   mod_revision=1)
+               for index in range(backlog_size)]
+
+        def get_range(key, range_end, limit):
+            page = [kv for kv in kvs if kv.key.decode() >= key]
+            response = Mock(kvs=page[:limit], more=len(page) > limit)
+            response.header.revision = 1
+            return response
+
+        storage._get_range = Mock(side_effect=get_range)
+
+        servicer = simple_chat_server.SimpleChatServicer(storage)
+        request = Mock(login='2', resume_after='')
+        response = servicer.ReceiveMessages(request, Mock())
+        delivered = [next(response) for _ in range(backlog_size)]
+
+        # a page is acknowledged when the stream asks for more
+        self.assertEqual(
+            client.transaction.call_count,
+            math.ceil(backlog_size / storage_module.QUEUE_PAGE_SIZE) - 1)
+        subscription, = storage._queue_dispatcher._subscriptions['2']
+        subscription.close()
+        self.assertEqual(list(response), [])
+
+        self.assertEqual(len(delivered), backlog_size)
+        client.delete.assert_not_called()
+        self.assertEqual(
+            client.transaction.call_count,
+            math.ceil(backlog_size / storage_module.STORAGE_MAX_TXN_OPS))
+        deleted = sum(len(call.kwargs['success'])
+                      for call in client.transaction.call_args_list)
+        self.assertEqual(deleted, backlog_size)
+        self.assertEqual(
+            storage._get_range.call_count,
+            math.ceil(backlog_size / storage_module.QUEUE_PAGE_SIZE))
+        for call in storage._get_range.call_args_list:
+            self.assertEqual(call[0][2], storage_module.QUEUE_PAGE_SIZE)
+
+    def test_ReceiveMessages_resume(self):
+        """Tests that messages received before a reconnect are deleted"""
+        self.storage.watch_user_queue_messages.return_value = \
+            (iter([]), Mock())
+        request = simple_chat_pb2.ReceiveMessagesRequest(
+            login='2', resume_after='01ID')
+
+        self.assertEqual(
+            list(self.servicer.ReceiveMessages(request, Mock())), [])
+
+        self.storage.delete_user_queue_messages_until.assert_called_once_with(
+            '2', '01ID')
+
+    def test_SubscribeMessages(self):
+        """Tests that only acknowledged messages are deleted"""
+        messages = [Message('1', '2', str(index), message_id=str(index))
+                    for index in range(3)]
+        self.storage.watch_user_queue_messages.return_value = \
+            (iter([messages[:2], messages]), Mock())
+        requests = queue.Queue()
+        requests.put(simple_chat_pb2.SubscribeMessagesRequest(
+            subscribe=simple_chat_pb2.ReceiveMessagesRequest(login='2')))
+
+        response = self.servicer.SubscribeMessages(
+            iter(requests.get, None), Mock())
+        received = [next(response) for _ in range(3)]
+        self.assertEqual(list(response), [])
+        deleted = threading.Event()
+        delete = self.storage.delete_user_queue_message_ids
+        delete.side_effect = lambda login, message_ids: deleted.set()
+        requests.put(simple_chat_pb2.SubscribeMessagesRequest(
+            ack=simple_chat_pb2.MessagesAck(message_id='1')))
+        requests.put(None)
+
+        # the re-read message 1 is not sent twice
+        self.assertEqual([message.id for message in received],
+                         ['0', '1', '2'])
+        self.assertTrue(deleted.wait(5))
+        delete.assert_called_once_with('2', ['0', '1'])
+        self.storage.delete_user_queue_messages.assert_not_called()
+        self.storage.delete_user_queue_messages_until.assert_not_called()
+
+    def test_SubscribeMessages_forward(self):
+        """Tests that the forward mode streams stored values"""
+        stored_message = StoredMessage('message/queue/user/2/01ID', b'value')
+        self.storage.watch_user_queue_stored_messages.return_value = \
+            (iter([[stored_message]]), Mock())
+        servicer = simple_chat_server.SimpleChatServicer(
+            self.storage, simple_chat_server.DELIVERY_MODE_FORWARD)
+        requests = [simple_chat_pb2.SubscribeMessagesRequest(
+            subscribe=simple_chat_pb2.ReceiveMessagesRequest(
+                login='2', resume_after='01HD'))]
+
+        response = servicer.SubscribeMessages(iter(requests), Mock())
+
+        self.assertEqual(next(response), b'value')
+        self.storage.delete_user_queue_messages_until.assert_called_once_with(
+            '2', '01HD')
+
+    def test_SubscribeMessages_requires_subscription(self):
+        """Tests that the stream must start with a subscription"""
+        context = Mock(abort=Mock(side_effect=grpc.RpcError))
+        requests = [simple_chat_pb2.SubscribeMessagesRequest(
+            ack=simple_chat_pb2.MessagesAck(message_id='1'))]
+
+        with self.assertRaises(grpc.RpcError):
+            next(self.servicer.SubscribeMessages(iter(requests), context))
+
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.INVALID_ARGUMENT,
+            simple_chat_server.SUBSCRIBE_FIRST_DETAILS)
+
+    def test_Chat(self):
+        """Tests that sent messages are confirmed and received ones are
+        streamed on the same stream
+        """
+        batches = queue.Queue()
+        self.storage.watch_user_queue_messages.return_value = \
+            (iter(batches.get, None), Mock())
+        deleted = threading.Event()
+        delete = self.storage.delete_user_queue_message_ids
+        delete.side_effect = lambda login, message_ids: deleted.set()
+        requests = queue.Queue()
+        requests.put(simple_chat_pb2.ChatRequest(
+            subscribe=simple_chat_pb2.ReceiveMessagesRequest(login='2')))
+        requests.put(simple_chat_pb2.ChatRequest(
+            message=simple_chat_pb2.Message(sender='3', recipient='1',
+                                            body='Hi!')))
+
+        response = self.servicer.Chat(iter(requests.get, None), Mock())
+
+        # the sender is the subscribed user
+        sent = next(response).sent
+        self.assertEqual((sent.sender, sent.recipient, sent.body),
+                         ('2', '1', 'Hi!'))
+        message = self.storage.put_message.call_args[0][0]
+        self.assertEqual((message.sender, message.recipient, message.body),
+                         ('2', '1', 'Hi!'))
+
+        batches.put([Message('1', '2', 'Hello!', message_id='0')])
+        self.assertEqual(next(response).message.id, '0')
+        requests.put(simple_chat_pb2.ChatRequest(
+            ack=simple_chat_pb2.MessagesAck(message_id='0')))
+        self.assertTrue(deleted.wait(5))
+        delete.assert_called_once_with('2', ['0'])
+
+        batches.put(None)
+        requests.put(None)
+        self.assertEqual(list(response), [])
+
+    def test_Chat_send_failed(self):
+        """Tests that the stream is aborted when a message is not stored"""
+        batches = queue.Queue()
+        self.storage.watch_user_queue_messages.return_value = \
+            (iter(batches.get, None), Mock())
+        self.storage.put_message.side_effect = Exception('unavailable')
+        context = Mock(abort=Mock(side_effect=grpc.RpcError))
+        requests = [
+            simple_chat_pb2.ChatRequest(
+                subscribe=simple_chat_pb2.ReceiveMessagesRequest(login='2')),
+            simple_chat_pb2.ChatRequest(
+                message=simple_chat_pb2.Message(recipient='1', body='Hi!'))]
+
+        with self.assertRaises(grpc.RpcError):
+            next(self.servicer.Chat(iter(requests), context))
+        batches.put(None)
+
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.ABORTED,
+            simple_chat_server.CHAT_SEND_FAILED_DETAILS.format(
+                'unavailable'))
+
+    def test_Chat_forward(self):
+        """Tests that the forward mode wraps stored values"""
+        value = simple_chat_pb2.Message(body='Hello!', id='01ID')
+        stored_message = StoredMessage('message/queue/user/2/01ID',
+                                       value.SerializeToString())
+        self.storage.watch_user_queue_stored_messages.return_value = \
+            (iter([[stored_message]]), Mock())
+        servicer = simple_chat_server.SimpleChatServicer(
+            self.storage, simple_chat_server.DELIVERY_MODE_FORWARD)
+        requests = [simple_chat_pb2.ChatRequest(
+            subscribe=simple_chat_pb2.ReceiveMessagesRequest(login='2'))]
+
+        response = list(servicer.Chat(iter(requests), Mock()))
+
+        self.assertEqual(response, [
+            simple_chat_pb2.ChatResponse(message=value).SerializeToString()])
+
+    def test_unknown_delivery_mode(self):
+        """Tests of servicer creation with unknown delivery mode"""
+        with self.assertRaises(ValueError):
+            simple_chat_server.SimpleChatServicer(self.storage, 'push')
+
+
+class MessageAcknowledgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.acknowledger = simple_chat_server.MessageAcknowledger(window=3)
+
+    def test_ack(self):
+        """Tests that an ack covers all messages streamed before"""
+        for message_id in ('3', '1', '2'):
+            self.assertTrue(self.acknowledger.add(message_id))
+        self.assertFalse(self.acknowledger.add('1'))
+
+        self.assertEqual(self.acknowledger.ack('unknown'), [])
+        self.assertEqual(self.acknowledger.ack('1'), ['3', '1'])
+        self.assertEqual(self.acknowledger.ack('1'), [])
+        self.assertEqual(self.acknowledger.ack('2'), ['2'])
+
+    def test_window(self):
+        """Tests that the stream waits for acks when the window is full"""
+        for message_id in ('1', '2', '3'):
+            self.assertTrue(self.acknowledger.wait_for_room(0))
+            self.acknowledger.add(message_id)
+        self.assertFalse(self.acknowledger.wait_for_room(0))
+
+        threading.Timer(0.05, self.acknowledger.ack, args=('1',)).start()
+        self.assertTrue(self.acknowledger.wait_for_room(5))
+
+    def test_close(self):
+        """Tests that the window is not waited for when acks can not
+        come
+        """
+        self.acknowledger.close()
+
+        for message_id in ('1', '2', '3'):
+            self.assertTrue(self.acknowledger.wait_for_room(5))
+            self.acknowledger.add(message_id)
+        started = time.monotonic()
+        self.assertFalse(self.acknowledger.wait_for_room(5))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(self.acknowledger.closed)
+
+
+class SubscribeMessagesStandInTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = EtcdStandIn()
+        self.storage = Storage('127.0.0.1', self.stand_in.start())
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            address = '127.0.0.1:{}'.format(sock.getsockname()[1])
+        self.server = simple_chat_server.create_server(address, self.storage)
+        self.server.start()
+        self.channel = grpc.insecure_channel(address)
+        self.stub = simple_chat_pb2_grpc.SimpleChatStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        self.stand_in.stop()
+
+    def subscribe(self, requests, resume_after=''):
+        requests.put(simple_chat_pb2.SubscribeMessagesRequest(
+            subscribe=simple_chat_pb2.ReceiveMessagesRequest(
+                login='2', resume_after=resume_after)))
+        return self.stub.SubscribeMessages(iter(requests.get, None))
+
+    def test_chat(self):
+        """Tests that users chatting over the Chat streams receive each
+        other's messages
+        """
+        streams = {}
+        for login in ('1', '2'):
+            requests = queue.Queue()
+            requests.put(simple_chat_pb2.ChatRequest(
+                subscribe=simple_chat_pb2.ReceiveMessagesRequest(
+                    login=login)))
+            streams[login] = (requests,
+                              self.stub.Chat(iter(requests.get, None)))
+
+        requests, responses = streams['1']
+        requests.put(simple_chat_pb2.ChatRequest(
+            message=simple_chat_pb2.Message(recipient='2', body='Hi!')))
+        sent = next(responses).sent
+
+        requests, responses = streams['2']
+        received = next(responses).message
+        self.assertEqual((received.sender, received.body, received.id),
+                         ('1', 'Hi!', sent.id))
+        requests.put(simple_chat_pb2.ChatRequest(
+            ack=simple_chat_pb2.MessagesAck(message_id=received.id)))
+        while self.storage.get_user_queue_messages('2'):
+            time.sleep(0.01)
+
+        for requests, responses in streams.values():
+            responses.cancel()
+
+    def test_reconnect(self):
+        """Tests that unacknowledged messages are streamed again after
+        a reconnect and resumed ones are not
+        """
+        self.storage.put_messages([Message('1', '2', str(index))
+                                   for index in range(4)])
+
+        requests = queue.Queue()
+        responses = self.subscribe(requests)
+        received = [next(responses) for _ in range(3)]
+        requests.put(simple_chat_pb2.SubscribeMessagesRequest(
+            ack=simple_chat_pb2.MessagesAck(message_id=received[0].id)))
+        # the ack is handled before the stream is broken
+        while len(self.storage.get_user_queue_messages('2')) == 4:
+            time.sleep(0.01)
+        responses.cancel()
+
+        requests = queue.Queue()
+        responses = self.subscribe(requests, resume_after=received[1].id)
+        self.assertEqual([next(responses).body for _ in range(2)],
+                         ['2', '3'])
+        responses.cancel()
+
+        self.assertEqual(
+            [message.body
+             for message in self.storage.get_user_queue_messages('2')],
+            ['2', '3'])
+
+
+class UserDirectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Mock()
+        self.storage.get_users_with_revision = Mock(return_value=(
+            [User('2', 'Second'), User('1', 'First')], 10))
+        self.user_directory = simple_chat_server.UserDirectory(self.storage)
+
+    def get_users(self):
+        return list(simple_chat_pb2.GetUsersResponse.FromString(
+            self.user_directory.get_serialized_response()).users)
+
+    def test_get_serialized_response(self):
+        """Tests that the directory is read once and served from memory"""
+        first = self.user_directory.get_serialized_response()
+        second = self.user_directory.get_serialized_response()
+
+        self.assertIs(first, second)
+        self.storage.get_users_with_revision.assert_called_once()
+        self.storage.watch_users.assert_called_once_with(
+            self.user_directory._on_users_changed, 11)
+        self.assertEqual([user.login for user in self.get_users()],
+                         ['1', '2'])
+
+    def test_users_changed(self):
+        """Tests that watched changes update the cached response"""
+        self.get_users()
+
+        self.user_directory._on_users_changed(
+            [('3', User('3', 'Third')), ('1', None)])
+
+        self.assertEqual([user.login for user in self.get_users()],
+                         ['2', '3'])
+        self.assertEqual(self.user_directory.get_users(),
+                         [User('2', 'Second'), User('3', 'Third')])
+        self.storage.get_users_with_revision.assert_called_once()
+
+    def test_watch_error_reloads(self):
+        """Tests that broken watch makes the directory load again"""
+        self.get_users()
+
+        self.user_directory._on_users_changed(Exception('stream broken'))
+        self.get_users()
+
+        self.assertEqual(self.storage.get_users_with_revision.call_count, 2)
+        self.assertEqual(self.storage.watch_users.call_count, 2)
+
+    def test_close(self):
+        """Tests that closing the directory cancels its watch"""
+        self.get_users()
+
+        self.user_directory.close()
+
+        self.storage.watch_users.return_value.assert_called_once()
+
+
+class ServerOptionsStandInTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = EtcdStandIn()
+        self.storage = Storage('127.0.0.1', self.stand_in.start())
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            address = '127.0.0.1:{}'.format(sock.getsockname()[1])
+        self.server = simple_chat_server.create_server(
+            address, self.storage, is_cache_users=False,
+            options=simple_chat_server.ServerOptions(unary_workers=1,
+                                                     max_streams=2))
+        self.server.start()
+        self.channel = grpc.insecure_channel(address)
+        self.stub = simple_chat_pb2_grpc.SimpleChatStub(self.channel)
+
+    def tearDown(self):
+        self.channel.close()
+        self.server.stop(0)
+        self.stand_in.stop()
+
+    def receive(self, login):
+        """Opens the stream and waits until it is served"""
+        self.storage.put_message(Message('1', login, 'Hello!'))
+        responses = self.stub.ReceiveMessages(
+            simple_chat_pb2.ReceiveMessagesRequest(login=login))
+        self.assertEqual(next(responses).body, 'Hello!')
+        return responses
+
+    def test_stream_limit(self):
+        """Tests that streams over the limit are refused at once and
+        unary calls are served while the streams are open
+        """
+        streams = [self.receive(str(login)) for login in range(2)]
+
+        with self.assertRaises(grpc.RpcError) as raised:
+            self.receive('2')
+        self.assertEqual(raised.exception.code(),
+                         grpc.StatusCode.RESOURCE_EXHAUSTED)
+        self.assertEqual(raised.exception.details(),
+                         simple_chat_server.STREAMS_EXHAUSTED_DETAILS)
+
+        self.stub.SendMessage(simple_chat_pb2.SendMessageRequest(
+            message=simple_chat_pb2.Message(sender='1', recipient='0',
+                                            body='Hi!')), timeout=5)
+        self.assertEqual(next(streams[0]).body, 'Hi!')
+
+        streams[0].cancel()
+        deadline = time.time() + 5
+        while True:
+            try:
+                streams.append(self.receive('3'))
+                break
+            except grpc.RpcError:
+                # the cancelled stream is released asynchronously
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+
+        for stream in streams:
+            stream.cancel()
+
+
+class StreamLimitInterceptorTestCase(unittest.TestCase):
+
+    def test_intercept_service(self):
+        """Tests that only response streams are limited"""
+        interceptor = simple_chat_server.StreamLimitInterceptor(1)
+        unary = grpc.unary_unary_rpc_method_handler(Mock())
+        stream = grpc.unary_stream_rpc_method_handler(
+            lambda request, context: iter([request]))
+
+        self.assertIs(interceptor.intercept_service(
+            Mock(return_value=unary), Mock()), unary)
+        self.assertIsNone(interceptor.intercept_service(
+            Mock(return_value=None), Mock()))
+
+        limited = interceptor.intercept_service(Mock(return_value=stream),
+                                                Mock())
+        context = Mock()
+        context.abort.side_effect = Exception('aborted')
+        responses = limited.unary_stream('request', context)
+        self.assertEqual(next(responses), 'request')
+        self.assertEqual(interceptor.limiter.count, 1)
+
+        with self.assertRaises(Exception):
+            next(limited.unary_stream('request', context))
+        context.abort.assert_called_once_with(
+            grpc.StatusCode.RESOURCE_EXHAUSTED,
+            simple_chat_server.STREAMS_EXHAUSTED_DETAILS)
+
+        self.assertEqual(list(responses), [])
+        self.assertEqual(interceptor.limiter.count, 0)
+
+    def test_server_options(self):
+        """Tests of the default gRPC options of the server"""
+        options = simple_chat_server.ServerOptions(unary_workers=4,
+                                                   max_streams=100)
+
+        self.assertEqual(options.get_maximum_concurrent_rpcs(),
+                         104 + simple_chat_server.UNARY_MAX_QUEUED)
+        self.assertIn(('grpc.keepalive_time_ms', 60000),
+                      options.get_grpc_options())
+        self.assertIn(('grpc.max_receive_message_length', 4 * 1024 * 1024),
+                      options.get_grpc_options())
+
+
+class PreSerializedResponseHandlerTestCase(unittest.TestCase):
+
+    def test_service(self):
+        """Tests of pre-serialized handler lookup"""
+        servicer = Mock()
+        handler = simple_chat_server.PreSerializedResponseHandler(servicer)
+
+        method_handler = handler.service(Mock(method='/SimpleChat/GetUsers'))
+
+        self.assertIs(method_handler.unary_unary, servicer.GetUsers)
+        method_handler = handler.service(
+            Mock(method='/SimpleChat/ReceiveMessages'))
+        self.assertIs(method_handler.unary_stream, servicer.ReceiveMessages)
+        method_handler = handler.service(
+            Mock(method='/SimpleChat/SubscribeMessages'))
+        self.assertIs(method_handler.stream_stream,
+                      servicer.SubscribeMessages)
+        method_handler = handler.service(Mock(method='/SimpleChat/Chat'))
+        self.assertIs(method_handler.stream_stream, servicer.Chat)
+        self.assertIsNone(handler.service(
+            Mock(method='/SimpleChat/SendMessage')))
+
+    def test_serialize_response(self):
+        """Tests of serialize_response method"""
+        response = simple_chat_pb2.SendMessagesResponse(count=1)
+
+        self.assertEqual(simple_chat_server.serialize_response(response),
+                         response.SerializeToString())
+        self.assertEqual(simple_chat_server.serialize_response(b'raw'),
+                         b'raw')
+
+    def test_serialize_chat_message(self):
+        """Tests that the received message is wrapped like by protobuf"""
+        for body in ('Hello!', 'x' * 200, 'x' * 20000):
+            value = simple_chat_pb2.Message(body=body).SerializeToString()
+
+            self.assertEqual(
+                simple_chat_server.serialize_chat_message(value),
+                simple_chat_pb2.ChatResponse(
+                    message=simple_chat_pb2.Message.FromString(value)
+                ).SerializeToString())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,331 @@
+"""Tests shared by all storage backends"""
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from simple_chat_etcd_stand_in import EtcdStandIn
+from simple_chat_etcd_storage import (BaseStorage, Message, Storage,
+                                      StoredMessage, User,
+                                      STORAGE_MAX_TXN_OPS, USERS_TXN_SIZE)
+from simple_chat_memory_storage import MemoryStorage, MemoryUserQueue
+from simple_chat_sqlite_storage import SqliteQueueStorage
+
+
+class StorageConformanceMixin:
+    """Behaviour every storage backend has, test cases give the storage"""
+
+    def create_storage(self, **kwargs) -> BaseStorage:
+        raise NotImplementedError
+
+    def setUp(self):
+        self.storage = self.create_storage()
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_put_message(self):
+        """Tests that queued messages are read in the order they were
+        stored, with their ids
+        """
+        for body in ('a', 'b', 'c'):
+            self.storage.put_message(Message('1', '2', body, 1.7e9))
+        self.storage.put_message(Message('1', '3', 'd', 1.7e9))
+
+        messages = self.storage.get_user_queue_messages('2')
+
+        self.assertEqual([message.body for message in messages],
+                         ['a', 'b', 'c'])
+        self.assertEqual(len({message.message_id for message in messages}),
+                         3)
+        self.assertEqual(messages[0],
+                         Message('1', '2', 'a', 1.7e9,
+                                 messages[0].message_id))
+
+    def test_put_messages(self):
+        messages = [Message('1', str(index % 2), str(index), 1.7e9)
+                    for index in range(2 * STORAGE_MAX_TXN_OPS + 1)]
+
+        self.storage.put_messages(messages)
+
+        for recipient in ('0', '1'):
+            self.assertEqual(
+                [message.body for message in
+                 self.storage.get_user_queue_messages(recipient)],
+                [message.body for message in messages
+                 if message.recipient == recipient])
+
+    def test_queue_pages(self):
+        self.storage.put_messages([Message('1', '2', str(index))
+                                   for index in range(5)])
+
+        pages = list(self.storage.iterate_user_queue_pages('2', 2))
+
+        self.assertEqual([len(page.messages) for page in pages], [2, 2, 1])
+        self.assertIsNone(pages[-1].next_key)
+        self.assertEqual(
+            [self.storage.decode_message(message).body
+             for page in pages for _, message in page.messages],
+            ['0', '1', '2', '3', '4'])
+        self.assertEqual(
+            list(self.storage.iterate_user_queue_pages('3', 2))[0].messages,
+            [])
+        with self.assertRaises(ValueError):
+            self.storage.get_user_queue_page('2', 2, pages[0].next_key
+                                             .replace('/2/', '/3/'))
+
+    def test_delete_messages(self):
+        messages = [Message('1', '2', str(index)) for index in range(7)]
+        self.storage.put_messages(messages)
+
+        self.storage.delete_user_queue_message(messages[0])
+        self.storage.delete_user_queue_messages(messages[1:2])
+        self.storage.delete_user_queue_message_ids(
+            '2', [messages[3].message_id])
+        self.storage.delete_user_queue_stored_messages(
+            list(self.storage.iterate_user_queue_stored_messages('2'))[0]
+            [-1:])
+        self.assertEqual([message.body for message in
+                          self.storage.get_user_queue_messages('2')],
+                         ['2', '4', '5'])
+
+        self.storage.delete_user_queue_messages_until(
+            '2', messages[4].message_id)
+        self.assertEqual([message.body for message in
+                          self.storage.get_user_queue_messages('2')],
+                         ['5'])
+
+    def test_users_page(self):
+        for login, full_name in (('ann', 'Zoe Ann'), ('bob', 'Bob Bee'),
+                                 ('ben', 'Ben Bee'), ('cid', 'Ann Cid')):
+            self.storage.put_user(User(login, full_name))
+        self.storage.put_user(User('cid', 'Cid Cee'))
+
+        users, next_key = self.storage.get_users_page(2)
+        self.assertEqual([user.login for user in users], ['ann', 'ben'])
+        users, next_key = self.storage.get_users_page(2, next_key)
+        self.assertEqual([user.login for user in users], ['bob', 'cid'])
+        self.assertIsNone(next_key)
+
+        users, _ = self.storage.get_users_page(10, login_prefix='b')
+        self.assertEqual([user.login for user in users], ['ben', 'bob'])
+        users, _ = self.storage.get_users_page(10, name_prefix='b')
+        self.assertEqual([user.full_name for user in users],
+                         ['Ben Bee', 'Bob Bee'])
+        users, _ = self.storage.get_users_page(10, name_prefix='ann')
+        self.assertEqual(users, [])
+        with self.assertRaises(ValueError):
+            self.storage.get_users_page(2, 'user/ann\0', login_prefix='b')
+        self.assertEqual(self.storage.reindex_users(), 4)
+
+    def test_put_users(self):
+        """Tests that stored and repeated users end as if they were
+        stored one by one, with the name index following their names
+        """
+        self.storage.put_user(User('u0', 'Old Name'))
+        users = [User('u{}'.format(index), 'User {}'.format(index))
+                 for index in range(2 * USERS_TXN_SIZE + 1)]
+        users.extend([User('u1', 'Renamed'), User('dup', 'First'),
+                      User('dup', 'Second')])
+
+        self.storage.put_users(users)
+
+        stored = {user.login: user for user in self.storage.get_users()}
+        self.assertEqual(len(stored), 2 * USERS_TXN_SIZE + 2)
+        self.assertEqual(stored['u0'], User('u0', 'User 0'))
+        self.assertEqual(stored['u1'], User('u1', 'Renamed'))
+        self.assertEqual(stored['dup'], User('dup', 'Second'))
+        for name_prefix in ('old', 'first'):
+            self.assertEqual(self.storage.get_users_page(
+                10, name_prefix=name_prefix)[0], [])
+        users, _ = self.storage.get_users_page(10, name_prefix='user 1')
+        self.assertNotIn('u1', [user.login for user in users])
+        self.assertEqual(self.storage.get_users_page(
+            10, name_prefix='renamed')[0], [User('u1', 'Renamed')])
+
+    def test_history(self):
+        """Tests that messages between two users are read the newest
+        first, page by page and in time ranges
+        """
+        storage = self.create_storage(history_ttl=60)
+        self.addCleanup(storage.close)
+        started = time.time()
+        for body in ('a', 'b'):
+            storage.put_message(Message('1', '2', body))
+        storage.put_messages([Message('2', '1', 'c'), Message('1', '3', 'x'),
+                              Message('1', '2', 'd')])
+
+        messages, next_key = storage.get_history_page('2', '1', 3)
+        self.assertEqual([message.body for message in messages],
+                         ['d', 'c', 'b'])
+        self.assertEqual(messages[1], storage.get_user_queue_messages('1')[0])
+        messages, next_key = storage.get_history_page('2', '1', 3,
+                                                      start_key=next_key)
+        self.assertEqual([message.body for message in messages], ['a'])
+        self.assertIsNone(next_key)
+
+        # ids tell stored time to the millisecond
+        for start_time, end_time, count in ((started, None, 4),
+                                            (None, started - 0.001, 0),
+                                            (time.time() + 1, None, 0),
+                                            (started - 1, time.time() + 1, 4)):
+            messages, _ = storage.get_history_page('1', '2', 10, start_time,
+                                                   end_time)
+            self.assertEqual(len(messages), count)
+        self.assertEqual(storage.get_history_page('1', '3', 10)[0][0].body,
+                         'x')
+        with self.assertRaises(ValueError):
+            storage.get_history_page('1', '3', 10, start_key='history/1/2/')
+
+        # no history is kept without the time to live
+        self.storage.put_message(Message('1', '2', 'a'))
+        self.assertEqual(self.storage.get_history_page('1', '2', 10),
+                         ([], None))
+
+    def test_watch_users(self):
+        self.storage.put_user(User('ann', 'Ann'))
+        users, revision = self.storage.get_users_with_revision()
+        self.assertEqual(users, [User('ann', 'Ann')])
+        changes = queue.Queue()
+
+        cancel = self.storage.watch_users(changes.put, revision + 1)
+        self.storage.put_user(User('bob', 'Bob'))
+
+        self.assertEqual(changes.get(timeout=5), [('bob', User('bob', 'Bob'))])
+        cancel()
+
+    def test_watch_queue(self):
+        """Tests that the subscription gets the backlog and then the
+        messages stored later
+        """
+        self.storage.put_messages([Message('1', '2', str(index))
+                                   for index in range(3)])
+        batches, cancel = self.storage.watch_user_queue_messages('2')
+        timer = threading.Timer(10, cancel)
+        timer.start()
+
+        delivered = list(next(batches))
+        self.storage.delete_user_queue_messages(delivered)
+        self.storage.put_message(Message('1', '2', '3'))
+        while len(delivered) < 4:
+            delivered.extend(next(batches))
+        cancel()
+        timer.cancel()
+
+        self.assertEqual([message.body for message in delivered],
+                         ['0', '1', '2', '3'])
+
+
+class EtcdStorageConformanceTestCase(StorageConformanceMixin,
+                                     unittest.TestCase):
+
+    def create_storage(self, **kwargs) -> BaseStorage:
+        self.stand_in = EtcdStandIn()
+        self.addCleanup(self.stand_in.stop)
+        return Storage('127.0.0.1', self.stand_in.start(), **kwargs)
+
+    def test_history_page_limit(self):
+        """Tests that etcd reads only the page of a long conversation"""
+        storage = self.create_storage(history_ttl=60)
+        self.addCleanup(storage.close)
+        storage.put_messages([Message('a', 'b', str(index))
+                              for index in range(50)])
+        responses = []
+        read_range = self.stand_in._range
+
+        def record_range(request):
+            response = read_range(request)
+            responses.append((request, response))
+            return response
+
+        with patch.object(self.stand_in, '_range', record_range):
+            messages, next_key = storage.get_history_page('a', 'b', 10)
+
+        self.assertEqual([message.body for message in messages],
+                         [str(index) for index in range(49, 39, -1)])
+        self.assertIsNotNone(next_key)
+        request, response = responses[-1]
+        self.assertEqual(request.limit, 10)
+        self.assertEqual(len(response.kvs), 10)
+
+
+class MemoryStorageConformanceTestCase(StorageConformanceMixin,
+                                       unittest.TestCase):
+
+    def create_storage(self, **kwargs) -> BaseStorage:
+        return MemoryStorage(**kwargs)
+
+    def test_user_queue(self):
+        """Tests that queue pages and deletions start from the bisected
+        key and deleted keys are dropped once they reach the head
+        """
+        user_queue = MemoryUserQueue()
+        for revision, key in enumerate(('b', 'd', 'c', 'a', 'e'), 1):
+            user_queue.append(revision, StoredMessage(key, key.encode()))
+        self.assertEqual(user_queue.keys, ['a', 'b', 'c', 'd', 'e'])
+
+        messages, is_more = user_queue.get_page('b\0', 2)
+        self.assertEqual([message.key for _, message in messages],
+                         ['c', 'd'])
+        self.assertTrue(is_more)
+
+        user_queue.delete(['b'])
+        user_queue.delete_until('a')
+        self.assertEqual(user_queue.get_page('', None)[0][0][1].key, 'c')
+        user_queue.delete_until('c')
+        self.assertEqual(user_queue.keys, ['d', 'e'])
+        self.assertEqual([message.key for _, message in
+                          user_queue.get_page('', None)[0]], ['d', 'e'])
+
+    @patch('simple_chat_memory_storage.time')
+    def test_history_expires(self, mock_time):
+        """Tests that expired messages are skipped and dropped by the
+        next compaction
+        """
+        mock_time.time.return_value = 1000
+        storage = self.create_storage(history_ttl=60)
+        storage.put_message(Message('1', '2', 'a'))
+        mock_time.time.return_value = 1030
+        storage.put_message(Message('1', '2', 'b'))
+
+        mock_time.time.return_value = 1070
+        self.assertEqual([message.body for message in
+                          storage.get_history_page('1', '2', 10)[0]], ['b'])
+        storage.put_message(Message('1', '3', 'c'))
+        self.assertEqual(len(storage._conversations['history/1/2/'].keys),
+                         1)
+
+        mock_time.time.return_value = 1200
+        storage.put_message(Message('1', '3', 'd'))
+        self.assertNotIn('history/1/2/', storage._conversations)
+
+
+class SqliteQueueStorageConformanceTestCase(StorageConformanceMixin,
+                                            unittest.TestCase):
+
+    def create_storage(self, **kwargs) -> BaseStorage:
+        self.stand_in = EtcdStandIn()
+        self.addCleanup(self.stand_in.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return SqliteQueueStorage(
+            '127.0.0.1', self.stand_in.start(),
+            os.path.join(directory.name, 'queues.db'), **kwargs)
+
+    def test_reopen(self):
+        """Tests that queued messages outlive the storage and new ones
+        are stored after them
+        """
+        self.storage.put_message(Message('1', '2', 'a'))
+        self.storage.close()
+
+        self.storage = SqliteQueueStorage('127.0.0.1', 0,
+                                          self.storage.database_path)
+        self.storage.put_message(Message('1', '2', 'b'))
+
+        self.assertEqual([message.body for message in
+                          self.storage.get_user_queue_messages('2')],
+                         ['a', 'b'])